@@ -13,7 +13,7 @@ from pysam.libcalignedsegment cimport pysam_bam_get_cigar, \
     pysam_bam_get_qname, pysam_get_n_cigar
 from pysam.libcfaidx cimport *
 from libc.string cimport strchr
-from libc.stdint cimport int8_t
+from libc.stdint cimport int8_t, int32_t, int64_t, uint16_t, uint32_t
 from libc.stdio cimport puts, printf
 from libc.stdlib cimport abs
 from cpython cimport PyErr_SetString, PyBytes_FromStringAndSize
@@ -35,6 +35,7 @@ import sys
 cimport numpy
 
 import CGATCore.Experiment as E
+import CGAT.Parallel as Parallel
 
 def parse_region_string(s):
     """parse a genomic region string.
@@ -1469,56 +1470,16 @@ cdef bytes count_md_tag_mismatches(AlignedSegment read):
     return seq
 
 
-def bam2stats_window_count(AlignmentFile samfile,
-                           region=None,
-                           chromosomes=None,
-                           window_size=1000,
-                           fasta=None):
-    '''
-    '''
-    cdef AlignedSegment read
-    cdef uint32_t idx = 0
-    cdef uint32_t length = 0
-    cdef int nflags = len(FLAGS)
-    cdef int tid = -1
-    cdef int flag
-    cdef uint32_t f = 0
-    cdef uint32_t offset = 0
-    cdef uint32_t ref_window = 0
-    cdef uint32_t x = 0
-    cdef uint32_t _window_size = window_size
-    cdef int ninput = 0
-    cdef int nunmapped = 0
-    cdef char code
-    cdef int32_t ref_pos
-    cdef int32_t next_window_start
-    cdef int32_t window_start
-    cdef int32_t window_end
-    cdef char * sequence
-    cdef int nmatches, nmismatches, ndeletions, ninsertios 
+def bam2stats_window_columns():
+    '''return the column names of the counts computed by
+    :func:`bam2stats_window_count`.'''
 
-    cdef int idx_alignment_starts = nflags
-    cdef int idx_alignment_ends = idx_alignment_starts + 1
-    cdef int idx_alignments = idx_alignment_ends + 1
-    cdef int idx_matches = idx_alignments + 1
-    cdef int idx_mismatches = idx_matches + 1
-    cdef int idx_insertions = idx_mismatches + 1
-    cdef int idx_deletions = idx_insertions + 1
-    cdef int idx_hard_clipped = idx_deletions + 1
-    cdef int idx_hard_clipped_bases = idx_hard_clipped + 1
-    cdef int idx_soft_clipped = idx_hard_clipped_bases + 1
-    cdef int idx_soft_clipped_bases = idx_soft_clipped + 1
-    cdef int idx_gc = idx_soft_clipped_bases + 1
-    cdef int idx_at = idx_gc + 1
-
-    # build list of column names
-    # add flags to cloumns
     columns = []
     f = 1
-    for x from 0 <= x < nflags:
+    for x in range(len(FLAGS)):
         columns.append(FLAGS[f])
         f = f << 1
-    
+
     columns.extend([
         "alignment_starts",
         "alignment_ends",
@@ -1533,184 +1494,288 @@ def bam2stats_window_count(AlignmentFile samfile,
         "soft_clipped_bases",
         "bases_gc",
         "bases_at"])
+    return columns
 
-    assert idx_at == len(columns) - 1
-
-    # build counting matrix
-    contigs = samfile.references
-    lengths = samfile.lengths
-
-    if region is not None:
-        itr = samfile.fetch(region)
-        contig, start, end = parse_region_string(region)
-
-        pairs = []
-        for c, l in zip(contigs, lengths):
-            if c == contig:
-                pairs.append((c, l))
-            else:
-                pairs.append((c, 0))
-        contigs, lengths = zip(*pairs)
-    else:
-        itr = samfile.fetch()
-        
-    cdef uint32_t total_length = sum(lengths) + _window_size * len(lengths)
-    cdef uint32_t ncontigs = len(contigs)
-    cdef int ncolumns = len(columns)
-    cdef numpy.ndarray offsets = numpy.zeros(
-        ncontigs + 1, dtype=numpy.int32)
-
-    for idx, length in enumerate(lengths):
-        offsets[idx] = offset
-        if length > 0:
-            offset += (length + _window_size) // _window_size
-
-    cdef uint32_t total_windows = offset
-    offsets[idx + 1] = offset
 
-    cdef numpy.ndarray window_counts = numpy.zeros(
-        (total_windows, ncolumns),
-        dtype=numpy.int32)
+cdef count_reads_in_windows(itr,
+                            int32_t [:, :] counts,
+                            uint32_t window_size):
+    '''add counts for alignments in *itr* to windows in *counts*.
 
-    cdef int32_t [:, :] window_counts_view = window_counts
+    Alignments are assumed to be on the same contig.
+    '''
+    cdef AlignedSegment read
+    cdef bam1_t * src
+    cdef uint32_t * cigar_p
+    cdef int nflags = len(FLAGS)
+    cdef int ncigar, k, op, x
+    cdef uint32_t l, i, f
+    cdef uint16_t flag
+    cdef int64_t ref_pos, ref_start, ref_end
+    cdef int64_t window_start, window_end, idx
+    cdef int64_t last_window = counts.shape[0] - 1
+    cdef bytes md
+    cdef char * md_seq
+    cdef int64_t s_idx
 
-    E.debug("total_windows={}, total_length={}, nflags={}, ncolumns={}, ncontigs={}".format(
-            total_windows, total_length, nflags, ncolumns, ncontigs))
+    cdef int idx_alignment_starts = nflags
+    cdef int idx_alignment_ends = idx_alignment_starts + 1
+    cdef int idx_alignments = idx_alignment_ends + 1
+    cdef int idx_matches = idx_alignments + 1
+    cdef int idx_mismatches = idx_matches + 1
+    cdef int idx_insertions = idx_mismatches + 1
+    cdef int idx_deletions = idx_insertions + 1
+    cdef int idx_hard_clipped = idx_deletions + 1
+    cdef int idx_hard_clipped_bases = idx_hard_clipped + 1
+    cdef int idx_soft_clipped = idx_hard_clipped_bases + 1
+    cdef int idx_soft_clipped_bases = idx_soft_clipped + 1
 
-    E.info("computing read counts in windows")
+    cdef int ninput = 0
 
     for read in itr:
-
-        flag = read._delegate.core.flag
+        src = read._delegate
+        flag = src.core.flag
         ninput += 1
 
-        if ninput % 1000 == 0:
-            E.debug("processing read number {} at {}:{}".format(
-                    ninput, read.reference_name, read.reference_start))
-        
-        tid = read.tid
-        if tid < 0:
+        if src.core.tid < 0 or flag & 4:
             continue
 
-        if flag & 4:
-            nunmapped += 1
+        ncigar = pysam_get_n_cigar(src)
+        if ncigar == 0:
             continue
+        cigar_p = pysam_bam_get_cigar(src)
 
-        window_start = offsets[tid] + read.reference_start // _window_size
-        window_end = offsets[tid] + read.reference_end // _window_size
+        ref_start = src.core.pos
+        ref_end = bam_endpos(src)
+        window_start = min(ref_start // window_size, last_window)
+        window_end = min(ref_end // window_size, last_window)
 
-        window_counts[window_start][idx_alignment_starts] += 1
-        window_counts[window_end][idx_alignment_ends] += 1
+        counts[window_start, idx_alignment_starts] += 1
+        counts[window_end, idx_alignment_ends] += 1
 
         # count hard/soft-clipping
-        cigar = read.cigartuples
-        if cigar[0][0] == 5:
-            window_counts[window_start][idx_hard_clipped] += 1
-            window_counts[window_start][idx_hard_clipped_bases] += cigar[0][1]
-        elif cigar[0][0] == 4:
-            window_counts[window_start][idx_soft_clipped] += 1
-            window_counts[window_start][idx_soft_clipped_bases] += cigar[0][1]
-
-        if cigar[-1][0] == 5:
-            window_counts[window_end][idx_hard_clipped] += 1
-            window_counts[window_end][idx_hard_clipped_bases] += cigar[-1][1]
-        elif cigar[-1][0] == 4:
-            window_counts[window_end][idx_soft_clipped] += 1
-            window_counts[window_end][idx_soft_clipped_bases] += cigar[-1][1]
-
-        for idx from window_start <= idx <= window_end:
-            window_counts[idx][idx_alignments] += 1
+        op = cigar_p[0] & BAM_CIGAR_MASK
+        l = cigar_p[0] >> BAM_CIGAR_SHIFT
+        if op == BAM_CHARD_CLIP:
+            counts[window_start, idx_hard_clipped] += 1
+            counts[window_start, idx_hard_clipped_bases] += l
+        elif op == BAM_CSOFT_CLIP:
+            counts[window_start, idx_soft_clipped] += 1
+            counts[window_start, idx_soft_clipped_bases] += l
+
+        op = cigar_p[ncigar - 1] & BAM_CIGAR_MASK
+        l = cigar_p[ncigar - 1] >> BAM_CIGAR_SHIFT
+        if op == BAM_CHARD_CLIP:
+            counts[window_end, idx_hard_clipped] += 1
+            counts[window_end, idx_hard_clipped_bases] += l
+        elif op == BAM_CSOFT_CLIP:
+            counts[window_end, idx_soft_clipped] += 1
+            counts[window_end, idx_soft_clipped_bases] += l
+
+        for idx in range(window_start, window_end + 1):
+            counts[idx, idx_alignments] += 1
             f = 1
-            for x from 0 <= x < nflags:
+            for x in range(nflags):
                 if flag & f:
-                    window_counts[idx][x] += 1
+                    counts[idx, x] += 1
                 f = f << 1
 
-        idx = window_start
-        md_seq = count_md_tag_mismatches(read)
-        ref_pos = read.reference_start
-        nmatches = nmismatches = ndeletions = ninsertions = 0
-        # border of next window
-        next_window_start = offsets[tid] + ((ref_pos // _window_size + 1) * _window_size)
-        for code in md_seq:
-
-            if code == '=':
-                nmatches += 1
-                ref_pos += 1
-            elif code == "+":
-                ninsertions += 1
-            elif code == "-":
-                ndeletions += 1
-                ref_pos += 1
-            elif code == "*":
-                nmismatches += 1
-                ref_pos += 1
-                
-            if ref_pos >= next_window_start:
-                window_counts[idx][idx_matches] += nmatches
-                window_counts[idx][idx_mismatches] += nmismatches
-                window_counts[idx][idx_deletions] += ndeletions
-                window_counts[idx][idx_insertions] += ninsertions
+        # walk along the cigar string and the match/mismatch
+        # string in parallel to assign bases to windows
+        md = count_md_tag_mismatches(read)
+        md_seq = md
+        s_idx = 0
+        ref_pos = ref_start
+        for k in range(ncigar):
+            op = cigar_p[k] & BAM_CIGAR_MASK
+            l = cigar_p[k] >> BAM_CIGAR_SHIFT
+            if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
+                for i in range(l):
+                    idx = min(ref_pos // window_size, last_window)
+                    if md_seq[s_idx] == b'*':
+                        counts[idx, idx_mismatches] += 1
+                    else:
+                        counts[idx, idx_matches] += 1
+                    s_idx += 1
+                    ref_pos += 1
+            elif op == BAM_CINS:
+                idx = min(ref_pos // window_size, last_window)
+                counts[idx, idx_insertions] += l
+                s_idx += l
+            elif op == BAM_CDEL:
+                for i in range(l):
+                    idx = min(ref_pos // window_size, last_window)
+                    counts[idx, idx_deletions] += 1
+                    s_idx += 1
+                    ref_pos += 1
+            elif op == BAM_CREF_SKIP:
+                ref_pos += l
+
+    return ninput
+
+
+def count_gc_in_windows(fasta, contig, length, window_size,
+                        chunk_size=10000000):
+    '''count G+C and A+T bases in windows of *window_size* on *contig*.
+
+    Returns two arrays with the number of G+C and A+T bases in each
+    window. The sequence is processed in chunks of about *chunk_size*
+    bases.
+    '''
 
-                next_window_start += _window_size
-                idx += 1
+    nwindows = (length + window_size) // window_size
+    gc = numpy.zeros(nwindows, dtype=numpy.int32)
+    at = numpy.zeros(nwindows, dtype=numpy.int32)
+    chunk_size = max(1, chunk_size // window_size) * window_size
+
+    for start in range(0, length, chunk_size):
+        end = min(start + chunk_size, length)
+        sequence = numpy.frombuffer(
+            fasta.fetch(contig, start, end).upper().encode("ascii"),
+            dtype=numpy.uint8)
+        if len(sequence) == 0:
+            break
+        windows = numpy.arange(start // window_size,
+                               start // window_size +
+                               (len(sequence) + window_size - 1) //
+                               window_size)
+        first = numpy.arange(0, len(sequence), window_size)
+        gc[windows] += numpy.add.reduceat(
+            (sequence == ord("G")) | (sequence == ord("C")), first)
+        at[windows] += numpy.add.reduceat(
+            (sequence == ord("A")) | (sequence == ord("T")), first)
+
+    return gc, at
+
+
+def bam2stats_window_count_contig(AlignmentFile samfile,
+                                  contig,
+                                  length,
+                                  region=None,
+                                  window_size=1000,
+                                  fasta=None):
+    '''compute counts in windows on a single contig.
+
+    Returns an array of counts with one row per window and one
+    column per statistic, see :func:`bam2stats_window_columns`.
+    '''
+    columns = bam2stats_window_columns()
+    nwindows = (length + window_size) // window_size
+
+    window_counts = numpy.zeros((nwindows, len(columns)), dtype=numpy.int32)
 
-        window_counts[idx][idx_matches] += nmatches
-        window_counts[idx][idx_mismatches] += nmismatches
-        window_counts[idx][idx_deletions] += ndeletions
-        window_counts[idx][idx_insertions] += ninsertions
+    if region is not None:
+        itr = samfile.fetch(region=region)
+    else:
+        itr = samfile.fetch(contig)
+
+    ninput = count_reads_in_windows(itr, window_counts, window_size)
+    E.debug("counted {} alignments on {}".format(ninput, contig))
 
-    # compute G+C content
     if fasta:
-        E.info("computing G+C content windows")
-        idx = 0
-        for contig, length in zip(contigs, lengths):
-            if length == 0:
-                idx += 1
-                continue
+        gc, at = count_gc_in_windows(fasta, contig,
+                                     min(length,
+                                         fasta.get_reference_length(contig)),
+                                     window_size)
+        window_counts[:len(gc), columns.index("bases_gc")] = gc
+        window_counts[:len(at), columns.index("bases_at")] = at
+
+    return window_counts
 
-            offset = offsets[idx]
-            s = fasta.fetch(contig)
-            sequence = s
-            for x from 0 <= x < length:
-                # do not increment at x == 0
-                if x and x % _window_size == 0:
-                    offset += 1
-                    
-                code = sequence[x]
-                if code > 97:
-                    code -= 32
 
-                if code == 'C' or code == 'G':
-                    window_counts[offset][idx_gc] += 1
-                elif code == 'A' or code == 'T':
-                    window_counts[offset][idx_at] += 1
+WINDOW_WORKER = {}
 
-            idx += 1
+
+def init_window_count_worker(bam_filename, fasta_filename, region,
+                             window_size):
+    '''initialize a worker process for :func:`bam2stats_window_count`.'''
+    WINDOW_WORKER["samfile"] = pysam.AlignmentFile(bam_filename)
+    if fasta_filename:
+        WINDOW_WORKER["fasta"] = pysam.FastaFile(fasta_filename)
+    else:
+        WINDOW_WORKER["fasta"] = None
+    WINDOW_WORKER["region"] = region
+    WINDOW_WORKER["window_size"] = window_size
+
+
+def window_count_worker(args):
+    '''count windows on a contig in a worker process.'''
+    contig, length = args
+    return bam2stats_window_count_contig(
+        WINDOW_WORKER["samfile"],
+        contig,
+        length,
+        region=WINDOW_WORKER["region"],
+        window_size=WINDOW_WORKER["window_size"],
+        fasta=WINDOW_WORKER["fasta"])
+
+
+def bam2stats_window_count(AlignmentFile samfile,
+                           region=None,
+                           chromosomes=None,
+                           window_size=1000,
+                           fasta=None,
+                           num_workers=1):
+    '''compute per-window statistics of alignments in *samfile*.
+
+    Windows are counted separately for each contig. If *num_workers*
+    is larger than 1, contigs are distributed over worker processes
+    that open *samfile* and *fasta* by their filename.
+
+    Returns a dataframe with one row per window indexed by contig,
+    start and end.
+    '''
+
+    columns = bam2stats_window_columns()
+
+    contigs = samfile.references
+    lengths = samfile.lengths
+
+    if region is not None:
+        contig, start, end = parse_region_string(region)
+        work = [(c, l) for c, l in zip(contigs, lengths) if c == contig]
+    else:
+        work = [(c, l) for c, l in zip(contigs, lengths) if l > 0]
+
+    E.info("computing read counts in windows on {} contigs".format(
+        len(work)))
+
+    if num_workers > 1 and len(work) > 1:
+        results = list(Parallel.imap(
+            window_count_worker, work,
+            num_workers=num_workers,
+            initializer=init_window_count_worker,
+            initargs=(samfile.filename,
+                      fasta.filename if fasta else None,
+                      region,
+                      window_size)))
+    else:
+        results = [bam2stats_window_count_contig(
+            samfile, contig, length,
+            region=region,
+            window_size=window_size,
+            fasta=fasta) for contig, length in work]
 
     # set window coordinates
     E.info("setting window coordinates")
     chromosomes, starts, ends = [], [], []
-    idx = 0
-    for contig, length in zip(contigs, lengths):
-        if length == 0:
-            idx += 1
-            continue
-
-        offset = offsets[idx]
-        next_offset = offsets[idx + 1]
-        nwindows = next_offset - offset
+    for (contig, length), counts in zip(work, results):
+        nwindows = len(counts)
         chromosomes.extend([contig] * nwindows)
-        starts.extend(numpy.arange(0, 
+        starts.extend(numpy.arange(0,
                                    window_size * nwindows,
                                    window_size))
         ends.extend(numpy.arange(window_size,
                                  window_size * (nwindows + 1),
                                  window_size))
-        idx += 1
+
+    if results:
+        window_counts = numpy.concatenate(results)
+    else:
+        window_counts = numpy.zeros((0, len(columns)), dtype=numpy.int32)
 
     E.info("building dataframe")
-    window_df = pandas.DataFrame(window_counts, 
+    window_df = pandas.DataFrame(window_counts,
                                  columns=columns,
                                  index=[chromosomes, starts, ends])
     window_df.index.names = ["contig", "start", "end"]
@@ -2087,6 +2152,115 @@ def merge_pairs(AlignmentFile input_samfile,
     return c
 
 
+def bam2intervals(AlignmentFile samfile,
+                  contig,
+                  int shift=0,
+                  int extend=0,
+                  merge_pairs=False,
+                  int min_insert_size=0,
+                  int max_insert_size=0):
+    '''return intervals covered by reads or read pairs on *contig*.
+
+    If *merge_pairs* is set, read pairs are merged into a single
+    interval as in :func:`merge_pairs`. If *shift* or *extend* are
+    given, reads are shifted by *shift* and extended to *extend*
+    bases (ChIP-Seq). Otherwise, intervals are the reference region
+    of each read, which is the region the read contributes to in
+    :meth:`pysam.AlignmentFile.pileup` including deletions and
+    skipped regions. As in the pileup, unmapped, secondary, duplicate
+    and qc-fail alignments are ignored as are paired reads that are
+    not part of a proper pair.
+
+    Intervals are truncated at the contig end, empty intervals are
+    removed.
+
+    Returns
+    -------
+    starts : numpy.array
+        Interval start positions.
+    ends : numpy.array
+        Interval end positions.
+    ncounted : int
+        Number of reads counted. Each merged pair is counted as two
+        reads.
+    '''
+
+    cdef AlignedSegment read
+    cdef int flag
+    cdef int64_t start, end, xstart, xend
+    cdef int64_t lcontig = samfile.get_reference_length(contig)
+    cdef int64_t shift_extend = shift + extend
+    cdef int use_shift = shift > 0 or extend > 0
+    cdef int use_pairs = merge_pairs
+    cdef int ncounted = 0
+    cdef int n = 0
+    cdef int size = 1024
+
+    cdef int64_t[::1] starts = numpy.empty(size, dtype=numpy.int64)
+    cdef int64_t[::1] ends = numpy.empty(size, dtype=numpy.int64)
+
+    for read in samfile.fetch(contig):
+        flag = read._delegate.core.flag
+
+        if use_pairs:
+            # see merge_pairs
+            if flag & 4:
+                continue
+            if read.pos < read.mpos:
+                continue
+            elif read.pos == read.mpos and flag & 64:
+                continue
+            xstart = read.next_reference_start
+            xend = read.reference_end
+            if xstart < xend:
+                start, end = xstart, xend
+            else:
+                start, end = xend, xstart
+            if not flag & 2:
+                continue
+            if read.tid != read.mrnm:
+                continue
+            if (max_insert_size and abs(read.isize) > max_insert_size) or \
+               (min_insert_size and abs(read.isize) < min_insert_size):
+                continue
+            ncounted += 2
+        elif use_shift:
+            if read.is_reverse:
+                start = max(0, read.pos + read.alen - shift_extend)
+            else:
+                start = max(0, read.pos + shift)
+            # intervals extending beyond contig are removed
+            if start >= lcontig:
+                continue
+            end = start + extend
+            ncounted += 1
+        else:
+            # reads ignored by the pileup engine
+            if flag & (BAM_FUNMAP | BAM_FSECONDARY | BAM_FQCFAIL | BAM_FDUP):
+                continue
+            # orphans are ignored by the pileup engine
+            if flag & BAM_FPAIRED and not flag & BAM_FPROPER_PAIR:
+                continue
+            start = read.pos
+            end = read.reference_end
+            ncounted += 1
+
+        end = min(end, lcontig)
+        if start >= end:
+            continue
+
+        if n == size:
+            size *= 2
+            starts = numpy.resize(starts, size)
+            ends = numpy.resize(ends, size)
+
+        starts[n] = start
+        ends[n] = end
+        n += 1
+
+    return numpy.asarray(starts)[:n], numpy.asarray(ends)[:n], ncounted
+
+
 def bams2bam_filter(AlignmentFile genome_samfile,
                     AlignmentFile output_samfile,
                     AlignmentFile output_mismapped,
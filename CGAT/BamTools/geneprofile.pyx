@@ -14,6 +14,22 @@ import numpy
 CountResult = collections.namedtuple(
     "Counts", "upstream upstream_utr cds downstream_utr downstream")
 
+
+cdef inline void addInterval(double[::1] diff, int rstart, int rend):
+    '''record interval [rstart, rend) in difference array *diff*.'''
+    if rstart < rend:
+        diff[rstart] += 1
+        diff[rend] -= 1
+
+
+def addDifferences(counts, diff):
+    '''add densities recorded in difference array *diff* to *counts*.
+
+    *diff* needs to be one element longer than *counts*.
+    '''
+    counts += numpy.cumsum(diff[:-1])
+
+
 class RangeCounter:
     
     def __init__(self, countfiles, 
@@ -132,6 +148,8 @@ class RangeCounterBAM(RangeCounter):
         cdef int length
 
         cdef AlignmentFile samfile
+        # reads are recorded as start/end events and summed up once
+        cdef double[::1] diff = numpy.zeros(len(counts) + 1)
 
         for samfile in files:
 
@@ -150,10 +168,12 @@ class RangeCounterBAM(RangeCounter):
                     if read.aend is None:
                         continue
                     rend = min( end, read.aend) - start + current_offset
-                    for i from rstart <= i < rend: counts[i] += 1
+                    addInterval(diff, rstart, rend)
 
                 current_offset += length
 
+        addDifferences(counts, diff)
+
     def getTotal(self, samfile):
         '''return total number of mapped tags in samfile.'''
         return samfile.mapped
@@ -229,6 +249,7 @@ class RangeCounterBAMShift(RangeCounterBAM):
         cdef int extend
         cdef int shift
         cdef AlignmentFile samfile
+        cdef double[::1] diff = numpy.zeros(len(counts) + 1)
 
         for samfile, shift, extend in zip(files, self.shifts, self.extends):
 
@@ -252,10 +273,12 @@ class RangeCounterBAMShift(RangeCounterBAM):
 
                     rend = min( length, rstart + extend ) + current_offset
                     rstart = max( 0, rstart ) + current_offset
-                    for i from rstart <= i < rend: counts[i] += 1
+                    addInterval(diff, rstart, rend)
 
                 current_offset += length
 
+        addDifferences(counts, diff)
+
 class RangeCounterBAMMerge(RangeCounterBAM):
     '''count densities using bam files.
 
@@ -300,6 +323,7 @@ class RangeCounterBAMMerge(RangeCounterBAM):
         cdef AlignmentFile samfile
         cdef int min_insert_size = self.min_insert_size
         cdef int max_insert_size = self.max_insert_size
+        cdef double[::1] diff = numpy.zeros(len(counts) + 1)
 
         for samfile in files:
 
@@ -341,11 +365,12 @@ class RangeCounterBAMMerge(RangeCounterBAM):
 
                     rstart += -start + current_offset
                     rend += -start + current_offset
-                    for i from rstart <= i < rend:
-                        counts[i] += 1
+                    addInterval(diff, rstart, rend)
 
                 current_offset += length
 
+        addDifferences(counts, diff)
+
 class RangeCounterBAMBaseAccuracy(RangeCounterBAM):
     '''count densities using bam files with base accuracy.
     '''
@@ -422,6 +447,7 @@ class RangeCounterBed(RangeCounter):
         cdef int length
         cdef int current_offset
         cdef int interval_width
+        cdef double[::1] diff = numpy.zeros(len(counts) + 1)
 
         for bedfile in files:
             current_offset = 0
@@ -434,13 +460,15 @@ class RangeCounterBed(RangeCounter):
                         # truncate to range of interest
                         rstart = max(0, bed.start - start) + current_offset
                         rend = min( length, bed.end - start) + current_offset
-                        for i from rstart <= i < rend: counts[i] += 1
+                        addInterval(diff, rstart, rend)
                 except (ValueError, KeyError):
                     # contig not present
                     pass
 
                 current_offset += length
 
+        addDifferences(counts, diff)
+
         
 
 class RangeCounterBigWig(RangeCounter):
@@ -673,6 +701,34 @@ class IntervalsCounter:
 
         return profile
 
+    def getState(self):
+        '''return counts collected so far.
+
+        The state can be added to another counter of the same
+        configuration with :meth:`addState`.
+        '''
+        return (self.aggregate_counts, self.counts,
+                self.lengths, self.nskipped)
+
+    def resetState(self):
+        '''remove all counts collected so far.'''
+        self.aggregate_counts = [numpy.zeros(len(x), dtype=self.dtype)
+                                 for x in self.aggregate_counts]
+        self.counts = [0] * len(self.counts)
+        self.lengths = [[] for x in self.lengths]
+        self.nskipped = 0
+
+    def addState(self, state):
+        '''add counts collected by another counter, see :meth:`getState`.'''
+        aggregate_counts, counts, lengths, nskipped = state
+        for agg, c in zip(self.aggregate_counts, aggregate_counts):
+            agg += c
+        for x, c in enumerate(counts):
+            self.counts[x] += c
+        for l, c in zip(self.lengths, lengths):
+            l.extend(c)
+        self.nskipped += nskipped
+
     def writeLengthStats(self, outfile):
         '''output length stats to outfile.'''
         
@@ -628,7 +628,7 @@ class Counts(object):
                     min_cbin, max_cbin, width_cbin,
                     min_ibin, max_ibin, width_ibin,
                     tracks_map,  groups,
-                    difference, s_max=100, i=1):
+                    difference, s_max=100, i=1, rng=None):
         '''take a dataframe and shuffle the rows to obtain spike in rows.
         return the indices to obtain the rows from the counts table
         and the counts per bin
@@ -644,6 +644,7 @@ class Counts(object):
         * difference = "relative", "logfold" or "abs_logfold"
         * s_max = maximum number of spikes per bin
         * i = number of iterations. More iterations = more filled bins
+        * rng = random number generator, see :func:`permutation`
         '''
 
         # make bins with an extra bin at the end to capture spike-ins with
@@ -658,46 +659,39 @@ class Counts(object):
                    for key1 in np.digitize(i_bins, i_bins)
                    for key2 in np.digitize(c_bins, c_bins)}
 
-        min_occup = min(bin_counts.flatten())
+        # row means do not depend on the order of rows
+        labels = self.table.index.tolist()
+        group1_means = self.table.loc[:, tracks_map[groups[0]]].mean(
+            axis=1).values
+        group2_means = self.table.loc[:, tracks_map[groups[1]]].mean(
+            axis=1).values
+
         for iteration in range(0,  i):
+            # stop if all bins are filled
+            if bin_counts.min() >= s_max:
+                break
+
             E.info("performing shuffling iteration number %i.." % (
                 iteration + 1))
-            if min_occup < s_max:
-                group1_rand = copy.copy(self.table.index.tolist())
-                group2_rand = copy.copy(self.table.index.tolist())
-                random.shuffle(group1_rand)
-                random.shuffle(group2_rand)
-
-                # subset the dataframe rows in the first random order
-                # and by the column_ids in the first group
-                # and return means across columns. Repeat for group2
-                group1_mean = self.table.ix[group1_rand,
-                                            tracks_map[groups[0]]].apply(
-                                                np.mean, axis=1).tolist()
-                group2_mean = self.table.ix[group2_rand,
-                                            tracks_map[groups[1]]].apply(
-                                                np.mean, axis=1).tolist()
-                # retrieve the index for the bin in
-                # which each index value falls
-                change_idx, initial_idx = means2idxarrays(
-                    group1_mean, group2_mean, i_bins, c_bins, difference)
-
-                # for each initial and change value coordinate
-                for idx, coord in enumerate(zip(initial_idx, change_idx)):
-                    # ignore spike-in if change or initial fall into the final
-                    # bin
-                    if coord[0] < len(i_bins) and coord[1] < len(c_bins):
-                        if coord in list(indices.keys()):
-                            # if max fill of bin not reached
-                            if bin_counts[coord] < s_max:
-                                # ...append tuple of df indeces for groups
-                                bin_counts[coord] += 1
-                                indices[coord].append((group1_rand[idx],
-                                                       group2_rand[idx]))
-
-                    # find the minimum value in the counts array this should
-                    # save time if all bins are filled before final iteration
-                    min_occup = min(bin_counts.flatten())
+            group1_rand = permutation(len(labels), rng)
+            group2_rand = permutation(len(labels), rng)
+
+            # retrieve the index for the bin in
+            # which each index value falls
+            change_idx, initial_idx = means2idxarrays(
+                group1_means[group1_rand], group2_means[group2_rand],
+                i_bins, c_bins, difference)
+
+            # ignore spike-in if change or initial fall into the first or
+            # final bin
+            valid = ((initial_idx > 0) & (initial_idx < len(i_bins)) &
+                     (change_idx > 0) & (change_idx < len(c_bins)))
+
+            # ...append tuple of df indeces for groups
+            for idx in fillBins(bin_counts, (initial_idx, change_idx),
+                                valid, s_max):
+                indices[(initial_idx[idx], change_idx[idx])].append(
+                    (labels[group1_rand[idx]], labels[group2_rand[idx]]))
 
         E.info("The largest bin has %i entries" % max(bin_counts.flatten()))
 
@@ -750,7 +744,7 @@ class Counts(object):
         header = makeHeader(tracks_map, groups, keep_columns=keep_columns)
 
         if output_method == "append":
-            self.table = self.table.ix[:, header]
+            self.table = self.table.loc[:, header]
             self.table.to_csv(sys.stdout, index=index, header=True, sep="\t",
                               dtype={'position': int})
         else:
@@ -789,8 +783,8 @@ class Counts(object):
                         key, width_ibin, min_ibin, width_cbin, min_cbin)
                     row = ["_".join(map(str,
                                         ("spike-in", initial, change, n)))]
-                    row.extend(self.table.ix[pair[0], tracks_map[groups[0]]])
-                    row.extend(self.table.ix[pair[1], tracks_map[groups[1]]])
+                    row.extend(self.table.loc[pair[0], tracks_map[groups[0]]])
+                    row.extend(self.table.loc[pair[1], tracks_map[groups[1]]])
                     sys.stdout.write("%s\n" % "\t".join(map(str, row)))
                     n += 1
 
@@ -806,13 +800,13 @@ class Counts(object):
                         map(str, ("spike-in", initial, change,
                                   size, c1rs - c1s, n)))
 
-                    temp_cluster_df = self.table.ix[c1s:c1e, keep_cols]
+                    temp_cluster_df = self.table.loc[c1s:c1e, keep_cols]
                     temp_cluster_df['contig'] = cluster_id
-                    temp_cluster_swap = self.table.ix[
+                    temp_cluster_swap = self.table.loc[
                         c2rs:c2re, tracks_map[groups[1]]]
-                    temp_cluster_swap.set_index(self.table.ix[c1rs:c1re].index,
+                    temp_cluster_swap.set_index(self.table.loc[c1rs:c1re].index,
                                                 drop=True,  inplace=True)
-                    temp_cluster_df.ix[c1rs:c1re, tracks_map[
+                    temp_cluster_df.loc[c1rs:c1re, tracks_map[
                         groups[1]]] = temp_cluster_swap
                     temp_cluster_df.to_csv(sys.stdout, index=index,
                                            header=False, sep="\t",
@@ -820,26 +814,75 @@ class Counts(object):
                     n += 1
 
 
+def permutation(n, rng=None):
+    '''return a random permutation of the integers 0 to *n* - 1.
+
+    *rng* is a random number generator with a ``permutation`` method
+    such as :class:`numpy.random.RandomState`. If *rng* is None, the
+    permutation is obtained from the :mod:`random` module, so that
+    results for a given ``--random-seed`` are the same as in previous
+    versions.
+    '''
+    if rng is None:
+        order = list(range(n))
+        random.shuffle(order)
+        return np.array(order, dtype=np.int64)
+    return rng.permutation(n)
+
+
+def fillBins(counts, coords, valid, s_max):
+    '''fill bins with spike-ins up to a maximum of *s_max* per bin.
+
+    *coords* is a tuple of arrays with the bin index of each spike-in
+    in each dimension of *counts*. Spike-ins are accepted in order
+    as long as their bin contains less than *s_max* spike-ins.
+    Spike-ins that are not *valid* are ignored.
+
+    *counts* is updated in place. Returns the positions of the
+    accepted spike-ins in order.
+    '''
+    positions = np.flatnonzero(valid)
+    if len(positions) == 0:
+        return positions
+
+    bins = np.ravel_multi_index(tuple(x[positions] for x in coords),
+                                counts.shape)
+
+    # rank of each spike-in among the spike-ins in the same bin
+    order = np.argsort(bins, kind="stable")
+    sorted_bins = bins[order]
+    first = np.concatenate(
+        ([0], np.flatnonzero(sorted_bins[1:] != sorted_bins[:-1]) + 1))
+    sizes = np.diff(np.concatenate((first, [len(bins)])))
+    rank = np.empty(len(bins), dtype=np.int64)
+    rank[order] = np.arange(len(bins)) - np.repeat(first, sizes)
+
+    accept = counts.ravel()[bins] + rank < s_max
+    counts += np.bincount(bins[accept],
+                          minlength=counts.size).reshape(counts.shape)
+    return positions[accept]
+
+
 def means2idxarrays(g1, g2, i_bins, c_bins, difference):
     '''take two arrays of values and return the initial values
     and differences as numpy digitised arrays'''
 
+    g1 = np.asarray(g1, dtype=np.float64)
+    g2 = np.asarray(g2, dtype=np.float64)
+
     if difference == "relative":
         # calculate difference between mean values for group1 and group2
         # g1 and g2 always the same length
-        change = [g2[x] - g1[x] for x in range(0, len(g1))]
+        change = g2 - g1
         initial = g1
 
     elif difference == "logfold":
-        change = [np.log2((g2[x] + 1.0) / (g1[x] + 1.0))
-                  for x in range(0, len(g1))]
-        initial = [np.log2(g1[x] + 1.0) for x in range(0, len(g1))]
+        change = np.log2((g2 + 1.0) / (g1 + 1.0))
+        initial = np.log2(g1 + 1.0)
 
     elif difference == "abs_logfold":
-        change = [abs(np.log2((g2[x] + 1.0) / (g1[x] + 1.0)))
-                  for x in range(0, len(g1))]
-        initial = [max(np.log2(g1[x] + 1.0), np.log2(g2[x] + 1.0))
-                   for x in range(0, len(g1))]
+        change = np.abs(np.log2((g2 + 1.0) / (g1 + 1.0)))
+        initial = np.maximum(np.log2(g1 + 1.0), np.log2(g2 + 1.0))
 
     # return arrays of len(change) with the index position in c_bins
     # corresponding to the bin in which the value of change falls
@@ -881,13 +924,57 @@ def findClusters(df, distance, size, tracks_map, groups):
     return (cluster_dfs)
 
 
+def clusterSums(clusters, tracks):
+    '''return cumulative sums and numbers of values of *tracks*
+    in a list of *clusters* for :func:`clusterMeans`.
+
+    Clusters are expected to be indexed by consecutive integers.
+    '''
+    # clusters are stacked and separated by a row of zeros
+    offsets = np.zeros(len(clusters), dtype=np.int64)
+    values = []
+    nrows = 0
+    for x, cluster in enumerate(clusters):
+        offsets[x] = nrows - cluster.index[0]
+        values.append(np.zeros((1, len(tracks))))
+        values.append(cluster.loc[:, tracks].values.astype(np.float64))
+        nrows += len(cluster) + 1
+    values = np.vstack(values)
+    present = ~np.isnan(values)
+    sums = np.cumsum(np.where(present, values, 0), axis=0)
+    nvalues = np.cumsum(present, axis=0)
+    return offsets, sums, nvalues
+
+
+def clusterMeans(cluster_sums, selected, starts, size):
+    '''return the mean of values in windows of *size* + 1 rows
+    starting at index *starts* in the clusters *selected*.
+
+    The mean is the mean across tracks of the mean within each track.
+    Missing values are ignored.
+    '''
+    offsets, sums, nvalues = cluster_sums
+    a = offsets[selected] + starts
+    b = a + size + 1
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        track_means = (sums[b] - sums[a]) / (nvalues[b] - nvalues[a])
+        with_values = ~np.isnan(track_means)
+        return (np.where(with_values, track_means, 0).sum(axis=1) /
+                with_values.sum(axis=1))
+
+
 def shuffleCluster(i_bins, c_bins, tracks_map, groups,
                    difference, s_max, i, clusters_dict,
-                   s_bins_max, s_bins_min, s_bins_width):
+                   s_bins_max, s_bins_min, s_bins_width, rng=None):
     '''take a dictionary containing clusters (subdataframes) and shuffle
     subregions of clusters to obtain spike in clusters.
     return indeces from which the spike in clusters can be obtained from the
     original dataframe
+
+    *rng* is a :class:`numpy.random.RandomState`. If not given, the
+    global :mod:`numpy.random` and :mod:`random` number generators are
+    used as in previous versions.
     '''
     s_bins = list(range(s_bins_min, s_bins_max + 1, s_bins_width,))
 
@@ -898,56 +985,58 @@ def shuffleCluster(i_bins, c_bins, tracks_map, groups,
                for key2 in np.digitize(c_bins, c_bins)
                for key3 in np.digitize(s_bins, s_bins)}
 
+    keys = list(clusters_dict.keys())
+    clusters = [clusters_dict[key] for key in keys]
+    first = np.array([cluster.index[0] for cluster in clusters])
+    last = np.array([cluster.index[-1] for cluster in clusters])
+    group1_sums = clusterSums(clusters, tracks_map[groups[0]])
+    group2_sums = clusterSums(clusters, tracks_map[groups[1]])
+
     for iteration in range(0,  i):
         E.info("performing shuffling iteration number %i.." % (iteration + 1))
         for size in s_bins:
-            group1_mean = []
-            group2_mean = []
-            g1_rand_s = []
-            g2_rand_s = []
-            g1_rand = np.random.permutation(list(clusters_dict.keys()))
-            g2_rand = np.random.permutation(list(clusters_dict.keys()))
-            for perm in range(0, len(g1_rand)):
-                cluster1 = clusters_dict[g1_rand[perm]].ix[
-                    :, tracks_map[groups[0]]]
-                cluster2 = clusters_dict[g2_rand[perm]].ix[
-                    :, tracks_map[groups[1]]]
-                c1_rand_s = random.randint(
-                    min(cluster1.index), max(cluster1.index) - size)
-                c1_e = int(c1_rand_s + size)
-                c2_rand_s = random.randint(
-                    min(cluster2.index), max(cluster2.index) - size)
-                c2_e = int(c2_rand_s + size)
-
-                c1_mean = np.mean(np.mean(cluster1.ix[c1_rand_s: c1_e]))
-                c2_mean = np.mean(np.mean(cluster2.ix[c2_rand_s: c2_e]))
-                group1_mean.append(c1_mean)
-                group2_mean.append(c2_mean)
-                g1_rand_s.append(c1_rand_s)
-                g2_rand_s.append(c2_rand_s)
+            if rng is None:
+                g1_rand = np.random.permutation(len(keys))
+                g2_rand = np.random.permutation(len(keys))
+                g1_rand_s, g2_rand_s = [], []
+                for c1, c2 in zip(g1_rand, g2_rand):
+                    g1_rand_s.append(random.randint(first[c1],
+                                                    last[c1] - size))
+                    g2_rand_s.append(random.randint(first[c2],
+                                                    last[c2] - size))
+                g1_rand_s = np.array(g1_rand_s, dtype=np.int64)
+                g2_rand_s = np.array(g2_rand_s, dtype=np.int64)
+            else:
+                g1_rand = rng.permutation(len(keys))
+                g2_rand = rng.permutation(len(keys))
+                g1_rand_s = rng.randint(first[g1_rand],
+                                        last[g1_rand] - size + 1)
+                g2_rand_s = rng.randint(first[g2_rand],
+                                        last[g2_rand] - size + 1)
+
+            group1_mean = clusterMeans(group1_sums, g1_rand, g1_rand_s, size)
+            group2_mean = clusterMeans(group2_sums, g2_rand, g2_rand_s, size)
 
             change_idx, initial_idx,  = means2idxarrays(
                 group1_mean, group2_mean, i_bins,
                 c_bins,  difference)
             size_idx = np.digitize([size] * len(initial_idx), s_bins)
-            for idx, coord in enumerate(zip(
-                    initial_idx, change_idx, size_idx)):
-                if counts[coord] < s_max:
-                    counts[coord] += 1
-                    cluster1_ix = clusters_dict[g1_rand[idx]].index.values
-                    cluster1_start = cluster1_ix[0]
-                    cluster1_end = cluster1_ix[-1]
-                    cluster2_ix = clusters_dict[g2_rand[idx]].index.values
-                    cluster2_start = cluster2_ix[0]
-                    cluster2_end = cluster2_ix[-1]
-                    c1_rand_s = g1_rand_s[idx]
-                    c1_rand_e = int(c1_rand_s + size)
-                    c2_rand_s = g2_rand_s[idx]
-                    c2_rand_e = int(c2_rand_s + size)
-                    indices[coord].append((
-                        cluster1_start, cluster1_end, cluster2_start,
-                        cluster2_end, c1_rand_s, c1_rand_e, c2_rand_s,
-                        c2_rand_e))
+
+            # only count spike-ins within bins that are kept
+            valid = ((initial_idx > 0) & (initial_idx <= len(i_bins)) &
+                     (change_idx > 0) & (change_idx <= len(c_bins)))
+
+            for idx in fillBins(counts, (initial_idx, change_idx, size_idx),
+                                valid, s_max):
+                c1, c2 = g1_rand[idx], g2_rand[idx]
+                c1_rand_s = g1_rand_s[idx]
+                c2_rand_s = g2_rand_s[idx]
+                indices[(initial_idx[idx],
+                         change_idx[idx],
+                         size_idx[idx])].append((
+                             first[c1], last[c1], first[c2], last[c2],
+                             c1_rand_s, int(c1_rand_s + size),
+                             c2_rand_s, int(c2_rand_s + size)))
     return indices, counts
 
 
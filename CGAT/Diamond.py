@@ -1,5 +1,10 @@
+import csv
+import io
 import random
 
+import numpy
+import pandas
+
 
 class Diamond(object):
 
@@ -112,3 +117,111 @@ def best_alignment_iterator(query_iterator):
             best_alignments = random.sample(best_alignments, 1)
         best_alignment = best_alignments[0]
         yield best_alignment
+
+
+# columns in tabular (outfmt 6) output
+COLUMNS = ("qid", "sid", "identity", "length", "nmismatches", "ngaps",
+           "qstart", "qend", "sstart", "send", "evalue", "score")
+
+
+def query_block_iterator(alignment_file, block_size=10000000):
+    '''
+    iterate over blocks of lines of about block_size bytes.
+    All alignments of a query are in the same block.
+    '''
+    remainder = []
+    while True:
+        lines = alignment_file.readlines(block_size)
+        if not lines:
+            break
+        if remainder:
+            lines = remainder + lines
+        # keep alignments of the last query for the next block
+        prefix = lines[-1].split("\t", 1)[0] + "\t"
+        x = len(lines) - 1
+        while x > 0 and lines[x - 1].startswith(prefix):
+            x -= 1
+        remainder = lines[x:]
+        if x > 0:
+            yield lines[:x]
+    if remainder:
+        yield remainder
+
+
+def read_block(lines, columns=("qid", "ref", "score")):
+    '''
+    return a dataframe with alignment data in a block of lines.
+
+    The reference identifier is split into ``gi`` and ``ref`` as in
+    :func:`alignment_iterator`.
+    '''
+    usecols = [COLUMNS.index(x) for x in columns
+               if x not in ("gi", "ref")]
+    if "gi" in columns or "ref" in columns:
+        usecols.append(COLUMNS.index("sid"))
+    usecols = sorted(set(usecols))
+
+    df = pandas.read_csv(io.StringIO("".join(lines)),
+                         sep="\t",
+                         header=None,
+                         names=[COLUMNS[x] for x in usecols],
+                         usecols=usecols,
+                         dtype={"qid": str, "sid": str},
+                         quoting=csv.QUOTE_NONE,
+                         na_filter=False)
+
+    if "gi" in columns or "ref" in columns:
+        sid = df["sid"]
+        has_gi = sid.str.contains("|", regex=False)
+        df["gi"] = None
+        df["ref"] = sid
+        if has_gi.any():
+            fields = sid[has_gi].str.split("|")
+            df.loc[has_gi, "gi"] = fields.str[1]
+            df.loc[has_gi, "ref"] = fields.str[3]
+
+    return df[list(columns)]
+
+
+def query_index(df):
+    '''
+    return an array numbering queries in a dataframe, starting
+    from 0. Queries are consecutive rows with the same ``qid``.
+    '''
+    qids = df["qid"].values
+    queries = numpy.zeros(len(qids), dtype=numpy.int64)
+    numpy.cumsum(qids[1:] != qids[:-1], out=queries[1:])
+    return queries
+
+
+def best_alignments(df, random_state=None):
+    '''
+    return the row indices of the best alignment for each query.
+
+    The best alignment has the highest bit score; ties are broken
+    randomly using random_state. Indices are ordered by query as
+    numbered by :func:`query_index`.
+    '''
+    if len(df) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    if random_state is None:
+        random_state = numpy.random.RandomState()
+
+    queries = query_index(df)
+    order = numpy.lexsort((random_state.random_sample(len(queries)),
+                           -df["score"].values.astype(numpy.float64),
+                           queries))
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = queries[order][1:] != queries[order][:-1]
+    return order[first]
+
+
+def count_best_alignments(lines, random_state=None):
+    '''
+    return a dictionary with the number of best alignments
+    to each reference in a block of lines.
+    '''
+    df = read_block(lines)
+    refs = df["ref"].values[best_alignments(df, random_state)]
+    codes, uniques = pandas.factorize(refs)
+    return dict(zip(uniques, numpy.bincount(codes).tolist()))
@@ -5,6 +5,8 @@ This module provides an iterator of :term:`fastq` formatted files
 (:func:`iterate`). Additional iterators allow guessing of the quality
 score format (:func:`iterate_guess`) or converting them
 (:func:`iterate_convert`) while iterating through a file.
+:func:`iterate_phred_blocks` iterates over blocks of records with
+quality scores decoded into numpy arrays.
 
 :func:`guessFormat` inspects a fastq file to guess the quality score format
 and :func:`getOffset` returns the numeric offset for quality score conversion
@@ -23,6 +25,8 @@ import string
 
 from math import log
 
+import numpy
+
 import CGATCore.Experiment as E
 import CGATCore.IOTools as IOTools
 
@@ -298,6 +302,262 @@ def iterate_convert(infile, format, max_tries=10000, guess=None):
         yield r
 
 
+def iterate_blocks(infile, block_size=1000000):
+    '''iterate over contents of fastq file in blocks of records.
+
+    Lines are read in chunks of about `block_size` bytes and split
+    into records without creating a :class:`Record` for each entry.
+
+    Arguments
+    ---------
+    infile : File
+       File or file-like object to iterate over
+    block_size : int
+       Approximate number of bytes to read per block.
+
+    Yields
+    ------
+    block : tuple
+        A tuple of three lists with identifiers, sequences and
+        quality strings of the records in the block.
+
+    Raises
+    ------
+    ValueError
+        If the file is not properly formatted.
+    '''
+
+    remainder = []
+    while 1:
+        lines = infile.readlines(block_size)
+        if not lines:
+            break
+        if not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        if remainder:
+            lines = remainder + lines
+        nlines = len(lines) - len(lines) % 4
+        remainder = lines[nlines:]
+        if nlines == 0:
+            continue
+        del lines[nlines:]
+
+        headers = lines[0::4]
+        for line in headers:
+            if not line.startswith("@"):
+                raise ValueError(
+                    "parsing error: expected '@' in line %s" % line)
+        for line in lines[2::4]:
+            if not line.startswith("+"):
+                raise ValueError(
+                    "parsing error: expected '+' in line %s" % line)
+
+        yield ([x[1:-1] for x in headers],
+               [x[:-1] for x in lines[1::4]],
+               [x[:-1] for x in lines[3::4]])
+
+    if remainder:
+        raise ValueError("incomplete entry for %s" % remainder[0])
+
+
+def getPhredTable(format, target_format=None):
+    '''return a lookup table converting quality codes to phred scores.
+
+    The table is computed with :meth:`Record.toPhred` and thus gives
+    the same scores as converting records one by one. If
+    `target_format` is given, scores are converted into this format
+    and back as done by :func:`iterate_convert`.
+
+    Codes that can not be converted or give negative scores are
+    mapped to 0.
+
+    Arguments
+    ---------
+    format : string
+       Quality score format of the input.
+    target_format : string
+       Quality score format to convert into.
+
+    Returns
+    -------
+    table : numpy.array
+       Array of 256 phred scores indexed by ASCII code.
+    '''
+    table = numpy.zeros(256, dtype=numpy.uint8)
+    for code in range(33, 127):
+        record = Record("", "N", chr(code))
+        record.format = format
+        try:
+            quals = record.toPhred()
+            if target_format not in (None, "integer"):
+                record.fromPhred(quals, target_format)
+                quals = record.toPhred()
+        except ValueError:
+            continue
+        table[code] = max(0, min(255, quals[0]))
+    return table
+
+
+def _compatibleFormats(min_codes, max_codes):
+    '''return quality score formats compatible with a range of codes.
+
+    Records are examined in order until at most one format remains.
+
+    Returns a tuple of the set of compatible formats and a flag
+    indicating if the set could not be narrowed down further.
+    '''
+    formats = sorted(RANGES.keys())
+    if len(min_codes) == 0:
+        return set(formats), False
+
+    lowest = numpy.minimum.accumulate(min_codes)
+    highest = numpy.maximum.accumulate(max_codes)
+    compatible = numpy.array(
+        [(lowest >= RANGES[f][0]) & (highest <= RANGES[f][1])
+         for f in formats])
+    resolved = numpy.nonzero(compatible.sum(axis=0) <= 1)[0]
+    if len(resolved):
+        column, is_resolved = compatible[:, resolved[0]], True
+    else:
+        column, is_resolved = compatible[:, -1], False
+    return set(f for f, c in zip(formats, column) if c), is_resolved
+
+
+def guessFormatFromCodes(min_codes, max_codes, guess=None):
+    '''guess quality score format from the range of quality codes.
+
+    Records are examined in order until the format is unambiguous.
+    Ambiguities are resolved as in :func:`iterate_guess`.
+
+    Arguments
+    ---------
+    min_codes : numpy.array
+       Minimum ASCII quality code of each record.
+    max_codes : numpy.array
+       Maximum ASCII quality code of each record.
+    guess : string
+       Default format if the quality score format is ambiguous.
+
+    Returns
+    -------
+    format : string
+       The quality score format.
+
+    Raises
+    ------
+    ValueError
+        If the ranges of the records are not compatible,
+        are incompatible with guess or are ambiguous.
+    '''
+    quals, resolved = _compatibleFormats(min_codes, max_codes)
+
+    if len(quals) == 0:
+        raise ValueError("could not guess format - ranges incompatible.")
+    elif len(quals) == 1:
+        return list(quals)[0]
+    elif guess in quals:
+        E.warn("multiple input formats possible: %s. Continuing with %s" %
+               (", ".join(quals), guess))
+        return guess
+    elif quals.issubset(set(["solexa", "phred64"])):
+        # both solexa and phred64 are compatible with phred64 reads
+        return "phred64"
+    else:
+        raise ValueError(
+            "could not guess format - could be one of %s." % str(quals))
+
+
+def _codeRanges(codes, offsets):
+    '''return minimum and maximum code for each record.
+
+    Records without qualities are assigned an empty range.
+    '''
+    nrecords = len(offsets) - 1
+    min_codes = numpy.full(nrecords, 255, dtype=numpy.uint8)
+    max_codes = numpy.zeros(nrecords, dtype=numpy.uint8)
+    nonempty = offsets[1:] > offsets[:-1]
+    if nonempty.any():
+        starts = offsets[:-1][nonempty]
+        min_codes[nonempty] = numpy.minimum.reduceat(codes, starts)
+        max_codes[nonempty] = numpy.maximum.reduceat(codes, starts)
+    return min_codes, max_codes
+
+
+def iterate_phred_blocks(infile, guess=None, target_format=None,
+                         max_tries=10000, block_size=1000000):
+    '''iterate over contents of fastq file in blocks of phred scores.
+
+    The quality score format is guessed from the first `max_tries`
+    records as in :func:`iterate_guess`. Quality strings are decoded
+    block-wise into numpy arrays of phred scores. If `target_format`
+    is given, scores are those obtained by :func:`iterate_convert`.
+
+    Arguments
+    ---------
+    infile : File
+       File or file-like object to iterate over
+    guess : string
+       Default format if the quality score format is ambiguous.
+    target_format : string
+       Quality score format to convert records into.
+    max_tries : int
+       Number of records to examine for guessing the quality score
+       format.
+    block_size : int
+       Approximate number of bytes to read per block.
+
+    Yields
+    ------
+    block : tuple
+        A tuple of (identifiers, sequences, scores, offsets).
+        `scores` is an array of the concatenated phred scores of
+        all records in the block. The scores of record `i` are
+        ``scores[offsets[i]:offsets[i + 1]]``.
+    '''
+
+    def _decode(qualities):
+        codes = numpy.frombuffer(
+            "".join(qualities).encode("ascii"), dtype=numpy.uint8)
+        offsets = numpy.zeros(len(qualities) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(x) for x in qualities], out=offsets[1:])
+        return codes, offsets
+
+    cache = []
+    min_codes, max_codes = [], []
+    nrecords = 0
+    table = None
+    for identifiers, sequences, qualities in iterate_blocks(
+            infile, block_size=block_size):
+        codes, offsets = _decode(qualities)
+
+        if table is None:
+            cache.append((identifiers, sequences, codes, offsets))
+            mi, ma = _codeRanges(codes, offsets)
+            min_codes.append(mi)
+            max_codes.append(ma)
+            nrecords += len(identifiers)
+            mi = numpy.concatenate(min_codes)[:max_tries]
+            ma = numpy.concatenate(max_codes)[:max_tries]
+            if nrecords < max_tries and not _compatibleFormats(mi, ma)[1]:
+                continue
+            format = guessFormatFromCodes(mi, ma, guess=guess)
+            table = getPhredTable(format, target_format)
+            for identifiers, sequences, codes, offsets in cache:
+                yield identifiers, sequences, table[codes], offsets
+            cache = None
+            continue
+
+        yield identifiers, sequences, table[codes], offsets
+
+    if table is None and cache:
+        format = guessFormatFromCodes(numpy.concatenate(min_codes)[:max_tries],
+                                      numpy.concatenate(max_codes)[:max_tries],
+                                      guess=guess)
+        table = getPhredTable(format, target_format)
+        for identifiers, sequences, codes, offsets in cache:
+            yield identifiers, sequences, table[codes], offsets
+
+
 def guessFormat(infile, max_lines=10000, raises=True):
     '''guess format of FASTQ File.
 
@@ -8,43 +8,260 @@ from pysam.libcbcf cimport VariantFile, VariantRecord, VariantRecordSample
 from pysam.libcfaidx cimport FastxFile, FastqProxy
 from pysam.libctabix cimport TabixFile
 from libc.string cimport strchr
-from libc.stdint cimport int8_t
+from libc.stdint cimport int8_t, uint64_t
 from libc.stdio cimport puts, printf
 from cpython cimport array as c_array
 
 import CGATCore.Experiment as E
+import CGAT.Parallel as Parallel
 from CGAT.Genomics import reverse_complement
 import numpy
 cimport numpy
+cimport cython
 DTYPE = numpy.uint32
 ctypedef numpy.uint32_t DTYPE_t
 
-cdef count_diagonals(sequence,
-                     forward_hash,
-                     reverse_hash,
-                     uint32_t query_sequence_length,
-                     uint32_t kmer_size):
-    cdef uint32_t x, count
-    cdef uint32_t offset = len(sequence)
-    cdef uint32_t l = len(sequence) + query_sequence_length
-    cdef numpy.ndarray[DTYPE_t, ndim=1] forward_counts = numpy.zeros(l, dtype=DTYPE)
-    cdef numpy.ndarray[DTYPE_t, ndim=1] reverse_counts = numpy.zeros(l, dtype=DTYPE)
-    
-    for x from 0 <= x < len(sequence) - kmer_size:
-        kmer = sequence[x: x + kmer_size]
-        if kmer in forward_hash:
-            for count in forward_hash[kmer]:
-                forward_counts[count - x + offset] += 1
-
-        if kmer in reverse_hash:
-            for count in reverse_hash[kmer]:
-                reverse_counts[count - x + offset] += 1
-
-    return forward_counts.max(), reverse_counts.max()
+# 2-bit codes of nucleotides, -1 for all other characters
+cdef int8_t NUCLEOTIDE_CODES[256]
+NUCLEOTIDE_CODES[:] = [-1] * 256
+NUCLEOTIDE_CODES[<int>b'A'] = NUCLEOTIDE_CODES[<int>b'a'] = 0
+NUCLEOTIDE_CODES[<int>b'C'] = NUCLEOTIDE_CODES[<int>b'c'] = 1
+NUCLEOTIDE_CODES[<int>b'G'] = NUCLEOTIDE_CODES[<int>b'g'] = 2
+NUCLEOTIDE_CODES[<int>b'T'] = NUCLEOTIDE_CODES[<int>b't'] = 3
+
+# multiplier for hashing kmer codes into buckets
+cdef uint64_t HASH_MULTIPLIER = 0x9E3779B97F4A7C15ULL
+
+
+def encode_kmers(sequence, uint32_t kmer_size):
+    """return 2-bit packed codes of all kmers in *sequence*.
+
+    Returns a tuple of two arrays, the codes and the positions
+    of all kmers. Kmers containing characters other than
+    A, C, G or T are skipped.
+    """
+    cdef bytes _sequence = sequence.encode("ascii")
+    cdef const unsigned char * s = _sequence
+    cdef uint32_t length = len(_sequence)
+    cdef uint64_t mask = (<uint64_t>-1) >> (64 - 2 * kmer_size)
+    cdef uint64_t code = 0
+    cdef uint32_t valid = 0
+    cdef uint32_t x, n = 0
+    cdef int8_t c
+
+    codes = numpy.zeros(length, dtype=numpy.uint64)
+    positions = numpy.zeros(length, dtype=numpy.uint32)
+    cdef uint64_t [:] codes_view = codes
+    cdef uint32_t [:] positions_view = positions
+
+    for x in range(length):
+        c = NUCLEOTIDE_CODES[s[x]]
+        if c < 0:
+            valid = 0
+            continue
+        code = ((code << 2) | c) & mask
+        valid += 1
+        if valid >= kmer_size:
+            codes_view[n] = code
+            positions_view[n] = x + 1 - kmer_size
+            n += 1
+
+    return codes[:n], positions[:n]
+
+
+cdef class KmerIndex:
+    """index of kmers in one or more query sequences.
+
+    Kmers are packed into 64-bit integers with two bits per
+    nucleotide and stored in a hash table together with their
+    position in the forward or reverse complemented query sequence.
+
+    :meth:`count_diagonals` counts kmer matches of a sequence along
+    each diagonal of the alignment matrix between the sequence and
+    each query sequence on both strands. Counts are accumulated in
+    buffers that are allocated once and reset after each sequence.
+    """
+
+    cdef readonly uint32_t kmer_size
+    cdef readonly uint32_t nqueries
+    cdef uint32_t max_query_length
+    cdef uint32_t max_sequence_length
+    cdef uint32_t stride
+    cdef int bucket_shift
+    cdef uint32_t [:] bucket_offsets
+    cdef uint64_t [:] entry_codes
+    cdef uint32_t [:] entry_positions
+    cdef uint32_t [:] entry_regions
+    cdef uint32_t [:] counts
+    cdef uint32_t [:] touched
+
+    def __init__(self, query_sequences, uint32_t kmer_size=10,
+                 uint32_t max_sequence_length=1000):
+
+        if kmer_size == 0 or kmer_size > 32:
+            raise ValueError(
+                "kmer size needs to be between 1 and 32, got {}".format(
+                    kmer_size))
+
+        if isinstance(query_sequences, str):
+            query_sequences = [query_sequences]
+
+        self.kmer_size = kmer_size
+        self.nqueries = len(query_sequences)
+        self.max_query_length = max(
+            [len(x) for x in query_sequences] + [0])
+
+        # a region is a (query, strand) combination
+        codes, positions, regions = [], [], []
+        for idx, query_sequence in enumerate(query_sequences):
+            for strand, sequence in enumerate(
+                    (query_sequence, reverse_complement(query_sequence))):
+                c, p = encode_kmers(sequence, kmer_size)
+                codes.append(c)
+                positions.append(p)
+                regions.append(numpy.zeros(len(c), dtype=numpy.uint32) +
+                               2 * idx + strand)
+
+        codes = numpy.concatenate(codes + [numpy.zeros(0, numpy.uint64)])
+        positions = numpy.concatenate(
+            positions + [numpy.zeros(0, numpy.uint32)])
+        regions = numpy.concatenate(regions + [numpy.zeros(0, numpy.uint32)])
+
+        # hash table with at least two buckets per entry
+        nbits = 1
+        while (1 << nbits) < 2 * len(codes):
+            nbits += 1
+        self.bucket_shift = 64 - nbits
+        buckets = self._hash_codes(codes)
+        order = numpy.argsort(buckets, kind="stable")
+        offsets = numpy.zeros((1 << nbits) + 1, dtype=numpy.uint32)
+        numpy.cumsum(numpy.bincount(buckets, minlength=1 << nbits),
+                     out=offsets[1:])
+
+        self.bucket_offsets = offsets
+        self.entry_codes = codes[order]
+        self.entry_positions = positions[order]
+        self.entry_regions = regions[order]
+
+        self._allocate(max_sequence_length)
+
+    def _hash_codes(self, codes):
+        return ((codes * numpy.uint64(HASH_MULTIPLIER)) >>
+                numpy.uint64(self.bucket_shift)).astype(numpy.int64)
+
+    def _allocate(self, uint32_t max_sequence_length):
+        """allocate diagonal count buffers for sequences up to
+        *max_sequence_length*."""
+        self.max_sequence_length = max_sequence_length
+        self.stride = self.max_query_length + max_sequence_length
+        size = max(1, 2 * self.nqueries * self.stride)
+        self.counts = numpy.zeros(size, dtype=numpy.uint32)
+        self.touched = numpy.zeros(size, dtype=numpy.uint32)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef uint32_t count_diagonals(self, sequence):
+        """return the maximum number of kmer matches of *sequence*
+        on any diagonal with any query sequence on either strand."""
+
+        cdef bytes _sequence = sequence.encode("ascii")
+        cdef const unsigned char * s = _sequence
+        cdef uint32_t length = len(_sequence)
+
+        if length > self.max_sequence_length:
+            self._allocate(max(length, 2 * self.max_sequence_length))
+
+        cdef uint32_t kmer_size = self.kmer_size
+        cdef uint64_t mask = (<uint64_t>-1) >> (64 - 2 * kmer_size)
+        cdef uint64_t code = 0
+        cdef uint64_t bucket
+        cdef uint32_t valid = 0
+        cdef uint32_t x, pos, e, idx
+        cdef uint32_t ntouched = 0
+        cdef uint32_t best = 0
+        cdef int8_t c
+        cdef uint32_t stride = self.stride
+        cdef int bucket_shift = self.bucket_shift
+        cdef uint32_t [:] bucket_offsets = self.bucket_offsets
+        cdef uint64_t [:] entry_codes = self.entry_codes
+        cdef uint32_t [:] entry_positions = self.entry_positions
+        cdef uint32_t [:] entry_regions = self.entry_regions
+        cdef uint32_t [:] counts = self.counts
+        cdef uint32_t [:] touched = self.touched
+
+        if entry_codes.shape[0] == 0:
+            return 0
+
+        with nogil:
+            for x in range(length):
+                c = NUCLEOTIDE_CODES[s[x]]
+                if c < 0:
+                    valid = 0
+                    continue
+                code = ((code << 2) | c) & mask
+                valid += 1
+                if valid < kmer_size:
+                    continue
+                pos = x + 1 - kmer_size
+                bucket = (code * HASH_MULTIPLIER) >> bucket_shift
+                for e in range(bucket_offsets[bucket],
+                               bucket_offsets[bucket + 1]):
+                    if entry_codes[e] != code:
+                        continue
+                    # diagonal within region, offset by length to
+                    # keep indices positive
+                    idx = (entry_regions[e] * stride +
+                           entry_positions[e] + length - pos)
+                    if counts[idx] == 0:
+                        touched[ntouched] = idx
+                        ntouched += 1
+                    counts[idx] += 1
+                    if counts[idx] > best:
+                        best = counts[idx]
+
+            for x in range(ntouched):
+                counts[touched[x]] = 0
+
+        return best
+
+
+WORKER = {}
+
+
+def init_filter_worker(query_sequences, kmer_size):
+    '''initialize a worker process for :func:`filter_by_sequence`.'''
+    WORKER["index"] = KmerIndex(query_sequences, kmer_size=kmer_size)
+
+
+def filter_worker(args):
+    '''return the maximum number of kmer matches for a chunk
+    of read pairs.'''
+    cdef KmerIndex index = WORKER["index"]
+    return [max(index.count_diagonals(sequence1),
+                index.count_diagonals(sequence2))
+            for sequence1, sequence2 in args]
+
+
+def iterate_chunks(in_stream1, in_stream2, chunk_size):
+    """iterate over chunks of read pairs.
+
+    Yields tuples of a list of read pairs formatted as strings and
+    a list of sequence pairs. Reads are converted when they are read
+    as the streams may re-use their records.
+    """
+    reads, sequences = [], []
+    for read1, read2 in zip(in_stream1, in_stream2):
+        reads.append((str(read1), str(read2)))
+        sequences.append((read1.sequence, read2.sequence))
+        if len(reads) >= chunk_size:
+            yield reads, sequences
+            reads, sequences = [], []
+    if reads:
+        yield reads, sequences
 
 
 def filter_by_sequence(
-        query_sequence,
+        query_sequences,
         FastxFile in_stream1,
         FastxFile in_stream2,
         outf_matched1,
@@ -52,54 +269,58 @@ def filter_by_sequence(
         outf_unmatched1,
         outf_unmatched2,
         uint32_t kmer_size=10,
-        uint32_t min_kmer_matches=20):
+        uint32_t min_kmer_matches=20,
+        num_workers=1,
+        chunk_size=1000):
+    """split read pairs into those that match any of
+    *query_sequences* and those that do not.
 
-    _query_sequence = query_sequence.encode("ascii")
-    reverse_sequence = reverse_complement(query_sequence)
-    cdef uint32_t query_sequence_length = len(query_sequence)
-    cdef uint32_t x
-    cdef char * s = _query_sequence
+    A pair matches if either read has more than *min_kmer_matches*
+    kmers in common with a query sequence on the same diagonal.
 
-    forward_hash = collections.defaultdict(list)
-    reverse_hash = collections.defaultdict(list)
-    for x from 0 <= x < query_sequence_length - kmer_size:
-        forward_hash[query_sequence[x:x + kmer_size]].append(x)
-        reverse_hash[reverse_sequence[x: x + kmer_size]].append(x)
+    If *num_workers* is larger than 1, chunks of *chunk_size* pairs
+    are processed by worker processes. The order of reads in the
+    output files is the same as in the input.
+    """
+
+    if isinstance(query_sequences, str):
+        query_sequences = [query_sequences]
 
-    cdef FastqProxy read1, read2
     cdef uint32_t ninput = 0
     cdef uint32_t nmatched = 0
     cdef uint32_t nunmatched = 0
-    cdef uint32_t fc1, rc1, fc2, rc2
+    cdef uint32_t matches
 
-    for read1, read2 in zip(in_stream1, in_stream2):
-    
-        fc1, rc1 = count_diagonals(
-            read1.sequence,
-            forward_hash,
-            reverse_hash,
-            query_sequence_length,
-            kmer_size)
-        fc2, rc2 = count_diagonals(
-            read2.sequence,
-            forward_hash,
-            reverse_hash,
-            query_sequence_length,
-            kmer_size)
-
-        if max(fc1, rc1, fc2, rc2) > min_kmer_matches:
-            nmatched += 1
-            outf_matched1.write(str(read1) + "\n")
-            outf_matched2.write(str(read2) + "\n")
-        else:
-            nunmatched += 1
-            outf_unmatched1.write(str(read1) + "\n")
-            outf_unmatched2.write(str(read2) + "\n")
-        
-        ninput += 1
-        if ninput % 1000 == 0:
-            E.info("iteration: {}, matched={}, unmatched={}, permille_matched={}".format(
-                ninput, nmatched, nunmatched, 1000.0 * nmatched / ninput))
+    # reads stay in this process, only sequences are sent to workers
+    pending = collections.deque()
+
+    def iterate_sequences():
+        for reads, sequences in iterate_chunks(
+                in_stream1, in_stream2, chunk_size):
+            pending.append(reads)
+            yield sequences
+
+    # process a limited number of chunks at a time to bound memory usage
+    for counts in Parallel.imap(
+            filter_worker, iterate_sequences(),
+            num_workers=num_workers,
+            initializer=init_filter_worker,
+            initargs=(query_sequences, kmer_size),
+            batch_size=4 * max(1, num_workers)):
+        chunk = pending.popleft()
+        for (read1, read2), matches in zip(chunk, counts):
+            if matches > min_kmer_matches:
+                nmatched += 1
+                outf_matched1.write(read1 + "\n")
+                outf_matched2.write(read2 + "\n")
+            else:
+                nunmatched += 1
+                outf_unmatched1.write(read1 + "\n")
+                outf_unmatched2.write(read2 + "\n")
+        ninput += len(chunk)
+
+        E.info("iteration: {}, matched={}, unmatched={}, permille_matched={}".format(
+            ninput, nmatched, nunmatched, 1000.0 * nmatched / ninput))
 
     c = E.Counter()
     c.input = ninput
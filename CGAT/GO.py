@@ -16,10 +16,12 @@ import random
 import collections
 
 import scipy
+import scipy.sparse
 import scipy.stats
 import scipy.special
 import numpy
 from CGAT import Stats as Stats
+from CGAT import Parallel as Parallel
 from CGATCore import Experiment as E
 from CGATCore import IOTools as IOTools
 from CGATCore import Database as Database
@@ -136,6 +138,139 @@ def hypergeometric_Q(k, n0, n1, t):
     return P
 
 
+def _iterateHypergeometricTables(N, n, M, max_table_size):
+    """tabulate hypergeometric probability mass functions.
+
+    Elements are grouped by the totals *N* and *M*. For each group,
+    the probability mass function is computed in log-space for all
+    category sizes *n* in the group. Tables are computed in chunks of
+    at most *max_table_size* elements. Elements with *M* = 0 are
+    skipped.
+
+    Yields tuples of element indices, the table row of each element
+    and the table of probabilities with one row per category size.
+    """
+    # group elements by totals, then by category size
+    order = numpy.lexsort((n, N, M))
+    boundaries = numpy.nonzero(
+        (numpy.diff(N[order]) != 0) | (numpy.diff(M[order]) != 0))[0] + 1
+
+    for group in numpy.split(order, boundaries):
+        if len(group) == 0:
+            continue
+        sample_total, background_total = N[group[0]], M[group[0]]
+        if background_total == 0:
+            continue
+
+        sizes, size_index = numpy.unique(n[group], return_inverse=True)
+        size_index = size_index.ravel()
+        # group is sorted by category size
+        starts = numpy.searchsorted(size_index, numpy.arange(len(sizes)))
+        starts = numpy.append(starts, len(group))
+
+        first = 0
+        while first < len(sizes):
+            width = min(sizes[-1], sample_total) + 1
+            last = min(len(sizes), first + max(1, max_table_size // width))
+            width = min(sizes[last - 1], sample_total) + 1
+
+            rows = sizes[first:last, numpy.newaxis]
+            i = numpy.arange(width)
+            valid = (i <= rows) & (sample_total - i <= background_total - rows)
+            logpmf = numpy.where(
+                valid,
+                lnchoose(rows, i) +
+                lnchoose(background_total - rows,
+                         numpy.maximum(sample_total - i, 0)) -
+                lnchoose(background_total, sample_total),
+                -numpy.inf)
+
+            yield (group[starts[first]:starts[last]],
+                   size_index[starts[first]:starts[last]] - first,
+                   numpy.exp(logpmf))
+            first = last
+
+
+def _broadcastCounts(*args):
+    """broadcast arguments against each other and flatten them."""
+    arrays = numpy.broadcast_arrays(
+        *[numpy.asarray(x, dtype=numpy.int64) for x in args])
+    return arrays[0].shape, [x.ravel() for x in arrays]
+
+
+def hypergeometricProbabilities(sample_counts, sample_totals,
+                                background_counts, background_totals,
+                                max_table_size=2 ** 20):
+    """compute probabilities of over- and under-representation.
+
+    This is a vectorized version of :meth:`GOResult.UpdateProbabilities`.
+    Arguments are arrays (or scalars) that are broadcast against each
+    other.
+
+    For each combination of totals, the hypergeometric probability
+    mass function is tabulated in log-space for all category sizes and
+    converted into lower and upper cumulative tails.
+
+    Returns a tuple of arrays with the probabilities of over- and
+    under-representation.
+    """
+    shape, (k, N, n, M) = _broadcastCounts(
+        sample_counts, sample_totals, background_counts, background_totals)
+
+    # probabilities are not computed for an empty background
+    pover = numpy.where(M > 0, 1.0, 0.0)
+    punder = numpy.where(M > 0, 1.0, 0.0)
+
+    for select, row, pmf in _iterateHypergeometricTables(
+            N, n, M, max_table_size):
+        lower = numpy.cumsum(pmf, axis=1)
+        upper = numpy.cumsum(pmf[:, ::-1], axis=1)[:, ::-1]
+        col = numpy.minimum(k[select], pmf.shape[1] - 1)
+        pover[select] = upper[row, col]
+        punder[select] = lower[row, col]
+
+    # same conventions as hypergeometric_P and hypergeometric_Q
+    nonempty = M > 0
+    pover[nonempty] = numpy.clip(pover[nonempty], MIN_FLOAT, 1.0)
+    punder[nonempty] = numpy.clip(punder[nonempty], MIN_FLOAT, 1.0)
+    pover[(k == 0) & nonempty] = 1.0
+    punder[((k >= n) | (k >= N)) & nonempty] = 1.0
+
+    return pover.reshape(shape), punder.reshape(shape)
+
+
+def fisherExactTests(aa, bb, cc, dd, max_table_size=2 ** 20):
+    """compute two-sided P-values of Fisher's exact test for
+    2x2 tables ((aa, bb), (cc, dd)).
+
+    This is a vectorized version of :func:`scipy.stats.fisher_exact`.
+    Arguments are arrays (or scalars) that are broadcast against each
+    other. The P-value is the sum of the probabilities of all tables
+    that are not more likely than the observed table.
+
+    Returns an array of P-values.
+    """
+    shape, (aa, bb, cc, dd) = _broadcastCounts(aa, bb, cc, dd)
+
+    # first row total, first column total and table total
+    n, N, M = aa + bb, aa + cc, aa + bb + cc + dd
+    pvalues = numpy.ones(len(aa), dtype=numpy.float64)
+
+    # tables with an empty row or column have a P-value of 1
+    informative = (n > 0) & (N > 0) & (M - n > 0) & (M - N > 0)
+    M = numpy.where(informative, M, 0)
+
+    for select, row, pmf in _iterateHypergeometricTables(
+            N, n, M, max_table_size):
+        pmf = pmf[row]
+        observed = pmf[numpy.arange(len(select)), aa[select]]
+        # relative tolerance for ties as in fisher.test in R
+        threshold = observed[:, numpy.newaxis] * (1.0 + 1e-7)
+        pvalues[select] = numpy.where(pmf <= threshold, pmf, 0).sum(axis=1)
+
+    return numpy.minimum(pvalues, 1.0).reshape(shape)
+
+
 class Error(Exception):
 
     """Base class for exceptions in this module."""
@@ -308,6 +443,21 @@ class GOResult:
                                                                 self.mBackgroundCountsCategory,
                                                                 self.mSampleCountsTotal)
 
+        self.updateRatio()
+
+    def setProbabilities(self, pover, punder):
+        """set probabilities of over- and under-representation
+        computed elsewhere, for example by
+        :func:`hypergeometricProbabilities`."""
+        if self.mBackgroundCountsTotal == 0:
+            return
+
+        self.mProbabilityOverRepresentation = pover
+        self.mProbabilityUnderRepresentation = punder
+        self.updateRatio()
+
+    def updateRatio(self):
+        """update P-value and ratio from probabilities."""
         self.mPValue = min(
             self.mProbabilityOverRepresentation, self.mProbabilityUnderRepresentation)
 
@@ -500,6 +650,8 @@ def GetGOFrequencies(gene2go, genes):
     * the total number of GO categories found.
     * dictionary of counts per GO category
     * dictionary of genes found with GO categories
+
+    Genes listed more than once in *genes* are counted once.
     """
     counts = {}
     total = 0
@@ -507,7 +659,7 @@ def GetGOFrequencies(gene2go, genes):
 
     for gene_id in genes:
 
-        if gene_id not in gene2go:
+        if gene_id not in gene2go or gene_id in found_genes:
             continue
 
         found_genes[gene_id] = 1
@@ -578,7 +730,24 @@ def AnalyseGO(gene2go,
                  )
                 )
 
-        if do_probabilities:
+        result.mResults[go_id] = result_go
+
+    if do_probabilities and result.mResults:
+        go_ids = list(result.mResults.keys())
+        sample_category = numpy.array(
+            [sample_counts.get(x, 0) for x in go_ids])
+        background_category = numpy.array(
+            [background_counts[x] for x in go_ids])
+
+        # sanity checks, see GOResult.UpdateProbabilities
+        invalid = numpy.nonzero(
+            (background_category < sample_category) |
+            (len(background_genes) < background_category) |
+            (len(sample_genes) < sample_category))[0]
+
+        if len(invalid) > 0 and len(background_genes) > 0:
+            go_id = go_ids[invalid[0]]
+            result_go = result.mResults[go_id]
             try:
                 result_go.UpdateProbabilities()
             except AssertionError as msg:
@@ -595,7 +764,12 @@ def AnalyseGO(gene2go,
 
                 sys.exit(0)
 
-        result.mResults[go_id] = result_go
+        pover, punder = hypergeometricProbabilities(
+            sample_category, len(sample_genes),
+            background_category, len(background_genes))
+
+        for go_id, po, pu in zip(go_ids, pover, punder):
+            result.mResults[go_id].setProbabilities(float(po), float(pu))
 
     return result
 
@@ -1118,56 +1292,163 @@ def outputResults(outfile,
         outfile.write("\n")
 
 
+class GOSampler:
+
+    """count GO categories in random samples of genes.
+
+    The GO assignments of the background genes are compiled once into
+    a sparse gene x category incidence matrix. Counts for a batch of
+    samples are computed by multiplying a sparse sample x gene matrix
+    with the incidence matrix.
+
+    Counts are computed as in :func:`AnalyseGO`: categories are all
+    categories in the background and totals are the numbers of genes
+    with GO assignments.
+    """
+
+    def __init__(self, gene2go, background):
+
+        self.gene_index = {}
+        self.categories = []
+        category_index = {}
+        rows, cols = [], []
+
+        for gene_id in background:
+            if gene_id not in gene2go or gene_id in self.gene_index:
+                continue
+            row = len(self.gene_index)
+            self.gene_index[gene_id] = row
+            for go in gene2go[gene_id]:
+                if go.mGOId not in category_index:
+                    category_index[go.mGOId] = len(self.categories)
+                    self.categories.append(go.mGOId)
+                rows.append(row)
+                cols.append(category_index[go.mGOId])
+
+        # duplicate entries are summed
+        self.incidence = scipy.sparse.csr_matrix(
+            (numpy.ones(len(rows), dtype=numpy.int32), (rows, cols)),
+            shape=(len(self.gene_index), len(self.categories)))
+
+        self.background_counts = numpy.asarray(
+            self.incidence.sum(axis=0)).ravel()
+        self.background_total = len(self.gene_index)
+
+    def countSamples(self, samples):
+        """count categories in a list of samples.
+
+        Returns a samples x categories array of counts and an array
+        with the number of genes with GO assignments in each sample.
+        """
+        rows, cols = [], []
+        for x, genes in enumerate(samples):
+            found = set([self.gene_index[gene_id] for gene_id in genes
+                         if gene_id in self.gene_index])
+            rows.extend([x] * len(found))
+            cols.extend(found)
+
+        selection = scipy.sparse.csr_matrix(
+            (numpy.ones(len(rows), dtype=numpy.int32), (rows, cols)),
+            shape=(len(samples), len(self.gene_index)))
+
+        counts = (selection * self.incidence).toarray()
+        totals = numpy.bincount(numpy.array(rows, dtype=numpy.int64),
+                                minlength=len(samples))
+        return counts, totals
+
+    def analyseSamples(self, samples):
+        """count categories and compute probabilities of over- and
+        under-representation for a list of samples.
+
+        Returns samples x categories arrays of counts, probabilities of
+        over-representation and probabilities of under-representation.
+        """
+        counts, totals = self.countSamples(samples)
+        pover, punder = hypergeometricProbabilities(
+            counts, totals[:, numpy.newaxis],
+            self.background_counts, self.background_total)
+        return counts, pover, punder
+
+
+# state of a worker process in getSamples
+WORKER = {}
+
+
+def initSamplerWorker(sampler):
+    """initialize a worker process with a :class:`GOSampler`."""
+    WORKER["sampler"] = sampler
+
+
+def analyseSamplesWorker(samples):
+    """analyse a batch of samples in a worker process."""
+    return WORKER["sampler"].analyseSamples(samples)
+
+
 def getSamples(gene2go, foreground, background, options, test_ontology,
                go2info):
+    """sample gene sets of the size of *foreground* from *background*
+    and compute statistics of GO category counts in the samples.
+
+    Samples are evaluated in batches of ``options.sample_batch_size``
+    with a :class:`GOSampler`. If ``options.num_workers`` is larger
+    than 1, batches are evaluated in parallel.
+    """
 
     sample_size = options.sample
-    # List of all minimum probabilities in simulation
-    simulation_min_pvalues = []
+    batch_size = getattr(options, "sample_batch_size", 100)
+    num_workers = getattr(options, "num_workers", 1)
+
     E.info("sampling: calculating %i samples: " % (sample_size))
 
-    counts = {}
-    prob_overs = {}
-    prob_unders = {}
+    sampler = GOSampler(gene2go, background)
+    ncategories = len(sampler.categories)
 
-    samples = {}
+    def iterate_batches():
+        # samples are drawn in the main process to preserve the
+        # sequence of random numbers
+        for start in range(0, sample_size, batch_size):
+            yield [random.sample(background, len(foreground))
+                   for x in range(min(batch_size, sample_size - start))]
+
+    results = Parallel.imap(analyseSamplesWorker, iterate_batches(),
+                            num_workers=num_workers,
+                            initializer=initSamplerWorker,
+                            initargs=(sampler,))
+
+    counts = numpy.zeros((sample_size, ncategories), dtype=numpy.int32)
+    prob_overs = numpy.zeros((sample_size, ncategories), dtype=numpy.float64)
+    prob_unders = numpy.zeros((sample_size, ncategories),
+                              dtype=numpy.float64)
 
     options.stdlog.write("# ")
     options.stdlog.flush()
 
-    for x in range(sample_size):
+    start = 0
+    for batch_counts, batch_overs, batch_unders in results:
 
         if options.loglevel >= 1:
             options.stdlog.write(".")
             options.stdlog.flush()
 
-        # get shuffled array of genes from background
-        sample_genes = random.sample(background, len(foreground))
-
-        go_results = AnalyseGO(gene2go, sample_genes, background)
-
-        pairs = list(go_results.mResults.items())
-
-        for k, v in pairs:
-            if k not in counts:
-                counts[k] = []
-                prob_overs[k] = []
-                prob_unders[k] = []
-
-            counts[k].append(v.mSampleCountsCategory)
-            prob_overs[k].append(v.mProbabilityOverRepresentation)
-            prob_unders[k].append(v.mProbabilityUnderRepresentation)
-
-            simulation_min_pvalues.append(v.mPValue)
+        end = start + len(batch_counts)
+        counts[start:end] = batch_counts
+        prob_overs[start:end] = batch_overs
+        prob_unders[start:end] = batch_unders
+        start = end
 
     if options.loglevel >= 1:
         sys.stdout.write("\n")
         sys.stdout.flush()
 
+    # List of all minimum probabilities in simulation
+    simulation_min_pvalues = numpy.minimum(prob_overs, prob_unders).ravel()
+
     E.info("sampling: sorting %i P-Values" % len(simulation_min_pvalues))
 
     simulation_min_pvalues.sort()
-    simulation_min_pvalues = numpy.array(simulation_min_pvalues)
+
+    prob_overs.sort(axis=0)
+    prob_unders.sort(axis=0)
 
     samples = {}
 
@@ -1183,34 +1464,34 @@ def getSamples(gene2go, foreground, background, options, test_ontology,
                              "CI95lower", "CI95upper",
                              "pover", "punder", "goid",
                              "category", "description")) + "\n")
-    for k in sorted(list(counts.keys())):
 
-        c = counts[k]
+    column = dict([(y, x) for x, y in enumerate(sampler.categories)])
+    for k in sorted(sampler.categories):
 
-        prob_overs[k].sort()
-        prob_unders[k].sort()
+        x = column[k]
+        c = counts[:, x]
 
-        s = GOSample(min(c),
-                     max(c),
-                     scipy.mean(c),
+        s = GOSample(c.min(),
+                     c.max(),
+                     numpy.mean(c),
                      numpy.std(c),
-                     numpy.array(prob_overs[k]),
-                     numpy.array(prob_unders[k]),
-                     counts[k])
+                     prob_overs[:, x],
+                     prob_unders[:, x],
+                     list(c))
 
         samples[k] = s
 
         outfile.write("%s\t%i\t%i\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%s\n" %
                       (k,
-                       min(c),
-                       max(c),
-                       scipy.mean(c),
-                       scipy.median(c),
+                       c.min(),
+                       c.max(),
+                       numpy.mean(c),
+                       numpy.median(c),
                        numpy.std(c),
                        scipy.stats.scoreatpercentile(c, 5),
                        scipy.stats.scoreatpercentile(c, 95),
-                       min(prob_overs[k]),
-                       min(prob_unders[k]),
+                       prob_overs[0, x],
+                       prob_unders[0, x],
                        go2info[k]))
 
     if options.output_filename_pattern:
@@ -1307,15 +1588,11 @@ def computeFDRs(go_results,
 
             # calculate values for FDR:
             # nfdr = number of entries with P-Value better than node.
-            a = 0
-            while a < len(simulation_min_pvalues) and \
-                    simulation_min_pvalues[a] < pvalue:
-                a += 1
+            a = numpy.searchsorted(simulation_min_pvalues, pvalue,
+                                   side="left")
             a = float(a) / float(sample_size)
-            b = 0
-            while b < len(observed_min_pvalues) and \
-                    observed_min_pvalues[b] < pvalue:
-                b += 1
+            b = numpy.searchsorted(observed_min_pvalues, pvalue,
+                                   side="left")
 
             if b > 0:
                 fdr = min(1.0, float(a) / float(b))
@@ -1515,6 +1792,7 @@ def pairwiseGOEnrichment(results_per_genelist, labels, test_ontology, go2info,
             shared = x_go_categories.intersection(y_go_categories)
 
             c = E.Counter()
+            tested = []
 
             for category in shared:
                 c.shared += 1
@@ -1540,10 +1818,14 @@ def pairwiseGOEnrichment(results_per_genelist, labels, test_ontology, go2info,
                     continue
 
                 c.tested += 1
+                tested.append((category, xx, yy, aa, bb, cc, dd))
+
+            # compute all tests for this pair of gene lists at once
+            pvalues = fisherExactTests(*[[t[z] for t in tested]
+                                         for z in range(3, 7)])
 
-                fisher, pvalue = scipy.stats.fisher_exact(numpy.array(
-                    ((aa, bb),
-                     (cc, dd))))
+            for (category, xx, yy, aa, bb, cc, dd), pvalue in \
+                    zip(tested, pvalues):
 
                 if pvalue < 0.05:
                     c.significant_pvalue += 1
@@ -1561,7 +1843,7 @@ def pairwiseGOEnrichment(results_per_genelist, labels, test_ontology, go2info,
                                                  yy.mSampleCountsTotal,
                                                  yy.mPValue,
                                                  yy.mQValue,
-                                                 pvalue,
+                                                 float(pvalue),
                                                  1.0,
                                                  go2info[category].mDescription)))
 
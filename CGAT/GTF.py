@@ -35,7 +35,14 @@ Apart from basic iteration, this module provides the following utilities:
 
 """
 
+import re
 import collections
+import heapq
+import operator
+import os
+import pickle
+import shutil
+import tempfile
 from CGAT import Intervals as Intervals
 from CGAT import Genomics as Genomics
 from CGAT import IndexedGenome as IndexedGenome
@@ -280,7 +287,8 @@ def iterator_filtered(gff_iterator, feature=None,
         yield gff
 
 
-def iterator_sorted_chunks(gff_iterator, sort_by="contig-start"):
+def iterator_sorted_chunks(gff_iterator, sort_by="contig-start",
+                           max_memory=None, tmpdir=None):
     """iterate over chunks in a sorted order
 
     sort_by can be
@@ -292,34 +300,41 @@ def iterator_sorted_chunks(gff_iterator, sort_by="contig-start"):
     contig-strand-start-end
        intervals with the same start position will be sorted by end position
 
+    Chunks with the same sort key are returned in input order.
+
+    If *max_memory* is given, at most approximately *max_memory*
+    bytes of records are kept in memory, see :func:`iterator_sorted`.
+
     returns the chunks.
     """
 
-    # get all chunks and annotate with sort order
     if sort_by == "contig-start":
-        chunks = ([(x[0].contig, min([y.start for y in x]), x)
-                   for x in gff_iterator])
-        chunks.sort()
-        for contig, start, chunk in chunks:
-            chunk.sort(key=lambda x: (x.contig, x.start))
-            yield chunk
+        chunk_key = lambda x: (x[0].contig, min([y.start for y in x]))
+        entry_key = lambda x: (x.contig, x.start)
     elif sort_by == "contig-strand-start":
-        chunks = ([(x[0].contig, x[0].strand, min([y.start for y in x]), x)
-                   for x in gff_iterator])
-        chunks.sort()
-        for contig, start, strand, chunk in chunks:
-            chunk.sort(key=lambda x: (x.contig, x.strand, x.start))
-            yield chunk
+        chunk_key = lambda x: (x[0].contig, x[0].strand,
+                               min([y.start for y in x]))
+        entry_key = lambda x: (x.contig, x.strand, x.start)
     elif sort_by == "contig-strand-start-end":
-        chunks = ([(x[0].contig, x[0].strand, min([y.start for y in x]), x)
-                   for x in gff_iterator])
-        chunks.sort()
-        for contig, start, strand, chunk in chunks:
-            chunk.sort(key=lambda x: (x.contig, x.strand, x.start, x.end))
-            yield chunk
+        chunk_key = lambda x: (x[0].contig, x[0].strand,
+                               min([y.start for y in x]))
+        entry_key = lambda x: (x.contig, x.strand, x.start, x.end)
     else:
         raise ValueError("unknown sort order %s" % sort_by)
 
+    if max_memory is None:
+        chunks = sorted(gff_iterator, key=chunk_key)
+    else:
+        chunks = (_linesToEntries(lines.split("\n")) for key, lines in
+                  _iterator_sorted_external(
+                      ((chunk_key(x), "\n".join(map(str, x)))
+                       for x in gff_iterator),
+                      max_memory, tmpdir))
+
+    for chunk in chunks:
+        chunk.sort(key=entry_key)
+        yield chunk
+
 
 def iterator_min_feature_length(gff_iterator, min_length, feature="exon"):
     """select only those genes with a minimum length of a given feature."""
@@ -331,31 +346,159 @@ def iterator_min_feature_length(gff_iterator, min_length, feature="exon"):
             yield gffs
 
 
-def iterator_sorted(gff_iterator, sort_order="gene"):
-    '''sort input and yield sorted output.'''
-    entries = list(gff_iterator)
-    if sort_order == "gene":
-        entries.sort(key=lambda x: (x.gene_id, x.contig, x.start))
+# approximate memory used by a record in an external sort
+# in addition to its text
+_SORT_RECORD_OVERHEAD = 200
+
+# maximum number of sorted runs merged at once
+_SORT_MAX_RUNS = 64
+
+# number of records pickled together in a sorted run
+_SORT_BATCH_SIZE = 1024
+
+
+def _writeRun(records, workdir):
+    """write sorted *records* to a temporary file in *workdir*.
+
+    Returns the filename.
+    """
+    handle, filename = tempfile.mkstemp(dir=workdir, suffix=".run")
+    with os.fdopen(handle, "wb") as outf:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= _SORT_BATCH_SIZE:
+                pickle.dump(batch, outf, protocol=pickle.HIGHEST_PROTOCOL)
+                batch = []
+        if batch:
+            pickle.dump(batch, outf, protocol=pickle.HIGHEST_PROTOCOL)
+    return filename
+
+
+def _readRun(filename):
+    """iterate over records in a file created by :func:`_writeRun`."""
+    with open(filename, "rb") as inf:
+        while True:
+            try:
+                records = pickle.load(inf)
+            except EOFError:
+                break
+            for record in records:
+                yield record
+
+
+def _iterator_sorted_external(records, max_memory, tmpdir=None):
+    """sort (key, text) tuples in bounded memory.
+
+    Records are collected until their text exceeds approximately
+    *max_memory* bytes, sorted and written to a temporary file.
+    The sorted runs are then merged, at most :data:`_SORT_MAX_RUNS`
+    at a time. The sort is stable.
+    """
+
+    key = operator.itemgetter(0)
+    workdir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        runs, buffer, size = [], [], 0
+        for record in records:
+            buffer.append(record)
+            size += len(record[1]) + _SORT_RECORD_OVERHEAD
+            if size >= max_memory:
+                buffer.sort(key=key)
+                runs.append(_writeRun(buffer, workdir))
+                buffer, size = [], 0
+        buffer.sort(key=key)
+
+        # merge runs in groups to limit the number of open files
+        while len(runs) >= _SORT_MAX_RUNS:
+            merged = []
+            for x in range(0, len(runs), _SORT_MAX_RUNS):
+                group = runs[x:x + _SORT_MAX_RUNS]
+                merged.append(_writeRun(
+                    heapq.merge(*[_readRun(y) for y in group], key=key),
+                    workdir))
+                for filename in group:
+                    os.unlink(filename)
+            runs = merged
+
+        for record in heapq.merge(*([_readRun(x) for x in runs] +
+                                    [buffer]),
+                                  key=key):
+            yield record
+    finally:
+        shutil.rmtree(workdir)
+
+
+def _lineToEntry(line):
+    """convert a line in :term:`gtf` format to an :class:`Entry`."""
+    entry = Entry()
+    entry.read(line + "\n")
+    return entry
+
+
+def _linesToEntries(lines):
+    """convert lines in :term:`gtf` format to :class:`Entry`
+    objects."""
+    return [_lineToEntry(x) for x in lines]
+
+
+def iterator_sorted(gff_iterator, sort_order="gene",
+                    max_memory=None, tmpdir=None):
+    '''sort input and yield sorted output.
+
+    The sort is stable.
+
+    If *max_memory* is given, at most approximately *max_memory*
+    bytes of records are kept in memory. Sorted runs of records are
+    written to temporary files in *tmpdir* and merged. Records
+    are then returned as :class:`Entry` objects.
+    '''
+
+    if sort_order in ("gene", "gene+position"):
+        key = lambda x: (x.gene_id, x.contig, x.start)
     elif sort_order == "gene+transcript":
-        entries.sort(
-            key=lambda x: (x.gene_id, x.transcript_id, x.contig, x.start))
+        key = lambda x: (x.gene_id, x.transcript_id, x.contig, x.start)
     elif sort_order == "contig+gene":
-        entries.sort(
-            key=lambda x: (x.contig, x.gene_id, x.transcript_id, x.start))
+        key = lambda x: (x.contig, x.gene_id, x.transcript_id, x.start)
     elif sort_order == "transcript":
-        entries.sort(key=lambda x: (x.transcript_id, x.contig, x.start))
+        key = lambda x: (x.transcript_id, x.contig, x.start)
     elif sort_order == "position":
-        entries.sort(key=lambda x: (x.contig, x.start))
+        key = lambda x: (x.contig, x.start)
     elif sort_order == "position+gene":
-        entries.sort(key=lambda x: (x.gene_id, x.start))
-        genes = list(flat_gene_iterator(entries))
-        genes.sort(key=lambda x: (x[0].contig, x[0].start))
-        entries = IOTools.flatten(genes)
+        key = lambda x: (x.gene_id, x.start)
     elif sort_order == "gene+exon":
-        entries.sort(key=lambda x: (x.gene_id, x.exon_number))
-
-    for entry in entries:
-        yield entry
+        key = lambda x: (x.gene_id, x.exon_number)
+    else:
+        raise ValueError("unknown sort order %s" % sort_order)
+
+    if max_memory is None:
+        entries = sorted(gff_iterator, key=key)
+        if sort_order == "position+gene":
+            genes = list(flat_gene_iterator(entries))
+            genes.sort(key=lambda x: (x[0].contig, x[0].start))
+            entries = IOTools.flatten(genes)
+        for entry in entries:
+            yield entry
+        return
+
+    entries = _iterator_sorted_external(
+        ((key(x), str(x)) for x in gff_iterator), max_memory, tmpdir)
+
+    if sort_order == "position+gene":
+        # sort genes by the position of their first entry, genes
+        # with the same position remain sorted by gene_id
+        def _iterate_genes(entries):
+            for gene in flat_gene_iterator(
+                    _lineToEntry(line) for key, line in entries):
+                for entry in gene:
+                    yield ((gene[0].contig, gene[0].start, entry.gene_id),
+                           str(entry))
+
+        entries = _iterator_sorted_external(
+            _iterate_genes(entries), max_memory, tmpdir)
+
+    for key, line in entries:
+        yield _lineToEntry(line)
 
 
 def iterator_overlapping_genes(gtf_iterator, min_overlap=0):
@@ -755,6 +898,48 @@ def quote(v):
         return str(v)
 
 
+def toValue(v):
+    """convert an unquoted attribute value to a number if possible."""
+    try:
+        v = float(v)
+        v = int(v)
+    except ValueError:
+        pass
+    except TypeError:
+        pass
+    return v
+
+
+# an attribute field consisting only of fields of the form
+# 'key "value"' or 'key value' terminated by a semicolon and
+# separated by a single space. Values do not contain white space.
+_rx_attribute_field = re.compile(
+    r'(?:[^\s";]+ (?:"[^"\s]*"|[^\s";]+); )*'
+    r'[^\s";]+ (?:"[^"\s]*"|[^\s";]+);\s*$')
+# identifiers are searched for in "; " + attributes
+_rx_gene_id = re.compile(r'; gene_id (?:"([^"\s]*)"|([^\s";]+));')
+_rx_transcript_id = re.compile(
+    r'; transcript_id (?:"([^"\s]*)"|([^\s";]+));')
+
+
+def decodeAttributes(attributes):
+    """decode a GTF attribute field into a dictionary.
+
+    The field has to be matched by :data:`_rx_attribute_field`.
+    The gene_id and transcript_id attributes are not included.
+    """
+    result = {}
+    for field in attributes[:attributes.rfind(";")].split("; "):
+        key, value = field.split(" ", 1)
+        if value[0] == '"':
+            result[key] = value[1:-1]
+        else:
+            result[key] = toValue(value)
+    del result["gene_id"]
+    del result["transcript_id"]
+    return result
+
+
 class Entry:
     """representation of a :term:`GTF` formatted entry.
 
@@ -783,9 +968,15 @@ class Entry:
        Transcript identifier of feature. Not present for :term:`GFF` formatted
        data.
     attributes : dict
-       Dictionary of additional attributes in the GFF/GTF record (last column)
+       Dictionary of additional attributes in the GFF/GTF record (last
+       column). When read from a line, attributes are decoded on first
+       access.
     """
 
+    __slots__ = ("contig", "source", "feature", "frame", "start", "end",
+                 "score", "strand", "gene_id", "transcript_id",
+                 "_attributes", "_attribute_field", "__dict__")
+
     def __init__(self):
         self.contig = "."
         self.source = "."
@@ -797,7 +988,21 @@ class Entry:
         self.strand = "."
         self.gene_id = None
         self.transcript_id = None
-        self.attributes = collections.OrderedDict()
+        self._attributes = collections.OrderedDict()
+        self._attribute_field = None
+
+    def _get_attributes(self):
+        # attributes are decoded on first access
+        if self._attribute_field is not None:
+            self._attributes = decodeAttributes(self._attribute_field)
+            self._attribute_field = None
+        return self._attributes
+
+    def _set_attributes(self, attributes):
+        self._attributes = attributes
+        self._attribute_field = None
+
+    attributes = property(_get_attributes, _set_attributes)
 
     def read(self, line):
         """read gff entry from line in GTF/GFF format.
@@ -824,6 +1029,42 @@ class Entry:
     def parseInfo(self, attributes, line):
         """parse attributes.
 
+        This method will set the gene_id and transcript_id attributes
+        if present. Attribute fields of the common form
+        ``key "value"; key value;`` are only checked for gene_id and
+        transcript_id and the remaining attributes are decoded on first
+        access. Other fields are parsed by :meth:`parseInfoGeneric`.
+        """
+        if _rx_attribute_field.match(attributes) is None:
+            self.parseInfoGeneric(attributes, line)
+            return
+
+        fields = "; " + attributes
+        gene_id = _rx_gene_id.findall(fields)
+        if not gene_id:
+            raise ParsingError("missing attribute 'gene_id' in line %s" % line)
+        transcript_id = _rx_transcript_id.findall(fields)
+        if not transcript_id:
+            raise ParsingError(
+                "missing attribute 'transcript_id' in line %s" % line)
+
+        quoted, value = gene_id[-1]
+        self.gene_id = quoted or toValue(value)
+        quoted, value = transcript_id[-1]
+        self.transcript_id = quoted or toValue(value)
+
+        # mimic parseInfoGeneric which does not accept empty identifiers
+        if not self.gene_id:
+            raise ParsingError("missing attribute 'gene_id' in line %s" % line)
+        if not self.transcript_id:
+            raise ParsingError(
+                "missing attribute 'transcript_id' in line %s" % line)
+
+        self._attribute_field = attributes
+
+    def parseInfoGeneric(self, attributes, line):
+        """parse attributes field of any form.
+
         This method will set the gene_id and transcript_id attributes
         if present.
         """
@@ -852,14 +1093,7 @@ class Entry:
             if v[0] == '"' and v[-1] == '"':
                 v = v[1:-1]
             else:
-                # try to convert to a value
-                try:
-                    v = float(v)
-                    v = int(v)
-                except ValueError:
-                    pass
-                except TypeError:
-                    pass
+                v = toValue(v)
 
             if n == "gene_id":
                 self.gene_id = v
@@ -0,0 +1,314 @@
+'''GTFCache.py - Binary, memory-mapped cache of GTF formatted gene sets
+=====================================================================
+
+Parsing a large :term:`gtf` formatted gene set is slow. This module
+compiles a gene set into a columnar binary file that can be loaded
+quickly by memory-mapping it.
+
+The cache stores the following columns:
+
+* contig, source, feature, score, strand and frame as indices into
+  small string tables,
+* start and end coordinates as 64-bit integers (0-based, half-open),
+* gene_id and transcript_id as indices into tables of unique
+  identifiers,
+* the raw attribute field of each record, which is only decoded
+  when it is accessed,
+* an index of records per gene so that all records of a gene can be
+  retrieved without scanning the file.
+
+The basic usage is::
+
+   import CGAT.GTF as GTF
+   import CGAT.GTFCache as GTFCache
+
+   with IOTools.openFile("geneset.gtf.gz") as inf:
+       GTFCache.build_cache(inf, "geneset.gtfc")
+
+   cache = GTFCache.GTFCache("geneset.gtfc")
+   for gene in GTF.flat_gene_iterator(cache.iterator()):
+       ...
+
+The iterators return :class:`GTF.Entry` objects. Numeric columns are
+available as read-only :mod:`numpy` arrays, for example
+``cache.start`` or ``cache.contig``.
+
+Note that gene and transcript identifiers are always returned as
+strings.
+
+A cache can be built from the command line with
+``gtf2gtf --method=compile --output-filename-cache=geneset.gtfc``.
+
+'''
+
+import json
+import mmap
+import struct
+
+import numpy
+
+from CGAT import GTF as GTF
+
+MAGIC = b"CGATGTFC"
+VERSION = 1
+
+# header: magic, version, length of json table of contents
+_header = struct.Struct("<8sII")
+
+# per-record columns and their types
+_columns = (("contig", numpy.uint32),
+            ("source", numpy.uint32),
+            ("feature", numpy.uint32),
+            ("score", numpy.uint32),
+            ("strand", numpy.uint32),
+            ("frame", numpy.uint32),
+            ("start", numpy.int64),
+            ("end", numpy.int64),
+            ("gene", numpy.uint32),
+            ("transcript", numpy.uint32),
+            ("generic", numpy.uint8))
+
+# columns that are stored as indices into a string table
+_tables = ("contig", "source", "feature", "score", "strand", "frame",
+           "gene", "transcript")
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class FormatError(Error):
+    """raised if a file is not a valid cache."""
+    pass
+
+
+def _encodeStrings(strings):
+    '''encode a list of strings into a blob and an array of offsets.'''
+    encoded = [x.encode("utf-8") for x in strings]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(x) for x in encoded], out=offsets[1:])
+    return numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8), offsets
+
+
+def _decodeStrings(blob, offsets):
+    '''decode all strings in a blob.'''
+    offsets = offsets.tolist()
+    data = bytes(blob).decode("utf-8")
+    if len(data) == len(blob):
+        # ascii only, offsets apply directly
+        return [data[offsets[x]:offsets[x + 1]]
+                for x in range(len(offsets) - 1)]
+    data = bytes(blob)
+    return [data[offsets[x]:offsets[x + 1]].decode("utf-8")
+            for x in range(len(offsets) - 1)]
+
+
+def build_cache(infile, filename):
+    '''compile a :term:`gtf` formatted file into a cache.
+
+    Records are parsed with :class:`GTF.Entry`. Comments, empty lines
+    and track lines are skipped.
+
+    Arguments
+    ---------
+    infile : file
+       Input file with :term:`gtf` formatted records.
+    filename : string
+       Output filename.
+
+    Returns
+    -------
+    nrecords : int
+       Number of records written.
+    '''
+
+    tables = dict([(x, {}) for x in _tables])
+    columns = dict([(x, []) for x, t in _columns])
+    attributes = []
+
+    for line in infile:
+        if line[0] == "#" or line.startswith("track") or not line.strip():
+            continue
+        entry = GTF.Entry()
+        entry.read(line)
+        for key, value in (("contig", entry.contig),
+                           ("source", entry.source),
+                           ("feature", entry.feature),
+                           ("score", GTF.toDot(entry.score)),
+                           ("strand", entry.strand),
+                           ("frame", GTF.toDot(entry.frame)),
+                           ("gene", str(entry.gene_id)),
+                           ("transcript", str(entry.transcript_id))):
+            table = tables[key]
+            try:
+                columns[key].append(table[value])
+            except KeyError:
+                table[value] = len(table)
+                columns[key].append(table[value])
+        columns["start"].append(entry.start)
+        columns["end"].append(entry.end)
+        # fields not decoded lazily by GTF.Entry need the generic parser
+        columns["generic"].append(entry._attribute_field is None)
+        attributes.append(line[:-1].split("\t")[8])
+
+    arrays = [(x, numpy.array(columns[x], dtype=t)) for x, t in _columns]
+    nrecords = len(attributes)
+
+    # records grouped by gene, in file order within each gene
+    gene = arrays[[x for x, t in _columns].index("gene")][1]
+    arrays.append(("gene_order",
+                   numpy.argsort(gene, kind="stable").astype(numpy.int64)))
+    gene_offsets = numpy.zeros(len(tables["gene"]) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(gene, minlength=len(tables["gene"])),
+                 out=gene_offsets[1:])
+    arrays.append(("gene_offsets", gene_offsets))
+
+    arrays.extend(zip(("attributes_blob", "attributes_offsets"),
+                      _encodeStrings(attributes)))
+    for key in _tables:
+        table = sorted(tables[key], key=tables[key].get)
+        arrays.extend(zip(("table_%s_blob" % key, "table_%s_offsets" % key),
+                          _encodeStrings(table)))
+
+    # lay out arrays at 8-byte aligned offsets after the header
+    toc, offset = {}, 0
+    for name, array in arrays:
+        toc[name] = (array.dtype.str, len(array), offset)
+        offset += (array.nbytes + 7) // 8 * 8
+
+    toc = json.dumps({"nrecords": nrecords, "arrays": toc}).encode("ascii")
+    toc += b" " * (-(_header.size + len(toc)) % 8)
+
+    with open(filename, "wb") as outf:
+        outf.write(_header.pack(MAGIC, VERSION, len(toc)))
+        outf.write(toc)
+        for name, array in arrays:
+            outf.write(array.tobytes())
+            outf.write(b"\0" * (-array.nbytes % 8))
+
+    return nrecords
+
+
+class GTFCache(object):
+    '''a gene set compiled with :func:`build_cache`.
+
+    The file is memory-mapped. String tables are decoded when the
+    cache is opened, attribute fields are decoded when they are
+    accessed.
+
+    Arguments
+    ---------
+    filename : string
+       Filename of the cache.
+    '''
+
+    def __init__(self, filename):
+
+        with open(filename, "rb") as inf:
+            self._mmap = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < _header.size:
+            raise FormatError("%s is not a gtf cache" % filename)
+        magic, version, ltoc = _header.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise FormatError("%s is not a gtf cache" % filename)
+        if version != VERSION:
+            raise FormatError(
+                "%s: expected cache version %i, got %i" %
+                (filename, VERSION, version))
+
+        toc = json.loads(
+            self._mmap[_header.size:_header.size + ltoc].decode("ascii"))
+        start = _header.size + ltoc
+        self.nrecords = toc["nrecords"]
+
+        arrays = {}
+        for name, (dtype, size, offset) in toc["arrays"].items():
+            arrays[name] = numpy.frombuffer(self._mmap,
+                                            dtype=numpy.dtype(dtype),
+                                            count=size,
+                                            offset=start + offset)
+
+        for name, t in _columns:
+            setattr(self, name, arrays[name])
+
+        self.gene_order = arrays["gene_order"]
+        self.gene_offsets = arrays["gene_offsets"]
+        self._attributes_blob = arrays["attributes_blob"]
+        self._attributes_offsets = arrays["attributes_offsets"]
+
+        for key in _tables:
+            setattr(self, "%ss" % key,
+                    _decodeStrings(arrays["table_%s_blob" % key],
+                                   arrays["table_%s_offsets" % key]))
+
+        self._map_gene2index = dict(
+            [(y, x) for x, y in enumerate(self.genes)])
+
+    def __len__(self):
+        return self.nrecords
+
+    def getAttributeField(self, index):
+        '''return the attribute field of record *index*.'''
+        return bytes(self._attributes_blob[
+            self._attributes_offsets[index]:
+            self._attributes_offsets[index + 1]]).decode("utf-8")
+
+    def getEntry(self, index):
+        '''return record *index* as a :class:`GTF.Entry`.'''
+        entry = GTF.Entry()
+        entry.contig = self.contigs[self.contig[index]]
+        entry.source = self.sources[self.source[index]]
+        entry.feature = self.features[self.feature[index]]
+        entry.score = self.scores[self.score[index]]
+        entry.strand = self.strands[self.strand[index]]
+        entry.frame = self.frames[self.frame[index]]
+        entry.start = int(self.start[index])
+        entry.end = int(self.end[index])
+        field = self.getAttributeField(index)
+        if self.generic[index]:
+            entry.parseInfoGeneric(field, field)
+        else:
+            entry._attribute_field = field
+        entry.gene_id = self.genes[self.gene[index]]
+        entry.transcript_id = self.transcripts[self.transcript[index]]
+        return entry
+
+    def iterator(self):
+        '''iterate over all records in the original order.'''
+        for index in range(self.nrecords):
+            yield self.getEntry(index)
+
+    def getGeneIndices(self, gene_id):
+        '''return indices of records for *gene_id*.
+
+        Raises a KeyError if the gene is not present.
+        '''
+        gene = self._map_gene2index[gene_id]
+        return self.gene_order[
+            self.gene_offsets[gene]:self.gene_offsets[gene + 1]]
+
+    def getGene(self, gene_id):
+        '''return all records of *gene_id* as a list of
+        :class:`GTF.Entry` objects in the original order.'''
+        return [self.getEntry(x) for x in self.getGeneIndices(gene_id)]
+
+    def close(self):
+        '''release the memory map.
+
+        Arrays obtained from the cache can not be used afterwards.
+        '''
+        for name, t in _columns:
+            setattr(self, name, None)
+        self.gene_order = self.gene_offsets = None
+        self._attributes_blob = self._attributes_offsets = None
+        self._mmap.close()
+
+
+def iterator(filename):
+    '''iterate over records in a cache returning :class:`GTF.Entry`
+    objects.'''
+    cache = GTFCache(filename)
+    for entry in cache.iterator():
+        yield entry
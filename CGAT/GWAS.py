@@ -3076,74 +3076,183 @@ def plotPCA(data, nPCs, point_labels, save_path,
     R('''dev.off()''')
 
 
+# genotype codes returned by iteratePedGenotypes
+PED_MISSING = 0
+PED_HOM_A1 = 1
+PED_HET = 2
+PED_HOM_A2 = 3
+
+
+def readMapVariants(map_file):
+    '''
+    Return the variant IDs of a plink text format .map file
+    in the order of the file.
+    '''
+
+    with open(map_file, "r") as mfile:
+        return [snp.split("\t")[1] for snp in mfile]
+
+
+def encodePedGenotypes(genos):
+    '''
+    Encode plink genotype strings into a :class:`numpy.uint8` array.
+
+    Genotypes are PED_MISSING for '00', PED_HOM_A1 for '11',
+    PED_HET for '12' and PED_HOM_A2 for any other genotype. Alleles
+    separated by a whitespace ('1 2') are accepted.
+
+    Arguments
+    ---------
+    genos: list
+      genotype strings of an individual
+
+    Returns
+    -------
+    codes: np.ndarray
+      encoded genotypes
+    '''
+
+    if not genos:
+        return np.zeros(0, dtype=np.uint8)
+
+    line = "\t".join(genos).replace(" ", "") + "\t"
+    if len(line) == 3 * len(genos):
+        # all genotypes are two characters - decode from the buffer
+        chars = np.frombuffer(line.encode("latin-1"),
+                              dtype=np.uint8).reshape(-1, 3)
+        first, second = chars[:, 0], chars[:, 1]
+        codes = np.full(len(genos), PED_HOM_A2, dtype=np.uint8)
+        # missing genotypes are coded '00' in plink format
+        codes[(first == ord("0")) & (second == ord("0"))] = PED_MISSING
+        codes[(first == ord("1")) & (second == ord("1"))] = PED_HOM_A1
+        codes[(first == ord("1")) & (second == ord("2"))] = PED_HET
+        return codes
+
+    genos = np.array(line[:-1].split("\t"))
+    codes = np.full(len(genos), PED_HOM_A2, dtype=np.uint8)
+    codes[genos == "00"] = PED_MISSING
+    codes[genos == "11"] = PED_HOM_A1
+    codes[genos == "12"] = PED_HET
+    return codes
+
+
+def iteratePedGenotypes(ped_file, variant_index=None):
+    '''
+    Iterate over the individuals in a plink text format .ped file.
+
+    Genotypes of an individual are encoded into a :class:`numpy.uint8`
+    array with one element per SNP: PED_MISSING for missing
+    genotypes ('00'), PED_HOM_A1 for '11', PED_HET for '12' and
+    PED_HOM_A2 for any other genotype. Only a single individual is
+    held in memory at a time.
+
+    Arguments
+    ---------
+    ped_file: string
+      plink text format .ped file - see Plink documentation
+      for details (https://www.cog-genomics.org/plink2/input#ped)
+
+    variant_index: list
+      if given, only return genotypes of SNPs at these positions
+
+    Returns
+    -------
+    genotypes: generator
+      tuples of the first six columns (FID, IID, PID, MID, gender,
+      phenotype) and the encoded genotypes of each individual
+    '''
+
+    with open(ped_file, "r") as pfile:
+        for indiv in pfile:
+            indiv_split = indiv.rstrip("\n").split("\t")
+            codes = encodePedGenotypes(indiv_split[6:])
+            if variant_index is not None:
+                codes = codes[variant_index]
+            yield indiv_split[:6], codes
+
+
+def countPedGenotypes(ped_file, groups=None):
+    '''
+    Count genotypes per SNP in a plink text format .ped file.
+
+    Individuals are streamed from the file and counts are
+    accumulated per SNP, thus memory usage is linear in the
+    number of SNPs.
+
+    Arguments
+    ---------
+    ped_file: string
+      plink text format .ped file
+
+    groups: dict
+      map of IID to group label. Genotypes are counted separately
+      for each group, individuals not in `groups` are skipped. If
+      not given, all individuals are counted in a single group
+      with the label None.
+
+    Returns
+    -------
+    counts: dict
+      map of group label to an array of shape (4, number of SNPs)
+      with the number of individuals for each genotype code
+
+    nindividuals: dict
+      map of group label to the number of individuals counted
+    '''
+
+    counts = {}
+    nindividuals = collections.defaultdict(int)
+
+    for fields, genos in iteratePedGenotypes(ped_file):
+        if groups is None:
+            group = None
+        elif fields[1] in groups:
+            group = groups[fields[1]]
+        else:
+            continue
+
+        if group not in counts:
+            counts[group] = np.zeros((4, len(genos)), dtype=np.int64)
+
+        group_counts = counts[group]
+        for code in (PED_HOM_A1, PED_HET, PED_HOM_A2):
+            group_counts[code] += genos == code
+        nindividuals[group] += 1
+
+    return counts, nindividuals
+
+
+def _calcMafs(counts, nindividuals):
+    '''minor allele frequencies from genotype counts.'''
+    allele_counts = ((2 * counts[PED_HOM_A2]) + counts[PED_HET]) / \
+        float(2 * nindividuals)
+    return 1 - allele_counts
+
+
 def countByVariantAllele(ped_file, map_file):
     '''
     Count the number of individuals carrying the variant allele
     for each SNP.
-    Count the number of occurences of each allele with the variant
-    allele of each other SNP.
 
     Requires ped file genotyping to be in format A1(minor)=1, A2=2
     '''
 
     # parse the ped file - get the variant column headers from
     # the map file - no headers with these files
-    # variant order in the map file matters, use an ordered dict
-    variants = collections.OrderedDict()
-    with open(map_file, "r") as mfile:
-        for snp in mfile.readlines():
-            attrs = snp.split("\t")
-            snpid = attrs[1]
-            variants[snpid] = {"chr": attrs[0],
-                               "pos": attrs[-1].strip("\n")}
-
-    variant_ids = variants.keys()
-    # store genotype matrix as an array
-    # rows and columns are variant IDs
-    homA1 = np.zeros((len(variant_ids), len(variant_ids)),
-                     dtype=np.int64)
+    # variant order in the map file matters
+    variant_ids = readMapVariants(map_file)
 
-    homA2 = np.zeros((len(variant_ids), len(variant_ids)),
-                     dtype=np.int64)
+    counts, nindividuals = countPedGenotypes(ped_file)
+    counts, tcount = counts[None], nindividuals[None]
 
-    het = np.zeros((len(variant_ids), len(variant_ids)),
-                   dtype=np.int64)
-
-    tcount = 0
-    with open(ped_file, "r") as pfile:
-        for indiv in pfile.readlines():
-            indiv = indiv.strip("\n")
-            indiv_split = indiv.split("\t")
-            fid = indiv_split[0]
-            iid = indiv_split[1]
-            mid = indiv_split[2]
-            pid = indiv_split[3]
-            gender = indiv_split[4]
-            phen = indiv_split[5]
-            genos = indiv_split[6:]
-            tcount += 1
-            # get genotype counts
-            for i in range(len(genos)):
-                # missing genotypes are coded '00' in plink format
-                if genos[i] == "00":
-                    pass
-                elif genos[i] == "11":
-                    homA1[i, i] += 1
-                elif genos[i] == "12":
-                    het[i, i] += 1
-                else:
-                    homA2[i, i] += 1
-    allele_counts = ((2 * homA2) + het)/float(2 * tcount)
-    mafs = 1 - allele_counts.diagonal()
-    maf_df = pd.DataFrame(zip(variant_ids, mafs), columns=["SNP", "MAF"],
-                          index=[x for x, y in enumerate(variant_ids)])
-    maf_df["A2_HOMS"] = (2 * homA1).diagonal()
-    maf_df["A2_HETS"] = het.diagonal()
-    maf_df.index = maf_df["SNP"]
-    maf_df.drop(["SNP"], axis=1, inplace=True)
+    maf_df = pd.DataFrame({"MAF": _calcMafs(counts, tcount),
+                           "A2_HOMS": 2 * counts[PED_HOM_A1],
+                           "A2_HETS": counts[PED_HET]},
+                          index=pd.Index(variant_ids, name="SNP"),
+                          columns=["MAF", "A2_HOMS", "A2_HETS"])
 
     E.info("allele frequencies calculated over %i SNPs and "
-           "%i individuals" % (len(genos), tcount))
+           "%i individuals" % (len(variant_ids), tcount))
 
     return maf_df
 
@@ -3214,120 +3323,39 @@ def calcMaxAlleleFreqDiff(ped_file, map_file, group_file,
 
     # parse the ped file - get the variant column headers from
     # the map file - no headers with these files
-    # variant order in the map file matters, use an ordered dict
-    variants = collections.OrderedDict()
-    with open(map_file, "r") as mfile:
-        for snp in mfile.readlines():
-            attrs = snp.split("\t")
-            snpid = attrs[1]
-            variants[snpid] = {"chr": attrs[0],
-                               "pos": attrs[-1].strip("\n")}
-
-    variant_ids = variants.keys()
-    # store genotype matrix as an array
-    # rows and columns are variant IDs
-    ref_homA1 = np.zeros((len(variant_ids), len(variant_ids)),
-                         dtype=np.int64)
-
-    ref_homA2 = np.zeros((len(variant_ids), len(variant_ids)),
-                         dtype=np.int64)
-
-    ref_het = np.zeros((len(variant_ids), len(variant_ids)),
-                       dtype=np.int64)
-
-    test_homA1 = np.zeros((len(variant_ids), len(variant_ids)),
-                          dtype=np.int64)
-
-    test_homA2 = np.zeros((len(variant_ids), len(variant_ids)),
-                          dtype=np.int64)
-
-    test_het = np.zeros((len(variant_ids), len(variant_ids)),
-                        dtype=np.int64)
-    tcount = 0
-    rcount = 0
-    ncount = 0
-    ref_ids = group_df["IID"][group_df["GROUP"] == ref].values
-    test_ids = group_df["IID"][group_df["GROUP"] == test].values
-    total = len(group_df)
-
-    with open(ped_file, "r") as pfile:
-        for indiv in pfile.readlines():
-            indiv = indiv.strip("\n")
-            indiv_split = indiv.split("\t")
-            fid = indiv_split[0]
-            iid = indiv_split[1]
-            mid = indiv_split[2]
-            pid = indiv_split[3]
-            gender = indiv_split[4]
-            phen = indiv_split[5]
-            genos = indiv_split[6:]
-
-            # check for ref and test conditions
-            # ignore individuals in neither camp
-            if iid in test_ids:
-                tcount += 1
-                # get genotype counts
-                for i in range(len(genos)):
-                    # missing genotypes are coded '00' in plink format
-                    if genos[i] == "00":
-                        pass
-                    elif genos[i] == "11":
-                        test_homA1[i, i] += 1
-                    elif genos[i] == "12":
-                        test_het[i, i] += 1
-                    else:
-                        test_homA2[i, i] += 1
-
-            elif iid in ref_ids:
-                rcount += 1
-                # get genotype counts
-                for i in range(len(genos)):
-                    # missing genotypes are coded '00' in plink format
-                    if genos[i] == "00":
-                        pass
-                    elif genos[i] == "11":
-                        ref_homA1[i, i] += 1
-                    elif genos[i] == "12":
-                        ref_het[i, i] += 1
-                    else:
-                        ref_homA2[i, i] += 1
-            else:
-                ncount += 1
-                if round((tcount + rcount + ncount)/total, 2) == 0.25:
-                    E.info("%i samples counted."
-                           "Approximately 25% samples counted" % tcount + rcount + ncount)
-                elif round((tcount + rcount + ncount)/total, 2) == 0.50:
-                    E.info("%i samples counted."
-                           "Approximately 50% samples counted" % tcount + rcount + ncount)
-                elif round((tcount + rcount + ncount)/total, 2) == 0.75:
-                    E.info("%i samples counted."
-                           "Approximately 75% samples counted" % tcount + rcount + ncount)
-
-    E.info("Counted alleles for %i test cases, %i ref cases,"
-           " %i neither reference nor test." % (tcount, rcount,
-                                                ncount))
-
-    ref_allele_counts = ((2 * ref_homA2) + ref_het)/float(2 * rcount)
-    test_allele_counts = ((2 * test_homA2) + test_het)/float(2 * tcount)
-
-    ref_mafs = 1 - ref_allele_counts.diagonal()
-    test_mafs = 1 - ref_allele_counts.diagonal()
-
-    ref_maf_df = pd.DataFrame(zip(variant_ids, ref_mafs),
-                              columns=["SNP", "ref_MAF"],
-                              index=[x for x, y in enumerate(variant_ids)])
-    ref_maf_df["ref_A2_HOMS"] = (2 * ref_homA1).diagonal()
-    ref_maf_df["ref_A2_HETS"] = ref_het.diagonal()
-    ref_maf_df.index = ref_maf_df["SNP"]
-    ref_maf_df.drop(["SNP"], axis=1, inplace=True)
-
-    test_maf_df = pd.DataFrame(zip(variant_ids, test_mafs),
-                               columns=["SNP", "test_MAF"],
-                               index=[x for x, y in enumerate(variant_ids)])
-    test_maf_df["test_A2_HOMS"] = (2 * test_homA1).diagonal()
-    test_maf_df["test_A2_HETS"] = test_het.diagonal()
-    test_maf_df.index = test_maf_df["SNP"]
-    test_maf_df.drop(["SNP"], axis=1, inplace=True)
+    # variant order in the map file matters
+    variant_ids = readMapVariants(map_file)
+
+    # check for ref and test conditions
+    # ignore individuals in neither camp
+    groups = dict([(iid, "ref") for iid in
+                   group_df["IID"][group_df["GROUP"] == ref].values])
+    groups.update([(iid, "test") for iid in
+                   group_df["IID"][group_df["GROUP"] == test].values])
+
+    counts, nindividuals = countPedGenotypes(ped_file, groups=groups)
+    tcount, rcount = nindividuals["test"], nindividuals["ref"]
+    empty = np.zeros((4, len(variant_ids)), dtype=np.int64)
+    ref_counts = counts.get("ref", empty)
+    test_counts = counts.get("test", empty)
+
+    E.info("Counted alleles for %i test cases, %i ref cases" %
+           (tcount, rcount))
+
+    index = pd.Index(variant_ids, name="SNP")
+    ref_maf_df = pd.DataFrame({"ref_MAF": _calcMafs(ref_counts, rcount),
+                               "ref_A2_HOMS": 2 * ref_counts[PED_HOM_A1],
+                               "ref_A2_HETS": ref_counts[PED_HET]},
+                              index=index,
+                              columns=["ref_MAF", "ref_A2_HOMS",
+                                       "ref_A2_HETS"])
+
+    test_maf_df = pd.DataFrame({"test_MAF": _calcMafs(test_counts, tcount),
+                                "test_A2_HOMS": 2 * test_counts[PED_HOM_A1],
+                                "test_A2_HETS": test_counts[PED_HET]},
+                               index=index,
+                               columns=["test_MAF", "test_A2_HOMS",
+                                        "test_A2_HETS"])
 
     freq_diffs = pd.merge(ref_maf_df, test_maf_df,
                           left_index=True, right_index=True,
@@ -3336,11 +3364,31 @@ def calcMaxAlleleFreqDiff(ped_file, map_file, group_file,
     freq_diffs["MAF_diff"] = freq_diffs["ref_MAF"] - freq_diffs["test_MAF"]
 
     E.info("allele frequencies calculated over %i SNPs and "
-           "%i individuals" % (len(genos), tcount + rcount))
+           "%i individuals" % (len(variant_ids), tcount + rcount))
 
     return freq_diffs
 
 
+# number of individuals added at a time in calcPenetrance
+_PENETRANCE_BLOCK_SIZE = 1024
+
+
+def _addGenotypePairs(block, pairs, homs):
+    '''
+    Add co-occurrences of heterozygotes in a block of encoded
+    genotypes to `pairs` and homozygote (A1) counts to `homs`.
+    The block is emptied.
+    '''
+
+    if not block:
+        return
+    genos = np.array(block)
+    het = (genos == PED_HET).astype(np.float64)
+    pairs += np.dot(het.T, het)
+    homs += (genos == PED_HOM_A1).sum(axis=0)
+    del block[:]
+
+
 def calcPenetrance(ped_file, map_file, mafs=None,
                    subset=None, snpset=None):
     '''
@@ -3371,29 +3419,26 @@ def calcPenetrance(ped_file, map_file, mafs=None,
 
     # parse the ped file - get the variant column headers from
     # the map file - no headers with these files
-    # variant order in the map file matters, use an ordered dict
-    variants = collections.OrderedDict()
-    with open(map_file, "r") as mfile:
-        for snp in mfile.readlines():
-            attrs = snp.split("\t")
-            snpid = attrs[1]
-            variants[snpid] = {"chr": attrs[0],
-                               "pos": attrs[-1].strip("\n")}
+    # variant order in the map file matters
+    variant_ids = readMapVariants(map_file)
 
     if snpset:
         with IOTools.open_file(snpset, "r") as sfile:
-            snps = sfile.readlines()
-            snps = [sx.rstrip("\n") for sx in snps]
-            variant_ids = [ks for ks in variants.keys() if ks in snps]
+            snps = set([sx.rstrip("\n") for sx in sfile])
+        var_idx = [si for si, sj in enumerate(variant_ids) if sj in snps]
+        variant_ids = [variant_ids[si] for si in var_idx]
     else:
-        variant_ids = variants.keys()
+        var_idx = None
 
-    var_idx = [si for si, sj in enumerate(variant_ids)]
-    case_mat = np.zeros((len(variant_ids), len(variant_ids)),
-                        dtype=np.float64)
+    nvariants = len(variant_ids)
 
-    all_mat = np.zeros((len(variant_ids), len(variant_ids)),
-                       dtype=np.float64)
+    # heterozygote pairs are counted off the diagonal, homozygotes
+    # on the diagonal. Individuals are added in blocks.
+    case_mat = np.zeros((nvariants, nvariants), dtype=np.float64)
+    other_mat = np.zeros((nvariants, nvariants), dtype=np.float64)
+    case_homs = np.zeros(nvariants, dtype=np.float64)
+    other_homs = np.zeros(nvariants, dtype=np.float64)
+    case_block, other_block = [], []
 
     tcount = 0
     ncases = 0
@@ -3401,62 +3446,43 @@ def calcPenetrance(ped_file, map_file, mafs=None,
     # missing phenotype individuals must be ignored, else
     # they will cause the number of individuals explained
     # to be underestimated
-    with open(ped_file, "r") as pfile:
-        for indiv in pfile.readlines():
-            indiv = indiv.strip("\n")
-            indiv_split = indiv.split("\t")
-            fid = indiv_split[0]
-            iid = indiv_split[1]
-            mid = indiv_split[2]
-            pid = indiv_split[3]
-            gender = int(indiv_split[4])
-            phen = int(indiv_split[5])
-            if phen != -9:
-                if subset == "cases":
-                    select = phen
-                elif subset == "gender":
-                    select = gender
-                else:
-                    select = None
-                genos = np.array(indiv_split[6:])
-                genos = genos[var_idx]
-                tcount += 1
-
-                het = np.zeros(len(genos), dtype=np.float64)
-                hom = np.zeros(len(genos), dtype=np.float64)
-
-                for i in range(len(genos)):
-                    # missing values are coded '00' in plink format
-                    # A2 homs are coded '11' in plink format
-                    if genos[i] == "11":
-                        hom[i] += 1
-                    elif genos[i] == "12":
-                        het[i] += 1
-                    else:
-                        pass
-
-                hom_mat = np.outer(hom, hom)
-                het_mat = np.outer(het, het)
-                homs = hom_mat.diagonal()
-                het_mat[np.diag_indices(len(genos))] = homs
-
-                gen_mat = het_mat
-
-                # separate matrix for subset
-                # reference is always level 2 for plink files,
-                # either cases or females
-                if select == 2:
-                    case_mat += gen_mat
-                    all_mat += gen_mat
-                    ncases += 1
-                else:
-                    all_mat += gen_mat
-            else:
-                pass
+    for fields, genos in iteratePedGenotypes(ped_file, var_idx):
+        gender = int(fields[4])
+        phen = int(fields[5])
+        if phen == -9:
+            continue
+
+        if subset == "cases":
+            select = phen
+        elif subset == "gender":
+            select = gender
+        else:
+            select = None
+        tcount += 1
+
+        # separate matrix for subset
+        # reference is always level 2 for plink files,
+        # either cases or females
+        if select == 2:
+            case_block.append(genos)
+            ncases += 1
+            if len(case_block) == _PENETRANCE_BLOCK_SIZE:
+                _addGenotypePairs(case_block, case_mat, case_homs)
+        else:
+            other_block.append(genos)
+            if len(other_block) == _PENETRANCE_BLOCK_SIZE:
+                _addGenotypePairs(other_block, other_mat, other_homs)
+
+    _addGenotypePairs(case_block, case_mat, case_homs)
+    _addGenotypePairs(other_block, other_mat, other_homs)
+
+    all_mat = case_mat + other_mat
+    np.fill_diagonal(case_mat, case_homs)
+    np.fill_diagonal(all_mat, case_homs + other_homs)
 
     E.info("alleles counted over %i SNPs "
            "and %i individuals, of which %i are "
-           "in the %s subset" % (len(genos), tcount, ncases, subset))
+           "in the %s subset" % (nvariants, tcount, ncases, subset))
 
     penetrance = np.divide(case_mat, all_mat)
     # round for the sake of aesthetics
@@ -5433,8 +5459,10 @@ def flipRiskAlleles(snp_index, snp_results, genos):
       results
 
     genos: np.ndarray
-      array of genotypes in format "11", "12" or
-      "22" where 1 = minor allele, 2 = major allele.
+      samples x SNPs matrix of genotypes encoded as in
+      :func:`encodePedGenotypes` or of genotype strings in
+      format "11", "12" or "22" where 1 = minor allele,
+      2 = major allele.
 
     Returns
     -------
@@ -5446,23 +5474,24 @@ def flipRiskAlleles(snp_index, snp_results, genos):
     genarray = np.array(genos)
 
     # find SNP alleles to flip
-    flip = []
-    for snp in snp_results.keys():
-        if snp_results[snp] < 1:
-            flip.append(snp_index[snp])
-        else:
-            pass
+    flip = [snp_index[snp] for snp in snp_results.keys()
+            if snp in snp_index and snp_results[snp] < 1]
 
     E.info("Flipped alleles: %i" % len(flip))
 
     # swap alleles for SNPs where the minor (A1) allele
     # is protective
-    # use intermediate values to avoid overwriting values
     flip_array = genarray[:, flip]
-    np.place(flip_array, flip_array == "22", ["88"])
-    np.place(flip_array, flip_array == "11", ["99"])
-    np.place(flip_array, flip_array == "88", ["11"])
-    np.place(flip_array, flip_array == "99", ["22"])
+    if np.issubdtype(flip_array.dtype, np.integer):
+        hom_a1 = flip_array == PED_HOM_A1
+        flip_array[flip_array == PED_HOM_A2] = PED_HOM_A1
+        flip_array[hom_a1] = PED_HOM_A2
+    else:
+        # use intermediate values to avoid overwriting values
+        np.place(flip_array, flip_array == "22", ["88"])
+        np.place(flip_array, flip_array == "11", ["99"])
+        np.place(flip_array, flip_array == "88", ["11"])
+        np.place(flip_array, flip_array == "99", ["22"])
 
     genarray[:, flip] = flip_array
 
@@ -5515,7 +5544,168 @@ def parsePed(ped_file, delim="\t", compound_geno="False"):
     return ped_frame
 
 
-def countRiskAlleles(ped_frame, snp_index, report, flag):
+def readPedGenotypes(ped_file, delim="\t", cache_file=None):
+    '''
+    Read a plink .ped file into a matrix of encoded genotypes.
+
+    The file is read line by line, genotypes are encoded with
+    :func:`encodePedGenotypes` and stored as a samples x SNPs
+    :class:`numpy.uint8` matrix.
+
+    If `cache_file` is given, the genotype matrix is saved in
+    :mod:`numpy` format to `cache_file` and the sample information
+    to `cache_file`.tsv. If the cache is newer than `ped_file`, it
+    is used instead of parsing `ped_file` and the genotype matrix is
+    memory-mapped.
+
+    Arguments
+    ---------
+    ped_file: string
+      Path to a plink .ped file
+
+    delim: string
+      delimiter that separates columns
+      in ped_file
+
+    cache_file: string
+      Path to a genotype cache
+
+    Returns
+    -------
+    samples: pd.Core.DataFrame
+      pandas dataframe with the columns FID, IID, SEX and PHEN
+      in the order of the ped_file
+
+    genotypes: np.ndarray
+      samples x SNPs matrix of encoded genotypes
+    '''
+
+    if cache_file and os.path.exists(cache_file) and \
+       os.path.exists(cache_file + ".tsv") and \
+       os.path.getmtime(cache_file) >= os.path.getmtime(ped_file):
+        E.info("reading genotypes from cache %s" % cache_file)
+        samples = pd.read_table(cache_file + ".tsv", sep="\t", header=0,
+                                index_col=None,
+                                dtype={"FID": str, "IID": str})
+        genotypes = np.load(cache_file, mmap_mode="r")
+        return samples, genotypes
+
+    samples = []
+    genotypes = None
+    nsamples = 0
+
+    with open(ped_file, "r") as pfile:
+        for indiv in pfile:
+            indiv_split = indiv.rstrip("\n").split(delim)
+            codes = encodePedGenotypes(indiv_split[6:])
+
+            if genotypes is None:
+                genotypes = np.empty((1024, len(codes)), dtype=np.uint8)
+            elif nsamples == len(genotypes):
+                genotypes = np.resize(genotypes,
+                                      (2 * nsamples, genotypes.shape[1]))
+
+            genotypes[nsamples] = codes
+            nsamples += 1
+            samples.append((indiv_split[0],
+                            indiv_split[1],
+                            int(indiv_split[4]),
+                            int(indiv_split[5])))
+
+    if genotypes is None:
+        genotypes = np.empty((0, 0), dtype=np.uint8)
+    genotypes = genotypes[:nsamples]
+    samples = pd.DataFrame(samples, columns=["FID", "IID", "SEX", "PHEN"])
+
+    if cache_file:
+        E.info("writing genotypes to cache %s" % cache_file)
+        with open(cache_file, "wb") as outf:
+            np.save(outf, genotypes)
+        samples.to_csv(cache_file + ".tsv", sep="\t", index=False)
+
+    return samples, genotypes
+
+
+def _buildBedCodes():
+    '''
+    lookup table to decode a byte of a plink .bed file into
+    the genotypes of four samples.
+    '''
+
+    # two-bit genotypes in plink .bed files
+    bed2code = (PED_HOM_A1, PED_MISSING, PED_HET, PED_HOM_A2)
+    table = np.zeros((256, 4), dtype=np.uint8)
+    for byte in range(256):
+        for sample in range(4):
+            table[byte, sample] = bed2code[(byte >> (2 * sample)) & 3]
+    return table
+
+
+_BED_CODES = _buildBedCodes()
+
+
+def readPlinkBed(bed_file, chunk_size=10000):
+    '''
+    Read a plink binary .bed file into a matrix of encoded genotypes.
+
+    The .bed file is memory-mapped and decoded in chunks of SNPs.
+    Sample information is read from the .fam file and the number of
+    SNPs from the .bim file with the same prefix. Only SNP-major
+    .bed files are supported.
+
+    Arguments
+    ---------
+    bed_file: string
+      Path to a plink .bed file
+
+    chunk_size: int
+      number of SNPs to decode at a time
+
+    Returns
+    -------
+    samples: pd.Core.DataFrame
+      pandas dataframe with the columns FID, IID, SEX and PHEN
+      in the order of the .fam file
+
+    genotypes: np.ndarray
+      samples x SNPs matrix of genotypes encoded as in
+      :func:`encodePedGenotypes`
+    '''
+
+    prefix = re.sub(r"\.bed$", "", bed_file)
+
+    samples = pd.read_table(prefix + ".fam", sep=r"\s+", header=None,
+                            index_col=None, usecols=[0, 1, 4, 5],
+                            names=["FID", "IID", "SEX", "PHEN"],
+                            dtype={"FID": str, "IID": str})
+    with open(prefix + ".bim", "r") as bfile:
+        nsnps = sum([1 for snp in bfile])
+
+    nsamples = len(samples)
+    nbytes = (nsamples + 3) // 4
+
+    data = np.memmap(bed_file, dtype=np.uint8, mode="r")
+    if len(data) < 3 or data[0] != 0x6c or data[1] != 0x1b:
+        raise ValueError("%s is not a plink .bed file" % bed_file)
+    if data[2] != 1:
+        raise ValueError("%s is not in SNP-major mode" % bed_file)
+    if len(data) != 3 + nsnps * nbytes:
+        raise ValueError("%s: expected %i bytes for %i samples and %i SNPs, "
+                         "got %i" % (bed_file, 3 + nsnps * nbytes, nsamples,
+                                     nsnps, len(data)))
+
+    packed = data[3:].reshape(nsnps, nbytes)
+    genotypes = np.empty((nsamples, nsnps), dtype=np.uint8)
+    for start in range(0, nsnps, chunk_size):
+        block = _BED_CODES[packed[start:start + chunk_size]]
+        block = block.reshape(len(block), nbytes * 4)[:, :nsamples]
+        genotypes[:, start:start + len(block)] = block.T
+
+    return samples, genotypes
+
+
+def countRiskAlleles(ped_frame, snp_index, report, flag,
+                     genotypes=None):
     '''
     Count the number of risk alleles per individual
     and calculate the probability of the phenotype
@@ -5523,11 +5713,13 @@ def countRiskAlleles(ped_frame, snp_index, report, flag):
     Arguments
     ---------
     ped_frame: pd.Core.DataFrame
-      Dataframe of SNP genotypes and phenotype information
+      Dataframe of SNP genotypes and phenotype information. If
+      `genotypes` is given, only the phenotype information
+      (FID, PHEN columns) is used.
 
     snp_index: list
       list of snp indices denoting which columns of
-      ped_frame are the relevant genotypes
+      ped_frame (or `genotypes`) are the relevant genotypes
 
     report: string
       either `cases_explained` - the proportion of cases
@@ -5540,44 +5732,45 @@ def countRiskAlleles(ped_frame, snp_index, report, flag):
       output individuals explained by carriage of 2
       risk alleles
 
+    genotypes: np.ndarray
+      samples x SNPs matrix of encoded genotypes in the order of
+      ped_frame, see :func:`readPedGenotypes`
+
     Returns
     -------
     count_freq: np.ndarray
       cumulative frequency array of #risk alleles
     '''
 
+    snp_index = list(snp_index)
+    if genotypes is None:
+        genotypes = np.array([encodePedGenotypes(list(x)) for x in
+                              ped_frame.loc[:, snp_index].values],
+                             dtype=np.uint8)
+    else:
+        genotypes = genotypes[:, snp_index]
+
+    # number of risk alleles for each genotype code,
+    # missing genotypes do not count
+    risk_alleles = np.zeros(4, dtype=np.int64)
+    risk_alleles[PED_HOM_A1] = 2
+    risk_alleles[PED_HET] = 1
+    risk_sums = risk_alleles[genotypes].sum(axis=1)
+
     # need to include 0 count
-    case_freq = np.zeros(shape=(len(snp_index)*2) + 1,
-                         dtype=np.float64)
-    cntrl_freq = np.zeros(shape=(len(snp_index)*2) + 1,
-                          dtype=np.float64)
-
-    # group by phenotype column
-    phen_groups = ped_frame.groupby(by="PHEN")
-    for name, group in phen_groups:
-        genos = group.loc[:, snp_index]
-
-        # convert to 0,1,2 coding for ease of counting
-        # treat 00 as missing/NA
-        genos.replace({"22": 0,
-                       "12": 1,
-                       "11": 2,
-                       "00": np.nan},
-                      inplace=True)
-        risk_sums = np.nansum(genos, axis=1)
-
-        for val in risk_sums:
-            if name == 1:
-                cntrl_freq[val] += 1
-            elif name == 2:
-                case_freq[val] += 1
+    nbins = (len(snp_index) * 2) + 1
+    phenotypes = np.asarray(ped_frame["PHEN"])
+    cntrl_freq = np.bincount(risk_sums[phenotypes == 1],
+                             minlength=nbins).astype(np.float64)
+    case_freq = np.bincount(risk_sums[phenotypes == 2],
+                            minlength=nbins).astype(np.float64)
 
     if flag:
-        explained = pd.DataFrame(risk_sums)
-        explained.index = group["FID"]
-        explained["IID"] = explained.index
-        explained.columns = ["IID", "riskAlleles"]
-        explained = explained[explained["riskAlleles"] == 2.0]
+        explained = pd.DataFrame({"IID": np.asarray(ped_frame["FID"]),
+                                  "riskAlleles": risk_sums},
+                                 index=np.asarray(ped_frame["FID"]),
+                                 columns=["IID", "riskAlleles"])
+        explained = explained[(phenotypes == 2) & (risk_sums == 2)]
         explained.to_csv("/".join([os.getcwd(), "cases_explained.tsv"]),
                          sep="\t", index_label="FID")
     else:
@@ -19,6 +19,8 @@ import bisect
 import array
 import collections
 import itertools
+import heapq
+import pickle
 import quicksect
 
 import CGAT.GTF as GTF
@@ -41,113 +43,286 @@ except ImportError:
     pass
 
 
-def readIntervalsFromGFF(filename_gff, source, feature,
-                         with_values=False, with_records=False, fasta=None,
-                         merge_genes=False, format="gtf", use_strand=False):
-    """read intervals from a file or list.
+def guessIntervalFormat(filename_gff, format=None):
+    """return format of an interval file.
+
+    If *format* is None, the format is guessed from the filename
+    extension. Pre-parsed entries are assumed to be in gff format.
     """
+    if format is not None:
+        return format
+
+    if isinstance(filename_gff, str):
+        fn = filename_gff
+        if fn.endswith(".gtf") or fn.endswith(".gtf.gz"):
+            return "gtf"
+        elif fn.endswith(".gff") or fn.endswith(".gff.gz"):
+            return "gff"
+        elif fn.endswith(".bed") or fn.endswith(".bed.gz"):
+            return "bed"
+        return None
+    else:
+        return "gff"
 
-    assert not (with_values and with_records), \
-        "both with_values and with_records are true."
+
+def readIntervalsFromBed(filename_bed, with_values=False, with_records=False,
+                         merge_genes=False, use_strand=False):
+    """read intervals from a bed formatted file."""
+
+    if merge_genes:
+        raise ValueError("can not merge genes from bed format")
+    if use_strand:
+        raise NotImplementedError(
+            "stranded comparison not implemented for bed format")
 
     ninput = 0
+    iterator = Bed.iterator(IOTools.open_file(filename_bed, "r"))
+    e = collections.defaultdict(list)
+    if with_values:
+        for bed in iterator:
+            ninput += 1
+            e[bed.contig].append((bed.start, bed.end, bed.fields[0]))
+    elif with_records:
+        for bed in iterator:
+            ninput += 1
+            bed.gene_id = bed.fields[0]
+            bed.transcript_id = bed.gene_id
+            e[bed.contig].append((bed.start, bed.end, bed))
+    else:
+        for bed in iterator:
+            ninput += 1
+            e[bed.contig].append((bed.start, bed.end))
+    E.info("read intervals for %i contigs from %s: %i intervals" %
+           (len(e), filename_bed, ninput))
+    return e
 
-    if format is None:
-        if isinstance(filename_gff, str):
-            fn = filename_gff
-            if fn.endswith(".gtf") or fn.endswith(".gtf.gz"):
-                format = "gtf"
-            elif fn.endswith(".gff") or fn.endswith(".gff.gz"):
-                format = "gff"
-            elif fn.endswith(".bed") or fn.endswith(".bed.gz"):
-                format = "bed"
-        else:
-            format = "gff"
 
-    if format in ("gtf", "gff"):
-        infile = None
-        # read data without value
-        if isinstance(filename_gff, str):
-            E.info("loading data from %s for source '%s' and feature '%s'" %
-                   (filename_gff, source, feature))
+def translateContigs(e, fasta, use_strand=False):
+    """return a copy of dictionary *e* with contig names translated
+    to the names used in *fasta*.
 
-            infile = IOTools.open_file(filename_gff, "r")
-            if format == "gtf":
-                iterator_gff = GTF.iterator(infile)
-            elif format == "gff":
-                iterator_gff = GTF.iterator(infile)
+    Values are shared with *e*.
+    """
+    if isinstance(e, collections.defaultdict):
+        result = collections.defaultdict(e.default_factory)
+    else:
+        result = {}
 
-        elif type(filename_gff) in (tuple, list):
+    for key, value in e.items():
+        if fasta:
+            if use_strand:
+                contig, strand = key
+                if contig in fasta:
+                    key = (fasta.getToken(contig), strand)
+            elif key in fasta:
+                key = fasta.getToken(key)
+        result[key] = value
+    return result
 
-            E.info("loading data from cache for source '%s' and feature '%s'" %
-                   (source, feature))
 
-            # from preparsed gff entries
-            iterator_gff = filename_gff
+class IntervalStore(object):
+    """process-wide store of intervals read from interval files.
 
-        gff_iterator = GTF.iterator_filtered(iterator_gff,
-                                             feature=feature,
-                                             source=source)
+    Each file is parsed only once. Entries in :term:`gtf` or
+    :term:`gff` files are grouped by source and feature in a single
+    pass, so that intervals for any combination of source and feature
+    can be selected without reading the file again.
+
+    Intervals and intersectors are cached by file, modification time,
+    format, source, feature, strand mode and value mode. They are
+    shared between all callers and must not be modified.
+
+    Intervals can be saved to disk with :meth:`save` and loaded in a
+    later run with :meth:`load`. Intervals of files that have been
+    modified in the meantime are ignored.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """remove all data from the store."""
+        # gtf/gff entries grouped by (source, feature) per file
+        self.mEntries = {}
+        self.mIntervals = {}
+        self.mIntersectors = {}
 
-        if format == "gtf":
-            e = GTF.readAsIntervals(gff_iterator,
-                                    with_values=with_values,
-                                    with_records=with_records,
-                                    merge_genes=merge_genes,
-                                    use_strand=use_strand)
-        elif format == "gff":
-            e = GTF.readAsIntervals(gff_iterator,
-                                    with_values=with_values,
-                                    with_records=with_records,
-                                    use_strand=use_strand)
-
-        if infile:
+    def releaseEntries(self):
+        """remove parsed gtf/gff entries from the store.
+
+        Intervals and intersectors that have been built are kept.
+        """
+        self.mEntries = {}
+
+    def getKey(self, filename_gff, source, feature,
+               with_values=False, with_records=False,
+               merge_genes=False, format="gtf", use_strand=False):
+        """return key for intervals in the store."""
+        format = guessIntervalFormat(filename_gff, format)
+        if format not in ("gtf", "gff", "bed"):
+            raise ValueError("unknown format %s" % format)
+        filename = os.path.abspath(filename_gff)
+        return (filename, os.path.getmtime(filename), format,
+                source, feature, use_strand,
+                with_values, with_records, merge_genes)
+
+    def getEntries(self, filename_gff, source, feature):
+        """return entries in a :term:`gtf` formatted file for
+        *source* and *feature* in the order of the file."""
+
+        filename = os.path.abspath(filename_gff)
+        key = (filename, os.path.getmtime(filename))
+        if key not in self.mEntries:
+            E.info("loading data from %s" % filename_gff)
+            groups = collections.defaultdict(list)
+            infile = IOTools.open_file(filename_gff, "r")
+            for idx, gff in enumerate(GTF.iterator(infile)):
+                groups[gff.source, gff.feature].append((idx, gff))
             infile.close()
+            self.mEntries[key] = groups
+
+        selected = [entries for (s, f), entries in
+                    self.mEntries[key].items()
+                    if (not source or s == source) and
+                    (not feature or f == feature)]
+        return [gff for idx, gff in heapq.merge(*selected,
+                                                 key=lambda x: x[0])]
+
+    def getIntervals(self, filename_gff, source, feature,
+                     with_values=False, with_records=False,
+                     merge_genes=False, format="gtf", use_strand=False):
+        """return a dictionary of intervals per contig in
+        *filename_gff*.
+
+        The dictionary is shared and must not be modified.
+        """
+        key = self.getKey(filename_gff, source, feature,
+                          with_values, with_records,
+                          merge_genes, format, use_strand)
+        if key not in self.mIntervals:
+            format = key[2]
+            if format == "bed":
+                e = readIntervalsFromBed(filename_gff,
+                                         with_values=with_values,
+                                         with_records=with_records,
+                                         merge_genes=merge_genes,
+                                         use_strand=use_strand)
+            else:
+                E.info("reading intervals from %s for source '%s' and "
+                       "feature '%s'" % (filename_gff, source, feature))
+                e = GTF.readAsIntervals(
+                    self.getEntries(filename_gff, source, feature),
+                    with_values=with_values,
+                    with_records=with_records,
+                    merge_genes=merge_genes and format == "gtf",
+                    use_strand=use_strand)
+            self.mIntervals[key] = dict(e)
+        return self.mIntervals[key]
+
+    def getIntersectors(self, filename_gff, source, feature,
+                        with_values=False, with_records=False, fasta=None,
+                        merge_genes=False, format="gtf", use_strand=False):
+        """return a dictionary of :class:`quicksect.IntervalTree`
+        objects per contig for intervals in *filename_gff*.
+
+        The intersectors are shared and must not be modified.
+        """
+        key = self.getKey(filename_gff, source, feature,
+                          with_values, with_records,
+                          merge_genes, format, use_strand)
+        if key not in self.mIntersectors:
+            e = self.getIntervals(filename_gff, source, feature,
+                                  with_values, with_records,
+                                  merge_genes, format, use_strand)
+            intersectors = {}
+            for contig, intervals in e.items():
+                intersector = quicksect.IntervalTree()
+                if with_values or with_records:
+                    for start, end, value in intervals:
+                        intersector.add(start, end, value)
+                else:
+                    for start, end in intervals:
+                        intersector.add(start, end)
+                intersectors[contig] = intersector
+            self.mIntersectors[key] = intersectors
 
-    elif format == "bed":
-        if merge_genes:
-            raise ValueError("can not merge genes from bed format")
-        if use_strand:
-            raise NotImplementedError(
-                "stranded comparison not implemented for bed format")
-        iterator = Bed.iterator(IOTools.open_file(filename_gff, "r"))
-        e = collections.defaultdict(list)
-        if with_values:
-            for bed in iterator:
-                ninput += 1
-                e[bed.contig].append((bed.start, bed.end, bed.fields[0]))
-        elif with_records:
-            for bed in iterator:
-                ninput += 1
-                bed.gene_id = bed.fields[0]
-                bed.transcript_id = bed.gene_id
-                e[bed.contig].append((bed.start, bed.end, bed))
-        else:
-            for bed in iterator:
-                ninput += 1
-                e[bed.contig].append((bed.start, bed.end))
-        E.info("read intervals for %i contigs from %s: %i intervals" %
-               (len(e), filename_gff, ninput))
+        return translateContigs(self.mIntersectors[key], fasta, use_strand)
+
+    def save(self, filename):
+        """save intervals to *filename*.
+
+        Intervals with records are not saved.
+        """
+        intervals = dict((key, value)
+                         for key, value in self.mIntervals.items()
+                         if not key[7])
+        with open(filename, "wb") as outf:
+            pickle.dump(intervals, outf, pickle.HIGHEST_PROTOCOL)
+        E.info("saved %i interval sets to %s" % (len(intervals), filename))
+
+    def load(self, filename):
+        """load intervals from *filename* created by :meth:`save`."""
+        with open(filename, "rb") as inf:
+            intervals = pickle.load(inf)
+        nloaded, nstale = 0, 0
+        for key, value in intervals.items():
+            fn, mtime = key[:2]
+            if not os.path.exists(fn) or os.path.getmtime(fn) != mtime:
+                nstale += 1
+                continue
+            self.mIntervals.setdefault(key, value)
+            nloaded += 1
+        E.info("loaded %i interval sets from %s, %i were out of date" %
+               (nloaded, filename, nstale))
+
+
+# process-wide interval store
+INTERVAL_STORE = IntervalStore()
+
+
+def readIntervalsFromGFF(filename_gff, source, feature,
+                         with_values=False, with_records=False, fasta=None,
+                         merge_genes=False, format="gtf", use_strand=False):
+    """read intervals from a file or list.
+
+    Intervals from files are obtained through :data:`INTERVAL_STORE`.
+    The returned dictionary and lists are a copy and can be modified.
+    """
+
+    assert not (with_values and with_records), \
+        "both with_values and with_records are true."
+
+    format = guessIntervalFormat(filename_gff, format)
+
+    if isinstance(filename_gff, str):
+        e = INTERVAL_STORE.getIntervals(filename_gff, source, feature,
+                                        with_values=with_values,
+                                        with_records=with_records,
+                                        merge_genes=merge_genes,
+                                        format=format,
+                                        use_strand=use_strand)
+        e = collections.defaultdict(
+            list, [(key, list(value)) for key, value in e.items()])
+
+    elif format in ("gtf", "gff"):
+        E.info("loading data from cache for source '%s' and feature '%s'" %
+               (source, feature))
+
+        # from preparsed gff entries
+        gff_iterator = GTF.iterator_filtered(filename_gff,
+                                             feature=feature,
+                                             source=source)
 
+        e = GTF.readAsIntervals(gff_iterator,
+                                with_values=with_values,
+                                with_records=with_records,
+                                merge_genes=merge_genes and format == "gtf",
+                                use_strand=use_strand)
     else:
         raise ValueError("unknown format %s" % format)
 
     # translate names of contigs
-    if fasta:
-        if use_strand:
-            for contig, strand in list(e.keys()):
-                if contig in fasta:
-                    x = e[contig]
-                    del e[contig, strand]
-                    e[fasta.getToken(contig), strand] = x
-        else:
-            for contig in list(e.keys()):
-                if contig in fasta:
-                    x = e[contig]
-                    del e[contig]
-                    e[fasta.getToken(contig)] = x
-
-    return e
+    return translateContigs(e, fasta, use_strand)
 
 
 class Counter:
@@ -674,6 +849,114 @@ cdef inline computeOverlapWithExons(long * block_starts,
     result_bases_exons[0] = nbases_exons
 
 
+cdef class ReadSweep:
+    '''fetch reads overlapping successive regions from a
+    :term:`bam` formatted file.
+
+    Regions are expected to be sorted by start coordinate within
+    each contig. Each contig is then read once in coordinate order.
+    Reads overlapping the current region are kept in a buffer,
+    so that reads in overlapping or nested regions are not fetched
+    and decoded again. A region on another contig or starting
+    before the previous region restarts the iteration at the
+    start of the region.
+
+    :meth:`fetch` returns the same reads in the same order as
+    :meth:`pysam.AlignmentFile.fetch`. The file is opened again,
+    so that the sweep is not affected by other iterators over
+    *samfile*.
+    '''
+
+    cdef object samfile
+    cdef object bamfile
+    cdef object iterator
+    cdef object contig
+    cdef long last_start
+    # buffered reads sorted by start with their start and end
+    cdef list reads
+    cdef list starts
+    cdef list ends
+    # maximum distance between start and end of a buffered read
+    cdef long max_span
+    cdef AlignedSegment pending
+    cdef bint exhausted
+
+    def __init__(self, samfile):
+        self.samfile = samfile
+        self.bamfile = None
+        self.iterator = None
+        self.contig = None
+        self.last_start = 0
+        self.reads = []
+        self.starts = []
+        self.ends = []
+        self.max_span = 0
+        self.pending = None
+        self.exhausted = True
+
+    def fetch(self, contig, long start, long end):
+        '''return a list of reads overlapping *contig*:*start*-*end*.'''
+        cdef AlignedSegment read
+        cdef long read_start, read_end
+        cdef int x, first, last
+        cdef list reads = self.reads
+        cdef list starts = self.starts
+        cdef list ends = self.ends
+
+        if self.bamfile is None:
+            self.bamfile = pysam.AlignmentFile(self.samfile.filename)
+
+        if contig != self.contig or start < self.last_start:
+            self.contig = contig
+            self.iterator = self.bamfile.fetch(contig, start)
+            del reads[:], starts[:], ends[:]
+            self.max_span = 0
+            self.pending = None
+            self.exhausted = False
+        self.last_start = start
+
+        # remove reads that end before the region, these can not
+        # overlap any later region
+        first = bisect.bisect_left(starts, start - self.max_span)
+        if first > 0:
+            del reads[:first], starts[:first], ends[:first]
+
+        # add reads starting before the end of the region
+        while not self.exhausted:
+            if self.pending is None:
+                try:
+                    self.pending = next(self.iterator)
+                except StopIteration:
+                    self.exhausted = True
+                    break
+            read = self.pending
+            read_start = read._delegate.core.pos
+            if read_start >= end:
+                break
+            self.pending = None
+            # same end coordinate as used by htslib for overlap
+            # queries, unmapped reads and reads without aligned
+            # bases have a length of 1
+            read_end = read.reference_end or 0
+            if read_end <= read_start:
+                read_end = read_start + 1
+            if read_end <= start:
+                continue
+            reads.append(read)
+            starts.append(read_start)
+            ends.append(read_end)
+            if read_end - read_start > self.max_span:
+                self.max_span = read_end - read_start
+
+        # reads starting before the region that overlap it
+        # followed by all reads starting within the region
+        first = bisect.bisect_left(starts, start)
+        last = bisect.bisect_left(starts, end)
+        result = [reads[x] for x in range(first) if ends[x] > start]
+        result.extend(reads[first:last])
+        return result
+
+
 class CounterBAM(Counter):
     '''base class for counters counting reads overlapping
     exons from BAM files.
@@ -695,11 +978,15 @@ class CounterBAM(Counter):
     # be considered exonic
     max_bases_outside_exons = 10
 
+    # maximum number of blocks in a read or read pair
+    max_nblocks = 1000
+
     def __init__(self, bamfiles, 
                  *args,
                  multi_mapping='all',
                  sample_probability=None,
                  minimum_mapping_quality=0,
+                 sweep=True,
                  **kwargs ):
         Counter.__init__(self, *args, **kwargs )
         if not bamfiles: 
@@ -708,6 +995,20 @@ class CounterBAM(Counter):
         self.multi_mapping = multi_mapping
         self.sample_probability = sample_probability
         self.minimum_mapping_quality = minimum_mapping_quality
+
+        # sources of reads for each bam file. If *sweep* is set,
+        # bam files are read once in coordinate order, see
+        # :class:`ReadSweep`.
+        if sweep:
+            self.mReadSources = [ReadSweep(x) for x in bamfiles]
+        else:
+            self.mReadSources = bamfiles
+
+        # buffers for blocks in reads and exons in transcripts
+        self.mBlockStarts = numpy.zeros(self.max_nblocks, dtype="l")
+        self.mBlockEnds = numpy.zeros(self.max_nblocks, dtype="l")
+        self.mExonStarts = numpy.zeros(0, dtype="l")
+        self.mExonEnds = numpy.zeros(0, dtype="l")
         self.header = ['_'.join(x) 
                        for x in itertools.product( 
                                self.headers_direction,
@@ -715,6 +1016,16 @@ class CounterBAM(Counter):
                                self.headers_splicing)] +\
             ['quality_pairs', 'quality_reads']
 
+    def getExonBuffers(self, exons):
+        '''return buffers with start and end coordinates of *exons*.'''
+        if len(exons) > len(self.mExonStarts):
+            self.mExonStarts = numpy.zeros(2 * len(exons), dtype="l")
+            self.mExonEnds = numpy.zeros(2 * len(exons), dtype="l")
+        for ix, exon in enumerate(exons):
+            self.mExonStarts[ix] = exon[0]
+            self.mExonEnds[ix] = exon[1]
+        return self.mExonStarts, self.mExonEnds
+
 
 class CounterReadCountsFull(CounterBAM):
     '''compute number of reads overlapping with exoIsoform
@@ -864,60 +1175,41 @@ class CounterReadCountsFull(CounterBAM):
         cdef long block_first_start = 0
         cdef long block_last_end = 0
         cdef long read_last_end = 0
-        # TODO: define block struc 
-        # maximum number of blocks is 100 
-        # we expect few (<10)
-        cdef int max_nblocks = 1000
-        cdef long * block_starts = <long*>malloc(max_nblocks *sizeof(long))
-        cdef long * block_ends = <long*>malloc(max_nblocks * sizeof(long))
-        cdef long * exon_starts = <long*>malloc(nexons *sizeof(long))
-        cdef long * exon_ends = <long*>malloc(nexons * sizeof(long))
+        # buffers are re-used between transcripts
+        cdef int max_nblocks = self.max_nblocks
+        cdef long [:] block_starts_view = self.mBlockStarts
+        cdef long [:] block_ends_view = self.mBlockEnds
+        exon_starts_buffer, exon_ends_buffer = self.getExonBuffers(exons)
+        cdef long [:] exon_starts_view = exon_starts_buffer
+        cdef long [:] exon_ends_view = exon_ends_buffer
+        cdef long * block_starts = &block_starts_view[0]
+        cdef long * block_ends = &block_ends_view[0]
+        cdef long * exon_starts = &exon_starts_view[0]
+        cdef long * exon_ends = &exon_ends_view[0]
         cdef int nblocks = 0
         cdef long max_start = 0
         cdef long min_end = 0
 
-        if block_starts == NULL or block_ends == NULL:
-            raise ValueError('could not allocated memory for blocks')
-
-        if exon_starts == NULL or exon_ends == NULL:
-            raise ValueError('could not allocated memory for exons')
-
-        for ix from 0 <= ix < nexons:
-            exon_starts[ix] = exons[ix][0]
-            exon_ends[ix] = exons[ix][1]
-            
         cdef AlignedSegment read
 
-        # define counters, add 1 for quality filtered reads
-        def get_counters(n=ncounters,
-                         x=ndirection_status, 
-                         y=nexons_status,
-                         z=nspliced_status):
-            counters = numpy.zeros(n, dtype=numpy.float)
-            counters.shape = (x,y,z)
-            return counters
-            
-        # counters = numpy.zeros(ncounters, dtype=numpy.float)
-        # counters.shape = (ndirection_status,
-        #                   nexons_status,
-        #                   nspliced_status)
-
-        # retrieve all reads
-        reads = []
+        # define counters
+        counters_shape = (ndirection_status,
+                          nexons_status,
+                          nspliced_status)
 
         if use_barcodes:
             barcode_counters = {}
         else:
-            counters = get_counters()
+            counters = numpy.zeros(counters_shape, dtype=numpy.float)
 
-        for samfile in self.mBamFiles:
+        for samfile, source in zip(self.mBamFiles, self.mReadSources):
             # skip bamfiles where contig is not present
             if samfile.gettid(contig) < 0:
                 continue
 
-            for read in samfile.fetch(contig,
-                                      exons_start,
-                                      exons_end):
+            for read in source.fetch(contig,
+                                     exons_start,
+                                     exons_end):
 
                 if do_sample and drand48() > sample_probability:
                         continue
@@ -928,7 +1220,8 @@ class CounterReadCountsFull(CounterBAM):
 
                 if use_barcodes:
                     barcode = read.qname.split("_")[-1]
-                    barcode_counters[barcode] = get_counters()
+                    barcode_counters[barcode] = numpy.zeros(
+                        counters_shape, dtype=numpy.float)
 
                 # Iterate over blocks within reads and 
                 # compute overlap with exons, introns, etc.
@@ -1060,13 +1353,8 @@ class CounterReadCountsFull(CounterBAM):
                 else:
                     counters[counters_index] += weight
 
-        free(block_starts)
-        free(block_ends)
-        free(exon_starts)
-        free(exon_ends)
-
         if use_barcodes:
-            counters = get_counters()
+            counters = numpy.zeros(counters_shape, dtype=numpy.float)
             for key, value in barcode_counters.iteritems():
                 counters += value
 
@@ -1390,28 +1678,21 @@ class CounterReadPairCountsFull(CounterBAM):
         cdef long block_first_start = 0
         cdef long block_last_end = 0
         cdef long read_last_end = 0
-        # TODO: define block struc 
-        # maximum number of blocks is 100 
-        # we expect few (<10)
-        cdef int max_nblocks = 1000
-        cdef long * block_starts = <long*>malloc(max_nblocks *sizeof(long))
-        cdef long * block_ends = <long*>malloc(max_nblocks * sizeof(long))
-        cdef long * exon_starts = <long*>malloc(nexons * sizeof(long))
-        cdef long * exon_ends = <long*>malloc(nexons * sizeof(long))
+        # buffers are re-used between transcripts
+        cdef int max_nblocks = self.max_nblocks
+        cdef long [:] block_starts_view = self.mBlockStarts
+        cdef long [:] block_ends_view = self.mBlockEnds
+        exon_starts_buffer, exon_ends_buffer = self.getExonBuffers(exons)
+        cdef long [:] exon_starts_view = exon_starts_buffer
+        cdef long [:] exon_ends_view = exon_ends_buffer
+        cdef long * block_starts = &block_starts_view[0]
+        cdef long * block_ends = &block_ends_view[0]
+        cdef long * exon_starts = &exon_starts_view[0]
+        cdef long * exon_ends = &exon_ends_view[0]
         cdef int nblocks = 0
         cdef long max_start = 0
         cdef long min_end = 0
 
-        if block_starts == NULL or block_ends == NULL:
-            raise ValueError('could not allocated memory for blocks')
-
-        if exon_starts == NULL or exon_ends == NULL:
-            raise ValueError('could not allocated memory for exons')
-
-        for ix from 0 <= ix < nexons:
-            exon_starts[ix] = exons[ix][0]
-            exon_ends[ix] = exons[ix][1]
-            
         cdef AlignedSegment read1
 
         # define counters, add 1 for quality filtered reads
@@ -1424,15 +1705,15 @@ class CounterReadPairCountsFull(CounterBAM):
         # retrieve all reads
         reads = []
 
-        for samfile in self.mBamFiles:
+        for samfile, source in zip(self.mBamFiles, self.mReadSources):
             # skip bamfiles where contig is not present
             if samfile.gettid(contig) < 0:
                 continue
 
             # make sure you get more than a proxy
-            reads.extend(list(samfile.fetch(contig, 
-                                            exons_start, 
-                                            exons_end)))
+            reads.extend(list(source.fetch(contig, 
+                                           exons_start, 
+                                           exons_end)))
             # sort by read name and position
             reads.sort(key=lambda x: (x.qname, x.pos))
 
@@ -1660,11 +1941,6 @@ class CounterReadPairCountsFull(CounterBAM):
                 # save weighted count for pair properties
                 counters[pair_status][direction_status][exons_status][spliced_status] += weight
 
-        free(block_starts)
-        free(block_ends)
-        free(exon_starts)
-        free(exon_ends)
-
         if not weight_multi_mapping:
             # convert to full counts
             counters = numpy.array(counters, dtype=numpy.int)
@@ -2013,28 +2289,17 @@ class CounterOverlap(Counter):
         if len(filename_gff) != 1:
             raise ValueError("expected one gff file")
 
-        e = readIntervalsFromGFF(filename_gff[0],
-                                 source,
-                                 feature,
-                                 self.mWithValues,
-                                 self.mWithRecords,
-                                 self.fasta,
-                                 format=self.options.filename_format,
-                                 use_strand=self.mUseStrand)
-
-        # convert intervals to intersectors
-        for key in list(e.keys()):
-            intersector = quicksect.IntervalTree()
-            if self.mWithValues or self.mWithRecords:
-                for start, end, value in e[key]:
-                    intersector.add(start, end, value)
-            else:
-                for start, end in e[key]:
-                    intersector.add(start, end)
-
-            e[key] = intersector
-
-        self.mIntersectors = e
+        # intersectors are shared between counters using the same
+        # intervals
+        self.mIntersectors = INTERVAL_STORE.getIntersectors(
+            filename_gff[0],
+            source,
+            feature,
+            with_values=self.mWithValues,
+            with_records=self.mWithRecords,
+            fasta=self.fasta,
+            format=self.options.filename_format,
+            use_strand=self.mUseStrand)
 
         E.info("loading data finished")
 
@@ -3815,23 +4080,14 @@ class CounterOverrun(Counter):
 
         source, feature = None, "CDS"
 
-        e = readIntervalsFromGFF(filename_gff[0],
-                                 source,
-                                 feature,
-                                 with_values=self.mWithValues,
-                                 with_records=self.mWithRecords,
-                                 fasta=self.fasta,
-                                 format=self.options.filename_format)
-
-        # convert intervals to intersectors
-        for contig in list(e.keys()):
-            intersector = quicksect.IntervalTree()
-            for start, end in e[contig]:
-                intersector.add(start, end)
-
-            e[contig] = intersector
-
-        self.mIntersectors = e
+        self.mIntersectors = INTERVAL_STORE.getIntersectors(
+            filename_gff[0],
+            source,
+            feature,
+            with_values=self.mWithValues,
+            with_records=self.mWithRecords,
+            fasta=self.fasta,
+            format=self.options.filename_format)
 
         E.info("loading data finished")
 
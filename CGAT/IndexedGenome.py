@@ -3,7 +3,7 @@
 
 This module provides a consistent front-end to various interval containers.
 
-Two implementations are available:
+Three implementations are available:
 
 NCL
    Nested containment lists as described in
@@ -17,11 +17,19 @@ quicksect
    to be installed. The benefit of quicksect is that it allows also
    quick retrieval of intervals that are closest before or after an query.
 
+arrays
+   Intervals are stored per contig in sorted arrays of start and end
+   coordinates together with the running maximum of end coordinates.
+   Overlap queries are answered by binary search and many queries can
+   be answered in a single call with :meth:`GenomeIndex.query_many`.
+   The index can be saved to disk and loaded in later runs.
+
 The principal clas is :class:`IndexedGenome` which uses NCL and stores
 a value associated with each interval. :class:`Quicksect` is equivalent
 to :class:`IndexedGenome` but uses quicksect. The :class:`Simple` is a
 light-weight version of :class:`IndexedGenome` that does not store a
-value and thus preserves space.
+value and thus preserves space. :class:`GenomeIndex` uses arrays and
+should be used if many queries are made against the same index.
 
 The basic usage is::
 
@@ -39,6 +47,11 @@ Reference
 ---------
 
 '''
+import array
+import pickle
+
+import numpy
+
 from CGAT import NCL as ncl
 import quicksect
 
@@ -143,3 +156,237 @@ class Quicksect(IndexedGenome):
                         quicksect.Interval(start, end),
                         num_intervals,
                         max_dist)]
+
+
+class GenomeIndex(object):
+
+    '''index intervals in sorted arrays.
+
+    Intervals are collected with :meth:`add` and the index is built
+    before the first query. The intervals of all contigs are stored
+    in fixed-width arrays (:attr:`starts`, :attr:`ends`) sorted by
+    contig and start coordinate. Each contig also stores the running
+    maximum of end coordinates, so that intervals overlapping a query
+    form a contiguous candidate range that can be found by binary
+    search.
+
+    If *with_values* is False, no values are stored and the value of
+    an interval is its index in the order intervals were added to its
+    contig, as in :class:`Simple`.
+
+    The index can be saved to disk with :meth:`save` and restored
+    with :meth:`load`.
+    '''
+
+    def __init__(self, with_values=True):
+        self.mWithValues = with_values
+        # intervals added since the index has last been built
+        self.mPending = {}
+        # contig to range of intervals in arrays
+        self.mContigs = {}
+        self.starts = numpy.zeros(0, dtype=numpy.int64)
+        self.ends = numpy.zeros(0, dtype=numpy.int64)
+        self.maxends = numpy.zeros(0, dtype=numpy.int64)
+        self.ids = numpy.zeros(0, dtype=numpy.int64)
+        self.mValues = []
+
+    def add(self, contig, start, end, value=None):
+
+        if start < 0:
+            raise ValueError(
+                "only positive coordinates are accepted (%i<0)" % start)
+        if start >= end:
+            raise ValueError(
+                "adding empty/invalid interval (%i,%i)" % (start, end))
+
+        if contig not in self.mPending:
+            self.mPending[contig] = (array.array("q"), array.array("q"), [])
+        starts, ends, values = self.mPending[contig]
+        starts.append(start)
+        ends.append(end)
+        if self.mWithValues:
+            values.append(value)
+
+    def _build(self):
+        '''merge pending intervals into the index.'''
+        if not self.mPending:
+            return
+
+        starts, ends, ids, values, contigs = [], [], [], [], {}
+        offset = 0
+        for contig in sorted(set(self.mContigs).union(self.mPending)):
+            if contig in self.mContigs:
+                first, last = self.mContigs[contig]
+                s = [self.starts[first:last]]
+                e = [self.ends[first:last]]
+                i = [self.ids[first:last]]
+                v = self.mValues[first:last]
+                nexisting = last - first
+            else:
+                s, e, i, v = [], [], [], []
+                nexisting = 0
+
+            if contig in self.mPending:
+                pending_starts, pending_ends, pending_values = \
+                    self.mPending[contig]
+                s.append(numpy.frombuffer(pending_starts, dtype=numpy.int64))
+                e.append(numpy.frombuffer(pending_ends, dtype=numpy.int64))
+                i.append(numpy.arange(
+                    nexisting, nexisting + len(pending_starts),
+                    dtype=numpy.int64))
+                v = v + pending_values
+
+            s, e, i = numpy.concatenate(s), numpy.concatenate(e), \
+                numpy.concatenate(i)
+            # stable sort keeps intervals with the same start in
+            # the order they have been added
+            order = numpy.argsort(s, kind="stable")
+            starts.append(s[order])
+            ends.append(e[order])
+            ids.append(i[order])
+            if self.mWithValues:
+                values.extend([v[x] for x in order])
+            contigs[contig] = (offset, offset + len(s))
+            offset += len(s)
+
+        self.starts = numpy.concatenate(starts)
+        self.ends = numpy.concatenate(ends)
+        self.ids = numpy.concatenate(ids)
+        self.maxends = numpy.empty_like(self.ends)
+        for first, last in contigs.values():
+            numpy.maximum.accumulate(self.ends[first:last],
+                                     out=self.maxends[first:last])
+        self.mValues = values
+        self.mContigs = contigs
+        self.mPending = {}
+
+    def _candidates(self, first, last, start, end):
+        '''return range of candidate intervals for query
+        *start*, *end* within the intervals *first* to *last*.'''
+        lo = first + numpy.searchsorted(
+            self.maxends[first:last], start, side="right")
+        hi = first + numpy.searchsorted(
+            self.starts[first:last], end, side="left")
+        return lo, hi
+
+    def intervals(self, hits):
+        '''return a list of tuples (start, end, value) for
+        indices *hits* into the index arrays.'''
+        if self.mWithValues:
+            values = [self.mValues[x] for x in hits]
+        else:
+            values = self.ids[hits].tolist()
+        return list(zip(self.starts[hits].tolist(),
+                        self.ends[hits].tolist(),
+                        values))
+
+    def __getitem__(self, args):
+        '''return intervals overlapping with key.'''
+        return self.get(*args)
+
+    def contains(self, contig, start, end):
+        self._build()
+        if contig not in self.mContigs or start >= end:
+            return False
+        first, last = self.mContigs[contig]
+        lo, hi = self._candidates(first, last, start, end)
+        return bool(numpy.any(self.ends[lo:hi] > start))
+
+    def get(self, contig, start, end):
+        '''return intervals overlapping with key.'''
+        self._build()
+        if contig not in self.mContigs:
+            raise KeyError("contig %s not in index" % contig)
+        if start >= end:
+            return []
+        first, last = self.mContigs[contig]
+        lo, hi = self._candidates(first, last, start, end)
+        hits = numpy.arange(lo, hi)
+        return self.intervals(hits[self.ends[lo:hi] > start])
+
+    def query_many(self, contigs, starts, ends, max_candidates=10000000):
+        '''find intervals overlapping many queries at once.
+
+        Returns a tuple of two arrays ``(offsets, hits)`` in compressed
+        sparse row format. The hits of query ``i`` are
+        ``hits[offsets[i]:offsets[i+1]]`` and are indices into the
+        arrays :attr:`starts`, :attr:`ends` and :attr:`ids`. Use
+        :meth:`intervals` to obtain the values. Queries on contigs that
+        are not in the index and empty queries have no hits.
+
+        Candidate intervals are examined in chunks of at most
+        *max_candidates* to bound memory usage.
+        '''
+        self._build()
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        nqueries = len(starts)
+        if isinstance(contigs, str):
+            contigs = [contigs] * nqueries
+
+        lo = numpy.zeros(nqueries, dtype=numpy.int64)
+        hi = numpy.zeros(nqueries, dtype=numpy.int64)
+        names, inverse = numpy.unique(numpy.asarray(contigs, dtype=str),
+                                      return_inverse=True)
+        order = numpy.argsort(inverse, kind="stable")
+        bounds = numpy.searchsorted(inverse[order],
+                                    numpy.arange(len(names) + 1))
+        for x, contig in enumerate(names):
+            if contig not in self.mContigs:
+                continue
+            first, last = self.mContigs[contig]
+            idx = order[bounds[x]:bounds[x + 1]]
+            lo[idx], hi[idx] = self._candidates(
+                first, last, starts[idx], ends[idx])
+
+        ncandidates = numpy.where(ends > starts,
+                                  numpy.maximum(hi - lo, 0), 0)
+        cumulative = numpy.cumsum(ncandidates)
+
+        offsets = numpy.zeros(nqueries + 1, dtype=numpy.int64)
+        hits = [numpy.zeros(0, dtype=numpy.int64)]
+        chunk_start = 0
+        while chunk_start < nqueries:
+            if chunk_start > 0:
+                limit = cumulative[chunk_start - 1] + max_candidates
+            else:
+                limit = max_candidates
+            chunk_end = max(chunk_start + 1,
+                            numpy.searchsorted(cumulative, limit,
+                                               side="right"))
+            counts = ncandidates[chunk_start:chunk_end]
+            query = numpy.repeat(numpy.arange(chunk_start, chunk_end),
+                                 counts)
+            candidates = (numpy.arange(len(query)) -
+                          numpy.repeat(numpy.cumsum(counts) - counts,
+                                       counts) +
+                          numpy.repeat(lo[chunk_start:chunk_end], counts))
+            keep = self.ends[candidates] > starts[query]
+            hits.append(candidates[keep])
+            offsets[chunk_start + 1:chunk_end + 1] = numpy.bincount(
+                query[keep] - chunk_start,
+                minlength=chunk_end - chunk_start)
+            chunk_start = chunk_end
+
+        numpy.cumsum(offsets, out=offsets)
+        return offsets, numpy.concatenate(hits)
+
+    def save(self, filename):
+        '''save index to *filename*.'''
+        self._build()
+        with open(filename, "wb") as outf:
+            pickle.dump(self, outf, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        '''load an index from *filename* created by :meth:`save`.'''
+        with open(filename, "rb") as inf:
+            index = pickle.load(inf)
+        if not isinstance(index, cls):
+            raise ValueError("%s does not contain a %s" %
+                             (filename, cls.__name__))
+        return index
+
+    def __len__(self):
+        '''return number of contigs.'''
+        return len(set(self.mContigs).union(self.mPending))
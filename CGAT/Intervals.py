@@ -14,11 +14,18 @@ An interval list is simply a list of such intervals.
 The majority of the functions in this module take one or more lists of
 intervals and return one or more new lists of intervals.
 
+Functions with the suffix ``Arrays`` take intervals as two
+:mod:`numpy` arrays of start and end coordinates instead of a list of
+tuples. They use a sweep over sorted coordinates and are suited to
+large sets of intervals.
+
 Reference
 ---------
 
 '''
 
+import numpy
+
 
 def getLength(intervals):
     """return sum of intervals lengths.
@@ -277,6 +284,81 @@ def fromArray(a):
     return intervals
 
 
+def combineArrays(starts, ends):
+    """combine overlapping and adjacent intervals given as arrays
+    of start and end coordinates.
+
+    Empty intervals are removed.
+
+    >>> starts, ends = combineArrays([30, 10, 15], [40, 20, 25])
+    >>> list(zip(starts.tolist(), ends.tolist()))
+    [(10, 25), (30, 40)]
+
+    Returns
+    -------
+    starts : numpy.array
+    ends : numpy.array
+       Sorted, non-overlapping intervals.
+    """
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    if len(starts) == 0:
+        return starts, ends
+
+    order = numpy.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    max_ends = numpy.maximum.accumulate(ends)
+
+    # a new interval starts after the end of all previous intervals
+    first = numpy.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > max_ends[:-1]
+    last = numpy.append(numpy.nonzero(first)[0][1:] - 1, len(starts) - 1)
+    return starts[first], max_ends[last]
+
+
+def calculateOverlapArrays(starts, ends, other_starts, other_ends):
+    """calculate the number of bases in each interval that are
+    covered by a set of other intervals.
+
+    The other intervals need to be sorted and non-overlapping, see
+    :func:`combineArrays`.
+
+    >>> calculateOverlapArrays([0, 15, 50], [12, 35, 60],
+    ...                        [10, 30], [20, 40]).tolist()
+    [2, 10, 0]
+
+    Returns
+    -------
+    overlap : numpy.array
+       Number of bases covered in each interval.
+    """
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    other_starts = numpy.asarray(other_starts, dtype=numpy.int64)
+    other_ends = numpy.asarray(other_ends, dtype=numpy.int64)
+
+    if len(other_starts) == 0:
+        return numpy.zeros(len(starts), dtype=numpy.int64)
+
+    cumulative = numpy.zeros(len(other_starts) + 1, dtype=numpy.int64)
+    numpy.cumsum(other_ends - other_starts, out=cumulative[1:])
+
+    def _coveredBefore(positions):
+        # bases covered by other intervals before positions
+        index = numpy.searchsorted(other_starts, positions, side="left")
+        covered = cumulative[index]
+        previous = index > 0
+        covered[previous] -= numpy.maximum(
+            other_ends[index[previous] - 1] - positions[previous], 0)
+        return covered
+
+    return numpy.where(ends > starts,
+                       _coveredBefore(ends) - _coveredBefore(starts),
+                       0)
+
+
 def combineAtDistance(intervals, min_distance):
     """combine a list intervals and merge those that are less than a
     certain distance apart.
@@ -0,0 +1,133 @@
+'''Parallel.py - Process data in chunks across worker processes
+==========================================================
+
+This module collects the functions shared by scripts and modules
+that offer a ``--num-workers`` option.
+
+Work is described by an iterable of picklable items, for example
+chunks of gene models or genomic windows. :func:`imap` applies a
+function to each item in a pool of worker processes and returns the
+results in the order of the input. With a single worker, the function
+is applied in the current process, so the same code path serves both
+modes.
+
+Open file handles can not be sent to worker processes. State that
+requires them, such as an open :term:`bam` file, is built by an
+`initializer` that is called once in each worker::
+
+   WORKER = {}
+
+   def initWorker(filename):
+       WORKER["samfile"] = pysam.AlignmentFile(filename)
+
+   def countWorker(region):
+       return count(WORKER["samfile"], *region)
+
+   for result in Parallel.imap(countWorker, regions,
+                               num_workers=options.num_workers,
+                               initializer=initWorker,
+                               initargs=(filename,)):
+       ...
+
+:func:`worker_options` returns a copy of the command line options
+without the standard file handles that can be passed as an argument
+to an initializer.
+
+Reference
+---------
+
+'''
+
+import copy
+import itertools
+import multiprocessing
+
+
+def worker_options(options, *keys):
+    '''return a copy of *options* to be sent to worker processes.
+
+    The standard streams (stdin, stdout, stdlog and stderr) and
+    any other attribute in *keys* are set to None as file handles
+    can not be shared with worker processes.
+    '''
+    options = copy.copy(options)
+    for key in ("stdin", "stdout", "stdlog", "stderr") + keys:
+        setattr(options, key, None)
+    return options
+
+
+def iterate_chunks(iterable, chunk_size, key=None):
+    '''group items in *iterable* into lists of at most *chunk_size*
+    items.
+
+    If *key* is given, a chunk only contains items for which *key*
+    returns the same value, for example items on the same contig.
+    '''
+    chunk, last_key = [], None
+    for item in iterable:
+        if key is not None:
+            item_key = key(item)
+            if chunk and item_key != last_key:
+                yield chunk
+                chunk = []
+            last_key = item_key
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def imap(function, iterable, num_workers=1,
+         initializer=None, initargs=(),
+         batch_size=None, chunksize=1):
+    '''apply *function* to each item in *iterable* and iterate over
+    the results in the order of *iterable*.
+
+    If *num_workers* is larger than 1, items are processed by a pool
+    of *num_workers* processes. Otherwise, items are processed in the
+    current process. *initializer* is called with *initargs* once in
+    each process before any item is processed.
+
+    By default, the pool consumes *iterable* as fast as it can and
+    holds all pending items in memory. If *batch_size* is given, at
+    most *batch_size* items are submitted at a time. *chunksize* is
+    passed to :meth:`multiprocessing.pool.Pool.imap`.
+
+    The pool is closed once all results have been returned and is
+    terminated if the iteration stops early.
+    '''
+
+    if num_workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in iterable:
+            yield function(item)
+        return
+
+    pool = multiprocessing.Pool(num_workers,
+                                initializer=initializer,
+                                initargs=initargs)
+    try:
+        if batch_size is None:
+            for result in pool.imap(function, iterable,
+                                    chunksize=chunksize):
+                yield result
+        else:
+            iterator = iter(iterable)
+            while True:
+                batch = list(itertools.islice(iterator, batch_size))
+                if not batch:
+                    break
+                for result in pool.map(function, batch):
+                    yield result
+    except BaseException:
+        # includes GeneratorExit if the caller stops early
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
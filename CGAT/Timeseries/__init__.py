@@ -21,7 +21,6 @@ import itertools
 import os
 import math
 from rpy2.robjects import pandas2ri
-from rpy2.robjects.packages import importr
 from rpy2.robjects import r as R
 import rpy2.robjects as ro
 import random
@@ -1057,40 +1056,91 @@ def adaptiveTune(value, k):
         return (2/(1 + math.exp(k*abs(value))))
 
 
-def dtwWrapper(data, rows, columns, k):
+def temporalCorrelationMatrix(x, y):
     '''
-    wrapper function for dynamic time warping.
-    includes use of exponential adaptive tuning function
-    with temporal correlation if k > 0
+    Calculate the temporal correlation between all rows of x and all
+    rows of y, see :func:`temporalCorrelate`.
+    Returns an array of shape (len(x), len(y)).
     '''
 
-    # not explicitly called, but needs to be in R environment
-    DTW = importr("dtw")
+    u = np.diff(np.asarray(x, dtype=np.float64), axis=1)
+    v = np.diff(np.asarray(y, dtype=np.float64), axis=1)
 
-    # create a data frame of zeros of size number of ids x number of ids
-    # fill it with the calculated distance metric for each pair wise comparison
+    nume = np.dot(u, v.T)
+    denom = np.outer(np.sqrt((u ** 2).sum(axis=1)),
+                     np.sqrt((v ** 2).sum(axis=1)))
 
-    df_ = pd.DataFrame(index=rows,
-                       columns=columns)
-    df_ = df_.fillna(0.0).astype(np.float64)
+    corr = np.zeros(nume.shape, dtype=np.float64)
+    np.divide(nume, denom, out=corr, where=denom != 0)
+    return corr
 
-    # fill the array with dtw-distance values
-    pandas2ri.activate()
 
-    for i in rows:
-        E.info("DTW %s" % i)
-        for j in columns:
-            series1 = data.loc[i].values.tolist()
-            series2 = data.loc[j].values.tolist()
-            DTW_value = (R.dtw(series1,
-                               series2)).rx('distance')[0][0]
-            cort_value = temporalCorrelate(series1, series2)
-            tuned_value = adaptiveTune(cort_value, k)
-            time_dist = DTW_value * tuned_value
-            df_.loc[i][j] = float(time_dist)
-            df_[j][i] = float(time_dist)
+def crossCorrelationMatrix(x, y, lag=0):
+    '''
+    Calculate the normalized cross-correlation at lag=n between all
+    rows of x and all rows of y, see :func:`crossCorrelate`.
+    Returns an array of shape (len(x), len(y)).
+    '''
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    len_t = x.shape[1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_norm = ((x - x.mean(axis=1)[:, np.newaxis]) /
+                  (x.std(axis=1)[:, np.newaxis] * len_t))
+        s_norm = ((y - y.mean(axis=1)[:, np.newaxis]) /
+                  y.std(axis=1)[:, np.newaxis])
+
+    # equivalent to np.correlate(t, s, mode=2)[len_t - 1 + lag]
+    if lag >= 0:
+        return np.dot(t_norm[:, lag:], s_norm[:, :len_t - lag].T)
+    else:
+        return np.dot(t_norm[:, :len_t + lag], s_norm[:, -lag:].T)
+
+
+def distanceMatrix(x, y, method, lag=0, k=0):
+    '''
+    Calculate time series distances between all rows of x and all
+    rows of y.
+
+    method is one of "cross-correlate", "temporal-correlate" or
+    "dtw". For the correlation methods the distance is 1 - abs(corr).
+    For dynamic time warping the distance is tuned with the temporal
+    correlation if k > 0 (see :func:`adaptiveTune`).
+
+    Returns an array of shape (len(x), len(y)).
+    '''
+
+    if method == "cross-correlate":
+        return 1.0 - np.abs(crossCorrelationMatrix(x, y, lag=lag))
+    elif method == "temporal-correlate":
+        return 1.0 - np.abs(temporalCorrelationMatrix(x, y))
+    elif method == "dtw":
+        dist = c2m.dtw_distance_matrix(x, y)
+        if k != 0:
+            dist *= 2.0 / (1.0 + np.exp(
+                k * np.abs(temporalCorrelationMatrix(x, y))))
+        return dist
+    else:
+        raise ValueError("unknown distance method '%s'" % method)
 
-    return df_
+
+def dtwWrapper(data, rows, columns, k):
+    '''
+    wrapper function for dynamic time warping.
+    includes use of exponential adaptive tuning function
+    with temporal correlation if k > 0
+    '''
+
+    rows, columns = list(rows), list(columns)
+    E.info("DTW for %i x %i time series" % (len(rows), len(columns)))
+
+    return pd.DataFrame(distanceMatrix(data.loc[rows].values,
+                                       data.loc[columns].values,
+                                       "dtw", k=k),
+                        index=rows,
+                        columns=columns)
 
 
 def correlateDistanceMetric(data, rows, columns, method, lag=0):
@@ -1101,33 +1151,14 @@ def correlateDistanceMetric(data, rows, columns, method, lag=0):
     or normalised cross correlation.
     '''
 
-    # create blank (all 0's) dataframe to fill with correlation values
+    rows, columns = list(rows), list(columns)
+    E.info("%s for %i x %i time series" % (method, len(rows), len(columns)))
 
-    df_ = pd.DataFrame(index=rows,
-                       columns=columns)
-    df_ = df_.fillna(0.0)
-
-    if method == "cross-correlate":
-        for i in rows:
-            E.info("cross-correlation %s" % i)
-            for j in columns:
-                series1 = data.loc[i].values.tolist()
-                series2 = data.loc[j].values.tolist()
-                corr = crossCorrelate(series1, series2, lag=lag)
-                df_.loc[i][j] = 1.0 - abs(corr)
-                df_[j][i] = 1.0 - abs(corr)
-
-    elif method == "temporal-correlate":
-        for i in rows:
-            E.info("temporal correlation %s" % i)
-            for j in columns:
-                series1 = data.loc[i].tolist()
-                series2 = data.loc[j].tolist()
-                corr = temporalCorrelate(series1, series2)
-                df_.loc[i][j] = 1.0 - abs(corr)
-                df_[j][i] = 1.0 - abs(corr)
-
-    return df_
+    return pd.DataFrame(distanceMatrix(data.loc[rows].values,
+                                       data.loc[columns].values,
+                                       method, lag=lag),
+                        index=rows,
+                        columns=columns)
 
 
 def splitFiles(infile, nchunks, out_dir):
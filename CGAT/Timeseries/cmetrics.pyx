@@ -1,6 +1,8 @@
 import CGATCore.Experiment as E
 import numpy as pynp
 cimport numpy as np
+cimport cython
+from libc.math cimport fabs
 
 def consensus_metrics(array):
     '''Cythonised attempt at consensus clustering
@@ -106,3 +108,79 @@ def adjusted_rand_index(agree_mat, disagree_mat, agree1_mat, agree2_mat, n):
     return (pynp.asarray(adjrand_array), pynp.asarray(rand_array))
 
 
+
+
+cdef inline double _dtw(const double * x, int n,
+                        const double * y, int m,
+                        double * previous, double * current) nogil:
+    '''dynamic time warping distance between x and y.
+
+    Uses the symmetric2 step pattern with absolute differences as
+    local cost. Only two rows of the cumulative cost matrix are kept.
+    '''
+
+    cdef int i, j
+    cdef double cost, best
+    cdef double * swap
+
+    for i in range(n):
+        for j in range(m):
+            cost = fabs(x[i] - y[j])
+            if i == 0 and j == 0:
+                current[j] = cost
+            elif i == 0:
+                current[j] = current[j - 1] + cost
+            elif j == 0:
+                current[j] = previous[j] + cost
+            else:
+                # diagonal step is weighted twice
+                best = previous[j - 1] + 2.0 * cost
+                if previous[j] + cost < best:
+                    best = previous[j] + cost
+                if current[j - 1] + cost < best:
+                    best = current[j - 1] + cost
+                current[j] = best
+
+        swap = previous
+        previous = current
+        current = swap
+
+    return previous[m - 1]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def dtw_distance_matrix(x, y):
+    '''dynamic time warping distances between all rows of
+    x and all rows of y.
+
+    The distance is computed with the symmetric2 step pattern
+    and absolute differences as local cost, the defaults of the
+    R dtw package.
+
+    Returns an array of shape (len(x), len(y)).
+    '''
+
+    cdef double[:, ::1] xv = pynp.ascontiguousarray(x, dtype=pynp.float64)
+    cdef double[:, ::1] yv = pynp.ascontiguousarray(y, dtype=pynp.float64)
+    cdef int nx = xv.shape[0]
+    cdef int ny = yv.shape[0]
+    cdef int n = xv.shape[1]
+    cdef int m = yv.shape[1]
+    cdef int a, b
+
+    result = pynp.zeros((nx, ny), dtype=pynp.float64)
+    if n == 0 or m == 0:
+        return result
+
+    buffers = pynp.empty((2, m), dtype=pynp.float64)
+    cdef double[:, ::1] rv = result
+    cdef double[:, ::1] bv = buffers
+
+    with nogil:
+        for a in range(nx):
+            for b in range(ny):
+                rv[a, b] = _dtw(&xv[a, 0], n, &yv[b, 0], m,
+                                &bv[0, 0], &bv[1, 0])
+
+    return result
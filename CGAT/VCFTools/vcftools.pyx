@@ -13,6 +13,7 @@ import array
 import base64
 import collections
 import collections
+import copyreg
 import hashlib
 import itertools
 import math
@@ -29,6 +30,7 @@ from rpy2.robjects import pandas2ri
 pandas2ri.activate()
 
 import CGATCore.Experiment as E
+import CGAT.Parallel as Parallel
 
 cimport numpy
 
@@ -46,10 +48,33 @@ def generate_from_region(vcf_file, region):
     for v in vcf_file.fetch(region=region):
         yield v
 
+def generate_from_regions(vcf_file, regions):
+    """iterate over records in a list of regions.
+
+    Each region is a tuple of contig, start, end and the minimum
+    start of records to output. Records starting before the minimum
+    start are skipped, so that records overlapping adjacent regions
+    are only returned once. If the minimum start is None, all
+    records overlapping the region are returned.
+    """
+    for contig, start, end, min_start in regions:
+        for v in vcf_file.fetch(contig, start, end):
+            if min_start is not None and v.start < min_start:
+                continue
+            yield v
+
 
 ACGT = str.maketrans("ACGT", "TGCA")
 
 
+def signature_counts():
+    """return a nested dictionary of counts by sample, mutation
+    class and context."""
+    return collections.defaultdict(
+        lambda: collections.defaultdict(
+            lambda: collections.defaultdict(int)))
+
+
 cdef class Counter(object):
 
     cdef int nsamples
@@ -64,6 +89,24 @@ cdef class Counter(object):
     cdef process_record(self, VariantRecord record, bint is_snp):
         raise NotImplementedError("base class must implement process_record")
 
+    def merge(self, Counter other):
+        """add the counts in *other* to this counter."""
+        raise NotImplementedError("base class must implement merge")
+
+    # Counters are sent between processes without their file
+    # handles, as these are only needed for counting.
+    def __reduce__(self):
+        return (copyreg.__newobj__, (type(self),), self.__getstate__())
+
+    def __getstate__(self):
+        return {"samples": self.samples,
+                "only_variant_positions": self.only_variant_positions}
+
+    def __setstate__(self, state):
+        self.samples = state["samples"]
+        self.nsamples = len(self.samples)
+        self.only_variant_positions = state["only_variant_positions"]
+
     
 cdef class CounterKinship(Counter):
 
@@ -176,6 +219,26 @@ cdef class CounterKinship(Counter):
                          self.n_AAaa[_i][_j],
                          self.n_AaAa[_i][_j]))) + "\n")
 
+    def merge(self, CounterKinship other):
+        self.n_Aa += other.n_Aa
+        self.n_AAaa += other.n_AAaa
+        self.n_AaAa += other.n_AaAa
+
+    def __getstate__(self):
+        state = Counter.__getstate__(self)
+        state.update({"n_Aa": self.n_Aa,
+                      "n_AAaa": self.n_AAaa,
+                      "n_AaAa": self.n_AaAa})
+        return state
+
+    def __setstate__(self, state):
+        Counter.__setstate__(self, state)
+        self.data_genotype_ptr = NULL
+        self.n_Aa = state["n_Aa"]
+        self.n_AAaa = state["n_AAaa"]
+        self.n_AaAa = state["n_AaAa"]
+        self.genotype_values = numpy.zeros(self.nsamples, dtype=numpy.int8)
+
     def __dealloc__(self):
         if self.data_genotype_ptr is not NULL:
             free(self.data_genotype_ptr)
@@ -301,6 +364,30 @@ cdef class CounterFormatDistributions(Counter):
                           delimiter="\t",
                           fmt="%i")
 
+    def merge(self, CounterFormatDistributions other):
+        self.counts += other.counts
+        self.unset_samples += other.unset_samples
+        self.unset_sites += other.unset_sites
+
+    def __getstate__(self):
+        state = Counter.__getstate__(self)
+        state.update({"codes": self.codes,
+                      "nbins": self.nbins,
+                      "counts": self.counts,
+                      "unset_samples": self.unset_samples,
+                      "unset_sites": self.unset_sites})
+        return state
+
+    def __setstate__(self, state):
+        Counter.__setstate__(self, state)
+        self.codes = state["codes"]
+        self.ncodes = len(self.codes)
+        self.nbins = state["nbins"]
+        self.counts = state["counts"]
+        self.unset_samples = state["unset_samples"]
+        self.unset_sites = state["unset_sites"]
+        self.values = numpy.zeros(self.nsamples, dtype=numpy.int32)
+
 
 cdef class CounterMutationalSignature(Counter):
 
@@ -349,9 +436,7 @@ cdef class CounterMutationalSignature(Counter):
         }
         assert len(self.profile.keys()) == 12
 
-        self.signatures = collections.defaultdict(
-            lambda: collections.defaultdict(
-                lambda: collections.defaultdict(int)))
+        self.signatures = signature_counts()
 
     cdef process_record(self, VariantRecord record, bint is_snp):
 
@@ -424,6 +509,29 @@ cdef class CounterMutationalSignature(Counter):
                              100.0 * count / total_class[cls])
                         )) + "\n")
 
+    def merge(self, CounterMutationalSignature other):
+        for s, dd in other.signatures.items():
+            for cls, d in dd.items():
+                for context, count in d.items():
+                    self.signatures[s][cls][context] += count
+
+    def __getstate__(self):
+        state = Counter.__getstate__(self)
+        state.update({
+            "profile": self.profile,
+            "signatures": {s: {cls: dict(d) for cls, d in dd.items()}
+                           for s, dd in self.signatures.items()}})
+        return state
+
+    def __setstate__(self, state):
+        Counter.__setstate__(self, state)
+        self.fasta_in = None
+        self.profile = state["profile"]
+        self.signatures = signature_counts()
+        for s, dd in state["signatures"].items():
+            for cls, d in dd.items():
+                self.signatures[s][cls].update(d)
+
 
 
 cdef class CounterMutationalSignatureProfile(CounterMutationalSignature):
@@ -446,6 +554,17 @@ cdef class CounterMutationalSignatureProfile(CounterMutationalSignature):
 
         self.signatures_database = "signatures.cosmic"
         self.counts_method = "genome"
+
+    def __getstate__(self):
+        state = CounterMutationalSignature.__getstate__(self)
+        state.update({"signatures_database": self.signatures_database,
+                      "counts_method": self.counts_method})
+        return state
+
+    def __setstate__(self, state):
+        CounterMutationalSignature.__setstate__(self, state)
+        self.signatures_database = state["signatures_database"]
+        self.counts_method = state["counts_method"]
         
     def output(self):
 
@@ -457,7 +576,7 @@ cdef class CounterMutationalSignatureProfile(CounterMutationalSignature):
 
         rows = []
         samples = []
-        for sample, dd in self.signatures.items():
+        for sample, dd in sorted(self.signatures.items()):
             values = {}
             for cls, d in dd.items():
                 for context, count in d.items():
@@ -559,6 +678,23 @@ cdef class CounterGCContext(Counter):
             for row in mm:
                 outf.write("{}\n".format("\t".join(map(str, row))))
 
+    def merge(self, CounterGCContext other):
+        self.counts += other.counts
+
+    def __getstate__(self):
+        state = Counter.__getstate__(self)
+        state.update({"nbins": self.nbins,
+                      "window_size": self.window_size,
+                      "counts": self.counts})
+        return state
+
+    def __setstate__(self, state):
+        Counter.__setstate__(self, state)
+        self.fasta_in = None
+        self.nbins = state["nbins"]
+        self.window_size = state["window_size"]
+        self.counts = state["counts"]
+
 
 cdef class CounterGCDepthProfile(Counter):
 
@@ -646,21 +782,34 @@ cdef class CounterGCDepthProfile(Counter):
                 for gc_bin, mean in zip(gc_bins, means):
                     outf.write("{}\t{}\t{:.2f}\n".format(sample, gc_bin, mean))
 
-
-def vcf2stats_count(VariantFile vcf_in,
-                    FastaFile fasta_in,
-                    TabixFile bed_in,
-                    options):
-
-    if options.region is not None:
-        vcf_records = generate_from_region(vcf_in, options.region)
-    elif bed_in is not None:
-        vcf_records = generate_from_bed(vcf_in, bed_in)
-    else:
-        vcf_records = generate_from_vcf(vcf_in)
-
-    samples = list(vcf_in.header.samples)
-
+    def merge(self, CounterGCDepthProfile other):
+        self.counts += other.counts
+
+    def __getstate__(self):
+        state = Counter.__getstate__(self)
+        state.update({"nbins_gc": self.nbins_gc,
+                      "nbins_dp": self.nbins_dp,
+                      "window_size": self.window_size,
+                      "counts": self.counts})
+        return state
+
+    def __setstate__(self, state):
+        Counter.__setstate__(self, state)
+        self.fasta_in = None
+        self.nbins_gc = state["nbins_gc"]
+        self.nbins_dp = state["nbins_dp"]
+        self.window_size = state["window_size"]
+        self.counts = state["counts"]
+
+
+def build_counters(samples, FastaFile fasta_in, options, with_output=True):
+    """return a list of counters for *options.methods*.
+
+    If *with_output* is False, counters are only used for counting
+    and will be merged into counters that produce the output. Counters
+    computing mutational signature profiles then do not need to set up
+    R.
+    """
     counters = []
 
     for method in options.methods:
@@ -669,9 +818,14 @@ def vcf2stats_count(VariantFile vcf_in,
                 fasta_in=fasta_in,
                 samples=samples))
         elif method == "mutational-signature-profile":
-            counters.append(CounterMutationalSignatureProfile(
-                fasta_in=fasta_in,
-                samples=samples))
+            if with_output:
+                counters.append(CounterMutationalSignatureProfile(
+                    fasta_in=fasta_in,
+                    samples=samples))
+            else:
+                counters.append(CounterMutationalSignature(
+                    fasta_in=fasta_in,
+                    samples=samples))
         elif method == "kinship":
             counters.append(CounterKinship(
                 samples=samples))
@@ -691,16 +845,19 @@ def vcf2stats_count(VariantFile vcf_in,
                 gc_window_size=options.gc_window_size,
                 only_variant_positions=options.only_variant_positions))
 
-    cdef bint is_snp
+    return counters
 
-    cdef int report_step = options.report_step
+
+def count_records(vcf_records, counters, int report_step):
+    """apply *counters* to all PASS records in *vcf_records*."""
+
+    cdef bint is_snp
     cdef int record_idx
     cdef VariantRecord record
-
     cdef Counter counter
 
     for record_idx, record in enumerate(vcf_records):
-        if (record_idx % options.report_step) == 0:
+        if (record_idx % report_step) == 0:
             E.debug("iteration {}: {}:{}".format(record_idx, record.chrom, record.pos))
 
         if record.filter.values()[0].name != "PASS":
@@ -719,5 +876,145 @@ def vcf2stats_count(VariantFile vcf_in,
         for counter in counters:
             counter.process_record(record, is_snp)
 
+
+def split_region(contig, start, end, region_size):
+    """split a region into windows of *region_size* for
+    :func:`generate_from_regions`.
+
+    Records overlapping the start of the region are returned
+    with the first window. If *end* is None, the last window
+    extends to the end of the contig.
+    """
+    regions = []
+    window_start = start
+    min_start = None
+    while end is None or window_start < end:
+        window_end = window_start + region_size
+        if end is None or window_end >= end:
+            regions.append((contig, window_start, end, min_start))
+            break
+        regions.append((contig, window_start, window_end, min_start))
+        window_start = min_start = window_end
+    return regions
+
+
+def get_regions(VariantFile vcf_in, TabixFile bed_in, options):
+    """return a list of regions covering the records selected
+    by *options* for :func:`generate_from_regions`.
+
+    Intervals in *bed_in* are returned as they are. Contigs or a
+    region given by *options.region* are split into windows of
+    *options.region_size*.
+    """
+    if options.region is not None:
+        region = options.region
+        if region in vcf_in.header.contigs or ":" not in region:
+            contig, start, end = region, 0, None
+        else:
+            contig, _, interval = region.rpartition(":")
+            start, _, end = interval.replace(",", "").partition("-")
+            # region strings are 1-based and closed
+            start = max(0, int(start) - 1)
+            end = int(end) if end else None
+        return split_region(contig, start, end, options.region_size)
+    elif bed_in is not None:
+        return [(bed.contig, bed.start, bed.end, None)
+                for bed in bed_in.fetch(parser=pysam.asBed())]
+    else:
+        regions = []
+        for contig in vcf_in.index:
+            # records beyond the contig length end up in the last window
+            if contig in vcf_in.header.contigs:
+                length = vcf_in.header.contigs[contig].length
+            else:
+                length = None
+            if length is None:
+                regions.append((contig, 0, None, None))
+                continue
+            regions.extend(
+                split_region(contig, 0, length, options.region_size))
+            contig, start, end, min_start = regions[-1]
+            regions[-1] = (contig, start, None, min_start)
+        return regions
+
+
+# state of a worker process
+WORKER = {}
+
+
+def init_count_worker(vcf_filename, fasta_filename, options):
+    """open files in a worker process for :func:`count_worker`."""
+    WORKER["vcf_in"] = pysam.VariantFile(vcf_filename)
+    if fasta_filename is not None:
+        WORKER["fasta_in"] = pysam.FastaFile(fasta_filename)
+    else:
+        WORKER["fasta_in"] = None
+    WORKER["options"] = options
+
+
+def count_worker(regions):
+    """return counters applied to all records in *regions*."""
+    vcf_in = WORKER["vcf_in"]
+    options = WORKER["options"]
+    counters = build_counters(list(vcf_in.header.samples),
+                              WORKER["fasta_in"],
+                              options,
+                              with_output=False)
+    count_records(generate_from_regions(vcf_in, regions),
+                  counters,
+                  options.report_step)
+    return counters
+
+
+def vcf2stats_count(VariantFile vcf_in,
+                    FastaFile fasta_in,
+                    TabixFile bed_in,
+                    options):
+    """apply counters in *options.methods* to the records in *vcf_in*
+    and output the results.
+
+    If *options.num_workers* is larger than 1, records are counted
+    in regions by worker processes. Each worker opens its own
+    :term:`vcf` and :term:`fasta` files and counts records in a
+    share of regions. The counters of all workers are merged
+    before output.
+    """
+    samples = list(vcf_in.header.samples)
+    counters = build_counters(samples, fasta_in, options)
+
+    if options.num_workers <= 1:
+        if options.region is not None:
+            vcf_records = generate_from_region(vcf_in, options.region)
+        elif bed_in is not None:
+            vcf_records = generate_from_bed(vcf_in, bed_in)
+        else:
+            vcf_records = generate_from_vcf(vcf_in)
+
+        count_records(vcf_records, counters, options.report_step)
+    else:
+        regions = get_regions(vcf_in, bed_in, options)
+        # assign regions in turn so that each worker receives
+        # regions from across the genome
+        shards = [regions[x::options.num_workers]
+                  for x in range(options.num_workers)]
+        shards = [x for x in shards if x]
+        E.info("counting {} regions with {} worker processes".format(
+            len(regions), len(shards)))
+
+        if fasta_in is not None:
+            fasta_filename = fasta_in.filename
+        else:
+            fasta_filename = None
+
+        # merge in a fixed order so that output is reproducible
+        for worker_counters in Parallel.imap(
+                count_worker, shards,
+                num_workers=len(shards),
+                initializer=init_count_worker,
+                initargs=(vcf_in.filename, fasta_filename,
+                          Parallel.worker_options(options))):
+            for counter, other in zip(counters, worker_counters):
+                counter.merge(other)
+
     for counter in counters:
         counter.output()
@@ -290,6 +290,18 @@ be compressed with and indexed with :file:`tabix`.
    treated individually.
 
 
+Parallel processing
++++++++++++++++++++
+
+Counting can be distributed over several processes with the
+``--num-workers`` option. Transcripts or genes are grouped into chunks
+of at most ``--chunk-size`` items that do not span contigs. Each worker
+process opens its own :term:`bam`, :term:`bed` or bigwig files and
+counts all of them for the transcripts in a chunk. The meta-gene
+profiles of all workers are added up at the end. The
+``--output-all-profiles`` option can not be used with multiple
+workers.
+
 Command line options
 --------------------
 
@@ -297,16 +309,257 @@ Command line options
 
 import os
 import sys
+import io
 import CGATCore.Experiment as E
 import CGATCore.IOTools as IOTools
 import pysam
 import CGAT.GTF as GTF
+import CGAT.Parallel as Parallel
 import numpy
 import pandas
 
 from CGAT.BamTools import geneprofile
 
 
+def buildRangeCounter(options):
+    """build the range counter for the input files.
+
+    All :term:`bam`, :term:`bed` and bigwig files are opened within
+    this function so that each worker process in ``--num-workers``
+    mode obtains its own set of file handles.
+    """
+
+    # Select rangecounter based on file type
+    if options.infiles[0].endswith(".bam"):
+        bamfiles = [pysam.AlignmentFile(x, "rb") for x in options.infiles]
+
+        if options.controlfiles:
+            controlfiles = [pysam.AlignmentFile(x, "rb")
+                            for x in options.controlfiles]
+        else:
+            controlfiles = None
+
+        format = "bam"
+        if options.merge_pairs:
+            range_counter = geneprofile.RangeCounterBAM(
+                bamfiles,
+                shifts=options.shifts,
+                extends=options.extends,
+                merge_pairs=options.merge_pairs,
+                min_insert_size=options.min_insert_size,
+                max_insert_size=options.max_insert_size,
+                controfiles=controlfiles,
+                control_factor=options.control_factor)
+
+        elif options.shifts or options.extends:
+            range_counter = geneprofile.RangeCounterBAM(
+                bamfiles,
+                shifts=options.shifts,
+                extends=options.extends,
+                controlfiles=controlfiles,
+                control_factor=options.control_factor)
+
+        elif options.base_accuracy:
+            range_counter = geneprofile.RangeCounterBAMBaseAccuracy(
+                bamfiles,
+                controlfiles=controlfiles,
+                control_factor=options.control_factor)
+        else:
+            range_counter = geneprofile.RangeCounterBAM(
+                bamfiles,
+                controlfiles=controlfiles,
+                control_factor=options.control_factor)
+
+    elif options.infiles[0].endswith(".bed.gz"):
+        bedfiles = [pysam.Tabixfile(x) for x in options.infiles]
+
+        if options.controlfiles:
+            controlfiles = [pysam.Tabixfile(x)
+                            for x in options.controlfiles]
+        else:
+            controlfiles = None
+
+        range_counter = geneprofile.RangeCounterBed(
+            bedfiles,
+            controlfiles=controlfiles,
+            control_factor=options.control_factor)
+
+    elif options.infiles[0].endswith(".bw"):
+        wigfiles = [BigWigFile(file=open(x)) for x in options.infiles]
+        range_counter = geneprofile.RangeCounterBigWig(wigfiles)
+
+    else:
+        raise NotImplementedError(
+            "can't determine file type for %s" % str(options.infiles))
+
+    return range_counter
+
+
+def buildCounters(options, range_counter):
+    """build the meta-gene counters selected on the command line.
+
+    Returns
+    -------
+    counters : list
+        List of :class:`geneprofile.IntervalsCounter` objects.
+    """
+
+    counters = []
+    for method in options.methods:
+        if method == "utrprofile":
+            counters.append(geneprofile.UTRCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_upstream_utr,
+                options.resolution_cds,
+                options.resolution_downstream_utr,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream,
+            ))
+
+        elif method == "geneprofile":
+            counters.append(geneprofile.GeneCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_cds,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream,
+                options.scale_flanks))
+
+        elif method == "geneprofilewithintrons":
+            counters.append(geneprofile.GeneCounterWithIntrons(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_cds,
+                options.resolution_introns,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream,
+                options.scale_flanks))
+
+        elif method == "geneprofileabsolutedistancefromthreeprimeend":
+            # options.extension_exons_absolute_distance_tostartsite,
+            # options.extension_introns_absolute_distance_tostartsite,
+            # Tim 31th Aug 2013: a possible feature for future,  if five prime
+            # bias is of your interest.
+            # (you need to create another class). It is not very difficult to
+            # derive from this class, but is not implemented yet
+            # This future feature is slightly different the TSS profile
+            # already implemented, because in this future feature introns are
+            # skipped,
+            counters.append(
+                geneprofile.GeneCounterAbsoluteDistanceFromThreePrimeEnd(
+                    range_counter, options.resolution_upstream,
+                    options.resolution_downstream,
+                    options.resolution_exons_absolute_distance_topolya,
+                    options.resolution_introns_absolute_distance_topolya,
+                    options.extension_upstream,
+                    options.extension_downstream,
+                    options.extension_exons_absolute_distance_topolya,
+                    options.extension_introns_absolute_distance_topolya,
+                    options.scale_flanks))
+
+        elif method == "tssprofile":
+            counters.append(geneprofile.TSSCounter(
+                range_counter,
+                options.extension_outward,
+                options.extension_inward))
+
+        elif method == "intervalprofile":
+            counters.append(geneprofile.RegionCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_cds,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+        elif method == "midpointprofile":
+            counters.append(geneprofile.MidpointCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+        # add new method to split 1st and last exons out
+        # requires a representative transcript for reach gene
+        # gtf should be sorted gene-position
+        elif method == "separateexonprofile":
+            counters.append(geneprofile.SeparateExonCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_first,
+                options.resolution_last,
+                options.resolution_cds,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+        elif method == "separateexonprofilewithintrons":
+            counters.append(geneprofile.SeparateExonWithIntronCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_first,
+                options.resolution_last,
+                options.resolution_cds,
+                options.resolution_introns,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+    # set normalization
+    for c in counters:
+        c.setNormalization(options.transcript_normalization)
+
+    return counters
+
+
+def iterator_chunks(gtf_iterator, chunk_size):
+    """group transcripts or genes into chunks to be processed by a worker.
+
+    Chunks do not span contigs and contain at most `chunk_size`
+    transcripts or genes. Each is represented by its :term:`gtf`
+    formatted lines.
+    """
+    for chunk in Parallel.iterate_chunks(
+            gtf_iterator, chunk_size, key=lambda gtf: gtf[0].contig):
+        yield ["".join(["%s\n" % x for x in gtf]) for gtf in chunk]
+
+
+# state of a worker process in --num-workers mode
+WORKER = {}
+
+
+def initWorker(options):
+    """open input files and set up counters in a worker process."""
+    WORKER["counters"] = buildCounters(options, buildRangeCounter(options))
+
+
+def countChunk(chunk):
+    """count a chunk of transcripts or genes in a worker process.
+
+    Returns the number of transcripts or genes in the chunk and the
+    counts collected by each counter, see
+    :meth:`geneprofile.IntervalsCounter.getState`.
+    """
+    counters = WORKER["counters"]
+    for lines in chunk:
+        gtf = list(GTF.iterator(io.StringIO(lines)))
+        gtf.sort(key=lambda x: x.start)
+        for counter in counters:
+            counter.update(gtf)
+
+    states = []
+    for counter in counters:
+        states.append(counter.getState())
+        counter.resetState()
+
+    return len(chunk), states
+
+
 def main(argv=None):
     """script main.
 
@@ -530,6 +783,19 @@ def main(argv=None):
         "to be considered for background meta-gene normalization "
         "[%default]")
 
+    parser.add_option("--num-workers",
+                      dest="num_workers",
+                      type="int",
+                      help="number of worker processes. Transcripts or "
+                      "genes are split into chunks by contig and counted "
+                      "in parallel [%default]")
+
+    parser.add_option("--chunk-size",
+                      dest="chunk_size",
+                      type="int",
+                      help="maximum number of transcripts or genes in a "
+                      "chunk processed by a worker [%default]")
+
     parser.set_defaults(
         remove_rna=False,
         ignore_pairs=False,
@@ -579,6 +845,8 @@ def main(argv=None):
         output_all_profiles=False,
         background_region_bins=10,
         input_filename_counts=None,
+        num_workers=1,
+        chunk_size=100,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -601,6 +869,11 @@ def main(argv=None):
     if len(options.infiles) == 0:
         raise ValueError("no bam/wig/bed files specified")
 
+    if options.num_workers > 1 and options.output_all_profiles:
+        raise ValueError(
+            "--output-all-profiles writes profiles in input order and "
+            "can not be used with --num-workers > 1")
+
     for methodsRequiresBaseAccuracy in [
             "geneprofilewithintrons",
             "geneprofileabsolutedistancefromthreeprimeend",
@@ -617,180 +890,11 @@ def main(argv=None):
     elif options.reporter == "transcript":
         gtf_iterator = GTF.transcript_iterator(GTF.iterator(options.gtffile))
 
-    # Select rangecounter based on file type
-    if len(options.infiles) > 0:
-        if options.infiles[0].endswith(".bam"):
-            bamfiles = [pysam.AlignmentFile(x, "rb") for x in options.infiles]
-
-            if options.controlfiles:
-                controlfiles = [pysam.AlignmentFile(x, "rb")
-                                for x in options.controlfiles]
-            else:
-                controlfiles = None
-
-            format = "bam"
-            if options.merge_pairs:
-                range_counter = geneprofile.RangeCounterBAM(
-                    bamfiles,
-                    shifts=options.shifts,
-                    extends=options.extends,
-                    merge_pairs=options.merge_pairs,
-                    min_insert_size=options.min_insert_size,
-                    max_insert_size=options.max_insert_size,
-                    controfiles=controlfiles,
-                    control_factor=options.control_factor)
-
-            elif options.shifts or options.extends:
-                range_counter = geneprofile.RangeCounterBAM(
-                    bamfiles,
-                    shifts=options.shifts,
-                    extends=options.extends,
-                    controlfiles=controlfiles,
-                    control_factor=options.control_factor)
-
-            elif options.base_accuracy:
-                range_counter = geneprofile.RangeCounterBAMBaseAccuracy(
-                    bamfiles,
-                    controlfiles=controlfiles,
-                    control_factor=options.control_factor)
-            else:
-                range_counter = geneprofile.RangeCounterBAM(
-                    bamfiles,
-                    controlfiles=controlfiles,
-                    control_factor=options.control_factor)
-
-        elif options.infiles[0].endswith(".bed.gz"):
-            bedfiles = [pysam.Tabixfile(x) for x in options.infiles]
-
-            if options.controlfiles:
-                controlfiles = [pysam.Tabixfile(x)
-                                for x in options.controlfiles]
-            else:
-                controlfiles = None
-
-            range_counter = geneprofile.RangeCounterBed(
-                bedfiles,
-                controlfiles=controlfiles,
-                control_factor=options.control_factor)
-
-        elif options.infiles[0].endswith(".bw"):
-            wigfiles = [BigWigFile(file=open(x)) for x in options.infiles]
-            range_counter = geneprofile.RangeCounterBigWig(wigfiles)
-
-        else:
-            raise NotImplementedError(
-                "can't determine file type for %s" % str(options.infiles))
-
-    counters = []
-    for method in options.methods:
-        if method == "utrprofile":
-            counters.append(geneprofile.UTRCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_upstream_utr,
-                options.resolution_cds,
-                options.resolution_downstream_utr,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream,
-            ))
-
-        elif method == "geneprofile":
-            counters.append(geneprofile.GeneCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_cds,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream,
-                options.scale_flanks))
-
-        elif method == "geneprofilewithintrons":
-            counters.append(geneprofile.GeneCounterWithIntrons(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_cds,
-                options.resolution_introns,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream,
-                options.scale_flanks))
-
-        elif method == "geneprofileabsolutedistancefromthreeprimeend":
-            # options.extension_exons_absolute_distance_tostartsite,
-            # options.extension_introns_absolute_distance_tostartsite,
-            # Tim 31th Aug 2013: a possible feature for future,  if five prime
-            # bias is of your interest.
-            # (you need to create another class). It is not very difficult to
-            # derive from this class, but is not implemented yet
-            # This future feature is slightly different the TSS profile
-            # already implemented, because in this future feature introns are
-            # skipped,
-            counters.append(
-                geneprofile.GeneCounterAbsoluteDistanceFromThreePrimeEnd(
-                    range_counter, options.resolution_upstream,
-                    options.resolution_downstream,
-                    options.resolution_exons_absolute_distance_topolya,
-                    options.resolution_introns_absolute_distance_topolya,
-                    options.extension_upstream,
-                    options.extension_downstream,
-                    options.extension_exons_absolute_distance_topolya,
-                    options.extension_introns_absolute_distance_topolya,
-                    options.scale_flanks))
-
-        elif method == "tssprofile":
-            counters.append(geneprofile.TSSCounter(
-                range_counter,
-                options.extension_outward,
-                options.extension_inward))
+    range_counter = buildRangeCounter(options)
+    counters = buildCounters(options, range_counter)
 
-        elif method == "intervalprofile":
-            counters.append(geneprofile.RegionCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_cds,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
-
-        elif method == "midpointprofile":
-            counters.append(geneprofile.MidpointCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
-
-        # add new method to split 1st and last exons out
-        # requires a representative transcript for reach gene
-        # gtf should be sorted gene-position
-        elif method == "separateexonprofile":
-            counters.append(geneprofile.SeparateExonCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_first,
-                options.resolution_last,
-                options.resolution_cds,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
-
-        elif method == "separateexonprofilewithintrons":
-            counters.append(geneprofile.SeparateExonWithIntronCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_first,
-                options.resolution_last,
-                options.resolution_cds,
-                options.resolution_introns,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
-
-    # set normalization
-    for c in counters:
-        c.setNormalization(options.transcript_normalization)
-        if options.output_all_profiles:
+    if options.output_all_profiles:
+        for c in counters:
             c.setOutputProfiles(IOTools.open_file(E.get_output_file(c.name) +
                                                  ".profiles.tsv.gz", "w"))
 
@@ -809,6 +913,27 @@ def main(argv=None):
         counters = [counter]
         geneprofile.countFromCounts(counters, all_counts)
 
+    elif options.num_workers > 1:
+        # workers open their own files in buildRangeCounter
+        worker_options = Parallel.worker_options(options, "gtffile")
+        # compute normalization factor for control files only once
+        worker_options.control_factor = range_counter.control_factor
+
+        E.info("starting counting with %i counters and %i worker processes" %
+               (len(counters), options.num_workers))
+        ninput = 0
+        results = Parallel.imap(
+            countChunk,
+            iterator_chunks(gtf_iterator, options.chunk_size),
+            num_workers=options.num_workers,
+            initializer=initWorker,
+            initargs=(worker_options,))
+        for n, states in results:
+            ninput += n
+            for counter, state in zip(counters, states):
+                counter.addState(state)
+        E.info("counted %i transcripts or genes" % ninput)
+
     else:
         E.info("starting counting with %i counters" % len(counters))
         feature_names = geneprofile.countFromGTF(counters,
@@ -960,5 +1085,6 @@ def main(argv=None):
     # write footer and output benchmark information.
     E.stop()
 
+
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
@@ -8,13 +8,15 @@ Purpose
 
 convert a bam file to a bigwig or bedgraph file.
 
-Depending on options chosen, this script either computes the densities
-itself or makes use of faster solutions if possible. The script
-requires the executables :file:`wigToBigWig` and :file:`bedToBigBed`
-to be in the user's PATH.
+:term:`bigwig` files are written directly using :mod:`pyBigWig`, no
+external executables or temporary files are required.
 
-If no --shift-size or --extend option are given, the coverage is computed
-directly on reads.  Counting can be performed at a certain resolution.
+:term:`wiggle` and :term:`bedgraph` output is computed by iterating
+over pileup columns. :term:`bigwig` coverage is computed from the
+reference region of each read, but counts the same reads and
+columns as the pileup, so that all three formats report the same
+coverage. Counting can be performed at a certain
+resolution (``--wiggle-span``).
 
 The counting currently is not aware of spliced reads, i.e., an
 inserted intron will be included in the coverage.
@@ -22,11 +24,24 @@ inserted intron will be included in the coverage.
 If --shift-size or --extend are given, the coverage is computed by shifting
 read alignment positions upstream for positive strand reads or
 downstream for negative strand reads and extend them by a fixed
-amount.
+amount. With --merge-pairs, the coverage is computed from the
+fragment spanned by each read pair. These options are only available
+for bigwig output.
+
+With ``--scale-method=reads``, bigwig coverage is normalized by the
+number of reads counted.
 
 For RNASEQ data it might be best to run genomeCoverageBed directly on
 the bam file.
 
+Parallel processing
++++++++++++++++++++
+
+With ``--num-workers`` larger than 1, bigwig coverage is computed for
+several contigs in parallel. Each worker process opens its own
+handle on the :term:`bam` file, which needs to be indexed. The output
+is identical to the serial computation.
+
 Usage
 -----
 
@@ -46,13 +61,12 @@ Command line options
 
 import os
 import sys
-import tempfile
-import shutil
-import subprocess
+import numpy
+import pyBigWig
 import CGATCore.Experiment as E
+import CGAT.Parallel as Parallel
 import pysam
-import CGATCore.IOTools as IOTools
-from CGAT.BamTools.bamtools import merge_pairs
+from CGAT.BamTools.bamtools import bam2intervals
 
 
 class SpanWriter(object):
@@ -144,6 +158,174 @@ class SpanWriter(object):
                 self.val / (self.lastend % self.span)))
 
 
+def intervals2runs(starts, ends):
+    """convert intervals into runs of constant coverage.
+
+    Returns arrays of start, end and coverage of runs with non-zero
+    coverage. Adjacent runs differ in coverage.
+    """
+    if len(starts) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, empty
+
+    positions = numpy.concatenate((starts, ends))
+    deltas = numpy.concatenate((numpy.ones(len(starts), dtype=numpy.int64),
+                                -numpy.ones(len(ends), dtype=numpy.int64)))
+    order = numpy.argsort(positions, kind="stable")
+    positions = positions[order]
+    coverage = numpy.cumsum(deltas[order])
+
+    # coverage after all events at a position have been applied
+    last = numpy.append(positions[1:] != positions[:-1], True)
+    positions = positions[last]
+    coverage = coverage[last]
+
+    starts, ends, coverage = positions[:-1], positions[1:], coverage[:-1]
+
+    # merge adjacent runs of identical coverage
+    first = numpy.append(True, coverage[1:] != coverage[:-1])
+    starts, coverage = starts[first], coverage[first]
+    ends = numpy.append(starts[1:], ends[-1])
+
+    nonzero = coverage > 0
+    return starts[nonzero], ends[nonzero], coverage[nonzero]
+
+
+def runs2windows(starts, ends, coverage, span):
+    """average coverage within windows of size *span*.
+
+    Returns the start and mean coverage of windows with non-zero
+    coverage.
+    """
+    if len(starts) == 0:
+        return starts, numpy.zeros(0, dtype=numpy.float64)
+
+    # cumulative coverage at run boundaries
+    totals = numpy.cumsum((ends - starts) * coverage, dtype=numpy.float64)
+    boundaries = numpy.empty(2 * len(starts), dtype=numpy.int64)
+    boundaries[0::2], boundaries[1::2] = starts, ends
+    cumulative = numpy.empty(2 * len(starts), dtype=numpy.float64)
+    cumulative[0] = 0
+    cumulative[2::2] = totals[:-1]
+    cumulative[1::2] = totals
+
+    first = starts[0] - starts[0] % span
+    last = ends[-1] + (-ends[-1]) % span
+    edges = numpy.arange(first, last + 1, span)
+    means = numpy.diff(numpy.interp(edges, boundaries, cumulative)) / span
+
+    nonzero = means > 0
+    return edges[:-1][nonzero], means[nonzero]
+
+
+def computeCoverage(samfile, contig, options):
+    """compute coverage runs on *contig*."""
+    starts, ends, ncounted = bam2intervals(
+        samfile,
+        contig,
+        shift=options.shift,
+        extend=options.extend,
+        merge_pairs=bool(options.merge_pairs),
+        min_insert_size=options.min_insert_size,
+        max_insert_size=options.max_insert_size)
+    starts, ends, coverage = intervals2runs(starts, ends)
+    if not (options.shift or options.extend or options.merge_pairs):
+        # output coverage as the pileup based wiggle and bedgraph
+        # output, which omits the last base of each run (see
+        # column_iter in main)
+        ends = ends - 1
+        keep = ends > starts
+        starts, ends, coverage = starts[keep], ends[keep], coverage[keep]
+    return contig, starts, ends, coverage, ncounted
+
+
+# state of a worker process, see initWorker
+WORKER = {}
+
+
+def initWorker(options):
+    """initialize a worker process with its own bam file handle."""
+    WORKER["options"] = options
+    WORKER["samfile"] = pysam.AlignmentFile(options.samfile, "rb")
+
+
+def countContig(contig):
+    """compute coverage on *contig* in a worker process."""
+    return computeCoverage(WORKER["samfile"], contig, WORKER["options"])
+
+
+def writeBigWig(options):
+    """compute coverage and write it to a bigwig file.
+
+    Contigs are processed in parallel if ``options.num_workers`` is
+    larger than 1. Results are written in the order of contigs in the
+    bam file header.
+    """
+
+    samfile = pysam.AlignmentFile(options.samfile, "rb")
+    contigs = list(samfile.references)
+
+    if options.num_workers > 1:
+        results = Parallel.imap(
+            countContig, contigs,
+            num_workers=options.num_workers,
+            initializer=initWorker,
+            initargs=(Parallel.worker_options(options),))
+    else:
+        results = (computeCoverage(samfile, contig, options)
+                   for contig in contigs)
+
+    if options.scale_method == "reads":
+        # scaling requires the total number of reads
+        results = list(results)
+        ncounted = sum([x[-1] for x in results])
+        if ncounted == 0:
+            raise ValueError("no reads counted, can not scale")
+        scale_factor = float(options.scale_base) / ncounted
+        E.info("scaling: method=%s scale_quantity=%i scale_factor=%f" %
+               (options.scale_method,
+                ncounted,
+                scale_factor))
+    else:
+        scale_factor = None
+
+    output_filename = os.path.abspath(options.output_filename_pattern)
+    E.info("starting output to %s" % output_filename)
+    outfile = pyBigWig.open(output_filename, "w")
+    outfile.addHeader(list(zip(samfile.references, samfile.lengths)))
+
+    ncontigs, ncounted = 0, 0
+    for contig, starts, ends, coverage, n in results:
+        E.debug("output for %s" % contig)
+        ncounted += n
+        ncontigs += 1
+        if len(starts) == 0:
+            continue
+        if scale_factor is not None:
+            coverage = coverage * scale_factor
+        if options.span > 1:
+            starts, values = runs2windows(starts, ends, coverage,
+                                          options.span)
+            outfile.addEntries(contig,
+                               starts.tolist(),
+                               values=values.astype(numpy.float64).tolist(),
+                               span=options.span)
+        else:
+            outfile.addEntries([contig] * len(starts),
+                               starts.tolist(),
+                               ends=ends.tolist(),
+                               values=coverage.astype(
+                                   numpy.float64).tolist())
+
+    outfile.close()
+
+    if options.merge_pairs and ncounted == 0:
+        raise ValueError("no pairs output after merging")
+
+    E.info("finished output: ncontigs=%i, ncounted=%i" %
+           (ncontigs, ncounted))
+
+
 def main(argv=None):
     """script main.
     """
@@ -206,6 +388,11 @@ def main(argv=None):
                       "at least # bases apart. "
                       "0 turns of this filter. [default=%default]")
 
+    parser.add_option("--num-workers", dest="num_workers", type="int",
+                      help="number of worker processes. Contigs are "
+                      "processed in parallel if larger than 1. Only "
+                      "applies to bigwig output [default=%default]")
+
     parser.set_defaults(
         samfile=None,
         output_format="wiggle",
@@ -217,6 +404,7 @@ def main(argv=None):
         max_insert_size=0,
         scale_method='none',
         scale_base=1000000,
+        num_workers=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -229,56 +417,34 @@ def main(argv=None):
     if not options.samfile:
         raise ValueError("please provide a bam file")
 
-    # Read BAM file using Pysam
-    samfile = pysam.AlignmentFile(options.samfile, "rb")
-
-    # Create temporary files / folders
-    tmpdir = tempfile.mkdtemp()
-    E.debug("temporary files are in %s" % tmpdir)
-    tmpfile_wig = os.path.join(tmpdir, "wig")
-    tmpfile_sizes = os.path.join(tmpdir, "sizes")
-
-    # Create dictionary of contig sizes
-    contig_sizes = dict(list(zip(samfile.references, samfile.lengths)))
-    # write contig sizes
-    outfile_size = IOTools.open_file(tmpfile_sizes, "w")
-    for contig, size in sorted(contig_sizes.items()):
-        outfile_size.write("%s\t%s\n" % (contig, size))
-    outfile_size.close()
-
     # Shift and extend only available for bigwig format
-    if options.shift or options.extend:
+    if options.shift or options.extend or options.merge_pairs:
         if options.output_format != "bigwig":
             raise ValueError(
-                "shift and extend only available for bigwig output")
+                "shift, extend and merge-pairs only available "
+                "for bigwig output")
 
-    # Output filename required for bigwig / bigbed computation
     if options.output_format == "bigwig":
+        # Workflow 1: compute coverage from read intervals and write
+        # it directly into a bigwig file.
         if not options.output_filename_pattern:
             raise ValueError(
                 "please specify an output file for bigwig computation.")
+        writeBigWig(options)
+        E.stop()
+        return
 
-        # Define executable to use for binary conversion
-        if options.output_format == "bigwig":
-            executable_name = "wigToBigWig"
-        else:
-            raise ValueError("unknown output format `%s`" %
-                             options.output_format)
+    # Read BAM file using Pysam
+    samfile = pysam.AlignmentFile(options.samfile, "rb")
 
-        # check required executable file is in the path
-        executable = IOTools.which(executable_name)
-        if not executable:
-            raise OSError("could not find %s in path." % executable_name)
+    # Create dictionary of contig sizes
+    contig_sizes = dict(list(zip(samfile.references, samfile.lengths)))
 
-        # Open outout file
-        outfile = IOTools.open_file(tmpfile_wig, "w")
-        E.info("starting output to %s" % tmpfile_wig)
-    else:
-        outfile = IOTools.open_file(tmpfile_wig, "w")
-        E.info("starting output to stdout")
+    outfile = options.stdout
+    E.info("starting output to stdout")
 
     # Set up output write functions
-    if options.output_format in ("wiggle", "bigwig"):
+    if options.output_format == "wiggle":
         # wiggle is one-based, so add 1, also step-size is 1, so need
         # to output all bases
         if options.span == 1:
@@ -292,178 +458,73 @@ def main(argv=None):
         # bed is 0-based, open-closed
         outf = lambda outfile, contig, start, end, val: \
             outfile.write("%s\t%i\t%i\t%i\n" % (contig, start, end, val))
+    else:
+        raise ValueError("unknown output format `%s`" %
+                         options.output_format)
 
     # initialise counters
     ninput, nskipped, ncontigs = 0, 0, 0
 
-    # set output file name
-    output_filename_pattern = options.output_filename_pattern
-    if output_filename_pattern:
-        output_filename = os.path.abspath(output_filename_pattern)
-
-    # shift and extend or merge pairs. Output temporay bed file
-    if options.shift > 0 or options.extend > 0 or options.merge_pairs:
-        # Workflow 1: convert to bed intervals and use bedtools
-        # genomecov to build a coverage file.
-        # Convert to bigwig with UCSC tools bedGraph2BigWig
-
-        if options.merge_pairs:
-            # merge pairs using bam2bed
-            E.info("merging pairs to temporary file")
-            counter = merge_pairs(
-                samfile,
-                outfile,
-                min_insert_size=options.min_insert_size,
-                max_insert_size=options.max_insert_size,
-                bed_format=3)
-            E.info("merging results: {}".format(counter))
-            if counter.output == 0:
-                raise ValueError("no pairs output after merging")
-        else:
-            # create bed file with shifted/extended tags
-            shift, extend = options.shift, options.extend
-            shift_extend = shift + extend
-            counter = E.Counter()
-
-            for contig in samfile.references:
-                E.debug("output for %s" % contig)
-                lcontig = contig_sizes[contig]
-
-                for read in samfile.fetch(contig):
-                    pos = read.pos
-                    if read.is_reverse:
-                        start = max(0, read.pos + read.alen - shift_extend)
-                    else:
-                        start = max(0, read.pos + shift)
-
-                    # intervals extending beyond contig are removed
-                    if start >= lcontig:
-                        continue
-
-                    end = min(lcontig, start + extend)
-                    outfile.write("%s\t%i\t%i\n" % (contig, start, end))
-                    counter.output += 1
-
-        outfile.close()
-
-        if options.scale_method == "reads":
-            scale_factor = float(options.scale_base) / counter.output
-
-            E.info("scaling: method=%s scale_quantity=%i scale_factor=%f" %
-                   (options.scale_method,
-                    counter.output,
-                    scale_factor))
-            scale = "-scale %f" % scale_factor
-        else:
-            scale = ""
-
-        # Convert bed file to coverage file (bedgraph)
-        tmpfile_bed = os.path.join(tmpdir, "bed")
-        E.info("computing coverage")
-        # calculate coverage - format is bedgraph
-        statement = """bedtools genomecov -bg -i %(tmpfile_wig)s %(scale)s
-        -g %(tmpfile_sizes)s > %(tmpfile_bed)s""" % locals()
-        E.run(statement)
-
-        # Convert bedgraph to bigwig
-        E.info("converting to bigwig")
-        tmpfile_sorted = os.path.join(tmpdir, "sorted")
-        statement = ("sort -k 1,1 -k2,2n %(tmpfile_bed)s > %(tmpfile_sorted)s;"
-                     "bedGraphToBigWig %(tmpfile_sorted)s %(tmpfile_sizes)s "
-                     "%(output_filename_pattern)s" % locals())
-        E.run(statement)
-
+    # Workflow 2: use pysam column iterator to build a
+    # wig or bedgraph file.
+    def column_iter(iterator):
+        start = None
+        end = 0
+        n = None
+        for t in iterator:
+            if t.pos - end > 1 or n != t.n:
+                if start is not None:
+                    yield start, end, n
+                start = t.pos
+                end = t.pos
+                n = t.n
+            end = t.pos
+        yield start, end, n
+
+    if options.scale_method != "none":
+        raise NotImplementedError(
+            "scaling not implemented for pileup method")
+
+    # Bedgraph track definition
+    if options.output_format == "bedgraph":
+        outfile.write("track type=bedGraph\n")
+
+    for contig in samfile.references:
+        E.debug("output for %s" % contig)
+        lcontig = contig_sizes[contig]
+
+        # Write wiggle header
+        if options.output_format == "wiggle":
+            outfile.write("variableStep chrom=%s span=%i\n" %
+                          (contig, options.span))
+
+        # Generate pileup per contig using pysam and iterate over columns
+        for start, end, val in column_iter(samfile.pileup(contig)):
+            # patch: there was a problem with bam files and reads
+            # overextending at the end. These are usually Ns, but
+            # need to check as otherwise wigToBigWig fails.
+            if lcontig <= end:
+                E.warn("read extending beyond contig: %s: %i > %i" %
+                       (contig, end, lcontig))
+                end = lcontig
+                if start >= end:
+                    continue
+
+            if val > 0:
+                outf(outfile, contig, start, end, val)
+        ncontigs += 1
+
+    # Close output file
+    if type(outf) == type(SpanWriter):
+        outf.flush(outfile)
     else:
+        outfile.flush()
 
-        # Workflow 2: use pysam column iterator to build a
-        # wig file. Then convert to bigwig of bedgraph file
-        # with UCSC tools.
-        def column_iter(iterator):
-            start = None
-            end = 0
-            n = None
-            for t in iterator:
-                if t.pos - end > 1 or n != t.n:
-                    if start is not None:
-                        yield start, end, n
-                    start = t.pos
-                    end = t.pos
-                    n = t.n
-                end = t.pos
-            yield start, end, n
-
-        if options.scale_method != "none":
-            raise NotImplementedError(
-                "scaling not implemented for pileup method")
-
-        # Bedgraph track definition
-        if options.output_format == "bedgraph":
-            outfile.write("track type=bedGraph\n")
-
-        for contig in samfile.references:
-            # if contig != "chrX": continue
-            E.debug("output for %s" % contig)
-            lcontig = contig_sizes[contig]
-
-            # Write wiggle header
-            if options.output_format in ("wiggle", "bigwig"):
-                outfile.write("variableStep chrom=%s span=%i\n" %
-                              (contig, options.span))
-
-            # Generate pileup per contig using pysam and iterate over columns
-            for start, end, val in column_iter(samfile.pileup(contig)):
-                # patch: there was a problem with bam files and reads
-                # overextending at the end. These are usually Ns, but
-                # need to check as otherwise wigToBigWig fails.
-                if lcontig <= end:
-                    E.warn("read extending beyond contig: %s: %i > %i" %
-                           (contig, end, lcontig))
-                    end = lcontig
-                    if start >= end:
-                        continue
-
-                if val > 0:
-                    outf(outfile, contig, start, end, val)
-            ncontigs += 1
-
-        # Close output file
-        if type(outf) == type(SpanWriter):
-            outf.flush(outfile)
-        else:
-            outfile.flush()
-
-        E.info("finished output")
-
-        # Report counters
-        E.info("ninput=%i, ncontigs=%i, nskipped=%i" %
-               (ninput, ncontigs, nskipped))
-
-        # Convert to binary formats
-        if options.output_format == "bigwig":
-            outfile.close()
-
-            E.info("starting %s conversion" % executable)
-            try:
-                retcode = subprocess.call(
-                    " ".join((executable,
-                              tmpfile_wig,
-                              tmpfile_sizes,
-                              output_filename_pattern)),
-                    shell=True)
-                if retcode != 0:
-                    E.warn("%s terminated with signal: %i" %
-                           (executable, -retcode))
-                    return -retcode
-            except OSError as msg:
-                E.warn("Error while executing bigwig: %s" % msg)
-                return 1
-            E.info("finished bigwig conversion")
-        else:
-            with open(tmpfile_wig) as inf:
-                sys.stdout.write(inf.read())
+    E.info("finished output")
 
-    # Cleanup temp files
-    shutil.rmtree(tmpdir)
+    # Report counters
+    E.info("ninput=%i, ncontigs=%i, nskipped=%i" %
+           (ninput, ncontigs, nskipped))
 
     E.stop()
 
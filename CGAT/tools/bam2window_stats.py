@@ -6,7 +6,39 @@ Purpose
 This script takes a bam file as input and computes a few metrics by
 iterating over the file. The metrics output are:
 
+<flag>
+    number of alignments with a particular flag set, one column for
+    each flag such as ``paired``, ``reverse`` or ``duplicate``.
+
+alignment_starts, alignment_ends
+    number of alignments starting or ending in a window.
+
+alignments
+    number of alignments overlapping a window.
+
+matched_bases, mismatched_bases
+    number of aligned bases matching or not matching the reference
+    according to the MD tag.
+
+inserted_bases, deleted_bases
+    number of bases inserted or deleted.
+
+hard_clipped_alignments, hard_clipped_bases
+    number of hard-clipped alignments and bases.
+
+soft_clipped_alignments, soft_clipped_bases
+    number of soft-clipped alignments and bases.
+
+bases_gc, bases_at, percent_gc
+    G+C and A+T content of a window. Only computed if
+    ``--reference-fasta`` is given.
+
+The :term:`bam` file needs to be indexed and given as a filename.
+Windows on different contigs can be counted in parallel with the
+``--num-workers`` option.
+
 '''
+import sys
 import pysam
 
 import CGATCore.Experiment as E
@@ -45,28 +77,37 @@ def main(argv=None):
         help="filename with reference sequence. If given, used to "
         "compute G+C content in windows [%default]")
 
+    parser.add_option(
+        "--num-workers", dest="num_workers", type="int",
+        help="number of worker processes to use for counting windows "
+        "on different contigs [%default]")
+
     parser.set_defaults(
         force_output=False,
         region=None,
         output_all_windows=False,
         window_size=500,
         input_filename_fasta=None,
+        num_workers=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.start(parser, argv=argv, add_output_options=True)
 
-    is_stdin = True
     if len(args) > 0:
-        pysam_in = pysam.AlignmentFile(args[0], "rb")
-        if args[0] != "-":
-            is_stdin = False
+        filename = args[0]
     elif options.stdin == sys.stdin:
-        pysam_in = pysam.AlignmentFile("-", "rb")
+        filename = "-"
     else:
-        pysam_in = pysam.AlignmentFile(options.stdin, "rb")
-        if options.stdin != "-":
-            is_stdin = False
+        filename = options.stdin
+
+    # windows are counted contig by contig, which requires an index
+    if filename == "-":
+        raise ValueError(
+            "bam2window_stats requires an indexed bam file given as "
+            "a filename, reading from stdin is not supported")
+
+    pysam_in = pysam.AlignmentFile(filename, "rb")
 
     if options.input_filename_fasta:
         fasta = pysam.FastaFile(options.input_filename_fasta)
@@ -77,7 +118,8 @@ def main(argv=None):
         pysam_in,
         region=options.region,
         window_size=options.window_size,
-        fasta=fasta)
+        fasta=fasta,
+        num_workers=options.num_workers)
 
     if not options.output_all_windows:
         counts_df = counts_df[counts_df.alignments > 0]
@@ -92,3 +134,7 @@ def main(argv=None):
         sep="\t")
 
     E.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
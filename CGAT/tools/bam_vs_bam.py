@@ -31,9 +31,19 @@ Documentation
 
 This tools allows users to compare the per base coverage between
 two BAM files. The output includes all bases in the supplied reference
-fasta except those with no coverage in the input BAMs.
+fasta except those with no coverage in the input BAMs. Coverage is the
+number of reads overlapping a base including reads with a deletion or
+skipped region at the base. Unmapped, secondary, duplicate and qc-fail
+reads are ignored, as are paired reads that are not mapped in a proper
+pair. Contigs that are not present in all BAM files are skipped.
 
-At present the --interval or -i option has not been implemented.
+Coverage is computed in windows of ``--window-size`` bases for all BAM
+files at once. The output is sorted by contig in the order of the first
+BAM file and by position. With ``--num-workers``, windows are processed
+by several worker processes.
+
+With ``--intervals-bed-file``, the output is restricted to bases within
+the intervals in a :term:`bed` formatted file.
 
 Command line options
 --------------------
@@ -42,12 +52,113 @@ Command line options
     supply a regex to extract an identifier from the filenames.
     defualts to using the filename
 
+``--intervals-bed-file``
+    restrict output to intervals in a :term:`bed` formatted file.
+
+``--window-size``
+    number of bases to compute coverage for at once.
+
+``--num-workers``
+    number of worker processes.
+
 """
 
+import collections
 import sys
 import re
+
+import numpy
 import pysam
 import CGATCore.Experiment as E
+import CGATCore.IOTools as IOTools
+import CGAT.Bed as Bed
+import CGAT.Parallel as Parallel
+
+# reads ignored in coverage computation: unmapped, secondary,
+# qc-fail and duplicates. Together with orphans (paired reads not
+# in a proper pair), these are the reads skipped by pileup.
+FILTER_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+WORKER = {}
+
+
+def fetchSpans(samfile, tid, start, end):
+    '''return arrays of reference start and end coordinates
+    of reads in *samfile* overlapping the region *start* to *end*.'''
+    starts, ends = [], []
+    for read in samfile.fetch(tid=tid, start=start, stop=end):
+        if read.flag & FILTER_FLAGS or read.reference_end is None:
+            continue
+        if read.is_paired and not read.is_proper_pair:
+            continue
+        starts.append(read.reference_start)
+        ends.append(read.reference_end)
+    return (numpy.array(starts, dtype=numpy.int64),
+            numpy.array(ends, dtype=numpy.int64))
+
+
+def computeDepth(starts, ends, start, end):
+    '''return an array with the per base coverage of reads
+    spanning *starts* to *ends* within the region *start* to *end*.'''
+    size = end - start
+    starts = numpy.clip(starts - start, 0, size)
+    ends = numpy.clip(ends - start, 0, size)
+    depth = (numpy.bincount(starts, minlength=size + 1) -
+             numpy.bincount(ends, minlength=size + 1))
+    return numpy.cumsum(depth[:-1])
+
+
+def initWorker(filenames):
+    WORKER["samfiles"] = [pysam.AlignmentFile(x, "rb") for x in filenames]
+
+
+def depthWorker(args):
+    '''return positions and depth in all BAM files of bases
+    covered in any BAM file within a window.'''
+    contig, tids, start, end = args
+    spans = [fetchSpans(samfile, tid, start, end)
+             for samfile, tid in zip(WORKER["samfiles"], tids)]
+
+    # skip empty windows without allocating depth arrays
+    if not any(len(starts) for starts, ends in spans):
+        return (contig,
+                numpy.zeros(0, dtype=numpy.int64),
+                numpy.zeros((len(spans), 0), dtype=numpy.int64))
+
+    depths = numpy.vstack([computeDepth(starts, ends, start, end)
+                           for starts, ends in spans])
+    covered = numpy.nonzero(depths.any(axis=0))[0]
+    return contig, covered + start, depths[:, covered]
+
+
+def readIntervals(filename):
+    '''return a dictionary of merged and sorted intervals per contig
+    in a :term:`bed` formatted file.'''
+    intervals = collections.defaultdict(list)
+    for bed in Bed.iterator(IOTools.open_file(filename)):
+        intervals[bed.contig].append((bed.start, bed.end))
+
+    merged = {}
+    for contig, segments in intervals.items():
+        segments.sort()
+        result = []
+        for start, end in segments:
+            if result and start <= result[-1][1]:
+                result[-1][1] = max(end, result[-1][1])
+            else:
+                result.append([start, end])
+        merged[contig] = result
+    return merged
+
+
+def iterateWindows(contigs, window_size):
+    '''iterate over windows of at most *window_size* within
+    regions *contigs*, a list of tuples (contig, tids, regions).'''
+    for contig, tids, regions in contigs:
+        for start, end in regions:
+            for window_start in range(start, end, window_size):
+                yield (contig, tids, window_start,
+                       min(end, window_start + window_size))
 
 
 def main(argv=None):
@@ -74,9 +185,19 @@ def main(argv=None):
                       help="regular expression to extract identifier from "
                       "filename [%default].")
 
+    parser.add_option("-w", "--window-size", dest="window_size",
+                      type="int",
+                      help="number of bases to compute coverage for "
+                      "at once [%default].")
+
+    parser.add_option("--num-workers", dest="num_workers", type="int",
+                      help="number of worker processes [%default].")
+
     parser.set_defaults(
         filename_intervals=None,
         regex_identifier="(.*)",
+        window_size=1000000,
+        num_workers=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -90,54 +211,60 @@ def main(argv=None):
         samfiles.append(pysam.AlignmentFile(f, "rb"))
 
     if options.filename_intervals:
-        raise NotImplementedError(
-            "It is not yet possible to specify intervals of interest.\
-            Repeat command without intervals option.")
+        intervals = readIntervals(options.filename_intervals)
+    else:
+        intervals = None
 
     titles = [re.search(options.regex_identifier, x).groups()[0] for x in args]
 
     options.stdout.write("contig\tpos\t%s\n" % "\t".join(titles))
 
     ninput, nskipped, noutput = 0, 0, 0
-    contigs = samfiles[0].references
-
-    for contig in contigs:
-
-        missing_contig = False
-
-        positions = {}
-
-        # lazy way: use dictionary
-        for x, f in enumerate(samfiles):
-            try:
-                i = f.pileup(contig)
-            except ValueError:
-                missing_contig = True
-                break
 
-            for v in i:
-                vp = v.pos
-                if vp in positions:
-                    positions[vp].append(v.n)
-                else:
-                    positions[vp] = [0] * x + [v.n]
-
-            # fill with 0 those not touched in this file
-            for p in list(positions.keys()):
-                if len(positions[p]) <= x:
-                    positions[p].append(0)
-
-        if missing_contig:
+    # collect regions to compute coverage for. Contigs are
+    # accessed by their index as names can not always be
+    # resolved.
+    contigs = []
+    for contig, length in zip(samfiles[0].references, samfiles[0].lengths):
+        ninput += 1
+        if not all(contig in f.references for f in samfiles):
             nskipped += 1
             continue
-
+        tids = [f.references.index(contig) for f in samfiles]
+        if intervals is None:
+            regions = [(0, length)]
+        elif contig in intervals:
+            regions = [(start, min(end, length))
+                       for start, end in intervals[contig]
+                       if start < length]
+        else:
+            regions = []
         noutput += 1
-        for pos in sorted(positions.keys()):
-            vals = positions[pos]
-            options.stdout.write("%s\t%i\t%s\n" % (contig, pos,
-                                                   "\t".join(map(str, vals))))
-
-    E.info("ninput=%i, noutput=%i, nskipped=%i" % (ninput, noutput, nskipped))
+        contigs.append((contig, tids, regions))
+
+    for f in samfiles:
+        f.close()
+
+    # process a limited number of windows at a time to bound memory usage
+    windows = iterateWindows(contigs, options.window_size)
+    npositions = 0
+    for contig, positions, depths in Parallel.imap(
+            depthWorker, windows,
+            num_workers=options.num_workers,
+            initializer=initWorker,
+            initargs=(args,),
+            batch_size=4 * options.num_workers):
+        if len(positions) == 0:
+            continue
+        npositions += len(positions)
+        numpy.savetxt(
+            options.stdout,
+            numpy.vstack([positions, depths]).T,
+            fmt=contig.replace("%", "%%") + "\t%i" * (len(titles) + 1),
+            delimiter="\t")
+
+    E.info("ninput=%i, noutput=%i, nskipped=%i, npositions=%i" %
+           (ninput, noutput, nskipped, npositions))
 
     # write footer and output benchmark information.
     E.stop()
@@ -19,15 +19,21 @@ Type::
 
 for command line help.
 
+Intervals in the second file are indexed and intervals from the first
+file are queried against the index in chunks of ``--chunk-size``
+intervals.
+
 Command line options
 --------------------
 
 """
 
+import itertools
 import sys
 import CGATCore.Experiment as E
 import CGATCore.IOTools as IOTools
 import CGAT.Bed as Bed
+import CGAT.IndexedGenome as IndexedGenome
 
 
 def main(argv=None):
@@ -47,8 +53,13 @@ def main(argv=None):
                       choices=("full", "name"),
                       help="output either ``full`` overlapping entries, only the ``name``s. [default=%default].")
 
+    parser.add_option("--chunk-size", dest="chunk_size", type="int",
+                      help="number of intervals to query at once "
+                      "[default=%default].")
+
     parser.set_defaults(
         output="full",
+        chunk_size=100000,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -64,7 +75,13 @@ def main(argv=None):
 
     infile2 = IOTools.open_file(args[1], "r")
 
-    idx = Bed.readAndIndex(infile2, with_values=True)
+    idx = IndexedGenome.GenomeIndex()
+    for bed in Bed.iterator(infile2):
+        try:
+            idx.add(bed.contig, bed.start, bed.end, bed)
+        except ValueError:
+            # ignore zero length intervals
+            continue
 
     output = options.output
     outfile = options.stdout
@@ -75,15 +92,22 @@ def main(argv=None):
     else:
         outf = str
 
-    for bed in Bed.iterator(infile1):
-        try:
-            overlaps = idx[bed.contig].find(bed.start, bed.end)
-        except (KeyError, IndexError):
-            # ignore missing contig and zero length intervals
-            continue
-
-        for o in overlaps:
-            outfile.write("\t".join((outf(bed), outf(o[2]))) + "\n")
+    iterator = Bed.iterator(infile1)
+    while True:
+        beds = list(itertools.islice(iterator, options.chunk_size))
+        if not beds:
+            break
+
+        # missing contigs and zero length intervals have no overlaps
+        offsets, hits = idx.query_many(
+            [bed.contig for bed in beds],
+            [bed.start for bed in beds],
+            [bed.end for bed in beds])
+        overlaps = idx.intervals(hits)
+
+        for x, bed in enumerate(beds):
+            for o in overlaps[offsets[x]:offsets[x + 1]]:
+                outfile.write("\t".join((outf(bed), outf(o[2]))) + "\n")
 
     E.stop()
 
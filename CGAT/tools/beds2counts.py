@@ -53,6 +53,7 @@ Command line options
 --------------------
 
 '''
+import itertools
 import tempfile
 import sys
 
@@ -87,7 +88,12 @@ def main(argv=None):
         help="supply list of bed files",
         action="append")
 
-    parser.set_defaults(infiles=[])
+    parser.add_option(
+        "--chunk-size", dest="chunk_size", type="int",
+        help="number of intervals to query at once [%default]")
+
+    parser.set_defaults(infiles=[],
+                        chunk_size=100000)
 
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.start(parser, argv=argv)
@@ -115,7 +121,7 @@ def main(argv=None):
 
     E.info("indexing bed entries")
     # index the bed entries
-    merged = IndexedGenome.Simple()
+    merged = IndexedGenome.GenomeIndex(with_values=False)
     for bed in Bed.iterator(IOTools.open_file(tmp_merge.name)):
         merged.add(bed.contig, bed.start, bed.end)
 
@@ -126,17 +132,26 @@ def main(argv=None):
     E.info("counting no. samples overlapping each interval")
     for sample in samples:
         found = set()
-        for bed in Bed.iterator(IOTools.open_file(sample)):
-            if merged.contains(bed.contig, bed.start, bed.end):
-                key = [bed.contig] + \
-                    [x for x in merged.get(bed.contig, bed.start, bed.end)]
-                key = (key[0], key[1][0], key[1][1])
-                if key in found:
-                    continue
-                found.add(key)
-
+        iterator = Bed.iterator(IOTools.open_file(sample))
+        while True:
+            beds = list(itertools.islice(iterator, options.chunk_size))
+            if not beds:
+                break
+            offsets, hits = merged.query_many(
+                [bed.contig for bed in beds],
+                [bed.start for bed in beds],
+                [bed.end for bed in beds])
+            # use the first merged interval overlapping each bed entry
+            has_hits = offsets[:-1] < offsets[1:]
+            first_hits = hits[offsets[:-1][has_hits]]
+            for bed, (start, end, idx) in zip(
+                    itertools.compress(beds, has_hits),
+                    merged.intervals(first_hits)):
                 # tuple of interval description as key - (contig, start, end)
-                counts[key] += 1
+                found.add((bed.contig, start, end))
+
+        for key in found:
+            counts[key] += 1
 
     # open outfile
     options.stdout.write("contig\tstart\tend\tcount\n")
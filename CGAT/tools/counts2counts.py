@@ -516,7 +516,7 @@ def main(argv=None):
                 raise Exception("no clusters were found, check parameters")
 
             E.info("shuffling subcluster regions...")
-            output_indices, counts = Counts.shuffleCluster(
+            output_indices, bin_counts = Counts.shuffleCluster(
                 initial_bins, change_bins, g_to_spike_tracks, groups,
                 options.difference, options.max_spike,
                 options.iterations, clusters_dict,
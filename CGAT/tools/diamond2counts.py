@@ -12,8 +12,13 @@ Count the number of alignments to each reference in outfmt6.
 Counts are based on various options specified by --method.
 
 best       This will take the best alignment as judged by the highest
-           bitscore.
+           bitscore. Ties are broken randomly, use --random-seed for
+           reproducible counts.
 
+The input is read in blocks of queries of about --block-size bytes
+that are parsed into columns. With --num-workers, blocks are processed
+by several worker processes. Ties are broken separately in each block,
+so counts depend on the block size but not on the number of workers.
 
 
 
@@ -40,11 +45,17 @@ Command line options
 
 import sys
 
+import numpy
+import pandas
+
 import CGATCore.Experiment as E
+import CGAT.Parallel as Parallel
 from CGAT.Diamond import *
 import collections
 import CGATCore.IOTools as IOTools
 
+WORKER = {}
+
 
 def readCogMap(cog_map):
     '''
@@ -57,6 +68,29 @@ def readCogMap(cog_map):
     return gene2cog
 
 
+def getRandomState(random_seed, index):
+    '''
+    return a random state for block index. The state is
+    derived from random_seed, if given.
+    '''
+    if random_seed is None:
+        return numpy.random.RandomState()
+    return numpy.random.RandomState([random_seed, index])
+
+
+def initWorker(random_seed):
+    WORKER["random_seed"] = random_seed
+
+
+def countWorker(args):
+    '''
+    count best alignments in a block of lines.
+    '''
+    index, lines = args
+    return count_best_alignments(
+        lines, getRandomState(WORKER["random_seed"], index))
+
+
 def main(argv=None):
     """script main.
 
@@ -90,11 +124,21 @@ def main(argv=None):
                       help="""number of queries to evaluate-
                               will take the first n in the file""")
 
+    parser.add_option("--num-workers", dest="num_workers", type="int",
+                      help="number of worker processes for counting "
+                      "[default=%default]")
+
+    parser.add_option("--block-size", dest="block_size", type="int",
+                      help="number of bytes of input to read and count "
+                      "at once [default=%default]")
+
     parser.set_defaults(method=None,
                         sum_cog=False,
                         evaluate_cog=False,
                         cog_map=None,
-                        nsamples=10000)
+                        nsamples=10000,
+                        num_workers=1,
+                        block_size=10000000)
 
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.start(parser, argv=argv)
@@ -112,32 +156,30 @@ def main(argv=None):
         E.info("retrieving alignment data")
         options.stdout.write("query\tpbest\tnalignments\n")
 
-        c = 0
-        for alignments in query_iterator(alignment_iterator(options.stdin)):
-            c += 1
-            scores = []
-            if c <= options.nsamples:
-                for alignment in alignments:
-                    scores.append(alignment.score)
-                    best = max(scores)
-                    best_alignments = [
-                        x for x in alignments if x.score == best]
-                    if len(best_alignments) > 1:
-                        best_alignments = random.sample(best_alignments, 1)
-                    best_alignment = best_alignments[0]
-                    best_cog = gene2cog[best_alignment.ref]
-                pbest = float(len(
-                    [gene2cog[x.ref]
-                     for x in alignments
-                     if gene2cog[x.ref] == best_cog])) / len(alignments) * 100
-                nalignments = len(alignments)
-                options.stdout.write(
-                    "\t".join(map(
-                        str, [alignments[0].qid,
-                              pbest,
-                              nalignments])) + "\n"
-                )
-            else:
+        nqueries = 0
+        blocks = query_block_iterator(options.stdin, options.block_size)
+        for index, lines in enumerate(blocks):
+            df = read_block(lines)
+            missing = ~df["ref"].isin(gene2cog)
+            if missing.any():
+                raise KeyError(df["ref"][missing].iloc[0])
+            cogs = pandas.factorize(df["ref"].map(gene2cog))[0]
+
+            queries = query_index(df)
+            best = best_alignments(
+                df, getRandomState(options.random_seed, index))
+            nalignments = numpy.bincount(queries)
+            nsame = numpy.bincount(
+                queries, weights=cogs == cogs[best][queries])
+            pbest = nsame / nalignments * 100
+
+            take = min(len(best), options.nsamples - nqueries)
+            for row in zip(df["qid"].values[best][:take],
+                           pbest[:take].tolist(),
+                           nalignments[:take]):
+                options.stdout.write("\t".join(map(str, row)) + "\n")
+            nqueries += take
+            if nqueries >= options.nsamples:
                 break
         return
 
@@ -153,24 +195,35 @@ def main(argv=None):
             assert options.cog_map, """a mapping between gene and
                                        function (COG) is required"""
 
+        E.info("counting best alignments")
+        blocks = enumerate(query_block_iterator(options.stdin,
+                                                options.block_size))
+        # process a limited number of blocks at a time to bound
+        # memory usage
+        for block_counts in Parallel.imap(
+                countWorker, blocks,
+                num_workers=options.num_workers,
+                initializer=initWorker,
+                initargs=(options.random_seed,),
+                batch_size=2 * max(1, options.num_workers)):
+            for ref, count in block_counts.items():
+                counts[ref] += count
+
+        if options.sum_cog:
             E.info("""reading gene to function (COG) mapping from %s"""
                    % options.cog_map)
             gene2cog = readCogMap(options.cog_map)
             E.info("loaded gene to function (COG) mapping")
 
             E.info("summing functional assignments")
-            query_it = query_iterator(alignment_iterator(options.stdin))
-            for best in best_alignment_iterator(query_it):
-                cog = gene2cog[best.ref]
+            cog_counts = collections.defaultdict(int)
+            for ref, count in counts.items():
+                cog = gene2cog[ref]
                 # removing uassigned or multiple assignments
                 if cog == "unknown" or cog.find(";") != -1:
                     continue
-                counts[cog] += 1
-        else:
-            E.info("counting best alignments")
-            query_it = query_iterator(alignment_iterator(options.stdin))
-            for best in best_alignment_iterator(query_it):
-                counts[best.ref] += 1
+                cog_counts[cog] += count
+            counts = cog_counts
         E.info("finished counting")
 
         E.info("writing results")
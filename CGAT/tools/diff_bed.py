@@ -45,6 +45,11 @@ To update results from a previous run, type::
 
    python diff_bed.py --update=out.tsv *.bed.gz > new.tsv
 
+Each file is read once. Comparisons can be distributed over several
+processes with the ``--num-workers`` option, for example::
+
+   python diff_bed.py --num-workers=8 *.bed.gz > out.tsv
+
 Type::
 
    python diff_bed.py --help
@@ -61,15 +66,62 @@ import re
 import CGATCore.Experiment as E
 import CGATCore.IOTools as IOTools
 import CGAT.Bed as Bed
+import CGAT.Intervals as Intervals
+import CGAT.Parallel as Parallel
 import numpy
 
 
+def buildIndex(beds):
+    """build an index of intervals per contig.
+
+    The index is a dictionary mapping each contig to a tuple of
+    arrays of start and end coordinates of the intervals and of
+    the combined intervals.
+    """
+    intervals = {}
+    for bed in beds:
+        if bed.contig not in intervals:
+            intervals[bed.contig] = ([], [])
+        intervals[bed.contig][0].append(bed.start)
+        intervals[bed.contig][1].append(bed.end)
+
+    index = {}
+    for contig, (starts, ends) in intervals.items():
+        starts = numpy.array(starts, dtype=numpy.int64)
+        ends = numpy.array(ends, dtype=numpy.int64)
+        index[contig] = (starts, ends) + Intervals.combineArrays(starts, ends)
+    return index
+
+
+def countIndices(idx_in, idx):
+    '''count intervals in idx_in against idx.'''
+
+    nexons, nexons_overlapping = 0, 0
+    nbases, nbases_overlapping = 0, 0
+    for contig, (starts, ends, combined_starts, combined_ends) in \
+            idx_in.items():
+        nexons += len(starts)
+        nbases += int((ends - starts).sum())
+
+        if contig not in idx:
+            continue
+
+        overlap = Intervals.calculateOverlapArrays(
+            starts, ends, idx[contig][2], idx[contig][3])
+        nexons_overlapping += int((overlap > 0).sum())
+        nbases_overlapping += int(overlap.sum())
+
+    return nexons, nexons_overlapping, nbases, nbases_overlapping
+
+
 class Counter:
 
     mPercentFormat = "%5.2f"
 
     def __init__(self):
-        pass
+        # indices are kept for all files so that each file
+        # is only read once
+        self.mIndices = {}
 
     def getHeader(self):
         h = []
@@ -84,48 +136,15 @@ class Counter:
 
         return "\t".join(h)
 
-    @E.cached_method
     def buildIndex(self, filename):
-        return Bed.readAndIndex(IOTools.open_file(filename, "r"))
+        if filename not in self.mIndices:
+            with IOTools.open_file(filename, "r") as infile:
+                self.mIndices[filename] = buildIndex(Bed.iterator(infile))
+        return self.mIndices[filename]
 
     def _count(self, filename, idx):
         '''count filename against idx.'''
-
-        overlapping_genes = set()
-        genes = set()
-
-        # iterate over exons
-        infile = IOTools.open_file(filename, "r")
-        it = Bed.bed_iterator(infile)
-
-        nexons, nexons_overlapping = 0, 0
-        nbases, nbases_overlapping = 0, 0
-        for this in it:
-            nexons += 1
-            nbases += this.end - this.start
-
-            try:
-                intervals = list(
-                    idx[this.contig].find(max(0, this.start), this.end))
-            except KeyError:
-                continue
-            except Exception as msg:
-                raise Exception(
-                    "error while processing %s, msg=%s" % (filename, msg))
-            if len(intervals) == 0:
-                continue
-
-            nexons_overlapping += 1
-            start, end = this.start, this.end
-            counts = numpy.zeros(end - start, numpy.int)
-            for other_start, other_end, other_value in intervals:
-                for x in range(max(start, other_start) - start, min(end, other_end) - start):
-                    counts[x] += 1
-            nbases_overlapping += sum([1 for x in counts if x > 0])
-
-        infile.close()
-
-        return nexons, nexons_overlapping, nbases, nbases_overlapping
+        return countIndices(self.buildIndex(filename), idx)
 
     def count(self, filename1, filename2):
         """count overlap between two bed files."""
@@ -173,54 +192,25 @@ class Counter:
 class CounterTracks(Counter):
 
     def __init__(self, filename):
-        self.mIndices = Bed.readAndIndex(IOTools.open_file(filename, "r"),
-                                         per_track=True)
+        Counter.__init__(self)
+        with IOTools.open_file(filename, "r") as infile:
+            self.mTracks = {}
+            for track, beds in Bed.grouped_iterator(Bed.iterator(infile)):
+                if track is None:
+                    raise ValueError("no tracks in %s" % filename)
+                self.mTracks[track["name"]] = buildIndex(beds)
 
     def getTracks(self):
-        return sorted(self.mIndices.keys())
-
-    def _countIndices(self, idx_in, idx):
-        '''count filename against idx.'''
-
-        overlapping_genes = set()
-        genes = set()
-
-        # iterate over exons
-
-        nexons, nexons_overlapping = 0, 0
-        nbases, nbases_overlapping = 0, 0
-        for contig, ix in idx_in.items():
-
-            # note: add a findall function to ncl
-            for start, end, value in ix.find(0, 1000000000):
-                nexons += 1
-                nbases += end - start
-
-                try:
-                    intervals = list(idx[contig].find(start, end))
-                except KeyError:
-                    continue
-
-                if len(intervals) == 0:
-                    continue
-
-                nexons_overlapping += 1
-                counts = numpy.zeros(end - start, numpy.int)
-                for other_start, other_end, other_value in intervals:
-                    for x in range(max(start, other_start) - start, min(end, other_end) - start):
-                        counts[x] += 1
-                nbases_overlapping += sum([1 for x in counts if x > 0])
-
-        return nexons, nexons_overlapping, nbases, nbases_overlapping
+        return sorted(self.mTracks.keys())
 
     def count(self, filename, track):
-        """count overlap between two gtf files."""
+        """count overlap between a bed file and a track."""
 
         E.info("counting started for %s versus %s" % (filename, track))
 
         (self.mExons1, self.mExonsOverlapping1,
          self.mBases1, self.mBasesOverlapping1 ) = \
-            self._count(filename, self.mIndices[track])
+            self._count(filename, self.mTracks[track])
 
         self.mExonsUnique1 = self.mExons1 - self.mExonsOverlapping1
         self.mBasesUnique1 = self.mBases1 - self.mBasesOverlapping1
@@ -230,12 +220,27 @@ class CounterTracks(Counter):
         # count index against index
         (self.mExons2, self.mExonsOverlapping2,
          self.mBases2, self.mBasesOverlapping2 ) = \
-            self._countIndices(self.mIndices[track], idx)
+            countIndices(self.mTracks[track], idx)
 
         self.mExonsUnique2 = self.mExons2 - self.mExonsOverlapping2
         self.mBasesUnique2 = self.mBases2 - self.mBasesOverlapping2
 
 
+WORKER = {}
+
+
+def initWorker(counter):
+    """initialize a worker process."""
+    WORKER["counter"] = counter
+
+
+def countWorker(pair):
+    """compare a pair of sets and return the formatted result."""
+    counter = WORKER["counter"]
+    counter.count(*pair)
+    return str(counter)
+
+
 def main(argv=None):
     """script main.
 
@@ -258,10 +263,15 @@ def main(argv=None):
     parser.add_option("-t", "--tracks", dest="tracks", action="store_true",
                       help="compare files against all tracks in the first file [default=%default]")
 
+    parser.add_option("--num-workers", dest="num_workers", type="int",
+                      help="number of worker processes to compute "
+                      "comparisons [default=%default]")
+
     parser.set_defaults(
         filename_update=None,
         pattern_id="(.*).bed",
         tracks=None,
+        num_workers=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -300,55 +310,52 @@ def main(argv=None):
         except AttributeError:
             return x
 
-    ncomputed, nupdated = 0, 0
+    # collect comparisons in output order, results from a
+    # previous run are re-used
+    tasks, pairs = [], []
+
+    def addTask(title1, title2, pair):
+        try:
+            prev = previous_results[title1][title2]
+        except KeyError:
+            prev = None
+            pairs.append(pair)
+        tasks.append((title1, title2, prev))
 
     if options.tracks:
         counter = CounterTracks(args[0])
-        options.stdout.write("set1\tset2\t%s\n" % counter.getHeader())
         for filename in args[1:]:
             title1 = getTitle(filename)
             for title2 in counter.getTracks():
-
-                if previous_results:
-                    try:
-                        prev = previous_results[title1][title2]
-                    except KeyError:
-                        pass
-                    else:
-                        options.stdout.write(
-                            "%s\t%s\t%s\n" % ((title1, title2, prev)))
-                        nupdated += 1
-                        continue
-
-                counter.count(filename, title2)
-                options.stdout.write(
-                    "%s\t%s\t%s\n" % ((title1, title2, str(counter))))
-                ncomputed += 1
+                addTask(title1, title2, (filename, title2))
     else:
         counter = Counter()
-        options.stdout.write("set1\tset2\t%s\n" % counter.getHeader())
-
         for x in range(len(args)):
-
             title1 = getTitle(args[x])
-
             for y in range(0, x):
-                title2 = getTitle(args[y])
-                if previous_results:
-                    try:
-                        prev = previous_results[title1][title2]
-                    except KeyError:
-                        pass
-                    else:
-                        options.stdout.write(
-                            "%s\t%s\t%s\n" % ((title1, title2, prev)))
-                        nupdated += 1
-                        continue
-
-                counter.count(args[x], args[y])
-                options.stdout.write(
-                    "%s\t%s\t%s\n" % ((title1, title2, str(counter))))
-                ncomputed += 1
+                addTask(title1, getTitle(args[y]), (args[x], args[y]))
+
+    # read each file once before distributing comparisons
+    for pair in pairs:
+        if not options.tracks:
+            counter.buildIndex(pair[1])
+        counter.buildIndex(pair[0])
+
+    results = Parallel.imap(countWorker, pairs,
+                            num_workers=min(options.num_workers, len(pairs)),
+                            initializer=initWorker,
+                            initargs=(counter,))
+
+    options.stdout.write("set1\tset2\t%s\n" % counter.getHeader())
+
+    ncomputed, nupdated = 0, 0
+    for title1, title2, prev in tasks:
+        if prev is None:
+            prev = next(results)
+            ncomputed += 1
+        else:
+            nupdated += 1
+        options.stdout.write("%s\t%s\t%s\n" % ((title1, title2, prev)))
 
     E.info("nupdated=%i, ncomputed=%i" % (nupdated, ncomputed))
     E.stop()
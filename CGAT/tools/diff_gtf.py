@@ -13,6 +13,9 @@ of gtf files.
 If results from a previous run are present, existing
 pairs are not re-computed but simply echoed.
 
+Each file is read once. Comparisons can be distributed over
+several processes with the ``--num-workers`` option.
+
 The output is a tab-separated table with counts for each pair
 of files being compared. The fields are:
 
@@ -132,7 +135,67 @@ import numpy
 import CGATCore.Experiment as E
 import CGAT.GTF as GTF
 import CGATCore.IOTools as IOTools
-import CGAT.NCL as NCL
+import CGAT.Intervals as Intervals
+import CGAT.Parallel as Parallel
+
+
+def buildIndex(gtfs):
+    """build an index of intervals per contig.
+
+    Returns a tuple of a list of gene identifiers and a dictionary
+    mapping each contig to a tuple of arrays of start and end
+    coordinates, gene indices and start and end coordinates of the
+    combined intervals.
+    """
+    intervals, map_gene2index = {}, {}
+    for gtf in gtfs:
+        if gtf.contig not in intervals:
+            intervals[gtf.contig] = ([], [], [])
+        if gtf.gene_id not in map_gene2index:
+            map_gene2index[gtf.gene_id] = len(map_gene2index)
+        starts, ends, genes = intervals[gtf.contig]
+        starts.append(gtf.start)
+        ends.append(gtf.end)
+        genes.append(map_gene2index[gtf.gene_id])
+
+    index = {}
+    for contig, (starts, ends, genes) in intervals.items():
+        starts = numpy.array(starts, dtype=numpy.int64)
+        ends = numpy.array(ends, dtype=numpy.int64)
+        index[contig] = ((starts, ends,
+                          numpy.array(genes, dtype=numpy.int64)) +
+                         Intervals.combineArrays(starts, ends))
+
+    return sorted(map_gene2index, key=map_gene2index.get), index
+
+
+def countIndices(idx_in, idx):
+    """count intervals in idx_in against idx.
+
+    Returns a set of indices of overlapping genes, the number of
+    exons and overlapping exons and the number of bases and
+    overlapping bases.
+    """
+
+    overlapping_genes = set()
+    nexons, nexons_overlapping = 0, 0
+    nbases, nbases_overlapping = 0, 0
+    for contig, (starts, ends, genes, combined_starts, combined_ends) in \
+            idx_in.items():
+        nexons += len(starts)
+        nbases += int((ends - starts).sum())
+
+        if contig not in idx:
+            continue
+
+        overlap = Intervals.calculateOverlapArrays(
+            starts, ends, idx[contig][3], idx[contig][4])
+        overlapping_genes.update(genes[overlap > 0].tolist())
+        nexons_overlapping += int((overlap > 0).sum())
+        nbases_overlapping += int(overlap.sum())
+
+    return (overlapping_genes, nexons, nexons_overlapping,
+            nbases, nbases_overlapping)
 
 
 class Counter:
@@ -140,7 +203,9 @@ class Counter:
     mPercentFormat = "%5.2f"
 
     def __init__(self):
-        pass
+        # indices are kept for all files so that each file
+        # is only read once
+        self.mIndices = {}
 
     def getHeader(self):
         h = []
@@ -155,52 +220,18 @@ class Counter:
 
         return "\t".join(h)
 
-    @E.cached_method
     def buildIndex(self, filename):
         """read and index."""
-
-        idx = {}
-        infile = IOTools.open_file(filename, "r")
-        for e in GTF.readFromFile(infile):
-            if e.contig not in idx:
-                idx[e.contig] = NCL.NCLSimple()
-            idx[e.contig].add(e.start, e.end)
-        infile.close()
-        return idx
+        if filename not in self.mIndices:
+            with IOTools.open_file(filename, "r") as infile:
+                self.mIndices[filename] = buildIndex(GTF.iterator(infile))
+        return self.mIndices[filename]
 
     def _count(self, filename, idx):
 
-        overlapping_genes = set()
-        genes = set()
-        # iterate over exons
-        infile = IOTools.open_file(filename, "r")
-        it = GTF.iterator(infile)
-
-        nexons, nexons_overlapping = 0, 0
-        nbases, nbases_overlapping = 0, 0
-        for this in it:
-            nexons += 1
-            nbases += this.end - this.start
-            genes.add(this.gene_id)
-
-            try:
-                intervals = list(idx[this.contig].find(this.start, this.end))
-            except KeyError:
-                continue
-
-            if len(intervals) == 0:
-                continue
-
-            overlapping_genes.add(this.gene_id)
-            nexons_overlapping += 1
-            start, end = this.start, this.end
-            counts = numpy.zeros(end - start, numpy.int)
-            for other_start, other_end, other_value in intervals:
-                for x in range(max(start, other_start) - start, min(end, other_end) - start):
-                    counts[x] += 1
-            nbases_overlapping += sum([1 for x in counts if x > 0])
-
-        infile.close()
+        genes, idx_in = self.buildIndex(filename)
+        (overlapping_genes, nexons, nexons_overlapping,
+         nbases, nbases_overlapping) = countIndices(idx_in, idx[1])
 
         return len(genes), len(overlapping_genes), nexons, nexons_overlapping, nbases, nbases_overlapping
 
@@ -274,26 +305,11 @@ class CounterGenes(Counter):
 
     def _count(self, filename, idx):
 
-        overlapping_genes = set()
-        genes = set()
-        # iterate over exons
-        infile = IOTools.open_file(filename, "r")
-        it = GTF.iterator(infile)
-
-        for this in it:
-            genes.add(this.gene_id)
-
-            try:
-                intervals = idx[this.contig].find(this.start, this.end)
-            except KeyError:
-                continue
-
-            if len(intervals) == 0:
-                continue
-	
-            overlapping_genes.add(this.gene_id)
+        genes, idx_in = self.buildIndex(filename)
+        overlapping_genes = countIndices(idx_in, idx[1])[0]
 
-        infile.close()
+        overlapping_genes = set([genes[x] for x in overlapping_genes])
+        genes = set(genes)
 
         return genes, overlapping_genes
 
@@ -311,8 +327,8 @@ class CounterGenes(Counter):
 
     def __str__(self):
 
-        uniq1 = self.mGenes1.difference(self.mGenesOverlapping)
-        uniq2 = self.mGenes2.difference(self.mGenesOverlapping)
+        uniq1 = self.mGenes1.difference(self.mGenesOverlapping1)
+        uniq2 = self.mGenes2.difference(self.mGenesOverlapping2)
 
         return "\t".join(map(str, (
             len(self.mGenes1),
@@ -321,10 +337,25 @@ class CounterGenes(Counter):
             len(self.mGenesOverlapping2),
             len(uniq1),
             len(uniq2),
-            self.mSeparator.join(self.mGenesOverlapping1),
-            self.mSeparator.join(self.mGenesOverlapping2),
-            self.mSeparator.join(uniq1),
-            self.mSeparator.join(uniq2))))
+            self.mSeparator.join(sorted(self.mGenesOverlapping1)),
+            self.mSeparator.join(sorted(self.mGenesOverlapping2)),
+            self.mSeparator.join(sorted(uniq1)),
+            self.mSeparator.join(sorted(uniq2)))))
+
+
+WORKER = {}
+
+
+def initWorker(counter):
+    """initialize a worker process."""
+    WORKER["counter"] = counter
+
+
+def countWorker(pair):
+    """compare a pair of gene sets and return the formatted result."""
+    counter = WORKER["counter"]
+    counter.count(*pair)
+    return str(counter)
 
 
 def main(argv=None):
@@ -356,11 +387,17 @@ def main(argv=None):
         help="only output gene stats (includes gene lists)"
         " [default=%default].")
 
+    parser.add_option(
+        "--num-workers", dest="num_workers", type="int",
+        help="number of worker processes to compute comparisons "
+        "[default=%default].")
+
     parser.set_defaults(
         ignore_strand=False,
         filename_update=None,
         pattern_id="(.*).gtf",
         output_only_genes=False,
+        num_workers=1,
     )
 
     (options, args) = E.start(parser)
@@ -406,26 +443,39 @@ def main(argv=None):
         except AttributeError:
             return x
 
-    ncomputed, nupdated = 0, 0
+    # collect comparisons in output order, results from a
+    # previous run are re-used
+    tasks, pairs = [], []
     for x in range(len(args)):
         title1 = getTitle(args[x])
         for y in range(0, x):
             title2 = getTitle(args[y])
-            if previous_results:
-                try:
-                    prev = previous_results[title1][title2]
-                except KeyError:
-                    pass
-                else:
-                    options.stdout.write(
-                        "%s\t%s\t%s\n" % ((title1, title2, prev)))
-                    nupdated += 1
-                    continue
-
-            counter.count(args[x], args[y])
-            options.stdout.write(
-                "%s\t%s\t%s\n" % ((title1, title2, str(counter))))
+            try:
+                prev = previous_results[title1][title2]
+            except KeyError:
+                prev = None
+                pairs.append((args[x], args[y]))
+            tasks.append((title1, title2, prev))
+
+    # read each file once before distributing comparisons
+    for pair in pairs:
+        for filename in pair:
+            counter.buildIndex(filename)
+
+    results = Parallel.imap(countWorker, pairs,
+                            num_workers=min(options.num_workers, len(pairs)),
+                            initializer=initWorker,
+                            initargs=(counter,))
+
+    ncomputed, nupdated = 0, 0
+    for title1, title2, prev in tasks:
+        if prev is None:
+            prev = next(results)
             ncomputed += 1
+        else:
+            nupdated += 1
+        options.stdout.write(
+            "%s\t%s\t%s\n" % ((title1, title2, prev)))
 
     E.info("nupdated=%i, ncomputed=%i" % (nupdated, ncomputed))
 
@@ -18,10 +18,17 @@ tab-delimited file of kmer counts::
 
 where n is the kmer and contig is the fasta entry.
 
-The user specifies the kmer length that is to be searched. Note that the longer
-the kmer, the longer the script will take to run.
+The user specifies the kmer length that is to be searched. Each
+sequence is scanned once with a rolling 2-bit encoding of the kmer, so
+overlapping occurrences are counted. Only upper case ``A``, ``C``,
+``G`` and ``T`` are counted, kmers containing any other character are
+skipped.
 
-Note the order of output will not necessarily be the same order as the input.
+For kmers of up to 8 nucleotides, all possible kmers are output. For
+longer kmers (up to 32 nucleotides) only kmers that have been observed
+in at least one sequence are output.
+
+Contigs are output in sorted order of their names.
 
 Usage
 -----
@@ -68,8 +75,6 @@ each four base combination out of the total tetranucleotide occurences.
 
 Options
 -------
-Two options control the behaviour of fasta2kmercontent.py; ``--kmer-size`` and
-``--output-proportion``.
 
 ``--kmer-size``::
   The kmer length to count over in the input fasta file
@@ -77,6 +82,14 @@ Two options control the behaviour of fasta2kmercontent.py; ``--kmer-size`` and
 ``--output-proportion``::
   The output values are proportions rather than absolute counts
 
+``--canonical``::
+  Count a kmer and its reverse complement together. Only the
+  lexicographically smaller of the two is output.
+
+``--num-workers``::
+  Number of processes used to count kmers. Contigs are distributed
+  across the processes.
+
 
 Type::
 
@@ -91,11 +104,104 @@ Command line options
 '''
 
 import sys
-import re
-import CGAT.FastaIterator as FastaIterator
 import itertools
+import numpy
+import CGAT.FastaIterator as FastaIterator
+import CGAT.Parallel as Parallel
 import CGATCore.Experiment as E
 
+# kmers up to this size are counted in dense arrays
+MAX_DENSE_KMER_SIZE = 8
+
+# 2-bit codes of nucleotides, other characters are flagged as 4
+NUCLEOTIDE_CODES = numpy.full(256, 4, dtype=numpy.uint64)
+for code, nucleotide in enumerate(b"ACGT"):
+    NUCLEOTIDE_CODES[nucleotide] = code
+
+
+def encodeKmers(sequence, kmer_size, canonical=False):
+    """return the 2-bit encoded kmers in *sequence*.
+
+    Kmers containing characters other than A, C, G and T are removed.
+    If *canonical* is set, the smaller of a kmer and its reverse
+    complement is returned.
+    """
+    codes = NUCLEOTIDE_CODES[numpy.frombuffer(
+        sequence.encode("ascii"), dtype=numpy.uint8)]
+    nkmers = len(codes) - kmer_size + 1
+    if nkmers <= 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+
+    invalid = numpy.zeros(len(codes) + 1, dtype=numpy.int64)
+    numpy.cumsum(codes == 4, out=invalid[1:])
+    valid = invalid[kmer_size:] == invalid[:nkmers]
+    codes[codes == 4] = 0
+
+    kmers = numpy.zeros(nkmers, dtype=numpy.uint64)
+    for offset in range(kmer_size):
+        kmers <<= numpy.uint64(2)
+        kmers |= codes[offset:offset + nkmers]
+
+    if canonical:
+        complement = numpy.uint64(3) - codes
+        reverse = numpy.zeros(nkmers, dtype=numpy.uint64)
+        for offset in range(kmer_size):
+            reverse |= (complement[offset:offset + nkmers] <<
+                        numpy.uint64(2 * offset))
+        kmers = numpy.minimum(kmers, reverse)
+
+    return kmers[valid]
+
+
+def countKmers(sequence, kmer_size, canonical=False):
+    """count kmers in *sequence*.
+
+    For kmer sizes up to :data:`MAX_DENSE_KMER_SIZE` an array of
+    counts for all possible kmers is returned. For longer kmers a
+    tuple of observed kmers and their counts is returned.
+    """
+    kmers = encodeKmers(sequence, kmer_size, canonical)
+    if kmer_size <= MAX_DENSE_KMER_SIZE:
+        return numpy.bincount(kmers.astype(numpy.int64),
+                              minlength=4 ** kmer_size)
+    else:
+        return numpy.unique(kmers, return_counts=True)
+
+
+def decodeKmer(code, kmer_size):
+    """return the kmer sequence for the 2-bit encoded *code*."""
+    kmer = []
+    for x in range(kmer_size):
+        kmer.append("ACGT"[code & 3])
+        code >>= 2
+    return "".join(reversed(kmer))
+
+
+def reverseComplementCodes(codes, kmer_size):
+    """return 2-bit encoded reverse complements of *codes*."""
+    reverse = numpy.zeros(len(codes), dtype=numpy.uint64)
+    codes = numpy.array(codes, dtype=numpy.uint64)
+    for x in range(kmer_size):
+        reverse <<= numpy.uint64(2)
+        reverse |= numpy.uint64(3) - (codes & numpy.uint64(3))
+        codes >>= numpy.uint64(2)
+    return reverse
+
+
+WORKER = {}
+
+
+def initWorker(options):
+    """initialize a worker process."""
+    WORKER["options"] = options
+
+
+def countKmersWorker(fasta):
+    """count kmers in a (title, sequence) tuple."""
+    title, sequence = fasta
+    options = WORKER["options"]
+    return title, countKmers(sequence, options.kmer, options.canonical)
+
 
 def main(argv=None):
     """script main.
@@ -117,23 +223,25 @@ def main(argv=None):
         "-p", "--output-proportion", dest="proportion", action="store_true",
         help="output proportions - overides the default output")
 
-    # add common options (-h/--help, ...) and parse command line
-    (options, args) = E.start(parser, argv=argv)
+    parser.add_option(
+        "--canonical", dest="canonical", action="store_true",
+        help="count a kmer and its reverse complement together")
+
+    parser.add_option(
+        "--num-workers", dest="num_workers", type="int",
+        help="number of worker processes to count kmers "
+        "[default=%default]")
 
-    # do not allow greater than octonucleotide
-    assert options.kmer <= 8, "cannot handle kmer of length %i" % options.kmer
+    parser.set_defaults(kmer=4,
+                        proportion=False,
+                        canonical=False,
+                        num_workers=1)
 
-    # how we deal with the nucleotides depends on the kmer length
-    nucleotides = []
-    for nucleotide in ["A", "C", "T", "G"]:
-        nucleotides = nucleotides + \
-            [x for x in itertools.repeat(nucleotide, options.kmer)]
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.start(parser, argv=argv)
 
-    E.info("retrieving %imer sequences" % options.kmer)
-    # get all kmer sequences to query
-    kmers = set()
-    for kmer in itertools.permutations(nucleotides, options.kmer):
-        kmers.add(kmer)
+    if options.kmer < 1 or options.kmer > 32:
+        raise ValueError("cannot handle kmer of length %i" % options.kmer)
 
     E.info("matching %imers in file" % options.kmer)
     # count the number of kmers in each sequence
@@ -141,40 +249,60 @@ def main(argv=None):
     result = {}
 
     # NB assume that non fasta files are caught by FastaIterator
+    sequences = ((fasta.title, fasta.sequence)
+                 for fasta in FastaIterator.iterate(options.stdin))
+
+    iterator = Parallel.imap(countKmersWorker, sequences,
+                             num_workers=options.num_workers,
+                             initializer=initWorker,
+                             initargs=(Parallel.worker_options(options),),
+                             chunksize=100)
+
     total_entries = 0
-    for fasta in FastaIterator.iterate(options.stdin):
+    for title, counts in iterator:
         total_entries += 1
-        result[fasta.title] = {}
-        for kmer in kmers:
-            counts = [m.start()
-                      for m in re.finditer("".join(kmer), fasta.sequence)]
-            result[fasta.title][kmer] = len(counts)
+        result[title] = counts
 
     E.info("writing results")
     # write out the results
     headers = sorted(result.keys())
-    rows = set()
-    for kmer_counts in list(result.values()):
-        for kmer, count in kmer_counts.items():
-            rows.add("".join(kmer))
+
+    if options.kmer <= MAX_DENSE_KMER_SIZE:
+        codes = numpy.arange(4 ** options.kmer, dtype=numpy.uint64)
+        matrix = numpy.zeros((len(codes), len(headers)), dtype=numpy.int64)
+        for column, header in enumerate(headers):
+            matrix[:, column] = result[header]
+        if options.canonical:
+            take = codes <= reverseComplementCodes(codes, options.kmer)
+            codes, matrix = codes[take], matrix[take]
+        rows = ["".join(x) for x in itertools.product(
+            "ACGT", repeat=options.kmer)]
+        if options.canonical:
+            rows = [rows[x] for x in codes]
+    else:
+        codes = numpy.unique(numpy.concatenate(
+            [numpy.zeros(0, dtype=numpy.uint64)] +
+            [result[header][0] for header in headers]))
+        matrix = numpy.zeros((len(codes), len(headers)), dtype=numpy.int64)
+        for column, header in enumerate(headers):
+            kmers, counts = result[header]
+            matrix[numpy.searchsorted(codes, kmers), column] = counts
+        rows = [decodeKmer(int(x), options.kmer) for x in codes]
 
     # write header row
     options.stdout.write("kmer\t" + "\t".join(headers) + "\n")
 
     # output proportions if required - normalises by
     # sequence length
-    E.info("computing total counts")
-    totals = {}
-    for header in headers:
-        totals[header] = sum([result[header][tuple(row)] for row in rows])
-
-    for row in sorted(rows):
-        if options.proportion:
-            options.stdout.write("\t".join(
-                [row] + [str(float(result[header][tuple(row)]) / totals[header]) for header in headers]) + "\n")
-        else:
-            options.stdout.write(
-                "\t".join([row] + [str(result[header][tuple(row)]) for header in headers]) + "\n")
+    if options.proportion:
+        E.info("computing total counts")
+        totals = matrix.sum(axis=0)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            matrix = matrix / totals
+
+    for row, values in zip(rows, matrix.tolist()):
+        options.stdout.write(
+            "\t".join([row] + [str(x) for x in values]) + "\n")
 
     E.info("written kmer counts for %i contigs" % total_entries)
     # write footer and output benchmark information.
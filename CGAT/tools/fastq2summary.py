@@ -31,6 +31,14 @@ depending on the option specified:
 |nfailed         |number of bases below quality threshold                    |
 +----------------+-----------------------------------------------------------+
 
+Statistics are accumulated in histograms while reading the file in
+blocks, so memory usage does not grow with the number of reads.
+
+If ``--output-position-quality`` is given, a table with the
+distribution of quality scores at each position in the reads is
+written to the file ``position_quality`` (see
+``--output-filename-pattern``).
+
 
 Usage
 -----
@@ -56,12 +64,47 @@ Command line options
 
 '''
 
+import collections
 import sys
 import numpy as np
 import CGATCore.Experiment as E
 import CGAT.Fastq as Fastq
 
 
+def histogramMedian(values, counts):
+    """return the median of data summarized by a histogram.
+
+    `values` need to be sorted. As with numpy.median, the mean of
+    the two central values is returned for an even number of
+    observations.
+    """
+    total = counts.sum()
+    if total == 0:
+        return np.nan
+    cumulative = np.cumsum(counts)
+    lower = values[np.searchsorted(cumulative, (total - 1) // 2, "right")]
+    upper = values[np.searchsorted(cumulative, total // 2, "right")]
+    return (lower + upper) / 2.0
+
+
+def addToMatrix(matrix, rows, columns, ncolumns):
+    """add counts for (row, column) pairs to `matrix`.
+
+    The matrix is extended with zero rows if necessary.
+    """
+    if len(rows) == 0:
+        return matrix
+    nrows = rows.max() + 1
+    counts = np.bincount(rows * ncolumns + columns,
+                         minlength=nrows * ncolumns).reshape(nrows, ncolumns)
+    if len(counts) > len(matrix):
+        matrix = np.vstack(
+            [matrix, np.zeros((len(counts) - len(matrix), ncolumns),
+                              dtype=np.int64)])
+    matrix[:len(counts)] += counts
+    return matrix
+
+
 def main(argv=None):
     """script main.
 
@@ -93,42 +136,87 @@ def main(argv=None):
         file and converts quality scores to the destination \
         format unless --format is specified [default=%default].")
 
+    parser.add_option(
+        "--output-position-quality", dest="output_position_quality",
+        action="store_true",
+        help="output the distribution of quality scores at each "
+        "position in the reads [default=%default].")
+
+    parser.add_option(
+        "--block-size", dest="block_size", type="int",
+        help="approximate number of bytes to read and process "
+        "at a time [default=%default].")
+
     parser.set_defaults(
         change_format=None,
         guess_format=None,
-        min_quality=10)
+        min_quality=10,
+        output_position_quality=False,
+        block_size=1000000)
 
     # add common options (-h/--help, ...) and parse command line
-    (options, args) = E.start(parser, argv=argv)
-
-    if options.change_format:
-        iterator = Fastq.iterate_convert(options.stdin,
-                                         format=options.change_format,
-                                         guess=options.guess_format)
-    else:
-        iterator = Fastq.iterate_guess(options.stdin,
-                                       guess=options.guess_format)
+    (options, args) = E.start(parser, argv=argv, add_output_options=True)
 
     min_quality = options.min_quality
     number_of_reads = 0
     number_of_bases = 0
-    read_lengths = []
-    read_qualities = []
     bases_below_min = 0
-
-    for record in iterator:
-        number_of_reads += 1
-        quals = record.toPhred()
-        length_read = len(quals)
-        number_of_bases += length_read
-        bases_below_min += len([x for x in quals if x < min_quality])
-        read_lengths.append(length_read)
-        read_qualities.append(np.mean(quals))
-
-    mean_length = round(np.mean(read_lengths), 2)
-    median_length = round(np.median(read_lengths), 2)
-    mean_quality = round(np.mean(read_qualities), 2)
-    median_quality = round(np.median(read_qualities), 2)
+    # histograms of read lengths, of the sum of quality scores
+    # for each read length and of quality scores per position
+    length_counts = np.zeros(0, dtype=np.int64)
+    quality_counts = collections.Counter()
+    position_counts = np.zeros((0, 256), dtype=np.int64)
+
+    for identifiers, sequences, scores, offsets in Fastq.iterate_phred_blocks(
+            options.stdin,
+            guess=options.guess_format,
+            target_format=options.change_format,
+            block_size=options.block_size):
+
+        nreads = len(identifiers)
+        lengths = np.diff(offsets)
+        reads = np.repeat(np.arange(nreads), lengths)
+        number_of_reads += nreads
+        number_of_bases += len(scores)
+        bases_below_min += np.count_nonzero(scores < min_quality)
+
+        counts = np.bincount(lengths)
+        if len(counts) > len(length_counts):
+            length_counts = np.concatenate(
+                [length_counts,
+                 np.zeros(len(counts) - len(length_counts), dtype=np.int64)])
+        length_counts[:len(counts)] += counts
+
+        sums = np.bincount(reads, weights=scores, minlength=nreads)
+        pairs, counts = np.unique(
+            np.column_stack([lengths, sums.astype(np.int64)]),
+            axis=0, return_counts=True)
+        quality_counts.update(
+            dict(zip(map(tuple, pairs.tolist()), counts.tolist())))
+
+        if options.output_position_quality:
+            positions = np.arange(len(scores)) - offsets[reads]
+            position_counts = addToMatrix(
+                position_counts, positions, scores, 256)
+
+    if number_of_reads > 0:
+        lengths = np.arange(len(length_counts))
+        mean_length = round(
+            float((lengths * length_counts).sum()) / number_of_reads, 2)
+        median_length = round(histogramMedian(lengths, length_counts), 2)
+
+        # mean quality of reads without bases is undefined
+        pairs = sorted(quality_counts.items())
+        means = np.array([float(s) / l if l > 0 else np.nan
+                          for (l, s), c in pairs])
+        counts = np.array([c for (l, s), c in pairs])
+        order = np.argsort(means, kind="stable")
+        means, counts = means[order], counts[order]
+        mean_quality = round(np.sum(means * counts) / number_of_reads, 2)
+        median_quality = round(histogramMedian(means, counts), 2)
+    else:
+        mean_length = median_length = np.nan
+        mean_quality = median_quality = np.nan
 
     options.stdout.write(
         "reads\tbases\tmean_length\tmedian_length\tmean_quality\tmedian_quality\tnfailed\n")
@@ -140,6 +228,20 @@ def main(argv=None):
                                           str(mean_quality),
                                           str(median_quality),
                                           bases_below_min))
+
+    if options.output_position_quality:
+        qualities = np.nonzero(position_counts.sum(axis=0))[0]
+        with E.open_output_file("position_quality") as outf:
+            outf.write("position\tnreads\tmean\t%s\n" %
+                       "\t".join(map(str, qualities)))
+            for position, counts in enumerate(position_counts):
+                nreads = counts.sum()
+                outf.write("%i\t%i\t%6.4f\t%s\n" % (
+                    position + 1,
+                    nreads,
+                    float((counts * np.arange(256)).sum()) / nreads,
+                    "\t".join(map(str, counts[qualities]))))
+
     E.stop()
 
 if __name__ == "__main__":
@@ -91,11 +91,60 @@ Command line options
 
 import sys
 
+import numpy
+
 import CGATCore.Experiment as E
 import CGAT.Stats as Stats
 import CGAT.Fastq as Fastq
 
 
+def summarizeQualities(scores, offsets):
+    """compute summary statistics of quality scores for each read.
+
+    The statistics are those computed by :class:`Stats.Summary`.
+    `scores` contains the concatenated phred scores of all reads
+    and the scores of read `i` are ``scores[offsets[i]:offsets[i+1]]``.
+
+    Returns a dictionary of arrays with one value per read.
+    """
+    nreads = len(offsets) - 1
+    lengths = numpy.diff(offsets)
+    nonempty = lengths > 0
+    reads = numpy.repeat(numpy.arange(nreads), lengths)
+
+    # sort scores within each read
+    ordered = numpy.sort(reads * 256 + scores) & 255
+    starts = offsets[:-1]
+    last = numpy.maximum(starts + lengths - 1, 0)
+
+    def _select(index):
+        if len(ordered) == 0:
+            return numpy.zeros(nreads)
+        return numpy.where(nonempty,
+                           ordered[numpy.minimum(index, len(ordered) - 1)],
+                           0)
+
+    totals = numpy.bincount(reads, weights=scores, minlength=nreads)
+    means = numpy.zeros(nreads)
+    means[nonempty] = totals[nonempty] / lengths[nonempty]
+    deviations = numpy.bincount(reads,
+                                weights=(scores - means[reads]) ** 2,
+                                minlength=nreads)
+    stddevs = numpy.zeros(nreads)
+    stddevs[nonempty] = numpy.sqrt(deviations[nonempty] / lengths[nonempty])
+
+    return {"nval": lengths,
+            "min": _select(starts),
+            "max": _select(last),
+            "mean": means,
+            "median": (_select(starts + (lengths - 1) // 2) +
+                       _select(starts + lengths // 2)) / 2.0,
+            "stddev": stddevs,
+            "sum": totals,
+            "q1": _select(starts + lengths // 4),
+            "q3": _select(starts + lengths * 3 // 4)}
+
+
 def main(argv=None):
     """script main.
 
@@ -126,10 +175,16 @@ def main(argv=None):
         help="The script will convert quality scores to the destination "
         "format unless [default=%default].")
 
+    parser.add_option(
+        "--block-size", dest="block_size", type="int",
+        help="approximate number of bytes to read and process "
+        "at a time [default=%default].")
+
     parser.set_defaults(
         target_format=None,
         guess_format=None,
         min_quality=10,
+        block_size=1000000,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -137,30 +192,40 @@ def main(argv=None):
 
     c = E.Counter()
 
-    if options.target_format:
-        iterator = Fastq.iterate_convert(options.stdin,
-                                         format=options.target_format,
-                                         guess=options.guess_format)
-    else:
-        iterator = Fastq.iterate_guess(options.stdin,
-                                       guess=options.guess_format)
-
     options.stdout.write("read\tnfailed\tnN\t%s\n" %
                          ("\t".join(Stats.Summary().getHeaders())))
 
     min_quality = options.min_quality
-
-    for record in iterator:
-        c.input += 1
-        quals = record.toPhred()
-        nfailed = len([x for x in quals if x < min_quality])
-        nns = record.seq.count("N") + record.seq.count(".")
-        options.stdout.write("%s\t%i\t%i\t%s\n" % (record.identifier,
-                                                   nfailed,
-                                                   nns,
-                                                   str(Stats.Summary(quals))
-                                                   ))
-        c.output += 1
+    row_format = "\t".join(
+        ["%s", "%i", "%i", "%i"] + ["%6.4f"] * 8) + "\n"
+
+    for identifiers, sequences, scores, offsets in Fastq.iterate_phred_blocks(
+            options.stdin,
+            guess=options.guess_format,
+            target_format=options.target_format,
+            block_size=options.block_size):
+
+        nreads = len(identifiers)
+        reads = numpy.repeat(numpy.arange(nreads), numpy.diff(offsets))
+        nfailed = numpy.bincount(reads[scores < min_quality],
+                                 minlength=nreads)
+
+        bases = numpy.frombuffer("".join(sequences).encode("ascii"),
+                                 dtype=numpy.uint8)
+        seq_reads = numpy.repeat(numpy.arange(nreads),
+                                 [len(x) for x in sequences])
+        nns = numpy.bincount(
+            seq_reads[(bases == ord("N")) | (bases == ord("."))],
+            minlength=nreads)
+
+        stats = summarizeQualities(scores, offsets)
+        columns = [stats[x] for x in Stats.Summary.fields]
+        options.stdout.write("".join(
+            [row_format % row for row in zip(
+                identifiers, nfailed, nns, *columns)]))
+
+        c.input += nreads
+        c.output += nreads
 
     # write footer and output benchmark information.
     E.info("%s" % str(c))
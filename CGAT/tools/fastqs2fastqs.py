@@ -25,7 +25,17 @@ reads might be missing from one file but not the other. The reconcile
 method will output two files containing only reads that are common to
 both files.
 
-The two files must be sorted by read identifier.
+Reads are matched while streaming through both files if the reads
+of the two files are in the same order (``--reconcile-method=ordered``),
+which is usually the case for files coming from the same sequencing
+run. Reads missing from either file are detected within a window of
+pending reads. If the order turns out not to be shared, the default
+``--reconcile-method=auto`` restarts with ``--reconcile-method=hash``.
+Until the ordered pass has succeeded, its output is kept in temporary
+files next to the output files. ``hash`` stores a 64-bit fingerprint
+of each read identifier in a sorted numpy array instead of the
+identifiers themselves. Throughput and peak memory usage are reported
+in the log.
 
 Example input, read2 and read3 are only present in either of the
 files:
@@ -58,6 +68,17 @@ Example output, only the reads common to both files are output::
    +              +
    !!!            !!!
 
+filter-by-sequence
+++++++++++++++++++
+
+Split read pairs into those that match any of the sequences in
+``--input-filename-fasta`` and those that do not. A pair matches if
+either read shares more than ``--filtering-min-kmer-matches`` kmers
+of size ``--filtering-kmer-size`` with a query sequence on the same
+diagonal on either strand. Pairs can be processed by several worker
+processes with ``--num-workers``, in chunks of ``--chunk-size``
+pairs. The output order is preserved.
+
 Usage
 -----
 
@@ -84,8 +105,16 @@ Command line options
 
 '''
 
+import collections
+import itertools
+import os
+import resource
 import sys
 import re
+import tempfile
+import time
+
+import numpy
 import pysam
 
 import CGATCore.IOTools as IOTools
@@ -106,6 +135,287 @@ def plain_getter(id):
     return id
 
 
+def iterate_reads(infile, id_getter=plain_getter, chop=False):
+    '''iterate over reads in a fastq file.
+
+    Yields tuples of read identifier and the formatted record.
+    '''
+    aread = infile.readline
+    while True:
+        l = [aread().rstrip("\r\n") for i in range(4)]
+        if not l[0]:
+            break
+        r = id_getter(l[0].split()[0])
+        # decide if to chop read number off
+        if chop:
+            r = r[:-1]
+        yield r, "\n".join(l) + "\n"
+
+
+def iterate_read_chunks(infile, id_getter=plain_getter, chop=False,
+                        chunk_size=10000):
+    '''iterate over chunks of reads in a fastq file.
+
+    Yields tuples of a list of identifiers, an array of their
+    fingerprints and a list of formatted records.
+    '''
+    reads = iterate_reads(infile, id_getter, chop)
+    while True:
+        chunk = list(itertools.islice(reads, chunk_size))
+        if not chunk:
+            break
+        ids, records = list(zip(*chunk))
+        yield ids, fingerprint(ids), records
+
+
+def fingerprint(ids):
+    '''return an array of 64-bit fingerprints of identifiers.'''
+    return numpy.fromiter(map(hash, ids), dtype=numpy.int64, count=len(ids))
+
+
+def contains(sorted_array, values):
+    '''return boolean array indicating if values are in sorted_array.'''
+    if len(sorted_array) == 0:
+        return numpy.zeros(len(values), dtype=bool)
+    idx = numpy.searchsorted(sorted_array, values)
+    idx[idx == len(sorted_array)] = 0
+    return sorted_array[idx] == values
+
+
+def reconcile_by_hash(fn1, fn2, outf1, outf2,
+                      unpaired1=None, unpaired2=None,
+                      id1_getter=plain_getter,
+                      id2_getter=plain_getter,
+                      chop=False):
+    '''output reads present in both fastq files.
+
+    Fingerprints of read identifiers in the first file are stored
+    in a sorted array. The second file is then filtered in a single
+    pass while collecting the fingerprints of shared reads, followed
+    by a pass through the first file.
+
+    Returns a tuple with the number of reads in the first and the
+    second file and the number of shared reads.
+    '''
+    E.info("reading first in pair")
+    chunks = []
+    with IOTools.open_file(fn1) as inf:
+        for ids, fingerprints, records in iterate_read_chunks(
+                inf, id1_getter, chop):
+            chunks.append(fingerprints)
+    ids1 = numpy.unique(numpy.concatenate(
+        chunks + [numpy.zeros(0, dtype=numpy.int64)]))
+    ninput1 = sum(len(x) for x in chunks)
+    del chunks
+
+    E.info("writing second in pair")
+    chunks = []
+    ninput2 = 0
+    with IOTools.open_file(fn2) as inf:
+        for ids, fingerprints, records in iterate_read_chunks(
+                inf, id2_getter, chop):
+            take = contains(ids1, fingerprints)
+            outf2.write("".join(itertools.compress(records, take)))
+            if unpaired2 is not None:
+                unpaired2.write("".join(
+                    itertools.compress(records, ~take)))
+            chunks.append(fingerprints[take])
+            ninput2 += len(ids)
+    del ids1
+    shared = numpy.unique(numpy.concatenate(
+        chunks + [numpy.zeros(0, dtype=numpy.int64)]))
+    del chunks
+
+    E.info("writing first in pair")
+    noutput = 0
+    with IOTools.open_file(fn1) as inf:
+        for ids, fingerprints, records in iterate_read_chunks(
+                inf, id1_getter, chop):
+            take = contains(shared, fingerprints)
+            outf1.write("".join(itertools.compress(records, take)))
+            if unpaired1 is not None:
+                unpaired1.write("".join(
+                    itertools.compress(records, ~take)))
+            noutput += take.sum()
+
+    return ninput1, ninput2, noutput
+
+
+def reconcile_by_order(fn1, fn2, outf1, outf2,
+                       unpaired1=None, unpaired2=None,
+                       id1_getter=plain_getter,
+                       id2_getter=plain_getter,
+                       chop=False,
+                       max_pending=100000):
+    '''output reads present in both fastq files.
+
+    Both files are streamed in parallel assuming that reads are in
+    the same order in both files. Reads without a partner so far are
+    kept in a window of pending reads. Once a pair is found, all
+    pending reads before it are unpaired.
+
+    Raises a ValueError if a read declared unpaired turns up later
+    in the other file, i.e. if the order of reads is not shared, or
+    if there are more than `max_pending` pending reads.
+
+    Returns a tuple with the number of reads in the first and the
+    second file and the number of shared reads.
+    '''
+
+    counts = [0, 0]
+    noutput = 0
+    unpaired_files = (unpaired1, unpaired2)
+    pending = (collections.OrderedDict(), collections.OrderedDict())
+    unpaired = (set(), set())
+
+    def _flush(side, until=None):
+        # mark pending reads before `until` as unpaired
+        queue = pending[side]
+        while queue:
+            read_id = next(iter(queue))
+            if read_id == until:
+                break
+            record = queue.pop(read_id)
+            unpaired[side].add(hash(read_id))
+            if unpaired_files[side] is not None:
+                unpaired_files[side].write(record)
+
+    def _add(side, read_id, record):
+        other = 1 - side
+        if hash(read_id) in unpaired[other]:
+            raise ValueError(
+                "read %s is out of order, files do not share the "
+                "same order of reads" % read_id)
+        if read_id in pending[other]:
+            _flush(other, read_id)
+            records = [None, None]
+            records[side] = record
+            records[other] = pending[other].pop(read_id)
+            outf1.write(records[0])
+            outf2.write(records[1])
+            _flush(side)
+            return 1
+        if read_id in pending[side]:
+            raise ValueError("duplicate read %s" % read_id)
+        pending[side][read_id] = record
+        if len(pending[side]) > max_pending:
+            raise ValueError(
+                "more than %i reads without partner, files do not "
+                "share the same order of reads" % max_pending)
+        return 0
+
+    with IOTools.open_file(fn1) as inf1, IOTools.open_file(fn2) as inf2:
+        reads1 = iterate_reads(inf1, id1_getter, chop)
+        reads2 = iterate_reads(inf2, id2_getter, chop)
+        for read1, read2 in itertools.zip_longest(reads1, reads2):
+            if read1 is not None:
+                counts[0] += 1
+            if read2 is not None:
+                counts[1] += 1
+            if read1 is not None and read2 is not None and \
+                    read1[0] == read2[0] and \
+                    not pending[0] and not pending[1]:
+                if hash(read1[0]) in unpaired[0] or \
+                        hash(read1[0]) in unpaired[1]:
+                    raise ValueError(
+                        "read %s is out of order, files do not share the "
+                        "same order of reads" % read1[0])
+                outf1.write(read1[1])
+                outf2.write(read2[1])
+                noutput += 1
+                continue
+            if read1 is not None:
+                noutput += _add(0, *read1)
+            if read2 is not None:
+                noutput += _add(1, *read2)
+
+    _flush(0)
+    _flush(1)
+    return counts[0], counts[1], noutput
+
+
+def get_temporary_filename(filename):
+    '''return the name of a new temporary file next to *filename*.
+
+    The temporary filename ends in the name of *filename* so that
+    it is compressed in the same way.
+    '''
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    handle, tmpfilename = tempfile.mkstemp(
+        dir=dirname, prefix="tmp", suffix="_" + basename)
+    os.close(handle)
+    # mkstemp creates files that are only accessible by the user,
+    # give the output file the permissions of a regular new file.
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmpfilename, 0o666 & ~umask)
+    return tmpfilename
+
+
+def reconcile(f, fn1, fn2, options, id1_getter, id2_getter,
+              temporary=False):
+    '''reconcile reads in *fn1* and *fn2* with the function *f* and
+    write the output files.
+
+    If *temporary* is set, output is written to temporary files. These
+    are moved to the output files if *f* succeeds and removed
+    otherwise.
+
+    Returns the counts returned by *f*.
+    '''
+    sections = ["1", "2"]
+    if options.unpaired:
+        sections.append("unpaired.fastq.gz")
+
+    if temporary:
+        filenames = [E.get_output_file(x) for x in sections]
+        if not options.output_force:
+            for fn in filenames:
+                if os.path.exists(fn):
+                    raise OSError(
+                        "file %s already exists, use --force-output to "
+                        "overwrite existing files." % fn)
+        tmpfilenames = [get_temporary_filename(x) for x in filenames]
+        outfiles = [IOTools.open_file(x, "w") for x in tmpfilenames]
+    else:
+        outfiles = [E.open_output_file(x, "w") for x in sections]
+
+    if options.unpaired:
+        unpaired1 = outfiles[2]
+        unpaired2 = tempfile.TemporaryFile(mode="w+")
+    else:
+        unpaired1 = unpaired2 = None
+
+    success = False
+    try:
+        counts = f(fn1, fn2, outfiles[0], outfiles[1],
+                   unpaired1, unpaired2,
+                   id1_getter, id2_getter,
+                   chop=options.chop)
+
+        if options.unpaired:
+            # unpaired reads of the second file follow those of the first
+            unpaired2.seek(0)
+            for line in unpaired2:
+                unpaired1.write(line)
+        success = True
+    finally:
+        for outf in outfiles:
+            outf.close()
+        if unpaired2 is not None:
+            unpaired2.close()
+        if temporary:
+            for tmpfilename, filename in zip(tmpfilenames, filenames):
+                if success:
+                    os.rename(tmpfilename, filename)
+                else:
+                    os.unlink(tmpfilename)
+
+    return counts
+
+
 def main(argv=None):
     """script main.
 
@@ -147,6 +457,15 @@ def main(argv=None):
         help="As above but for read 2",
         default=None)
 
+    parser.add_option(
+        "--reconcile-method", dest="reconcile_method", type="choice",
+        choices=("auto", "ordered", "hash"),
+        help="method used for reconciling reads. ``ordered`` assumes "
+        "that reads are in the same order in both files, ``hash`` "
+        "stores fingerprints of read identifiers. ``auto`` tries "
+        "``ordered`` and switches to ``hash`` if the order of reads "
+        "is not shared [default=%default].")
+
     parser.add_option(
         "--input-filename-fasta",
         dest="input_filename_fasta", type="string",
@@ -163,13 +482,28 @@ def main(argv=None):
         dest="filtering_min_kmer_matches", type="int",
         help="minimum number of matches 'filter-by-sequence' [default=%default].")
 
+    parser.add_option(
+        "--num-workers",
+        dest="num_workers", type="int",
+        help="number of worker processes for method 'filter-by-sequence' "
+        "[default=%default].")
+
+    parser.add_option(
+        "--chunk-size",
+        dest="chunk_size", type="int",
+        help="number of read pairs sent to a worker process at once "
+        "for method 'filter-by-sequence' [default=%default].")
+
     parser.set_defaults(
         method="reconcile",
         chop=False,
         unpaired=False,
+        reconcile_method="auto",
         input_filename_fasta=None,
         filtering_kmer_size=10,
-        filtering_min_kmer_matches=20
+        filtering_min_kmer_matches=20,
+        num_workers=1,
+        chunk_size=1000,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -194,89 +528,53 @@ def main(argv=None):
 
     if options.method == "reconcile":
 
-        # IMS: switching to no store second set of read names and only use
-        # lazily. Since generators don't have a size must keep track
-        id_lengths = {fn1: 0, fn2: 0}
-
-        def getIds(infile, id_getter=plain_getter):
-            '''return ids in infile.'''
-            aread = infile.readline
-            while True:
-                l = [aread().rstrip("\r\n") for i in range(4)]
-                if not l[0]:
-                    break
-                r = id_getter(l[0].split()[0])
-                # decide if to chop read number off
-                id_lengths[infile.name] += 1
-                if options.chop:
-                    yield r[:-1]
-                else:
-                    yield r
-
-        def write(outfile, infile, take, unpaired_file=None,
-                  id_getter=plain_getter):
-            '''filter fastq files with ids in take.'''
-            aread = infile.readline
-            while True:
-                l = [aread().rstrip("\r\n") for i in range(4)]
-                if not l[0]:
-                    break
-                r = id_getter(l[0].split()[0])
-                if options.chop:
-                    r = r[:-1]
-                if r not in take:
-                    if unpaired_file is None:
-                        continue
-                    else:
-                        unpaired_file.write("\n".join(l) + "\n")
-                else:
-                    outfile.write("\n".join(l) + "\n")
-
-        E.info("reading first in pair")
-        inf1 = IOTools.open_file(fn1)
-        ids1 = set(getIds(inf1, id1_getter))
-
-        E.info("reading second in pair")
-        inf2 = IOTools.open_file(fn2)
-        # IMS: No longer keep as a set, but lazily evaluate into intersection
-        # leads to large memory saving for large inf2, particularly if
-        # inf1 is small.
-        ids2 = getIds(inf2, id2_getter)
-        take = ids1.intersection(ids2)
+        start_time = time.time()
+        reconcile_method = options.reconcile_method
+
+        if reconcile_method == "auto":
+            # output is only moved into place if the order of reads
+            # is shared, otherwise start again by hashing
+            try:
+                ninput1, ninput2, noutput = reconcile(
+                    reconcile_by_order, fn1, fn2, options,
+                    id1_getter, id2_getter,
+                    temporary=True)
+                reconcile_method = "ordered"
+            except ValueError as msg:
+                E.warn("%s - switching to reconciliation by hashing" % msg)
+                reconcile_method = "hash"
+                ninput1, ninput2, noutput = reconcile(
+                    reconcile_by_hash, fn1, fn2, options,
+                    id1_getter, id2_getter)
+        elif reconcile_method == "ordered":
+            ninput1, ninput2, noutput = reconcile(
+                reconcile_by_order, fn1, fn2, options,
+                id1_getter, id2_getter)
+        else:
+            ninput1, ninput2, noutput = reconcile(
+                reconcile_by_hash, fn1, fn2, options,
+                id1_getter, id2_getter)
 
+        elapsed = time.time() - start_time
         E.info("first pair: %i reads, second pair: %i reads, "
                "shared: %i reads" %
-               (id_lengths[fn1],
-                id_lengths[fn2],
-                len(take)))
-
-        if options.unpaired:
-            unpaired_filename = E.open_output_file(
-                "unpaired.fastq.gz", "w")
-        else:
-            unpaired_filename = None
-
-        with E.open_output_file("1", "w") as outf:
-            inf = IOTools.open_file(fn1)
-            E.info("writing first in pair")
-            write(outf, inf, take, unpaired_filename, id1_getter)
-
-        with E.open_output_file("2", "w") as outf:
-            inf = IOTools.open_file(fn2)
-            E.info("writing second in pair")
-            write(outf, inf, take, unpaired_filename, id2_getter)
-
-        counter.output = len(take)
-        
-        if options.unpaired:
-            unpaired_filename.close()
+               (ninput1, ninput2, noutput))
+        E.info("reconciled by %s in %.1fs: %.0f reads/s, "
+               "peak memory %i Mb" % (
+                   reconcile_method,
+                   elapsed,
+                   (ninput1 + ninput2) / max(elapsed, 1e-6),
+                   resource.getrusage(
+                       resource.RUSAGE_SELF).ru_maxrss // 1024))
+
+        counter.input1 = ninput1
+        counter.input2 = ninput2
+        counter.output = noutput
 
     elif options.method == "filter-by-sequence":
 
         with pysam.FastxFile(options.input_filename_fasta) as inf:
-            for record in inf:
-                query_sequence = record.sequence
-                break
+            query_sequences = [record.sequence for record in inf]
 
         with pysam.FastxFile(fn1, persist=False) as inf1, \
                 pysam.FastxFile(fn2, persist=False) as inf2, \
@@ -285,7 +583,7 @@ def main(argv=None):
                 E.open_output_file("unmatched.fastq.1.gz", "w") as outf_unmatched1, \
                 E.open_output_file("unmatched.fastq.2.gz", "w") as outf_unmatched2:
             counter = fastqtools.filter_by_sequence(
-                query_sequence,
+                query_sequences,
                 inf1,
                 inf2,
                 outf_matched1,
@@ -293,7 +591,9 @@ def main(argv=None):
                 outf_unmatched1,
                 outf_unmatched2,
                 kmer_size=options.filtering_kmer_size,
-                min_kmer_matches=options.filtering_min_kmer_matches)
+                min_kmer_matches=options.filtering_min_kmer_matches,
+                num_workers=options.num_workers,
+                chunk_size=options.chunk_size)
         options.stdout.write(
             "\t".join(("input", "matched", "unmatched", "percent_matched")) + "\n")
 
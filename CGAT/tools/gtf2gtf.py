@@ -11,12 +11,13 @@ transformation, and outputs a new gene set in :term:`gtf` format to stdout.
 The transformation is chosen by the ``--method`` command line option.
 
 Transformations available for use in this script can broadly be
-classified into four categories:
+classified into five categories:
 
 1. sorting gene sets
 2. manipulating gene models
 3. filtering gene sets
 4. setting/resetting fields within a gtf file
+5. compiling gene sets
 
 Further options for working with gtf files are available in gff2gff.py,
 which can be run with the specification --is-gtf
@@ -52,6 +53,12 @@ Sorting gene sets
    N.B. position+gene sorts by gene_id, start, then subsequently sorts
    flattened gene lists by contig, start
 
+   By default, the input is sorted in memory. Use ``--max-memory``
+   to sort large files in bounded memory. Sorted runs of records are
+   then written to temporary files and merged, for example::
+
+      cgat gtf2gtf --method=sort --sort-order=gene --max-memory=2G
+
 
 Manipulating gene-models
 ++++++++++++++++++++++++
@@ -244,6 +251,14 @@ Options for altering fields within :term:`gtf`.
     attribute. Will only set if ``transcript_biotype`` attribute is
     present in the current record.
 
+Compiling gene sets
++++++++++++++++++++
+
+``compile``
+    Write the gene set into a binary cache that can be loaded quickly
+    with :mod:`CGAT.GTFCache`. The cache is written to the file given
+    by ``--output-filename-cache``. Nothing is written to stdout.
+
 Usage
 -----
 
@@ -281,6 +296,7 @@ import collections
 import itertools
 
 import CGAT.GTF as GTF
+import CGAT.GTFCache as GTFCache
 import CGATCore.Experiment as E
 import CGAT.Genomics as Genomics
 import CGAT.Intervals as Intervals
@@ -354,6 +370,15 @@ def gene_to_blocks(gene):
         yield entry
 
 
+def parse_memory(value):
+    '''convert a memory size such as 500M or 4G into bytes.'''
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip().upper()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
 def main(argv=None):
 
     if not argv:
@@ -386,6 +411,13 @@ def main(argv=None):
                                "gene+exon"),
                       help="sort input data [%default].")
 
+    parser.add_option("--max-memory",
+                      dest="max_memory",
+                      type="string",
+                      help="approximate amount of memory to use for "
+                      "sorting, for example 500M or 4G. If not set, the "
+                      "input is sorted in memory [%default].")
+
     parser.add_option("--mark-utr",
                       dest="mark_utr",
                       action="store_true",
@@ -493,10 +525,16 @@ def main(argv=None):
                       help="when merging transcripts, exons or introns, use "
                       "the parent gene_id as the transcript id.")
 
+    parser.add_option("--output-filename-cache", dest="cache_filename",
+                      type="string",
+                      help="filename of the binary cache written by "
+                      "--method=compile [%default].")
+
     parser.add_option("-m", "--method", dest="method", type="choice",
                       action="append",
                       choices=(
                           "add-protein-id",
+                          "compile",
                           "exons2introns",
                           "filter",
                           "find-retained-introns",
@@ -528,6 +566,7 @@ def main(argv=None):
 
     parser.set_defaults(
         sort_order="gene",
+        max_memory=None,
         filter_method="gene",
         pattern="%i",
         merge_exons_distance=0,
@@ -544,6 +583,7 @@ def main(argv=None):
         strict=True,
         method=None,
         use_geneid=False,
+        cache_filename=None,
     )
 
     (options, args) = E.start(parser, argv=argv)
@@ -558,6 +598,9 @@ def main(argv=None):
     else:
         options.method = options.method[0]
 
+    if options.max_memory is not None:
+        options.max_memory = parse_memory(options.max_memory)
+
     if options.method == "set-transcript-to-gene":
 
         for gff in GTF.iterator(options.stdin):
@@ -684,12 +727,22 @@ def main(argv=None):
     elif "sort" == options.method:
 
         for gff in GTF.iterator_sorted(GTF.iterator(options.stdin),
-                                       sort_order=options.sort_order):
+                                       sort_order=options.sort_order,
+                                       max_memory=options.max_memory):
             ninput += 1
             options.stdout.write("%s\n" % str(gff))
             noutput += 1
             nfeatures += 1
 
+    elif options.method == "compile":
+
+        if options.cache_filename is None:
+            raise ValueError(
+                "please specify --output-filename-cache for --method=compile")
+
+        ninput = GTFCache.build_cache(options.stdin, options.cache_filename)
+        nfeatures = ninput
+
     elif "set-gene-to-transcript" == options.method:
 
         for gff in GTF.iterator(options.stdin):
@@ -763,7 +816,8 @@ def main(argv=None):
         #
         gffs = GTF.iterator_sorted_chunks(
             GTF.flat_gene_iterator(GTF.iterator(options.stdin)),
-            sort_by="contig-strand-start")
+            sort_by="contig-strand-start",
+            max_memory=options.max_memory)
 
         def iterate_chunks(gff_chunks):
 
@@ -444,6 +444,36 @@ convention. A summary is `here
 For unstranded protocols, all reads and pairs are considered to matching
 in the sense direction.
 
+Parallel processing
+-------------------
+
+Annotation can be distributed over several processes with the
+``--num-workers`` option. Gene models are grouped into chunks of at
+most ``--chunk-size`` genes that do not span contigs. Each worker
+process opens its own :term:`bam`, bigwig and genome files. The
+output is identical to the output of the serial mode and in the same
+order as the input. The ``read-extension`` counter and the
+``--sample-probability`` option can not be used with multiple
+workers.
+
+Interval files
+--------------
+
+Files given with ``--gff-file`` are read only once, even if several
+counters, sections, sources or features use them. The intervals are
+shared between counters. With ``--interval-cache``, intervals are
+saved to a file and loaded from it in later runs. Intervals are only
+re-used if the ``--gff-file`` has not been modified in the meantime.
+
+The read and read pair counters (``read-counts``, ``read-fullcounts``,
+``readpair-counts`` and ``readpair-fullcounts``) read each contig of
+a :term:`bam` file once in coordinate order and keep reads overlapping
+the current gene model in a buffer. This is fastest if the input is
+sorted by contig and start coordinate. Gene models out of order are
+still counted correctly, but require the :term:`bam` file to be read
+again from their start. With ``--bam-access=fetch`` reads are fetched
+for each gene model separately.
+
 Usage
 -----
 
@@ -458,207 +488,33 @@ Command line options
 
 '''
 
+import os
 import sys
+import io
 import pysam
 
 import CGATCore.Experiment as E
 import CGAT.GTF as GTF
 import CGAT.IndexedFasta as IndexedFasta
 import CGAT.GeneModelAnalysis as GeneModelAnalysis
+import CGAT.Parallel as Parallel
 
 import pyBigWig
 
 
-def main(argv=None):
-
-    parser = E.OptionParser(version="%prog version: $Id$",
-                            usage=globals()["__doc__"])
-
-    parser.add_option("-g", "--genome-file", dest="genome_file", type="string",
-                      help="filename with genome [default=%default].")
-
-    parser.add_option("-q", "--quality-file",
-                      dest="quality_file",
-                      type="string",
-                      help="filename with genomic base quality "
-                      "information [default=%default].")
-
-    parser.add_option("-b", "--bam-file", dest="bam_files",
-                      type="string", metavar="bam",
-                      help="filename with read mapping information. "
-                      "Multiple files can be submitted in a "
-                      "comma-separated list [default=%default].")
-
-    parser.add_option("-i", "--bigwig-file", dest="bigwig_file",
-                      type="string", metavar="bigwig",
-                      help="filename with bigwig information "
-                      "[default=%default].")
-
-    parser.add_option("-f", "--gff-file", dest="filename_gff",
-                      type="string", action="append", metavar='bed',
-                      help="filename with extra gff files. The order "
-                      "is important [default=%default].")
-
-    parser.add_option("--filename-format", dest="filename_format",
-                      type="choice",
-                      choices=("bed", "gff", "gtf"),
-                      help="format of secondary stream [default=%default].")
-
-    parser.add_option("--restrict-source", dest="gff_sources", type="string",
-                      action="append",
-                      help="restrict input to this 'source' in extra "
-                      "gff file (for counter: overlap) [default=%default].")
-
-    parser.add_option("--restrict-feature", dest="gff_features", type="string",
-                      action="append",
-                      help="restrict input to this 'feature' in extra gff "
-                      "file (for counter: overlap) [default=%default].")
+def buildCounters(options):
+    """build the counters selected on the command line.
 
-    parser.add_option("-r", "--reporter", dest="reporter", type="choice",
-                      choices=("genes", "transcripts"),
-                      help="report results for 'genes' or 'transcripts' "
-                      "[default=%default].")
+    All input files (genome, quality scores, :term:`bam` and bigwig
+    files) are opened within this function so that each worker
+    process in ``--num-workers`` mode obtains its own set of file
+    handles.
 
-    parser.add_option("-s", "--section", dest="sections",
-                      type="choice",
-                      action="append",
-                      choices=("exons", "introns"),
-                      help="select range on which counters will operate "
-                      "[default=%default].")
-
-    parser.add_option("-c", "--counter", dest="counters",
-                      type="choice",
-                      action="append",
-                      choices=(	"bigwig-counts",
-                                "binding-pattern",
-                                "classifier",
-                                "classifier-rnaseq",
-                                "classifier-rnaseq-splicing",
-                                "classifier-polii",
-                                "composition-na",
-                                "composition-cpg",
-                                "coverage",
-                                "distance",
-                                "distance-genes",
-                                "distance-tss",
-                                "length",
-                                'neighbours',
-                                "overlap",
-                                "overlap-stranded",
-                                "overlap-transcripts",
-                                "overrun",
-                                "position",
-                                "proximity",
-                                "proximity-exclusive",
-                                "proximity-lengthmatched",
-                                "quality",
-                                "read-coverage",
-                                "read-extension",
-                                "read-overlap",
-                                "read-counts",
-                                "read-fullcounts",
-                                "readpair-counts",
-                                "readpair-fullcounts",
-                                "splice",
-                                "splice-comparison",
-                                "territories"),
-                      help="select counters to apply to input "
-                      "[default=%default].")
-
-    parser.add_option("--add-gtf-source", dest="add_gtf_source",
-                      action="store_true",
-                      help="add gtf field of source to output "
-                      "[default=%default].")
-
-    parser.add_option("--proximal-distance", dest="proximal_distance",
-                      type="int",
-                      help="distance to be considered proximal to "
-                      "an interval [default=%default].")
-
-    parser.add_option("--multi-mapping-method",
-                      dest="multi_mapping",
-                      type="choice",
-                      choices=('all', 'ignore', 'weight'),
-                      help="how to treat multi-mapping reads in "
-                      "bam-files. Requires "
-                      "the NH flag to be set by the mapper "
-                      "[default=%default].")
-
-    parser.add_option("--use-barcodes",
-                      dest="use_barcodes",
-                      action="store_true",
-                      help="Use barcodes to count unique umi's. "
-                      "UMI's are specified in the read identifier "
-                      "as the last field, where fields are separated "
-                      "by underscores, e.g. "
-                      "@READ:ILLUMINA:STUFF_NAMINGSTUFF_UMI. "
-                      "When true, unique counts are returned. "
-                      "Currently only compatible with count-reads")
-
-    parser.add_option("--sample-probability",
-                      dest="sample_probability",
-                      type="float",
-                      help="Specify the probability of whether any"
-                      "given read or read pair in a file bam is counted"
-                      "Currently only compatible with count-reads")
-
-    parser.add_option("--column-prefix", dest="prefixes",
-                      type="string",
-                      action="append",
-                      help="add prefix to column headers - prefixes "
-                      "are used in the same order as the counters "
-                      "[default=%default].")
-
-    parser.add_option("--library-type",
-                      dest="library_type",
-                      type="choice",
-                      choices=("unstranded",
-                               "firststrand",
-                               "secondstrand",
-                               "fr-unstranded",
-                               "fr-firststrand",
-                               "fr-secondstrand"),
-                      help="library type of reads in bam file. "
-                      "[default=%default]")
-
-    parser.add_option("--min-mapping-quality",
-                      dest="minimum_mapping_quality",
-                      type="float",
-                      help="minimum mapping quality. Reads with a quality "
-                      "score of less will be ignored. "
-                      "[default=%default]")
-
-    parser.set_defaults(
-        genome_file=None,
-        reporter="genes",
-        with_values=True,
-        sections=[],
-        counters=[],
-        filename_gff=[],
-        filename_format=None,
-        gff_features=[],
-        gff_sources=[],
-        add_gtf_source=False,
-        proximal_distance=10000,
-        bam_files=None,
-        multi_mapping='all',
-        library_type='fr-unstranded',
-        prefixes=[],
-        minimum_mapping_quality=0,
-        use_barcodes=False,
-        sample_probability=1.0
-    )
-
-    if not argv:
-        argv = sys.argv
-
-    (options, args) = E.start(parser, add_output_options=True, argv=argv)
-
-    if options.prefixes:
-        if len(options.prefixes) != len(options.counters):
-            raise ValueError(
-                "if any prefix is given, the number of prefixes "
-                "must be the same as the number of counters")
+    Returns
+    -------
+    counters : list
+        List of :class:`GeneModelAnalysis.Counter` objects.
+    """
 
     # get files
     if options.genome_file:
@@ -686,17 +542,6 @@ def main(argv=None):
 
     counters = []
 
-    if not options.sections:
-        E.info("counters will use the default section (exons)")
-        options.sections.append(None)
-
-    if not options.gff_sources:
-        options.gff_sources.append(None)
-    if not options.gff_features:
-        options.gff_features.append(None)
-
-    cc = E.Counter()
-
     for n, c in enumerate(options.counters):
         if options.prefixes:
             prefix = options.prefixes[n]
@@ -755,6 +600,7 @@ def main(argv=None):
                 use_barcodes=options.use_barcodes,
                 sample_probability=options.sample_probability,
                 minimum_mapping_quality=options.minimum_mapping_quality,
+                sweep=options.bam_access == "sweep",
                 options=options,
                 prefix=prefix))
         elif c == "read-fullcounts":
@@ -763,6 +609,7 @@ def main(argv=None):
                 multi_mapping=options.multi_mapping,
                 sample_probability=options.sample_probability,
                 minimum_mapping_quality=options.minimum_mapping_quality,
+                sweep=options.bam_access == "sweep",
                 options=options,
                 prefix=prefix))
         elif c == "readpair-counts":
@@ -772,6 +619,7 @@ def main(argv=None):
                 sample_probability=options.sample_probability,
                 library_type=options.library_type,
                 minimum_mapping_quality=options.minimum_mapping_quality,
+                sweep=options.bam_access == "sweep",
                 options=options,
                 prefix=prefix))
         elif c == "readpair-fullcounts":
@@ -780,6 +628,7 @@ def main(argv=None):
                 multi_mapping=options.multi_mapping,
                 sample_probability=options.sample_probability,
                 minimum_mapping_quality=options.minimum_mapping_quality,
+                sweep=options.bam_access == "sweep",
                 options=options,
                 prefix=prefix))
         elif c == "bigwig-counts":
@@ -900,6 +749,23 @@ def main(argv=None):
                 options=options,
                 prefix=prefix))
 
+    return counters
+
+
+def getReporter(options):
+    """return iterator and functions for the row labels of a table.
+
+    Returns
+    -------
+    iterator : function
+        Iterator grouping :term:`gtf` records into gene models.
+    header : list
+        Column names of the row labels.
+    fheader : function
+        Function returning the row label of a gene model.
+    ffields : function
+        Function returning additional fields of a gene model.
+    """
     if options.reporter == "genes":
         iterator = GTF.flat_gene_iterator
         header = ["gene_id"]
@@ -915,26 +781,366 @@ def main(argv=None):
     else:
         ffields = lambda x: []
 
-    options.stdout.write("\t".join(
-        header + [x.getHeader() for x in counters]) + "\n")
+    return iterator, header, fheader, ffields
+
+
+def annotate(gffs, counters, fheader, ffields):
+    """apply all counters to a gene model.
+
+    Returns a row in the output table or None if the gene model
+    has been skipped by all counters.
+    """
+    for counter in counters:
+        counter.update(gffs)
 
-    for gffs in iterator(GTF.iterator(options.stdin)):
-        cc.input += 1
+    skip = len([x for x in counters if x.skip]) == len(counters)
+    if skip:
+        return None
 
-        for counter in counters:
-            counter.update(gffs)
+    return "\t".join(
+        fheader(gffs) +
+        ffields(gffs) +
+        [str(counter) for counter in counters]) + "\n"
 
-        skip = len([x for x in counters if x.skip]) == len(counters)
-        if skip:
-            cc.skipped += 1
+
+def iterator_chunks(gene_iterator, chunk_size):
+    """group gene models into chunks to be processed by a worker.
+
+    Chunks do not span contigs and contain at most `chunk_size`
+    gene models. Each gene model is represented by its :term:`gtf`
+    formatted lines.
+    """
+    for chunk in Parallel.iterate_chunks(
+            gene_iterator, chunk_size, key=lambda gffs: gffs[0].contig):
+        yield ["".join(["%s\n" % x for x in gffs]) for gffs in chunk]
+
+
+# state of a worker process in --num-workers mode
+WORKER = {}
+
+
+def initWorker(options):
+    """set up counters and open files in a worker process."""
+    WORKER["counters"] = buildCounters(options)
+    WORKER["reporter"] = getReporter(options)
+
+
+def countChunk(chunk):
+    """annotate a chunk of gene models in a worker process.
+
+    Returns a tuple of output rows, the number of input and skipped
+    gene models and the counts collected by each counter while
+    processing this chunk.
+    """
+    counters = WORKER["counters"]
+    iterator, header, fheader, ffields = WORKER["reporter"]
+
+    rows = []
+    ninput, nskipped = 0, 0
+    for lines in chunk:
+        ninput += 1
+        gffs = list(GTF.iterator(io.StringIO(lines)))
+        row = annotate(gffs, counters, fheader, ffields)
+        if row is None:
+            nskipped += 1
             continue
+        rows.append(row)
+
+    counts = []
+    for counter in counters:
+        counts.append(dict(counter.counter.items()))
+        counter.counter = E.Counter()
+
+    return rows, ninput, nskipped, counts
 
-        options.stdout.write("\t".join(
-            fheader(gffs) +
-            ffields(gffs) +
-            [str(counter) for counter in counters]) + "\n")
 
-        cc.output += 1
+def main(argv=None):
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-g", "--genome-file", dest="genome_file", type="string",
+                      help="filename with genome [default=%default].")
+
+    parser.add_option("-q", "--quality-file",
+                      dest="quality_file",
+                      type="string",
+                      help="filename with genomic base quality "
+                      "information [default=%default].")
+
+    parser.add_option("-b", "--bam-file", dest="bam_files",
+                      type="string", metavar="bam",
+                      help="filename with read mapping information. "
+                      "Multiple files can be submitted in a "
+                      "comma-separated list [default=%default].")
+
+    parser.add_option("-i", "--bigwig-file", dest="bigwig_file",
+                      type="string", metavar="bigwig",
+                      help="filename with bigwig information "
+                      "[default=%default].")
+
+    parser.add_option("-f", "--gff-file", dest="filename_gff",
+                      type="string", action="append", metavar='bed',
+                      help="filename with extra gff files. The order "
+                      "is important [default=%default].")
+
+    parser.add_option("--filename-format", dest="filename_format",
+                      type="choice",
+                      choices=("bed", "gff", "gtf"),
+                      help="format of secondary stream [default=%default].")
+
+    parser.add_option("--restrict-source", dest="gff_sources", type="string",
+                      action="append",
+                      help="restrict input to this 'source' in extra "
+                      "gff file (for counter: overlap) [default=%default].")
+
+    parser.add_option("--restrict-feature", dest="gff_features", type="string",
+                      action="append",
+                      help="restrict input to this 'feature' in extra gff "
+                      "file (for counter: overlap) [default=%default].")
+
+    parser.add_option("-r", "--reporter", dest="reporter", type="choice",
+                      choices=("genes", "transcripts"),
+                      help="report results for 'genes' or 'transcripts' "
+                      "[default=%default].")
+
+    parser.add_option("-s", "--section", dest="sections",
+                      type="choice",
+                      action="append",
+                      choices=("exons", "introns"),
+                      help="select range on which counters will operate "
+                      "[default=%default].")
+
+    parser.add_option("-c", "--counter", dest="counters",
+                      type="choice",
+                      action="append",
+                      choices=(	"bigwig-counts",
+                                "binding-pattern",
+                                "classifier",
+                                "classifier-rnaseq",
+                                "classifier-rnaseq-splicing",
+                                "classifier-polii",
+                                "composition-na",
+                                "composition-cpg",
+                                "coverage",
+                                "distance",
+                                "distance-genes",
+                                "distance-tss",
+                                "length",
+                                'neighbours',
+                                "overlap",
+                                "overlap-stranded",
+                                "overlap-transcripts",
+                                "overrun",
+                                "position",
+                                "proximity",
+                                "proximity-exclusive",
+                                "proximity-lengthmatched",
+                                "quality",
+                                "read-coverage",
+                                "read-extension",
+                                "read-overlap",
+                                "read-counts",
+                                "read-fullcounts",
+                                "readpair-counts",
+                                "readpair-fullcounts",
+                                "splice",
+                                "splice-comparison",
+                                "territories"),
+                      help="select counters to apply to input "
+                      "[default=%default].")
+
+    parser.add_option("--add-gtf-source", dest="add_gtf_source",
+                      action="store_true",
+                      help="add gtf field of source to output "
+                      "[default=%default].")
+
+    parser.add_option("--proximal-distance", dest="proximal_distance",
+                      type="int",
+                      help="distance to be considered proximal to "
+                      "an interval [default=%default].")
+
+    parser.add_option("--multi-mapping-method",
+                      dest="multi_mapping",
+                      type="choice",
+                      choices=('all', 'ignore', 'weight'),
+                      help="how to treat multi-mapping reads in "
+                      "bam-files. Requires "
+                      "the NH flag to be set by the mapper "
+                      "[default=%default].")
+
+    parser.add_option("--use-barcodes",
+                      dest="use_barcodes",
+                      action="store_true",
+                      help="Use barcodes to count unique umi's. "
+                      "UMI's are specified in the read identifier "
+                      "as the last field, where fields are separated "
+                      "by underscores, e.g. "
+                      "@READ:ILLUMINA:STUFF_NAMINGSTUFF_UMI. "
+                      "When true, unique counts are returned. "
+                      "Currently only compatible with count-reads")
+
+    parser.add_option("--sample-probability",
+                      dest="sample_probability",
+                      type="float",
+                      help="Specify the probability of whether any"
+                      "given read or read pair in a file bam is counted"
+                      "Currently only compatible with count-reads")
+
+    parser.add_option("--column-prefix", dest="prefixes",
+                      type="string",
+                      action="append",
+                      help="add prefix to column headers - prefixes "
+                      "are used in the same order as the counters "
+                      "[default=%default].")
+
+    parser.add_option("--library-type",
+                      dest="library_type",
+                      type="choice",
+                      choices=("unstranded",
+                               "firststrand",
+                               "secondstrand",
+                               "fr-unstranded",
+                               "fr-firststrand",
+                               "fr-secondstrand"),
+                      help="library type of reads in bam file. "
+                      "[default=%default]")
+
+    parser.add_option("--min-mapping-quality",
+                      dest="minimum_mapping_quality",
+                      type="float",
+                      help="minimum mapping quality. Reads with a quality "
+                      "score of less will be ignored. "
+                      "[default=%default]")
+
+    parser.add_option("--num-workers",
+                      dest="num_workers",
+                      type="int",
+                      help="number of worker processes. Gene models are "
+                      "split into chunks by contig and annotated in "
+                      "parallel. Output is in input order "
+                      "[default=%default]")
+
+    parser.add_option("--chunk-size",
+                      dest="chunk_size",
+                      type="int",
+                      help="maximum number of gene models in a chunk "
+                      "processed by a worker [default=%default]")
+
+    parser.add_option("--interval-cache",
+                      dest="interval_cache",
+                      type="string",
+                      help="filename to load intervals of --gff-file "
+                      "from and to save them to [default=%default]")
+
+    parser.add_option("--bam-access",
+                      dest="bam_access",
+                      type="choice",
+                      choices=("sweep", "fetch"),
+                      help="how read and read pair counters access "
+                      "bam files. ``sweep`` reads each contig once, "
+                      "``fetch`` fetches reads for each gene model "
+                      "separately [default=%default]")
+
+    parser.set_defaults(
+        genome_file=None,
+        reporter="genes",
+        with_values=True,
+        sections=[],
+        counters=[],
+        filename_gff=[],
+        filename_format=None,
+        gff_features=[],
+        gff_sources=[],
+        add_gtf_source=False,
+        proximal_distance=10000,
+        bam_files=None,
+        multi_mapping='all',
+        library_type='fr-unstranded',
+        prefixes=[],
+        minimum_mapping_quality=0,
+        use_barcodes=False,
+        sample_probability=1.0,
+        num_workers=1,
+        chunk_size=1000,
+        interval_cache=None,
+        bam_access="sweep",
+    )
+
+    if not argv:
+        argv = sys.argv
+
+    (options, args) = E.start(parser, add_output_options=True, argv=argv)
+
+    if options.prefixes:
+        if len(options.prefixes) != len(options.counters):
+            raise ValueError(
+                "if any prefix is given, the number of prefixes "
+                "must be the same as the number of counters")
+
+    if not options.sections:
+        E.info("counters will use the default section (exons)")
+        options.sections.append(None)
+
+    if not options.gff_sources:
+        options.gff_sources.append(None)
+    if not options.gff_features:
+        options.gff_features.append(None)
+
+    if options.num_workers > 1:
+        if "read-extension" in options.counters:
+            raise ValueError(
+                "read-extension writes additional output files and "
+                "can not be used with --num-workers > 1")
+        if options.sample_probability < 1.0:
+            raise ValueError(
+                "--sample-probability requires a single random number "
+                "stream and can not be used with --num-workers > 1")
+
+    cc = E.Counter()
+
+    if options.interval_cache and os.path.exists(options.interval_cache):
+        GeneModelAnalysis.INTERVAL_STORE.load(options.interval_cache)
+
+    counters = buildCounters(options)
+    iterator, header, fheader, ffields = getReporter(options)
+
+    if options.interval_cache:
+        GeneModelAnalysis.INTERVAL_STORE.save(options.interval_cache)
+
+    # parsed entries are not needed once intervals have been built
+    GeneModelAnalysis.INTERVAL_STORE.releaseEntries()
+
+    options.stdout.write("\t".join(
+        header + [x.getHeader() for x in counters]) + "\n")
+
+    gene_iterator = iterator(GTF.iterator(options.stdin))
+
+    if options.num_workers > 1:
+        # workers open their own files in buildCounters
+        E.info("annotating with %i worker processes" % options.num_workers)
+        results = Parallel.imap(
+            countChunk,
+            iterator_chunks(gene_iterator, options.chunk_size),
+            num_workers=options.num_workers,
+            initializer=initWorker,
+            initargs=(Parallel.worker_options(options),))
+        for rows, ninput, nskipped, counts in results:
+            cc.input += ninput
+            cc.skipped += nskipped
+            cc.output += len(rows)
+            options.stdout.write("".join(rows))
+            for counter, c in zip(counters, counts):
+                counter.counter += c
+    else:
+        for gffs in gene_iterator:
+            cc.input += 1
+            row = annotate(gffs, counters, fheader, ffields)
+            if row is None:
+                cc.skipped += 1
+                continue
+            options.stdout.write(row)
+            cc.output += 1
 
     E.info("%s" % str(cc))
     for counter in counters:
@@ -125,6 +125,10 @@ The command below runs a GO analysis, computing an FDR using 10.000 samples::
         --output-filename-pattern='result/%(set)s.%(go)s.%(section)s'
    > go.log
 
+Samples are evaluated in batches of ``--sample-batch-size`` samples
+as sparse matrix products. Use ``--num-workers`` to evaluate batches
+in several processes.
+
 The output will be stored in the directory :file:`result` and output
 files will be created according to the pattern
 ``<set>.<go>.<section>``. ``<set>`` is the gene set that is analysed,
@@ -236,6 +240,16 @@ def main(argv=None):
         "--sample-size", dest="sample", type="int",
         help="do sampling (with # samples) [default=%default].")
 
+    parser.add_option(
+        "--num-workers", dest="num_workers", type="int",
+        help="number of processes to use for sampling "
+        "[default=%default].")
+
+    parser.add_option(
+        "--sample-batch-size", dest="sample_batch_size", type="int",
+        help="number of samples evaluated together "
+        "[default=%default].")
+
     parser.add_option(
         "--filename-output-pattern", "--output-filename-pattern",
         dest="output_filename_pattern", type="string",
@@ -297,6 +311,8 @@ def main(argv=None):
                         ontology=[],
                         filename_dump=None,
                         sample=0,
+                        num_workers=1,
+                        sample_batch_size=100,
                         fdr=False,
                         output_filename_pattern=None,
                         threshold=0.05,
@@ -7,7 +7,8 @@ snps2architecture.py - Calculate & plot disease frequency by allele
 
 Purpose
 -------
-This script requires a Plink .ped file and .map file.  It calculates
+This script requires a Plink .ped file and .map file or a Plink binary
+.bed file (``--bed-file``) with .bim and .fam files.  It calculates
 two sets of summary statistics:
     1. frequency of cases carrying risk alleles
     2. cumulative frequency of cases carrying risk alleles
@@ -29,6 +30,10 @@ The steps are:
   * calculate P(Disease) for each risk allele bin
   * plot
 
+Genotypes are loaded into a compact matrix of one byte per genotype.
+With ``--genotype-cache``, the parsed genotypes of a .ped file are saved
+and memory-mapped on subsequent runs.
+
 
 Methods
 -------
@@ -65,10 +70,10 @@ Command line options
 '''
 
 import sys
+import re
 import CGATCore.Experiment as E
 import CGAT.GWAS as gwas
 import pandas as pd
-import numpy as np
 
 
 def main(argv=None):
@@ -99,6 +104,16 @@ def main(argv=None):
                       help="plink ped file with phenotype and "
                       "genotype data - A2 major allele coded")
 
+    parser.add_option("--bed-file", dest="bed_file", type="string",
+                      help="plink binary .bed file with genotype data, "
+                      "used instead of --ped-file and --map-file. The "
+                      ".bim and .fam files need to have the same prefix")
+
+    parser.add_option("--genotype-cache", dest="genotype_cache",
+                      type="string",
+                      help="cache parsed ped file genotypes in this file. "
+                      "The cache is used if it is newer than the ped file")
+
     parser.add_option("--gwas-file", dest="gwas", type="string",
                       help="gwas results file, assumes Plink "
                       "output format.  Must contain SNP, BP, "
@@ -130,15 +145,22 @@ def main(argv=None):
                            index_col=None)
     snp_list = snp_df["SNP"].values
 
-    # parse ped file
-    E.info("Reading ped file: %s" % options.ped_file)
-    ped_df = gwas.parsePed(options.ped_file,
-                           compound_geno=True)
+    # parse genotypes into a samples x SNPs matrix
+    if options.bed_file:
+        E.info("Reading plink binary file: %s" % options.bed_file)
+        samples, genos = gwas.readPlinkBed(options.bed_file)
+        map_file = re.sub(r"\.bed$", "", options.bed_file) + ".bim"
+    else:
+        E.info("Reading ped file: %s" % options.ped_file)
+        samples, genos = gwas.readPedGenotypes(
+            options.ped_file,
+            cache_file=options.genotype_cache)
+        map_file = options.map_file
 
     # parse map file and get SNP indices that correspond to
     # ped file genotypes
-    E.info("Fetching SNPs from map file: %s" % options.map_file)
-    snp_index = gwas.getSNPs(options.map_file,
+    E.info("Fetching SNPs from map file: %s" % map_file)
+    snp_index = gwas.getSNPs(map_file,
                              snp_list)
 
     E.info("SNPs found: %i" % len(snp_index))
@@ -148,26 +170,19 @@ def main(argv=None):
 
     if options.flip:
         E.info("Flipping major alleles to risk alleles")
-        flipped_genos = gwas.flipRiskAlleles(snp_index=snp_index,
-                                             snp_results=snp_or,
-                                             genos=ped_df["GENOS"].tolist())
-        # merge flipped genotypes with pedigree frame to get phenotypes
-        geno_df = pd.DataFrame(flipped_genos, index=ped_df["FID"])
-    else:
-        # split genos into a dataframe
-        genos = np.array(ped_df["GENOS"].tolist())
-        geno_df = pd.DataFrame(genos, index=ped_df["FID"])
-
-    merged = pd.merge(geno_df, ped_df, left_index=True, right_on="FID")
+        genos = gwas.flipRiskAlleles(snp_index=snp_index,
+                                     snp_results=snp_or,
+                                     genos=genos)
 
     # need to discount missing genotypes > 1%
 
     # frequencies of number of risk alleles by trait frequency
     E.info("count #risk alleles per individual")
-    risk_results = gwas.countRiskAlleles(ped_frame=merged,
-                                         snp_index=snp_index.values(),
+    risk_results = gwas.countRiskAlleles(ped_frame=samples,
+                                         snp_index=list(snp_index.values()),
                                          report=options.method,
-                                         flag=options.explained)
+                                         flag=options.explained,
+                                         genotypes=genos)
     risk_freqs = risk_results["freqs"]
     cumulative = risk_results["cumulative"]
     # select results upto and including cumulative freq = 1.0
@@ -82,7 +82,15 @@ gc-depth-profile
 gc-context
 ----------
 
+Parallel processing
+===================
 
+With ``--num-workers``, records are counted by several processes.
+The genome or the region given by ``--region`` is split into
+regions of at most ``--region-size`` bases. These or the intervals
+in ``--input-bed`` are distributed between the workers. Each worker
+opens its own VCF and FASTA file. The counts of all workers are combined
+before output, which is the same as in the serial mode.
 
 """
 
@@ -92,7 +100,7 @@ import pysam
 
 import CGATCore.Experiment as E
 
-from CGAT.tools.VCFTools import vcf2stats_count
+from CGAT.VCFTools import vcf2stats_count
 
 
 def main(argv=sys.argv):
@@ -150,6 +158,15 @@ def main(argv=sys.argv):
         "of 50 means that 50 bases on either side of the variant are "
         "used to compute the G+C content [%default]")
 
+    parser.add_option(
+        "--num-workers", dest="num_workers", type="int",
+        help="number of worker processes to use [%default]")
+
+    parser.add_option(
+        "--region-size", dest="region_size", type="int",
+        help="size of regions counted by a worker process "
+        "if --num-workers > 1 [%default]")
+
     parser.set_defaults(
         methods=[],
         input_vcf_file=None,
@@ -160,6 +177,8 @@ def main(argv=sys.argv):
         format_distribution_nbins=1000,
         gc_window_size=50,
         report_step=1000000,
+        num_workers=1,
+        region_size=10000000,
     )
 
     (options, args) = E.start(parser, argv, add_output_options=True)
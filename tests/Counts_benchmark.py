@@ -0,0 +1,70 @@
+"""benchmark generation of spike-ins in Counts.py.
+
+Reports the number of rows or clusters, the time and the number of
+rows or clusters processed per second for
+
+rows
+    :meth:`Counts.Counts.shuffleRows`
+clusters
+    :func:`Counts.shuffleCluster` on clusters of 20 rows
+
+Tables with random counts are created for each size.
+
+Usage::
+
+   python tests/Counts_benchmark.py 10000 100000 500000
+
+"""
+
+import sys
+import time
+
+import numpy
+import pandas
+
+import CGAT.Counts as Counts
+
+TRACKS_MAP = {"a": ["a1", "a2", "a3"], "b": ["b1", "b2", "b3"]}
+GROUPS = ["a", "b"]
+
+
+def build_table(nrows, rng):
+    return pandas.DataFrame(
+        rng.poisson(100, size=(nrows, 6)),
+        columns=TRACKS_MAP["a"] + TRACKS_MAP["b"])
+
+
+def shuffle_rows(table, rng):
+    counts = Counts.Counts(table)
+    counts.shuffleRows(-100, 100, 10, 0, 200, 10,
+                       TRACKS_MAP, GROUPS, "relative",
+                       s_max=100, i=10, rng=rng)
+
+
+def shuffle_clusters(table, rng):
+    clusters = {}
+    for x, start in enumerate(range(0, len(table) - 19, 20)):
+        clusters[x] = table.iloc[start:start + 20]
+    Counts.shuffleCluster(numpy.arange(0, 200, 10),
+                          numpy.arange(-100, 100, 10),
+                          TRACKS_MAP, GROUPS, "relative",
+                          100, 10, clusters, 5, 1, 1, rng=rng)
+
+
+def main(argv=sys.argv):
+
+    sizes = [int(x) for x in argv[1:]] or [10000, 100000, 500000]
+    rng = numpy.random.RandomState(1)
+
+    for nrows in sizes:
+        table = build_table(nrows, rng)
+        for label, f in (("rows", shuffle_rows),
+                         ("clusters", shuffle_clusters)):
+            t0 = time.time()
+            f(table, rng)
+            t = time.time() - t0
+            print("%s\t%i\t%f\t%i" % (label, nrows, t, nrows / t))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
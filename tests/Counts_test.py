@@ -1,4 +1,5 @@
 import unittest
+import numpy
 import pandas
 import CGAT.Counts as Counts
 
@@ -23,3 +24,50 @@ class TestCountsClass(unittest.TestCase):
         self.assertRaises(
             self.counts.removeSamples,
             min_counts_per_sample='3')
+
+
+class TestSpikeIns(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(1)
+        self.counts = Counts.Counts(pandas.DataFrame(
+            rng.poisson(100, size=(200, 4)),
+            columns=['a1', 'a2', 'b1', 'b2']))
+        self.tracks_map = {'a': ['a1', 'a2'], 'b': ['b1', 'b2']}
+
+    def test_fillBins_is_identical_to_filling_in_order(self):
+        rng = numpy.random.RandomState(1)
+        for x in range(100):
+            counts = rng.randint(0, 4, size=(3, 4)).astype(float)
+            expected_counts = counts.copy()
+            coords = (rng.randint(0, 3, 50), rng.randint(0, 4, 50))
+            valid = rng.rand(50) > 0.2
+
+            expected = []
+            for idx, coord in enumerate(zip(*coords)):
+                if valid[idx] and expected_counts[coord] < 4:
+                    expected_counts[coord] += 1
+                    expected.append(idx)
+
+            accepted = Counts.fillBins(counts, coords, valid, 4)
+            self.assertEqual(list(accepted), expected)
+            self.assertTrue((counts == expected_counts).all())
+
+    def test_shuffleRows_respects_maximum_per_bin(self):
+        indices, bin_counts = self.counts.shuffleRows(
+            -50, 50, 10, 50, 150, 10,
+            self.tracks_map, ['a', 'b'], "relative",
+            s_max=5, i=3, rng=numpy.random.RandomState(1))
+
+        self.assertTrue(bin_counts.max() <= 5)
+        for key, pairs in indices.items():
+            self.assertEqual(len(pairs), bin_counts[key])
+            for row1, row2 in pairs:
+                g1 = self.counts.table.loc[row1, ['a1', 'a2']].mean()
+                g2 = self.counts.table.loc[row2, ['b1', 'b2']].mean()
+                change_idx, initial_idx = Counts.means2idxarrays(
+                    [g1], [g2],
+                    numpy.arange(50, 160, 10),
+                    numpy.arange(-50, 60, 10),
+                    "relative")
+                self.assertEqual((initial_idx[0], change_idx[0]), key)
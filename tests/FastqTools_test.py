@@ -0,0 +1,111 @@
+"""unit testing module for the FastqTools extension."""
+
+import collections
+import random
+import unittest
+
+import CGAT.FastqTools as FastqTools
+from CGAT.Genomics import reverse_complement
+
+
+def countDiagonals(sequence, query_sequences, kmer_size):
+    """return the maximum number of kmer matches of *sequence* on any
+    diagonal with any query sequence on either strand by comparing
+    all pairs of kmers."""
+    sequence = sequence.upper()
+    best = 0
+    for query_sequence in query_sequences:
+        for strand in (query_sequence, reverse_complement(query_sequence)):
+            strand = strand.upper()
+            counts = collections.defaultdict(int)
+            for x in range(len(sequence) - kmer_size + 1):
+                kmer = sequence[x:x + kmer_size]
+                if set(kmer) - set("ACGT"):
+                    continue
+                for y in range(len(strand) - kmer_size + 1):
+                    if strand[y:y + kmer_size] == kmer:
+                        counts[y - x] += 1
+            best = max([best] + list(counts.values()))
+    return best
+
+
+class TestKmerIndex(unittest.TestCase):
+
+    nsequences = 200
+
+    def setUp(self):
+        self.rng = random.Random(1)
+        self.query_sequences = [self.randomSequence(length)
+                                for length in (150, 80, 20)]
+        self.query_sequences[1] = self.query_sequences[1].lower()
+
+    def randomSequence(self, length, alphabet="ACGT"):
+        return "".join([self.rng.choice(alphabet) for x in range(length)])
+
+    def buildSequence(self, length):
+        """return a sequence that is a mosaic of random sequence and
+        segments of query sequences on either strand, with mutations
+        and ambiguous bases."""
+        sequence = []
+        while len(sequence) < length:
+            if self.rng.random() < 0.5:
+                sequence.extend(self.randomSequence(self.rng.randint(1, 30)))
+                continue
+            query_sequence = self.rng.choice(self.query_sequences)
+            if self.rng.random() < 0.5:
+                query_sequence = reverse_complement(query_sequence)
+            start = self.rng.randint(0, len(query_sequence) - 1)
+            end = self.rng.randint(start, len(query_sequence))
+            for c in query_sequence[start:end]:
+                r = self.rng.random()
+                if r < 0.03:
+                    c = self.rng.choice("ACGT")
+                elif r < 0.04:
+                    c = "N"
+                sequence.append(c)
+        return "".join(sequence[:length])
+
+    def checkSequences(self, index, kmer_size, lengths):
+        for length in lengths:
+            sequence = self.buildSequence(length)
+            self.assertEqual(
+                index.count_diagonals(sequence),
+                countDiagonals(sequence, self.query_sequences, kmer_size),
+                "mismatch for sequence {}".format(sequence))
+
+    def test_count_diagonals_matches_brute_force(self):
+        for kmer_size in (1, 4, 10, 32):
+            index = FastqTools.KmerIndex(self.query_sequences,
+                                         kmer_size=kmer_size)
+            self.checkSequences(
+                index, kmer_size,
+                [self.rng.randint(0, 120)
+                 for x in range(self.nsequences // 4)])
+
+    def test_count_diagonals_with_buffer_reallocation(self):
+        index = FastqTools.KmerIndex(self.query_sequences,
+                                     kmer_size=6,
+                                     max_sequence_length=10)
+        self.checkSequences(index, 6, [5, 50, 10, 300, 20])
+
+    def test_count_diagonals_without_kmers_in_queries(self):
+        index = FastqTools.KmerIndex(["ACGT"], kmer_size=10)
+        self.assertEqual(index.count_diagonals("ACGT" * 10), 0)
+
+    def test_single_query_sequence(self):
+        index = FastqTools.KmerIndex(self.query_sequences[0], kmer_size=5)
+        self.assertEqual(index.nqueries, 1)
+        sequence = self.query_sequences[0][20:100]
+        self.assertEqual(index.count_diagonals(sequence),
+                         countDiagonals(sequence,
+                                        [self.query_sequences[0]], 5))
+
+    def test_invalid_kmer_size_raises(self):
+        self.assertRaises(ValueError, FastqTools.KmerIndex,
+                          self.query_sequences, kmer_size=0)
+        self.assertRaises(ValueError, FastqTools.KmerIndex,
+                          self.query_sequences, kmer_size=33)
+
+
+if __name__ == "__main__":
+    unittest.main()
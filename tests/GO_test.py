@@ -0,0 +1,201 @@
+"""unit testing module for the GO.py module."""
+
+import contextlib
+import io
+import random
+import unittest
+
+import numpy
+import scipy.stats
+
+import CGAT.GO as GO
+
+
+class TestHypergeometricProbabilities(unittest.TestCase):
+
+    ntests = 500
+
+    def setUp(self):
+        rng = random.Random(1)
+        self.tests = []
+        for x in range(self.ntests):
+            background_total = rng.randint(1, 2000)
+            background_counts = rng.randint(0, background_total)
+            sample_total = rng.randint(0, background_total)
+            lower = max(0, sample_total - (background_total -
+                                           background_counts))
+            upper = min(background_counts, sample_total)
+            sample_counts = rng.choice((lower, upper,
+                                        rng.randint(lower, upper)))
+            self.tests.append((sample_counts, sample_total,
+                               background_counts, background_total))
+
+    def checkProbability(self, vectorized, expected):
+        # values close to the smallest float differ as the scalar
+        # implementation sums values floored at MIN_FLOAT
+        if expected < 1e-290:
+            self.assertLess(vectorized, 1e-290)
+        else:
+            self.assertAlmostEqual(vectorized / expected, 1.0, places=8)
+
+    def testIdenticalToScalarImplementation(self):
+        k, N, n, M = list(zip(*self.tests))
+        pover, punder = GO.hypergeometricProbabilities(k, N, n, M)
+
+        for x, test in enumerate(self.tests):
+            result = GO.GOResult("test")
+            (result.mSampleCountsCategory,
+             result.mSampleCountsTotal,
+             result.mBackgroundCountsCategory,
+             result.mBackgroundCountsTotal) = test
+            result.UpdateProbabilities()
+            self.checkProbability(
+                pover[x], result.mProbabilityOverRepresentation)
+            self.checkProbability(
+                punder[x], result.mProbabilityUnderRepresentation)
+
+    def testChunksGiveSameResults(self):
+        k, N, n, M = list(zip(*self.tests))
+        pover, punder = GO.hypergeometricProbabilities(k, N, n, M)
+        chunked_pover, chunked_punder = GO.hypergeometricProbabilities(
+            k, N, n, M, max_table_size=100)
+        self.assertTrue(numpy.all(pover == chunked_pover))
+        self.assertTrue(numpy.all(punder == chunked_punder))
+
+    def testFisherExactTests(self):
+        rng = random.Random(2)
+        tables = [[rng.randint(0, 50) for y in range(4)]
+                  for x in range(self.ntests)]
+        pvalues = GO.fisherExactTests(*list(zip(*tables)))
+        for (aa, bb, cc, dd), pvalue in zip(tables, pvalues):
+            odds, expected = scipy.stats.fisher_exact(
+                numpy.array(((aa, bb), (cc, dd))))
+            self.assertAlmostEqual(pvalue, expected, places=8)
+
+
+class TestAnalyseGO(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(3)
+        self.gene2go = {}
+        for gene in range(500):
+            self.gene2go["gene%i" % gene] = [
+                GO.GOInfo("GO:%07i" % x)
+                for x in rng.sample(range(100), rng.randint(1, 5))]
+        self.background = list(self.gene2go.keys())
+        self.foreground = rng.sample(self.background, 50)
+
+    def testProbabilitiesAreIdenticalToUpdateProbabilities(self):
+        results = GO.AnalyseGO(self.gene2go,
+                               self.foreground,
+                               self.background)
+        self.assertEqual(len(results.mResults), 100)
+
+        for go_id, result in results.mResults.items():
+            expected = GO.GOResult(go_id)
+            expected.mSampleCountsCategory = result.mSampleCountsCategory
+            expected.mSampleCountsTotal = result.mSampleCountsTotal
+            expected.mBackgroundCountsCategory = \
+                result.mBackgroundCountsCategory
+            expected.mBackgroundCountsTotal = result.mBackgroundCountsTotal
+            expected.UpdateProbabilities()
+
+            self.assertAlmostEqual(
+                result.mProbabilityOverRepresentation /
+                expected.mProbabilityOverRepresentation, 1.0, places=8)
+            self.assertAlmostEqual(
+                result.mProbabilityUnderRepresentation /
+                expected.mProbabilityUnderRepresentation, 1.0, places=8)
+            self.assertEqual(result.mRatio, expected.mRatio)
+
+
+class SamplingOptions:
+    """options used by GO.getSamples."""
+
+    def __init__(self, **kwargs):
+        self.sample = 20
+        self.sample_batch_size = 3
+        self.num_workers = 1
+        self.loglevel = 0
+        self.stdlog = io.StringIO()
+        self.output_filename_pattern = None
+        self.__dict__.update(kwargs)
+
+
+class TestGOSampler(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(4)
+        self.gene2go = {}
+        for gene in range(300):
+            self.gene2go["gene%i" % gene] = [
+                GO.GOInfo("GO:%07i" % x)
+                for x in rng.sample(range(50), rng.randint(1, 5))]
+        self.go2info = dict([(x.mGOId, x)
+                             for y in self.gene2go.values() for x in y])
+        # background with duplicated genes and genes without GO
+        # assignments
+        self.background = sorted(self.gene2go.keys()) + \
+            ["gene%i" % x for x in range(20)] + \
+            ["unknown%i" % x for x in range(20)]
+        self.samples = [rng.sample(self.background, 40)
+                        for x in range(10)]
+        # a sample with duplicated genes
+        self.samples.append(self.samples[0] + self.samples[0][:10])
+
+    def testIdenticalToAnalyseGO(self):
+        sampler = GO.GOSampler(self.gene2go, self.background)
+        counts, pover, punder = sampler.analyseSamples(self.samples)
+
+        for x, sample in enumerate(self.samples):
+            results = GO.AnalyseGO(self.gene2go, sample, self.background)
+            self.assertEqual(sorted(results.mResults.keys()),
+                             sorted(sampler.categories))
+            for y, go_id in enumerate(sampler.categories):
+                result = results.mResults[go_id]
+                self.assertEqual(counts[x, y], result.mSampleCountsCategory)
+                self.assertEqual(sampler.background_counts[y],
+                                 result.mBackgroundCountsCategory)
+                self.assertEqual(sampler.background_total,
+                                 result.mBackgroundCountsTotal)
+                self.assertAlmostEqual(
+                    pover[x, y] / result.mProbabilityOverRepresentation,
+                    1.0, places=8)
+                self.assertAlmostEqual(
+                    punder[x, y] / result.mProbabilityUnderRepresentation,
+                    1.0, places=8)
+
+    def getSamples(self, **kwargs):
+        random.seed(1)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            samples, min_pvalues = GO.getSamples(
+                self.gene2go, self.samples[0], self.background,
+                SamplingOptions(**kwargs), "test", self.go2info)
+        return samples, min_pvalues, output.getvalue()
+
+    def testWorkersGiveSameResults(self):
+        samples, min_pvalues, output = self.getSamples(num_workers=1)
+        self.assertEqual(len(samples), len(self.go2info))
+        self.assertEqual(len(min_pvalues), 20 * len(self.go2info))
+
+        for kwargs in ({"num_workers": 2},
+                       {"num_workers": 2, "sample_batch_size": 7},
+                       {"sample_batch_size": 100}):
+            other_samples, other_min_pvalues, other_output = \
+                self.getSamples(**kwargs)
+            self.assertEqual(other_output, output)
+            self.assertTrue(numpy.all(other_min_pvalues == min_pvalues))
+            for go_id, sample in samples.items():
+                other = other_samples[go_id]
+                self.assertEqual(other.mCounts, sample.mCounts)
+                self.assertTrue(numpy.all(
+                    other.mProbabilitiesOverRepresentation ==
+                    sample.mProbabilitiesOverRepresentation))
+                self.assertTrue(numpy.all(
+                    other.mProbabilitiesUnderRepresentation ==
+                    sample.mProbabilitiesUnderRepresentation))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import CGAT.GTF as GTF
+import CGAT.GTFCache as GTFCache
+import CGATCore.IOTools as IOTools
+
+
+class TestGTFCache(unittest.TestCase):
+
+    filename = os.path.join("data", "hg19.small.gtf.gz")
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_filename = os.path.join(self.tmpdir, "geneset.gtfc")
+
+        with IOTools.openFile(self.filename) as inf:
+            self.lines = [x for x in inf if not x.startswith("#")]
+        self.lines.append(
+            'chr1\tsrc\texon\t11\t20\t.\t+\t.\tgene_id "g1"; '
+            'transcript_id "t1"; note "with white space"; # comment\n')
+
+        self.entries = []
+        for line in self.lines:
+            entry = GTF.Entry()
+            entry.read(line)
+            self.entries.append(entry)
+
+        self.nrecords = GTFCache.build_cache(iter(self.lines),
+                                             self.cache_filename)
+        self.cache = GTFCache.GTFCache(self.cache_filename)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_number_of_records_is_correct(self):
+        self.assertEqual(self.nrecords, len(self.entries))
+        self.assertEqual(len(self.cache), len(self.entries))
+
+    def test_records_are_identical_to_input(self):
+        for a, b in zip(self.entries, self.cache.iterator()):
+            self.assertEqual(str(a), str(b))
+            self.assertEqual(a.gene_id, b.gene_id)
+            self.assertEqual(a.transcript_id, b.transcript_id)
+            self.assertEqual(a.attributes, b.attributes)
+
+    def test_columns_are_arrays(self):
+        self.assertEqual(list(self.cache.start),
+                         [x.start for x in self.entries])
+        self.assertEqual([self.cache.contigs[x] for x in self.cache.contig],
+                         [x.contig for x in self.entries])
+
+    def test_gene_lookup_returns_records_in_order(self):
+        gene_id = self.entries[0].gene_id
+        self.assertEqual(
+            [str(x) for x in self.cache.getGene(gene_id)],
+            [str(x) for x in self.entries if x.gene_id == gene_id])
+        self.assertRaises(KeyError, self.cache.getGene, "unknown")
+
+    def test_invalid_file_raises_error(self):
+        filename = os.path.join(self.tmpdir, "invalid.gtfc")
+        with open(filename, "w") as outf:
+            outf.write("\n".join(self.lines))
+        self.assertRaises(GTFCache.FormatError, GTFCache.GTFCache, filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
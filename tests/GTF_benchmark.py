@@ -0,0 +1,83 @@
+"""benchmark parsing of GTF formatted files.
+
+Reports the number of lines parsed per second for
+
+generic
+    the generic attribute parser :meth:`GTF.Entry.parseInfoGeneric`
+entry
+    :meth:`GTF.Entry.read` with attributes decoded on access
+entry+attributes
+    :meth:`GTF.Entry.read` and access to all attributes
+pysam
+    :func:`GTF.iterator` returning :class:`pysam.GTFProxy` objects
+pysam+attributes
+    :func:`GTF.iterator` and access to all attributes
+
+Usage::
+
+   python tests/GTF_benchmark.py gencode.gtf.gz
+
+"""
+
+import io
+import sys
+import time
+
+import CGAT.GTF as GTF
+import CGATCore.IOTools as IOTools
+
+
+class GenericEntry(GTF.Entry):
+    """entry always using the generic attribute parser."""
+
+    def parseInfo(self, attributes, line):
+        self.parseInfoGeneric(attributes, line)
+
+
+def parse_generic(lines):
+    for line in lines:
+        entry = GenericEntry()
+        entry.read(line)
+
+
+def parse_entry(lines):
+    for line in lines:
+        entry = GTF.Entry()
+        entry.read(line)
+
+
+def parse_entry_attributes(lines):
+    for line in lines:
+        entry = GTF.Entry()
+        entry.read(line)
+        entry.asDict()
+
+
+def parse_pysam(lines):
+    for gtf in GTF.iterator(io.StringIO("".join(lines))):
+        pass
+
+
+def parse_pysam_attributes(lines):
+    for gtf in GTF.iterator(io.StringIO("".join(lines))):
+        gtf.asDict()
+
+
+def main(argv=sys.argv):
+
+    with IOTools.open_file(argv[1]) as inf:
+        lines = [x for x in inf if not x.startswith("#")]
+
+    for label, f in (("generic", parse_generic),
+                     ("entry", parse_entry),
+                     ("entry+attributes", parse_entry_attributes),
+                     ("pysam", parse_pysam),
+                     ("pysam+attributes", parse_pysam_attributes)):
+        t0 = time.time()
+        f(lines)
+        t = time.time() - t0
+        print("%s\t%i\t%f\t%i" % (label, len(lines), t, len(lines) / t))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,5 +18,99 @@ class TestIteration(unittest.TestCase):
                          100)
 
 
+class TestSorting(unittest.TestCase):
+
+    filename = os.path.join("data", "hg19.small.gtf.gz")
+
+    sort_orders = ("gene", "gene+transcript", "contig+gene", "transcript",
+                   "position", "position+gene")
+
+    def setUp(self):
+        with IOTools.openFile(self.filename) as inf:
+            self.records = list(GTF.iterator(inf))
+
+    def test_external_sort_is_identical_to_sort_in_memory(self):
+        for sort_order in self.sort_orders:
+            expected = [str(x) for x in GTF.iterator_sorted(
+                iter(self.records), sort_order=sort_order)]
+            # small buffer to force records to be written to disk
+            result = [str(x) for x in GTF.iterator_sorted(
+                iter(self.records), sort_order=sort_order,
+                max_memory=2000)]
+            self.assertEqual(result, expected)
+
+    def test_external_sort_of_chunks_is_identical_to_sort_in_memory(self):
+        chunks = list(GTF.flat_gene_iterator(self.records, strict=False))
+        expected = [[str(y) for y in x] for x in GTF.iterator_sorted_chunks(
+            iter(chunks), sort_by="contig-strand-start")]
+        result = [[str(y) for y in x] for x in GTF.iterator_sorted_chunks(
+            iter(chunks), sort_by="contig-strand-start", max_memory=2000)]
+        self.assertEqual(result, expected)
+
+    def test_unknown_sort_order_raises_error(self):
+        self.assertRaises(ValueError, list,
+                          GTF.iterator_sorted(iter(self.records),
+                                              sort_order="unknown"))
+
+
+class TestEntryParsing(unittest.TestCase):
+
+    lines = [
+        'chr1\tsrc\texon\t11\t20\t.\t+\t.\tgene_id "g1"; '
+        'transcript_id "t1"; exon_number 2; gene_name "TXNRD2;-001";\n',
+        'chr1\tsrc\texon\t11\t20\t.\t+\t.\tgene_id "g1"; '
+        'transcript_id "t1"; tag "basic"; tag "CCDS"; level 1.5;\n',
+        'chr1\tsrc\texon\t11\t20\t.\t+\t.\tgene_id "g1"; '
+        'transcript_id "t1"; note "with white space"; # comment\n',
+        'chr1\tsrc\texon\t11\t20\t.\t+\t.\ttranscript_id "t1"; '
+        'gene_id "g1"\n',
+        'chr1\tsrc\texon\t11\t20\t.\t+\t.\tgene_id 12; '
+        'transcript_id "t1"; empty "";\n',
+    ]
+
+    def parse(self, line, generic=False):
+        entry = GTF.Entry()
+        if generic:
+            entry.parseInfoGeneric(line[:-1].split("\t")[8], line)
+        else:
+            entry.read(line)
+        return entry
+
+    def test_parsing_is_identical_to_generic_parser(self):
+
+        for line in self.lines:
+            try:
+                b = self.parse(line, generic=True)
+            except GTF.ParsingError:
+                self.assertRaises(GTF.ParsingError, self.parse, line)
+                continue
+            a = self.parse(line)
+            self.assertEqual(a.gene_id, b.gene_id)
+            self.assertEqual(a.transcript_id, b.transcript_id)
+            self.assertEqual(list(a.attributes.items()),
+                             list(b.attributes.items()))
+
+    def test_attributes_are_decoded_on_access(self):
+
+        entry = self.parse(self.lines[0])
+        self.assertEqual(entry.gene_id, "g1")
+        self.assertEqual(entry["exon_number"], 2)
+        self.assertEqual(entry["gene_name"], "TXNRD2;-001")
+        self.assertEqual(str(entry), self.lines[0][:-1])
+
+    def test_attributes_can_be_replaced(self):
+
+        entry = self.parse(self.lines[0])
+        entry.clearAttributes()
+        entry.addAttribute("exon_id", "e1")
+        self.assertEqual(list(entry.attributes.keys()), ["exon_id"])
+
+    def test_missing_identifier_raises_error(self):
+
+        self.assertRaises(
+            GTF.ParsingError, self.parse,
+            'chr1\tsrc\texon\t11\t20\t.\t+\t.\tgene_id "g1";\n')
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,189 @@
+"""unit testing module for the GWAS.py module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import CGAT.GWAS as GWAS
+
+# samples and genotypes of a small .ped file
+PED_SAMPLES = [("F1", "I1", "0", "0", "1", "2"),
+               ("F2", "I2", "0", "0", "2", "1"),
+               ("F3", "I3", "0", "0", "1", "1"),
+               ("F4", "I4", "0", "0", "2", "2"),
+               ("F5", "I5", "0", "0", "1", "1")]
+
+PED_GENOTYPES = [("11", "12", "00"),
+                 ("22", "22", "11"),
+                 ("12", "00", "22"),
+                 ("11", "11", "12"),
+                 ("22", "12", "11")]
+
+# PED_GENOTYPES encoded as in GWAS.encodePedGenotypes
+CODES = np.array([[GWAS.PED_HOM_A1, GWAS.PED_HET, GWAS.PED_MISSING],
+                  [GWAS.PED_HOM_A2, GWAS.PED_HOM_A2, GWAS.PED_HOM_A1],
+                  [GWAS.PED_HET, GWAS.PED_MISSING, GWAS.PED_HOM_A2],
+                  [GWAS.PED_HOM_A1, GWAS.PED_HOM_A1, GWAS.PED_HET],
+                  [GWAS.PED_HOM_A2, GWAS.PED_HET, GWAS.PED_HOM_A1]],
+                 dtype=np.uint8)
+
+# CODES as a SNP-major plink .bed file, packed by hand. Each SNP
+# takes two bytes for five samples, the first sample is in the
+# lowest two bits (00: hom A1, 01: missing, 10: het, 11: hom A2).
+BED_DATA = bytes([0x6c, 0x1b, 0x01,
+                  0x2c, 0x03,
+                  0x1e, 0x02,
+                  0xb1, 0x00])
+
+
+def writePed(filename, sep=""):
+    """write PED_SAMPLES and PED_GENOTYPES as a .ped file, alleles
+    are separated by *sep*."""
+    with open(filename, "w") as outf:
+        for sample, genotypes in zip(PED_SAMPLES, PED_GENOTYPES):
+            outf.write("\t".join(
+                sample + tuple(sep.join(x) for x in genotypes)) + "\n")
+
+
+class TestPedGenotypes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ped_file = os.path.join(self.tmpdir, "test.ped")
+        writePed(self.ped_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_encode_genotypes_with_and_without_whitespace(self):
+        for genotypes, codes in zip(PED_GENOTYPES, CODES):
+            self.assertEqual(
+                GWAS.encodePedGenotypes(list(genotypes)).tolist(),
+                codes.tolist())
+            self.assertEqual(
+                GWAS.encodePedGenotypes(
+                    [" ".join(x) for x in genotypes]).tolist(),
+                codes.tolist())
+
+    def test_encode_genotypes_with_multi_character_alleles(self):
+        self.assertEqual(
+            GWAS.encodePedGenotypes(["1 2", "10 2", "0 0"]).tolist(),
+            [GWAS.PED_HET, GWAS.PED_HOM_A2, GWAS.PED_MISSING])
+
+    def test_iterate_genotypes(self):
+        result = list(GWAS.iteratePedGenotypes(self.ped_file))
+        self.assertEqual([tuple(x[0]) for x in result], PED_SAMPLES)
+        self.assertEqual([x[1].tolist() for x in result], CODES.tolist())
+
+    def test_iterate_genotypes_of_selected_variants(self):
+        result = list(GWAS.iteratePedGenotypes(self.ped_file,
+                                               variant_index=[2, 0]))
+        self.assertEqual([x[1].tolist() for x in result],
+                         CODES[:, [2, 0]].tolist())
+
+    def test_count_genotypes_by_group(self):
+        groups = {"I1": "case", "I2": "control", "I4": "case"}
+        counts, nindividuals = GWAS.countPedGenotypes(self.ped_file,
+                                                      groups=groups)
+        self.assertEqual(dict(nindividuals), {"case": 2, "control": 1})
+        for group in ("case", "control"):
+            rows = [x for x, sample in enumerate(PED_SAMPLES)
+                    if groups.get(sample[1]) == group]
+            for code in (GWAS.PED_HOM_A1, GWAS.PED_HET, GWAS.PED_HOM_A2):
+                self.assertEqual(counts[group][code].tolist(),
+                                 (CODES[rows] == code).sum(axis=0).tolist())
+
+    def test_count_genotypes_without_groups(self):
+        counts, nindividuals = GWAS.countPedGenotypes(self.ped_file)
+        self.assertEqual(dict(nindividuals), {None: len(PED_SAMPLES)})
+        for code in (GWAS.PED_HOM_A1, GWAS.PED_HET, GWAS.PED_HOM_A2):
+            self.assertEqual(counts[None][code].tolist(),
+                             (CODES == code).sum(axis=0).tolist())
+
+
+class TestReadGenotypes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ped_file = os.path.join(self.tmpdir, "test.ped")
+        writePed(self.ped_file, sep=" ")
+        self.bed_file = self.writeBed(BED_DATA)
+        self.cache_file = os.path.join(self.tmpdir, "test.npy")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeBed(self, data, prefix="test"):
+        prefix = os.path.join(self.tmpdir, prefix)
+        with open(prefix + ".fam", "w") as outf:
+            for sample in PED_SAMPLES:
+                outf.write(" ".join(sample) + "\n")
+        with open(prefix + ".bim", "w") as outf:
+            for x in range(CODES.shape[1]):
+                outf.write("1\trs{}\t0\t{}\t1\t2\n".format(x, 1000 * x))
+        with open(prefix + ".bed", "wb") as outf:
+            outf.write(data)
+        return prefix + ".bed"
+
+    def checkSamples(self, samples):
+        self.assertEqual(list(samples.columns), ["FID", "IID", "SEX", "PHEN"])
+        self.assertEqual(
+            [tuple(x) for x in samples.itertuples(index=False)],
+            [(x[0], x[1], int(x[4]), int(x[5])) for x in PED_SAMPLES])
+
+    def test_read_ped(self):
+        samples, genotypes = GWAS.readPedGenotypes(self.ped_file)
+        self.checkSamples(samples)
+        self.assertEqual(genotypes.dtype, np.uint8)
+        self.assertEqual(genotypes.tolist(), CODES.tolist())
+
+    def test_read_bed_matches_ped(self):
+        ped_samples, ped_genotypes = GWAS.readPedGenotypes(self.ped_file)
+        for chunk_size in (1, 2, 10000):
+            samples, genotypes = GWAS.readPlinkBed(self.bed_file,
+                                                   chunk_size=chunk_size)
+            self.checkSamples(samples)
+            self.assertTrue(samples.equals(ped_samples))
+            self.assertEqual(genotypes.dtype, np.uint8)
+            self.assertEqual(genotypes.tolist(), ped_genotypes.tolist())
+
+    def test_read_bed_with_invalid_header_raises(self):
+        for header in ([0x6c, 0x1c, 0x01], [0x6c, 0x1b, 0x00]):
+            bed_file = self.writeBed(bytes(header) + BED_DATA[3:],
+                                     prefix="invalid")
+            self.assertRaises(ValueError, GWAS.readPlinkBed, bed_file)
+
+    def test_read_bed_with_wrong_size_raises(self):
+        for data in (BED_DATA[:-1], BED_DATA + bytes([0])):
+            bed_file = self.writeBed(data, prefix="truncated")
+            self.assertRaises(ValueError, GWAS.readPlinkBed, bed_file)
+
+    def test_cache_round_trip(self):
+        samples, genotypes = GWAS.readPedGenotypes(
+            self.ped_file, cache_file=self.cache_file)
+        self.assertFalse(isinstance(genotypes, np.memmap))
+        self.assertTrue(os.path.exists(self.cache_file))
+        self.assertTrue(os.path.exists(self.cache_file + ".tsv"))
+
+        cached_samples, cached_genotypes = GWAS.readPedGenotypes(
+            self.ped_file, cache_file=self.cache_file)
+        self.assertTrue(isinstance(cached_genotypes, np.memmap))
+        self.assertTrue(cached_samples.equals(samples))
+        self.assertEqual(cached_genotypes.dtype, np.uint8)
+        self.assertEqual(cached_genotypes.tolist(), genotypes.tolist())
+
+    def test_cache_older_than_ped_is_ignored(self):
+        GWAS.readPedGenotypes(self.ped_file, cache_file=self.cache_file)
+        mtime = os.path.getmtime(self.cache_file)
+        os.utime(self.ped_file, (mtime + 10, mtime + 10))
+        samples, genotypes = GWAS.readPedGenotypes(
+            self.ped_file, cache_file=self.cache_file)
+        self.assertFalse(isinstance(genotypes, np.memmap))
+        self.assertEqual(genotypes.tolist(), CODES.tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
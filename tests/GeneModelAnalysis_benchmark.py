@@ -0,0 +1,66 @@
+"""benchmark read counting in GeneModelAnalysis.pyx.
+
+Reports the number of gene models counted, the time and the number
+of gene models counted per second for
+
+read-fetch
+    :class:`GeneModelAnalysis.CounterReadCountsFull` fetching reads
+    for each gene model
+read-sweep
+    :class:`GeneModelAnalysis.CounterReadCountsFull` reading each
+    contig once
+readpair-fetch
+    :class:`GeneModelAnalysis.CounterReadPairCountsFull` fetching
+    reads for each gene model
+readpair-sweep
+    :class:`GeneModelAnalysis.CounterReadPairCountsFull` reading each
+    contig once
+
+The script checks that both modes return the same counts.
+
+Usage::
+
+   python tests/GeneModelAnalysis_benchmark.py gencode.gtf.gz reads.bam
+
+"""
+
+import sys
+import time
+
+import pysam
+
+import CGAT.GTF as GTF
+import CGAT.GeneModelAnalysis as GeneModelAnalysis
+import CGATCore.IOTools as IOTools
+
+
+def count(counter_class, genes, bamfile, sweep):
+    counter = counter_class([pysam.AlignmentFile(bamfile)], sweep=sweep)
+    result = []
+    for gffs in genes:
+        counter.update(gffs)
+        result.append(str(counter))
+    return result
+
+
+def main(argv=sys.argv):
+
+    with IOTools.open_file(argv[1]) as inf:
+        genes = list(GTF.flat_gene_iterator(GTF.iterator(inf)))
+
+    for label, counter_class in (
+            ("read", GeneModelAnalysis.CounterReadCountsFull),
+            ("readpair", GeneModelAnalysis.CounterReadPairCountsFull)):
+        results = []
+        for mode, sweep in (("fetch", False), ("sweep", True)):
+            t0 = time.time()
+            results.append(count(counter_class, genes, argv[2], sweep))
+            t = time.time() - t0
+            print("%s-%s\t%i\t%f\t%i" % (label, mode, len(genes),
+                                         t, len(genes) / t))
+        assert results[0] == results[1], \
+            "counts differ between fetch and sweep for %s" % label
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""unit testing module for the GeneModelAnalysis.pyx module."""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import CGAT.GTF as GTF
+import CGAT.GeneModelAnalysis as GeneModelAnalysis
+import CGATCore.IOTools as IOTools
+import pysam
+
+
+class TestIntervalStore(unittest.TestCase):
+
+    filename = os.path.join("data", "hg19.small.gtf.gz")
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = GeneModelAnalysis.IntervalStore()
+        with IOTools.open_file(self.filename) as inf:
+            self.entries = list(GTF.iterator(inf))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def getExpected(self, source, feature, **kwargs):
+        return dict(GTF.readAsIntervals(
+            GTF.iterator_filtered(iter(self.entries),
+                                  feature=feature,
+                                  source=source),
+            **kwargs))
+
+    def test_intervals_are_identical_to_filtered_reading(self):
+        for source in (None, "protein_coding", "lincRNA"):
+            for feature in (None, "exon", "CDS"):
+                for use_strand in (False, True):
+                    self.assertEqual(
+                        self.store.getIntervals(self.filename,
+                                                source,
+                                                feature,
+                                                with_values=True,
+                                                use_strand=use_strand),
+                        self.getExpected(source,
+                                         feature,
+                                         with_values=True,
+                                         use_strand=use_strand))
+
+    def test_file_is_parsed_once(self):
+        self.store.getIntervals(self.filename, None, "exon")
+        self.store.getIntervals(self.filename, "protein_coding", "CDS")
+        self.assertEqual(len(self.store.mEntries), 1)
+
+    def test_intersectors_are_shared(self):
+        a = self.store.getIntersectors(self.filename, None, "exon")
+        b = self.store.getIntersectors(self.filename, None, "exon")
+        self.assertTrue(len(a) > 0)
+        for contig in a:
+            self.assertTrue(a[contig] is b[contig])
+
+    def test_readIntervalsFromGFF_returns_copy(self):
+        a = GeneModelAnalysis.readIntervalsFromGFF(
+            self.filename, None, "exon", format="gtf")
+        for intervals in a.values():
+            intervals.reverse()
+        b = GeneModelAnalysis.readIntervalsFromGFF(
+            self.filename, None, "exon", format="gtf")
+        self.assertEqual(dict(b), self.getExpected(None, "exon"))
+
+    def test_save_and_load(self):
+        fn = os.path.join(self.tmpdir, "intervals.pickle")
+        expected = self.store.getIntervals(self.filename, None, "exon")
+        self.store.save(fn)
+
+        store = GeneModelAnalysis.IntervalStore()
+        store.load(fn)
+        self.assertEqual(len(store.mIntervals), 1)
+        self.assertEqual(store.getIntervals(self.filename, None, "exon"),
+                         expected)
+        self.assertEqual(len(store.mEntries), 0)
+
+    def test_load_ignores_modified_files(self):
+        filename = os.path.join(self.tmpdir, "geneset.gtf.gz")
+        shutil.copyfile(self.filename, filename)
+        fn = os.path.join(self.tmpdir, "intervals.pickle")
+        self.store.getIntervals(filename, None, "exon")
+        self.store.save(fn)
+
+        mtime = os.path.getmtime(filename)
+        os.utime(filename, (mtime + 10, mtime + 10))
+        store = GeneModelAnalysis.IntervalStore()
+        store.load(fn)
+        self.assertEqual(len(store.mIntervals), 0)
+
+
+class TestReadSweep(unittest.TestCase):
+
+    filename = os.path.join("data", "paired.bam")
+
+    def setUp(self):
+        self.samfile = pysam.AlignmentFile(self.filename)
+        rng = random.Random(1)
+        self.regions = []
+        for x in range(200):
+            start = rng.randint(9990000, 12000000)
+            # mixture of short and long regions to test nesting
+            end = start + rng.choice((rng.randint(1, 1000),
+                                      rng.randint(1, 100000)))
+            self.regions.append(("chr1", start, end))
+
+    def tearDown(self):
+        self.samfile.close()
+
+    def checkRegions(self, regions):
+        sweep = GeneModelAnalysis.ReadSweep(self.samfile)
+        for contig, start, end in regions:
+            self.assertEqual(
+                [x.tostring() for x in sweep.fetch(contig, start, end)],
+                [x.tostring() for x in self.samfile.fetch(contig, start, end)])
+
+    def test_sorted_regions_are_identical_to_fetch(self):
+        self.checkRegions(sorted(self.regions))
+
+    def test_unsorted_regions_are_identical_to_fetch(self):
+        self.checkRegions(self.regions)
+
+    def test_sweep_is_not_affected_by_other_iterators(self):
+        sweep = GeneModelAnalysis.ReadSweep(self.samfile)
+        for contig, start, end in sorted(self.regions):
+            expected = [x.tostring()
+                        for x in self.samfile.fetch(contig, start, end)]
+            reads = sweep.fetch(contig, start, end)
+            self.assertEqual([x.tostring() for x in reads], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
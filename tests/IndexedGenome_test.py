@@ -0,0 +1,127 @@
+"""unit testing module for the IndexedGenome.py module."""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import CGAT.IndexedGenome as IndexedGenome
+
+
+class TestGenomeIndex(unittest.TestCase):
+
+    ncontigs = 3
+    nintervals = 500
+    nqueries = 1000
+
+    def setUp(self):
+        rng = random.Random(1)
+        self.intervals = []
+        for x in range(self.nintervals):
+            contig = "chr%i" % rng.randint(1, self.ncontigs)
+            start = rng.randint(0, 10000)
+            # mixture of short and long intervals to test nesting
+            end = start + rng.choice((rng.randint(1, 100),
+                                      rng.randint(1, 5000)))
+            self.intervals.append((contig, start, end, "value%i" % x))
+
+        self.queries = []
+        for x in range(self.nqueries):
+            contig = "chr%i" % rng.randint(1, self.ncontigs + 1)
+            start = rng.randint(0, 12000)
+            end = start + rng.randint(0, 500)
+            self.queries.append((contig, start, end))
+
+    def buildIndex(self, with_values=True):
+        index = IndexedGenome.GenomeIndex(with_values=with_values)
+        for contig, start, end, value in self.intervals:
+            if with_values:
+                index.add(contig, start, end, value)
+            else:
+                index.add(contig, start, end)
+        return index
+
+    def buildReference(self, with_values=True):
+        if with_values:
+            index = IndexedGenome.IndexedGenome()
+        else:
+            index = IndexedGenome.Simple()
+        for contig, start, end, value in self.intervals:
+            if with_values:
+                index.add(contig, start, end, value)
+            else:
+                index.add(contig, start, end)
+        return index
+
+    def getReference(self, reference, contig, start, end):
+        if start >= end or contig not in reference.mIndex:
+            return []
+        return sorted(reference.get(contig, start, end))
+
+    def checkIndex(self, index, reference):
+        for contig, start, end in self.queries:
+            expected = self.getReference(reference, contig, start, end)
+            self.assertEqual(index.contains(contig, start, end),
+                             len(expected) > 0)
+            if contig in reference.mIndex:
+                self.assertEqual(sorted(index.get(contig, start, end)),
+                                 expected)
+            else:
+                self.assertRaises(KeyError, index.get, contig, start, end)
+
+    def testGetIsIdenticalToNCL(self):
+        self.checkIndex(self.buildIndex(), self.buildReference())
+
+    def testGetWithoutValuesIsIdenticalToNCL(self):
+        self.checkIndex(self.buildIndex(with_values=False),
+                        self.buildReference(with_values=False))
+
+    def testQueryManyIsIdenticalToGet(self):
+        index = self.buildIndex()
+        reference = self.buildReference()
+        contigs, starts, ends = list(zip(*self.queries))
+        for max_candidates in (10000000, 10, 1):
+            offsets, hits = index.query_many(
+                contigs, starts, ends, max_candidates=max_candidates)
+            self.assertEqual(len(offsets), len(self.queries) + 1)
+            for x, (contig, start, end) in enumerate(self.queries):
+                self.assertEqual(
+                    sorted(index.intervals(hits[offsets[x]:offsets[x + 1]])),
+                    self.getReference(reference, contig, start, end))
+
+    def testQueryManyWithoutQueries(self):
+        offsets, hits = self.buildIndex().query_many([], [], [])
+        self.assertEqual(list(offsets), [0])
+        self.assertEqual(len(hits), 0)
+
+    def testAddAfterQuery(self):
+        index = IndexedGenome.GenomeIndex()
+        reference = self.buildReference()
+        half = len(self.intervals) // 2
+        for contig, start, end, value in self.intervals[:half]:
+            index.add(contig, start, end, value)
+        index.contains("chr1", 0, 100)
+        for contig, start, end, value in self.intervals[half:]:
+            index.add(contig, start, end, value)
+        self.checkIndex(index, reference)
+
+    def testInvalidIntervals(self):
+        index = IndexedGenome.GenomeIndex()
+        self.assertRaises(ValueError, index.add, "chr1", 10, 10, None)
+        self.assertRaises(ValueError, index.add, "chr1", -10, 0, None)
+
+    def testSaveAndLoad(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "index.pickle")
+            self.buildIndex().save(filename)
+            index = IndexedGenome.GenomeIndex.load(filename)
+            self.assertEqual(len(index), self.ncontigs)
+            self.checkIndex(index, self.buildReference())
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
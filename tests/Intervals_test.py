@@ -22,6 +22,7 @@
 """unit testing module for the Tree.py class."""
 
 import CGAT.Intervals as Intervals
+import random
 import unittest
 
 
@@ -130,5 +131,42 @@ class FromArrayCheck(unittest.TestCase):
             Intervals.fromArray([not x for x in a]), [(3, 6), (9, 12)])
 
 
+class OverlapArraysCheck(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(1)
+        self.tests = []
+        for x in range(200):
+            intervals = []
+            for y in range(rng.randint(0, 20)):
+                start = rng.randint(0, 200)
+                intervals.append((start, start + rng.randint(0, 30)))
+            self.tests.append(intervals)
+
+    def testCombineIsIdenticalToCombine(self):
+        for intervals in self.tests:
+            starts, ends = Intervals.combineArrays(
+                [x[0] for x in intervals], [x[1] for x in intervals])
+            self.assertEqual(
+                list(zip(starts.tolist(), ends.tolist())),
+                Intervals.combine([x for x in intervals if x[1] > x[0]]))
+
+    def testOverlapIsIdenticalToCalculateOverlap(self):
+        for intervals, other in zip(self.tests[:-1], self.tests[1:]):
+            other = Intervals.combine([x for x in other if x[1] > x[0]])
+            overlap = Intervals.calculateOverlapArrays(
+                [x[0] for x in intervals], [x[1] for x in intervals],
+                [x[0] for x in other], [x[1] for x in other])
+            self.assertEqual(
+                overlap.tolist(),
+                [Intervals.calculateOverlap([x], other) if x[1] > x[0]
+                 else 0 for x in intervals])
+
+    def testEmpty(self):
+        self.assertEqual(
+            Intervals.calculateOverlapArrays([0, 10], [5, 20], [], []).tolist(),
+            [0, 0])
+
+
 if __name__ == "__main__":
     unittest.main()
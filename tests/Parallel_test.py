@@ -0,0 +1,113 @@
+"""unit testing module for the Parallel.py module."""
+
+import os
+import sys
+import unittest
+
+import CGAT.Parallel as Parallel
+
+WORKER = {}
+
+
+def initWorker(offset):
+    WORKER["offset"] = offset
+    WORKER["pid"] = os.getpid()
+
+
+def addOffset(x):
+    return x + WORKER["offset"], WORKER["pid"]
+
+
+def failOnNegative(x):
+    if x < 0:
+        raise ValueError("negative value %i" % x)
+    return x
+
+
+class Options:
+    pass
+
+
+class TestImap(unittest.TestCase):
+
+    values = list(range(100))
+
+    def check(self, **kwargs):
+        results = list(Parallel.imap(addOffset, iter(self.values),
+                                     initializer=initWorker,
+                                     initargs=(10,),
+                                     **kwargs))
+        self.assertEqual([x[0] for x in results],
+                         [x + 10 for x in self.values])
+        return set([x[1] for x in results])
+
+    def test_single_worker_runs_in_current_process(self):
+        self.assertEqual(self.check(num_workers=1), set([os.getpid()]))
+
+    def test_workers_preserve_order(self):
+        pids = self.check(num_workers=3)
+        self.assertNotIn(os.getpid(), pids)
+
+    def test_workers_preserve_order_in_batches(self):
+        for batch_size in (1, 7, 1000):
+            self.check(num_workers=3, batch_size=batch_size)
+
+    def test_workers_preserve_order_in_chunks(self):
+        self.check(num_workers=3, chunksize=10)
+
+    def test_empty_input(self):
+        self.assertEqual(list(Parallel.imap(failOnNegative, [],
+                                            num_workers=3)), [])
+
+    def test_worker_exception_is_raised(self):
+        for kwargs in ({"num_workers": 1},
+                       {"num_workers": 2},
+                       {"num_workers": 2, "batch_size": 4}):
+            self.assertRaises(
+                ValueError, list,
+                Parallel.imap(failOnNegative, [1, 2, -1, 3], **kwargs))
+
+    def test_stopping_early(self):
+        results = Parallel.imap(failOnNegative, self.values,
+                                num_workers=2, batch_size=10)
+        self.assertEqual(next(results), 0)
+        results.close()
+
+
+class TestIterateChunks(unittest.TestCase):
+
+    def test_chunks_have_maximum_size(self):
+        self.assertEqual(list(Parallel.iterate_chunks(range(7), 3)),
+                         [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(list(Parallel.iterate_chunks(range(6), 3)),
+                         [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(list(Parallel.iterate_chunks([], 3)), [])
+
+    def test_chunks_do_not_span_keys(self):
+        items = ["a1", "a2", "a3", "b1", "c1", "c2", "a4"]
+        self.assertEqual(
+            list(Parallel.iterate_chunks(items, 2, key=lambda x: x[0])),
+            [["a1", "a2"], ["a3"], ["b1"], ["c1", "c2"], ["a4"]])
+
+
+class TestWorkerOptions(unittest.TestCase):
+
+    def test_file_handles_are_removed(self):
+        options = Options()
+        options.stdin = sys.stdin
+        options.stdout = sys.stdout
+        options.stdlog = sys.stdout
+        options.stderr = sys.stderr
+        options.gtffile = sys.stdin
+        options.num_workers = 2
+
+        result = Parallel.worker_options(options, "gtffile")
+        for key in ("stdin", "stdout", "stdlog", "stderr", "gtffile"):
+            self.assertEqual(getattr(result, key), None)
+        self.assertEqual(result.num_workers, 2)
+        self.assertEqual(options.stdout, sys.stdout)
+        self.assertEqual(options.gtffile, sys.stdin)
+
+
+if __name__ == "__main__":
+    unittest.main()
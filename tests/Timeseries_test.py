@@ -0,0 +1,103 @@
+"""unit testing module for the Timeseries distance metrics."""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import CGAT.Timeseries as Timeseries
+
+
+def dtwDistance(x, y):
+    """dynamic time warping distance between x and y with the
+    symmetric2 step pattern, filling the full cost matrix."""
+    n, m = len(x), len(y)
+    cost = np.full((n, m), np.inf)
+    for i in range(n):
+        for j in range(m):
+            d = abs(x[i] - y[j])
+            if i == 0 and j == 0:
+                cost[i, j] = d
+                continue
+            steps = []
+            if i > 0 and j > 0:
+                steps.append(cost[i - 1, j - 1] + 2 * d)
+            if i > 0:
+                steps.append(cost[i - 1, j] + d)
+            if j > 0:
+                steps.append(cost[i, j - 1] + d)
+            cost[i, j] = min(steps)
+    return cost[-1, -1]
+
+
+class TestDistanceMetrics(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.data = pd.DataFrame(rng.rand(12, 8),
+                                 index=["g%i" % x for x in range(12)])
+        # constant time series have no variance
+        self.data.iloc[3] = 1.0
+        self.rows = list(self.data.index[:5])
+        self.columns = list(self.data.index)
+
+    def pairwise(self, f):
+        """apply the scalar distance f to all pairs of rows and
+        columns."""
+        return np.array(
+            [[f(self.data.loc[x].values, self.data.loc[y].values)
+              for y in self.columns] for x in self.rows])
+
+    def test_cross_correlate_matches_scalar_version(self):
+        for lag in (0, 2, -3):
+            result = Timeseries.correlateDistanceMetric(
+                self.data, self.rows, self.columns,
+                "cross-correlate", lag=lag)
+            self.assertEqual(list(result.index), self.rows)
+            self.assertEqual(list(result.columns), self.columns)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                expected = self.pairwise(
+                    lambda x, y: 1.0 - abs(float(np.ravel(
+                        Timeseries.crossCorrelate(x, y, lag=lag))[0])))
+            np.testing.assert_allclose(result.values, expected, atol=1e-12)
+
+    def test_temporal_correlate_matches_scalar_version(self):
+        result = Timeseries.correlateDistanceMetric(
+            self.data, self.rows, self.columns, "temporal-correlate")
+        expected = self.pairwise(
+            lambda x, y: 1.0 - abs(Timeseries.temporalCorrelate(x, y)))
+        np.testing.assert_allclose(result.values, expected, atol=1e-12)
+
+    def test_dtw_matches_scalar_version(self):
+        for k in (0, 2):
+            result = Timeseries.dtwWrapper(
+                self.data, self.rows, self.columns, k)
+            self.assertEqual(list(result.index), self.rows)
+            self.assertEqual(list(result.columns), self.columns)
+            expected = self.pairwise(
+                lambda x, y: dtwDistance(x, y) * Timeseries.adaptiveTune(
+                    Timeseries.temporalCorrelate(x, y), k))
+            np.testing.assert_allclose(result.values, expected, atol=1e-12)
+
+    def test_dtw_of_series_with_different_lengths(self):
+        x = self.data.values[:4]
+        y = self.data.values[4:, 2:]
+        result = Timeseries.c2m.dtw_distance_matrix(x, y)
+        self.assertEqual(result.shape, (len(x), len(y)))
+        np.testing.assert_allclose(
+            result, [[dtwDistance(a, b) for b in y] for a in x])
+
+    def test_distance_matrix_is_symmetric(self):
+        values = self.data.values
+        for method in ("cross-correlate", "temporal-correlate", "dtw"):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result = Timeseries.distanceMatrix(values, values, method)
+            np.testing.assert_allclose(result, result.T)
+
+    def test_unknown_method_raises(self):
+        self.assertRaises(ValueError, Timeseries.distanceMatrix,
+                          self.data.values, self.data.values, "euclidean")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+"""unit testing module for the geneprofile extension.
+
+The range counters accumulate densities in a difference array. The
+tests compare the counts with a per-base loop over each read.
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import pysam
+
+import CGAT.BamTools.geneprofile as geneprofile
+
+
+def addInterval(counts, rstart, rend):
+    """increment *counts* at each position in [rstart, rend)."""
+    for i in range(rstart, rend):
+        counts[i] += 1
+
+
+class TestRangeCounters(unittest.TestCase):
+
+    filename = os.path.join("data", "paired.bam")
+    contig = "chr1"
+
+    def setUp(self):
+        self.samfile = pysam.AlignmentFile(self.filename)
+        self.tmpdir = tempfile.mkdtemp()
+        rng = random.Random(1)
+
+        # sets of adjacent, overlapping and empty ranges. Reads extend
+        # beyond the ranges and are clipped.
+        self.ranges = []
+        for x in range(50):
+            ranges = []
+            for y in range(rng.randint(1, 4)):
+                start = rng.randint(9990000, 12000000)
+                ranges.append((start, start + rng.randint(0, 2000)))
+            self.ranges.append(sorted(ranges))
+        self.ranges.append([(10000000, 10000100), (10000050, 10000150)])
+        self.ranges.append([(9990000, 9999960)])
+
+        # overlapping bed intervals
+        bed_file = os.path.join(self.tmpdir, "intervals.bed")
+        with open(bed_file, "w") as outf:
+            for start in sorted(rng.randint(9990000, 10010000)
+                                for x in range(500)):
+                outf.write("%s\t%i\t%i\n" % (
+                    self.contig, start, start + rng.randint(1, 200)))
+        self.bed_file = pysam.tabix_index(bed_file, preset="bed")
+
+    def tearDown(self):
+        self.samfile.close()
+        shutil.rmtree(self.tmpdir)
+
+    def checkCounter(self, counter, files, count):
+        for ranges in self.ranges:
+            length = sum(end - start for start, end in ranges)
+            counts = numpy.zeros(length)
+            counter.count(counts, files, self.contig, ranges)
+            self.assertEqual(counts.tolist(),
+                             count(files, self.contig, ranges).tolist(),
+                             "mismatch for ranges {}".format(ranges))
+
+    def countBAM(self, files, contig, ranges):
+        counts = numpy.zeros(sum(end - start for start, end in ranges))
+        for samfile in files:
+            current_offset = 0
+            for start, end in ranges:
+                for read in samfile.fetch(contig, start, end):
+                    if read.aend is None:
+                        continue
+                    addInterval(
+                        counts,
+                        max(start, read.pos) - start + current_offset,
+                        min(end, read.aend) - start + current_offset)
+                current_offset += end - start
+        return counts
+
+    def test_bam_counter(self):
+        counter = geneprofile.RangeCounterBAM([self.samfile])
+        self.checkCounter(counter, [self.samfile, self.samfile],
+                          self.countBAM)
+
+    def test_bam_shift_counter(self):
+        shift, extend = 50, 120
+        counter = geneprofile.RangeCounterBAMShift(
+            [self.samfile], shifts=[shift], extends=[extend])
+
+        def count(files, contig, ranges):
+            counts = numpy.zeros(sum(end - start for start, end in ranges))
+            current_offset = 0
+            for start, end in ranges:
+                length = end - start
+                for read in files[0].fetch(contig,
+                                           max(0, start - shift - extend),
+                                           end + shift + extend):
+                    if read.is_reverse:
+                        rstart = read.aend - start - shift - extend
+                    else:
+                        rstart = read.pos - start + shift
+                    addInterval(
+                        counts,
+                        max(0, rstart) + current_offset,
+                        min(length, rstart + extend) + current_offset)
+                current_offset += length
+            return counts
+
+        self.checkCounter(counter, [self.samfile], count)
+
+    def test_bam_merge_counter(self):
+        min_insert_size, max_insert_size = 0, 500
+        counter = geneprofile.RangeCounterBAMMerge(
+            [self.samfile], True, min_insert_size, max_insert_size)
+
+        def count(files, contig, ranges):
+            counts = numpy.zeros(sum(end - start for start, end in ranges))
+            current_offset = 0
+            for start, end in ranges:
+                for read in files[0].fetch(contig, start, end):
+                    if read.is_unmapped or not read.is_proper_pair or \
+                       read.is_read2 or read.tid != read.mrnm:
+                        continue
+                    if not min_insert_size <= read.isize <= max_insert_size:
+                        continue
+                    if read.pos < read.mpos:
+                        rstart = max(start, read.pos)
+                        rend = min(end, read.mpos + read.rlen)
+                    else:
+                        rstart = max(start, read.mpos)
+                        rend = min(end, read.pos + read.rlen)
+                    addInterval(counts,
+                                rstart - start + current_offset,
+                                rend - start + current_offset)
+                current_offset += end - start
+            return counts
+
+        self.checkCounter(counter, [self.samfile], count)
+
+    def test_bed_counter(self):
+        bedfile = pysam.TabixFile(self.bed_file)
+        counter = geneprofile.RangeCounterBed([bedfile])
+
+        def count(files, contig, ranges):
+            counts = numpy.zeros(sum(end - start for start, end in ranges))
+            current_offset = 0
+            for start, end in ranges:
+                length = end - start
+                for bed in files[0].fetch(contig, max(0, start), end,
+                                          parser=pysam.asBed()):
+                    addInterval(
+                        counts,
+                        max(0, bed.start - start) + current_offset,
+                        min(length, bed.end - start) + current_offset)
+                current_offset += length
+            return counts
+
+        self.checkCounter(counter, [bedfile], count)
+        bedfile.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
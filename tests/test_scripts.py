@@ -330,7 +330,35 @@ def test_scripts():
                   current_dir)
 
 
+def _read_bigwig(fn):
+    '''return intervals in a bigwig file.
+
+    Adjacent intervals with the same value are merged, so that files
+    with the same coverage compare equal independent of how they
+    have been written.
+    '''
+    import pyBigWig
+    bw = pyBigWig.open(fn)
+    data = []
+    for contig in bw.chroms():
+        last = None
+        for start, end, value in bw.intervals(contig) or []:
+            if last and last[1] == start and last[2] == value:
+                last[1] = end
+            else:
+                if last:
+                    data.append("%s\t%i\t%i\t%f" % tuple([contig] + last))
+                last = [start, end, value]
+        if last:
+            data.append("%s\t%i\t%i\t%f" % tuple([contig] + last))
+    bw.close()
+    return data
+
+
 def _read(fn):
+    if fn.endswith(".bw"):
+        return _read_bigwig(fn)
+
     if fn.endswith(".gz"):
         with gzip.open(fn) as inf:
             data = inf.read()